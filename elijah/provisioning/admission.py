@@ -0,0 +1,252 @@
+#
+# cloudlet-admission control
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+import os
+import errno
+import fcntl
+import time
+import multiprocessing
+from contextlib import contextmanager
+
+import msgpack
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class SessionCost(object):
+    '''Resources that a synthesis or handoff session takes at the host.
+    cpu is the number of busy cores, memory is bytes of RAM and io is bytes
+    written to the launch disk and memory
+    '''
+
+    def __init__(self, cpu=0.0, memory=0, io=0):
+        self.cpu = float(cpu)
+        self.memory = long(memory)
+        self.io = long(io)
+
+    @classmethod
+    def from_meta(cls, meta_info, decomp_proc_count=1):
+        '''Estimate the cost of recovering the VM from the overlay meta.
+        Decompression processes are busy only for the compressed part, and
+        every blob in flight is held with its decompressed data. Handoff
+        sends its blobs after the meta, so the whole memory snapshot is
+        assumed to be written without the blob list
+        '''
+        launch_memory_size = meta_info.get(
+            Const.META_RESUME_VM_MEMORY_SIZE, 0)
+        blob_list = meta_info.get(Const.META_OVERLAY_FILES, None)
+        if not blob_list:
+            return cls(cpu=1 + decomp_proc_count,
+                       memory=launch_memory_size, io=launch_memory_size)
+
+        raw_size = 0
+        comp_raw_size = 0
+        max_blob_size = 0
+        chunk_count = 0
+        for blob_info in blob_list:
+            blob_raw_size = blob_info.get(
+                Const.META_OVERLAY_FILE_RAW_SIZE,
+                blob_info[Const.META_OVERLAY_FILE_SIZE])
+            raw_size += blob_raw_size
+            if blob_info.get(Const.META_OVERLAY_FILE_COMPRESSION,
+                             Const.COMPRESSION_LZMA) != \
+                    Const.COMPRESSION_NONE:
+                comp_raw_size += blob_raw_size
+            max_blob_size = max(
+                max_blob_size,
+                blob_raw_size + blob_info[Const.META_OVERLAY_FILE_SIZE])
+            chunk_count += \
+                len(blob_info[Const.META_OVERLAY_FILE_DISK_CHUNKS]) + \
+                len(blob_info[Const.META_OVERLAY_FILE_MEMORY_CHUNKS])
+        cpu = 1
+        if raw_size > 0:
+            cpu += decomp_proc_count * float(comp_raw_size) / raw_size
+        memory = launch_memory_size + max_blob_size*decomp_proc_count
+        io = max(raw_size, chunk_count*Const.CHUNK_SIZE)
+        return cls(cpu=cpu, memory=memory, io=io)
+
+    @classmethod
+    def from_list(cls, cost_list):
+        return cls(*cost_list)
+
+    def to_list(self):
+        return [self.cpu, self.memory, self.io]
+
+    def __add__(self, other):
+        return SessionCost(self.cpu + other.cpu, self.memory + other.memory,
+                           self.io + other.io)
+
+    def fits(self, capacity):
+        return self.cpu <= capacity.cpu and \
+            self.memory <= capacity.memory and self.io <= capacity.io
+
+    def __repr__(self):
+        return "SessionCost(cpu=%.2f, memory=%d, io=%d)" % \
+            (self.cpu, self.memory, self.io)
+
+
+def get_host_capacity():
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return SessionCost(cpu=multiprocessing.cpu_count(), memory=memory,
+                       io=Const.ADMISSION_IO_BUDGET)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class AdmissionController(object):
+    '''Admit synthesis and handoff sessions within the capacity of the host.
+    Each server process runs its own controller, and the running sessions
+    and the wait queue are kept at a state file locked with flock(), so
+    that every server at the host shares the limit. Session of a process
+    that is gone is dropped from the state
+    '''
+
+    def __init__(self, state_path=Const.ADMISSION_STATE_PATH, capacity=None,
+                 max_queue=Const.ADMISSION_MAX_QUEUE,
+                 poll_interval=Const.ADMISSION_POLL_INTERVAL):
+        self.state_path = state_path
+        self.capacity = capacity or get_host_capacity()
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+    @contextmanager
+    def _locked_state(self):
+        # running: session id --> [pid, cpu, memory, io]
+        # queued: [session id, pid] in arrival order
+        with open(self.state_path, "a+b") as state_file:
+            fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                data = state_file.read()
+                if data:
+                    state = msgpack.unpackb(data)
+                else:
+                    state = {"running": dict(), "queued": list()}
+                for session_id, item in state["running"].items():
+                    if not _is_alive(item[0]):
+                        LOG.warning("Drop session %s of the dead process" %
+                                    session_id)
+                        del state["running"][session_id]
+                state["queued"] = [item for item in state["queued"]
+                                   if _is_alive(item[1])]
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(msgpack.packb(state))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _get_used(state):
+        used = SessionCost()
+        for item in state["running"].itervalues():
+            used += SessionCost.from_list(item[1:])
+        return used
+
+    def _clamp(self, cost):
+        # session alone is always admitted to an idle host unless its VM
+        # does not fit at the memory
+        if cost.memory > self.capacity.memory:
+            msg = "Session needs %d bytes of memory, more than the host" % \
+                cost.memory
+            raise AdmissionError(msg)
+        return SessionCost(min(cost.cpu, self.capacity.cpu), cost.memory,
+                           min(cost.io, self.capacity.io))
+
+    def admit(self, session_id, cost, timeout=Const.ADMISSION_WAIT_TIMEOUT):
+        '''Wait in the queue until the cost fits at the host, and reserve
+        it for the session. Raise AdmissionError when the queue is full, or
+        the session is not admitted within timeout seconds
+        '''
+        session_id = str(session_id)
+        cost = self._clamp(cost)
+        entry = [session_id, os.getpid()]
+        with self._locked_state() as state:
+            if session_id in state["running"]:
+                raise AdmissionError("Session %s is already admitted" %
+                                     session_id)
+            if len(state["queued"]) >= self.max_queue:
+                raise AdmissionError("Admission queue is full (%d sessions)" %
+                                     len(state["queued"]))
+            state["queued"].append(entry)
+
+        start_time = time.time()
+        while True:
+            is_timeout = False
+            with self._locked_state() as state:
+                # first come, first served
+                if state["queued"][0] == entry and \
+                        (self._get_used(state) + cost).fits(self.capacity):
+                    state["queued"].pop(0)
+                    state["running"][session_id] = \
+                        [os.getpid()] + cost.to_list()
+                    LOG.info("Admit session %s with %s (%d sessions wait)" %
+                             (session_id, cost, len(state["queued"])))
+                    return cost
+                if timeout is not None and \
+                        time.time() - start_time >= timeout:
+                    state["queued"].remove(entry)
+                    is_timeout = True
+            if is_timeout:
+                msg = "Session %s is not admitted in %d seconds" % \
+                    (session_id, timeout)
+                raise AdmissionError(msg)
+            time.sleep(self.poll_interval)
+
+    def update(self, session_id, cost):
+        '''Change the reservation of the running session, for example to
+        keep only the memory of the resumed VM after its recovery
+        '''
+        with self._locked_state() as state:
+            item = state["running"].get(str(session_id), None)
+            if item is not None:
+                item[1:] = cost.to_list()
+
+    def release(self, session_id):
+        with self._locked_state() as state:
+            if state["running"].pop(str(session_id), None) is not None:
+                LOG.info("Release session %s" % session_id)
+
+    def get_state(self):
+        '''Return the capacity, resources in use, running sessions with
+        their cost, and the waiting sessions in order
+        '''
+        with self._locked_state() as state:
+            used = self._get_used(state)
+            return {
+                "capacity": self.capacity.to_list(),
+                "used": used.to_list(),
+                "running": dict((session_id, item[1:]) for session_id, item
+                                in state["running"].iteritems()),
+                "queued": [item[0] for item in state["queued"]],
+            }
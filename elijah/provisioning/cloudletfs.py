@@ -66,17 +66,10 @@ class CloudletFS(threading.Thread):
     def fuse_read(self):
         wait_statistics = list()
         if (self.meta_info is not None) and (self.demanding_queue is not None):
-            memory_overlay_dict = dict()
-            disk_overlay_dict = dict()
-            from .configuration import Const
-            for blob in self.meta_info[Const.META_OVERLAY_FILES]:
-                overlay_url = blob[Const.META_OVERLAY_FILE_NAME]
-                memory_chunks = blob[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
-                for chunk in memory_chunks:
-                    memory_overlay_dict[chunk] = overlay_url
-                disk_chunks = blob[Const.META_OVERLAY_FILE_DISK_CHUNKS]
-                for chunk in disk_chunks:
-                    disk_overlay_dict[chunk] = overlay_url
+            # chunk number --> segments (blob or its frame) having the chunk
+            from .delta import get_chunk_segment_dict
+            disk_overlay_dict, memory_overlay_dict = get_chunk_segment_dict(
+                self.meta_info[Const.META_OVERLAY_FILES])
 
         while(not self.stop.wait(0.001)):
             self._running = True
@@ -89,19 +82,24 @@ class CloudletFS(threading.Thread):
                         (request_split[0].find("REQUEST") > 0):
                     overlay_type = request_split[1].split(":")[1].strip()
                     chunk = long(request_split[2].split(":")[1])
+                    if self.meta_info is None:
+                        # chunks are streamed without overlay files
+                        self.demanding_queue.put((overlay_type, chunk))
+                        continue
                     if overlay_type == CloudletFS.FUSE_TYPE_DISK:
-                        url = disk_overlay_dict.get(chunk, None)
+                        urls = disk_overlay_dict.get(chunk, None)
                     elif overlay_type == CloudletFS.FUSE_TYPE_MEMORY:
-                        url = memory_overlay_dict.get(chunk, None)
+                        urls = memory_overlay_dict.get(chunk, None)
                     else:
                         msg = "FUSE type does not match : %s" % overlay_type
                         raise CloudletFSError(msg)
 
-                    if url is None:
+                    if urls is None:
                         msg = "Can't find matching blob with chunk(%ld)" % chunk
                         raise CloudletFSError(msg)
-                    #LOG.debug("requesting chunk(%ld) at %s" % (chunk, url))
-                    self.demanding_queue.put(url)
+                    #LOG.debug("requesting chunk(%ld) at %s" % (chunk, urls))
+                    for url in urls:
+                        self.demanding_queue.put(url)
                 elif (len(request_split) > 0) and (request_split[0].find("STATISTICS-WAIT") > 0):
                     type_name, overlay_type = request_split[1].split(":")
                     chunk_name, chunk = request_split[2].split(":")
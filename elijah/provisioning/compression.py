@@ -7,8 +7,18 @@ import msgpack
 import multiprocessing
 import traceback
 import ctypes
+import collections
+from hashlib import sha256
 
 from .delta import DeltaItem
+from .delta import IndexedDeltaList
+from .delta import get_overlay_segments
+from .delta import get_segment_compression
+from .delta import get_segment_digest
+from .delta import get_segment_digests
+from .delta import check_overlay_merkle
+from .delta import is_incompressible
+from .delta import add_item_statistics
 
 import lzma
 import bz2
@@ -25,6 +35,10 @@ class CompressionError(Exception):
     pass
 
 
+class CorruptedBlobError(CompressionError):
+    pass
+
+
 class CompressProc(process_manager.ProcWorker):
 
     def __init__(self, delta_list_queue, comp_delta_queue,
@@ -344,51 +358,39 @@ class CompChildProc(multiprocessing.Process):
                 else:
                     raise CompressionError("Not supporting")
 
-                # compression for each block
-                modified_memory_chunks = list()
-                modified_disk_chunks = list()
-                output_data = ''
-                child_cur_block_count = 0
-                indata_size_cur = 0
-                outdata_size_cur = 0
-                time_process_cur_time = 0
-
+                # incompressible chunks are sent at a separate stored blob
+                # rather than wasting CPU on the compressor. Recovery does not
+                # depend on the order of blobs
+                compressible_list = list()
+                stored_list = list()
                 time_process_start = time.clock()
                 for delta_item in deltaitem_list:
-                    delta_bytes = delta_item.get_serialized()
-                    offset = delta_item.offset/Const.CHUNK_SIZE
-                    if delta_item.delta_type == DeltaItem.DELTA_DISK or\
-                            delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
-                        modified_disk_chunks.append(offset)
-                    elif delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
-                            delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
-                        modified_memory_chunks.append(offset)
-                    compressed_bytes = comp.compress(delta_bytes)
-                    output_data += compressed_bytes
-                    outdata_size_cur += len(compressed_bytes)
-                    indata_size_cur += len(delta_bytes)
-                    child_cur_block_count += 1
-
-                compressed_bytes = comp.flush()
-                output_data += compressed_bytes
-                outdata_size_cur += len(compressed_bytes)
+                    if is_incompressible(delta_item):
+                        stored_list.append(delta_item)
+                    else:
+                        compressible_list.append(delta_item)
+                output_list = list()
+                if len(compressible_list) > 0:
+                    output_list.append(self._comp_deltalist(
+                        comp_type_cur, comp, compressible_list))
+                if len(stored_list) > 0:
+                    output_list.append(self._comp_deltalist(
+                        Const.COMPRESSION_NONE, None, stored_list))
                 time_process_end = time.clock()
 
                 time_process_cur_time = (time_process_end - time_process_start)
                 time_process_total_time += time_process_cur_time
 
-                indata_size += indata_size_cur
-                outdata_size += outdata_size_cur
-                child_total_block += child_cur_block_count
+                indata_size += sum([output[4] for output in output_list])
+                outdata_size += sum([len(output[1]) for output in output_list])
+                child_total_block += len(deltaitem_list)
                 self.child_input_size_total.value = indata_size
                 self.child_output_size_total.value = outdata_size
                 self.child_process_time_total.value = 1000.0 * \
                     time_process_total_time
                 self.child_process_block_total.value = child_total_block
-                self.output_queue.put((comp_type_cur,
-                                       output_data,
-                                       modified_disk_chunks,
-                                       modified_memory_chunks))
+                for output in output_list:
+                    self.output_queue.put(output)
 
         # sys.stdout.write("[Comp][Child] child finished. process %d jobs (%f)\n" % \
         #                 (loop_counter, time_process_total_time))
@@ -402,6 +404,35 @@ class CompChildProc(multiprocessing.Process):
             msg = "Empty new compression mode that does not refelected"
             sys.stdout.write(msg)
 
+    @staticmethod
+    def _comp_deltalist(comp_type, comp, deltaitem_list):
+        # comp is None for a stored blob
+        modified_memory_chunks = list()
+        modified_disk_chunks = list()
+        item_stats = dict()
+        output_data = ''
+        indata_size = 0
+        for delta_item in deltaitem_list:
+            delta_bytes = delta_item.get_serialized()
+            offset = delta_item.offset/Const.CHUNK_SIZE
+            if delta_item.delta_type == DeltaItem.DELTA_DISK or\
+                    delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
+                modified_disk_chunks.extend(
+                    delta_item.get_chunks(Const.CHUNK_SIZE))
+            elif delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+                    delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+                modified_memory_chunks.append(offset)
+            if comp is not None:
+                output_data += comp.compress(delta_bytes)
+            else:
+                output_data += delta_bytes
+            indata_size += len(delta_bytes)
+            add_item_statistics(item_stats, delta_item, len(delta_bytes))
+        if comp is not None:
+            output_data += comp.flush()
+        return (comp_type, output_data, modified_disk_chunks,
+                modified_memory_chunks, indata_size, item_stats)
+
 
 class DecompProc(multiprocessing.Process):
 
@@ -492,7 +523,10 @@ class DecompChildProc(multiprocessing.Process):
                 (comp_type, comp_data) = input_task
                 start = time.time()
                 comp_string = "Unknown Compression Algorithm!"
-                if comp_type == Const.COMPRESSION_LZMA:
+                if comp_type == Const.COMPRESSION_NONE:
+                    comp_string = "none"
+                    decomp_data = comp_data
+                elif comp_type == Const.COMPRESSION_LZMA:
                     comp_string = "lzma"
                     decompressor = lzma.LZMADecompressor()
                     decomp_data = decompressor.decompress(comp_data)
@@ -513,57 +547,220 @@ class DecompChildProc(multiprocessing.Process):
         self.command_queue.put("Compressed processed everything")
 
 
-def decomp_overlay(meta, output_path):
+def _decomp_lzma_blob(comp_data, blob_info):
+    # framed blob is a sequence of independent xz streams, and stored frames
+    # of incompressible chunks
+    decomp_data = ''
+    segment_compression = get_segment_compression([blob_info])
+    for (segment_name, blob_name, offset, size) in \
+            get_overlay_segments([blob_info]):
+        segment_data = comp_data[offset:offset+size]
+        if segment_compression[segment_name] == Const.COMPRESSION_NONE:
+            decomp_data += segment_data
+            continue
+        decompressor = lzma.LZMADecompressor()
+        decomp_data += decompressor.decompress(segment_data)
+        decomp_data += decompressor.flush()
+    return decomp_data
+
+
+def _check_blob_digest(comp_data, blob_info):
+    # each frame is checked with its own digest to find the corrupted frame.
+    # digest of the blob exists only at the newer overlay
+    blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+    digest_dict = get_segment_digests([blob_info])
+    segments = get_overlay_segments([blob_info])
+    if len(segments) > 1 and len(digest_dict) == len(segments):
+        if len(comp_data) != blob_info[Const.META_OVERLAY_FILE_SIZE]:
+            raise CorruptedBlobError("Corrupted overlay blob: %s" % blob_name)
+        leaf_size = blob_info.get(Const.META_OVERLAY_FILE_LEAF_SIZE, None)
+        for (segment_name, blob_name, offset, size) in segments:
+            segment_digest = get_segment_digest(
+                comp_data[offset:offset+size], leaf_size)
+            if segment_digest != digest_dict[segment_name]:
+                msg = "Corrupted overlay blob: %s" % segment_name
+                raise CorruptedBlobError(msg)
+        return
+    digest = blob_info.get(Const.META_OVERLAY_FILE_SHA256, None)
+    if digest is not None and sha256(comp_data).hexdigest() != digest:
+        raise CorruptedBlobError("Corrupted overlay blob: %s" % blob_name)
+
+
+def _decomp_blob(comp_data, blob_info):
+    _check_blob_digest(comp_data, blob_info)
+    comp_type = blob_info.get(
+        Const.META_OVERLAY_FILE_COMPRESSION,
+        Const.COMPRESSION_LZMA)
+    if comp_type == Const.COMPRESSION_LZMA:
+        return _decomp_lzma_blob(comp_data, blob_info)
+    elif comp_type == Const.COMPRESSION_NONE:
+        return comp_data
+    elif comp_type == Const.COMPRESSION_BZIP2:
+        decompressor = bz2.BZ2Decompressor()
+        return decompressor.decompress(comp_data)
+    elif comp_type == Const.COMPRESSION_GZIP:
+        return zlib.decompress(comp_data, zlib.MAX_WBITS | 16)
+    else:
+        raise CompressionError("Not valid compression option")
+
+
+def _decomp_frame(comp_data, segment_name, digest, leaf_size, comp_type):
+    if get_segment_digest(comp_data, leaf_size) != digest:
+        raise CorruptedBlobError("Corrupted overlay blob: %s" % segment_name)
+    if comp_type == Const.COMPRESSION_NONE:
+        return comp_data
+    decompressor = lzma.LZMADecompressor()
+    decomp_data = decompressor.decompress(comp_data)
+    decomp_data += decompressor.flush()
+    return decomp_data
+
+
+def _get_decomp_units(blob_info):
+    # (offset, size, inflight size, decompress function, its arguments) of
+    # each piece of the blob decompressed independently. Frame is the unit
+    # once each of them has its digest, and the others are checked and
+    # decompressed as a whole blob
+    segments = get_overlay_segments([blob_info])
+    digest_dict = get_segment_digests([blob_info])
+    raw_size = blob_info.get(Const.META_OVERLAY_FILE_RAW_SIZE, None)
+    frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+    if not frames or len(digest_dict) != len(segments):
+        # raw size does not exist at the old overlay
+        size = blob_info[Const.META_OVERLAY_FILE_SIZE]
+        return [(0, None, size + (raw_size or size), _decomp_blob,
+                 (blob_info,))]
+    leaf_size = blob_info.get(Const.META_OVERLAY_FILE_LEAF_SIZE, None)
+    segment_compression = get_segment_compression([blob_info])
+    raw_offsets = [frame.get(Const.META_OVERLAY_FRAME_RAW_OFFSET, None)
+                   for frame in frames] + [raw_size]
+    unit_list = list()
+    for (index, (segment_name, blob_name, offset, size)) in \
+            enumerate(segments):
+        frame_raw_size = size
+        if raw_offsets[index] is not None and \
+                raw_offsets[index+1] is not None:
+            frame_raw_size = raw_offsets[index+1] - raw_offsets[index]
+        unit_list.append((offset, size, size + frame_raw_size, _decomp_frame,
+                          (segment_name, digest_dict[segment_name],
+                           leaf_size, segment_compression[segment_name])))
+    return unit_list
+
+
+def _refetch_unit(read_blob, blob_info, unit, error):
+    # piece corrupted at the storage or on the wire is read again instead
+    # of failing the whole overlay
+    (offset, size, inflight_size, decomp_func, decomp_args) = unit
+    for retry in xrange(Const.OVERLAY_REFETCH_COUNT):
+        LOG.warning("%s, fetch it again (%d/%d)" %
+                    (str(error), retry+1, Const.OVERLAY_REFETCH_COUNT))
+        try:
+            return decomp_func(read_blob(blob_info, offset, size),
+                               *decomp_args)
+        except CorruptedBlobError as error:
+            pass
+    raise error
+
+
+def _decomp_blobs(blob_list, read_blob, out_fd, num_proc=None,
+                  inflight_size=Const.OVERLAY_DECOMP_INFLIGHT_SIZE):
+    """Decompress frames of the blobs at worker processes and write them in
+    order. read_blob(blob_info, offset, size) reads a range of the blob, or
+    the whole blob if size is None. The next frame is not read while
+    compressed and decompressed data in flight exceed inflight_size, but at
+    least one frame is always in flight. Frame failing its digest check is
+    fetched again with read_blob.
+    """
+    if num_proc is None:
+        num_proc = VMOverlayCreationMode.MAX_THREAD_NUM
+    unit_list = [(blob_info, unit) for blob_info in blob_list
+                 for unit in _get_decomp_units(blob_info)]
+    if num_proc <= 1 or len(unit_list) <= 1:
+        for (blob_info, unit) in unit_list:
+            (offset, size, unit_size, decomp_func, decomp_args) = unit
+            try:
+                decomp_data = decomp_func(read_blob(blob_info, offset, size),
+                                          *decomp_args)
+            except CorruptedBlobError as error:
+                decomp_data = _refetch_unit(read_blob, blob_info, unit,
+                                            error)
+            out_fd.write(decomp_data)
+        return
+
+    def write_result(result, blob_info, unit):
+        try:
+            decomp_data = result.get()
+        except CorruptedBlobError as error:
+            decomp_data = _refetch_unit(read_blob, blob_info, unit, error)
+        out_fd.write(decomp_data)
+
+    pool = multiprocessing.Pool(min(num_proc, len(unit_list)))
+    pending_list = collections.deque()
+    pending_size = 0
+    try:
+        for (blob_info, unit) in unit_list:
+            (offset, size, unit_size, decomp_func, decomp_args) = unit
+            while len(pending_list) > 0 and\
+                    pending_size + unit_size > inflight_size:
+                (result, pending_info, pending_unit) = pending_list.popleft()
+                write_result(result, pending_info, pending_unit)
+                pending_size -= pending_unit[2]
+            comp_data = read_blob(blob_info, offset, size)
+            result = pool.apply_async(decomp_func,
+                                      (comp_data,) + decomp_args)
+            pending_list.append((result, blob_info, unit))
+            pending_size += unit_size
+            comp_data = None
+        while len(pending_list) > 0:
+            (result, pending_info, pending_unit) = pending_list.popleft()
+            write_result(result, pending_info, pending_unit)
+    finally:
+        # terminate() of python 2.7 may hang with the busy workers, so wait
+        # for the frames in flight instead
+        pool.close()
+        pool.join()
+
+
+def decomp_overlay(meta, output_path, num_proc=None):
     meta_dict = msgpack.unpackb(open(meta, "r").read())
     decomp_start_time = time.time()
     comp_overlay_files = meta_dict[Const.META_OVERLAY_FILES]
-    comp_overlay_files = [item
-                          [Const.META_OVERLAY_FILE_NAME]
-                          for item in comp_overlay_files]
-    comp_overlay_files = [os.path.join
-                          (os.path.dirname(meta), item)
-                          for item in comp_overlay_files]
+    check_overlay_merkle(meta_dict)
+
+    def read_blob(blob_info, offset=0, size=None):
+        comp_file = os.path.join(os.path.dirname(meta),
+                                 blob_info[Const.META_OVERLAY_FILE_NAME])
+        with open(comp_file, "r") as comp_fd:
+            comp_fd.seek(offset)
+            if size is None:
+                return comp_fd.read()
+            return comp_fd.read(size)
+
+    # decompressed overlay is indexed to look up its items lazily
     overlay_file = open(output_path, "w+b")
-    for comp_file in comp_overlay_files:
-        decompressor = lzma.LZMADecompressor()
-        comp_data = open(comp_file, "r").read()
-        decomp_data = decompressor.decompress(comp_data)
-        decomp_data += decompressor.flush()
-        overlay_file.write(decomp_data)
+    IndexedDeltaList.begin_file(overlay_file)
+    _decomp_blobs(comp_overlay_files, read_blob, overlay_file,
+                  num_proc=num_proc)
+    IndexedDeltaList.finish_file(overlay_file)
     overlay_file.close()
 
     return meta_dict
 
 
-def decomp_overlayzip(overlay_path, outfilename):
+def decomp_overlayzip(overlay_path, outfilename, num_proc=None):
     overlay_package = VMOverlayPackage(overlay_path)
     decomp_start_time = time.time()
     meta_raw = overlay_package.read_meta()
     meta_info = msgpack.unpackb(meta_raw)
     comp_overlay_files = meta_info[Const.META_OVERLAY_FILES]
+    check_overlay_merkle(meta_info)
+
+    def read_blob(blob_info, offset=0, size=None):
+        return overlay_package.read_blob(
+            blob_info[Const.META_OVERLAY_FILE_NAME], offset, size)
 
     out_fd = open(outfilename, "w+b")
-    for blob_info in comp_overlay_files:
-        comp_filename = blob_info[Const.META_OVERLAY_FILE_NAME]
-        comp_type = blob_info.get(
-            Const.META_OVERLAY_FILE_COMPRESSION,
-            Const.COMPRESSION_LZMA)
-        if comp_type == Const.COMPRESSION_LZMA:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decompressor = lzma.LZMADecompressor()
-            decomp_data = decompressor.decompress(comp_data)
-            decomp_data += decompressor.flush()
-            out_fd.write(decomp_data)
-        elif comp_type == Const.COMPRESSION_BZIP2:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decompressor = bz2.BZ2Decompressor()
-            decomp_data = decompressor.decompress(comp_data)
-            out_fd.write(decomp_data)
-        elif comp_type == Const.COMPRESSION_GZIP:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decomp_data = zlib.decompress(comp_data, zlib.MAX_WBITS | 16)
-            out_fd.write(decomp_data)
-        else:
-            raise CompressionError("Not valid compression option")
+    IndexedDeltaList.begin_file(out_fd)
+    _decomp_blobs(comp_overlay_files, read_blob, out_fd, num_proc=num_proc)
+    IndexedDeltaList.finish_file(out_fd)
     out_fd.close()
     return meta_info
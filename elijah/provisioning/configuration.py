@@ -52,33 +52,100 @@ class Const(object):
     QUEUE_FAILED_MESSAGE = "!!@#^&!MemorySnapshot Transfer FAILED Marker!!@#^&!"
     QUEUE_SUCCESS_MESSAGE_LEN = len(QUEUE_SUCCESS_MESSAGE)
     QUEUE_FAILED_MESSAGE_LEN = len(QUEUE_FAILED_MESSAGE)
+    QUEUE_POST_COPY_MESSAGE = "!!@#^&!Post-copy Resume Marker!!@#^&!"
 
     BASE_DISK = ".base-img"
     BASE_MEM = ".base-mem"
     BASE_DISK_META = ".base-img-meta"
     BASE_MEM_META = ".base-mem-meta"
     BASE_HASH_VALUE = ".base-hash"
+    BASE_SIMILARITY_INDEX = ".simindex"
+    BASE_DISK_CDC_META = ".base-img-cdcmeta"
     OVERLAY_URIs = ".overlay-URIs"
     OVERLAY_META = "overlay-meta"
     OVERLAY_FILE_PREFIX = "overlay-blob"
     OVERLAY_ZIP = "overlay.zip"
     OVERLAY_LOG = ".overlay-log"
     LOG_PATH = "/var/tmp/cloudlet/log-synthesis"
+    HANDOFF_FLOW_DIR = "/var/tmp/cloudlet/handoff-flows"
     OVERLAY_BLOB_SIZE_KB = 1024*1024  # 1G
-
+    OVERLAY_FRAME_SIZE_KB = 256  # independently decompressible unit
+    # segment is verified on the wire by leaves of this size
+    OVERLAY_MERKLE_LEAF_SIZE = 1024*256
+    # compressed and decompressed blobs in flight at offline decompression
+    OVERLAY_DECOMP_INFLIGHT_SIZE = 1024*1024*512
+    # times to fetch a blob again when it does not match its digest
+    OVERLAY_REFETCH_COUNT = 2
+
+    # admission control of synthesis and handoff sessions at the host.
+    # IO budget is bytes written by the sessions being recovered at once
+    ADMISSION_STATE_PATH = "/var/tmp/cloudlet/admission-state"
+    ADMISSION_MAX_QUEUE = 8
+    ADMISSION_WAIT_TIMEOUT = 60*5
+    ADMISSION_POLL_INTERVAL = 0.5
+    ADMISSION_IO_BUDGET = 1024*1024*1024*8
+
+    # ready recovery contexts per base VM at the synthesis servers. Pool
+    # keeps the contexts for the requests expected within the horizon
+    RECOVERY_POOL_MIN_SIZE = 1
+    RECOVERY_POOL_MAX_SIZE = 8
+    RECOVERY_POOL_HORIZON = 10  # seconds
+
+    COMPRESSION_NONE = 0  # stored without compression
     COMPRESSION_LZMA = 1
     COMPRESSION_BZIP2 = 2
     COMPRESSION_GZIP = 3
+    # chunks whose prefix does not shrink below this ratio at zlib level 1
+    # are stored instead of being compressed
+    COMPRESSION_BYPASS_RATIO = 0.95
+    COMPRESSION_BYPASS_MIN_SIZE = 1024
+    COMPRESSION_BYPASS_SAMPLE_SIZE = 512
+
+    # hash of chunks to find the same chunk at the base VM and overlay.
+    # Every chunk hash has 32 bytes digest
+    CHUNK_HASH_SHA256 = "sha256"
+    CHUNK_HASH_BLAKE2B = "blake2b"
+    CHUNK_HASH_DEFAULT = CHUNK_HASH_SHA256
 
     META_BASE_VM_SHA256 = "base_vm_sha256"
+    META_CHUNK_HASH = "chunk_hash"
+    META_OVERLAY_ID = "overlay_id"
+    META_PARENT_OVERLAY_ID = "parent_overlay_id"
     META_RESUME_VM_DISK_SIZE = "resumed_vm_disk_size"
     META_RESUME_VM_MEMORY_SIZE = "resumed_vm_memory_size"
     META_OVERLAY_FILES = "overlay_files"
     META_OVERLAY_FILE_NAME = "overlay_name"
     META_OVERLAY_FILE_COMPRESSION = "overlay_compression"
     META_OVERLAY_FILE_SIZE = "overlay_size"
+    META_OVERLAY_FILE_RAW_SIZE = "overlay_raw_size"
+    META_OVERLAY_FILE_SHA256 = "overlay_sha256"
+    META_OVERLAY_FILE_MERKLE_ROOT = "overlay_merkle_root"
+    META_OVERLAY_FILE_LEAF_SIZE = "overlay_leaf_size"
+    META_OVERLAY_FILE_LEAVES = "overlay_leaves"
     META_OVERLAY_FILE_DISK_CHUNKS = "disk_chunk"
     META_OVERLAY_FILE_MEMORY_CHUNKS = "memory_chunk"
+    META_OVERLAY_FILE_FRAMES = "overlay_frames"
+    META_OVERLAY_FRAME_OFFSET = "frame_offset"
+    META_OVERLAY_FRAME_SIZE = "frame_size"
+    META_OVERLAY_FRAME_RAW_OFFSET = "frame_raw_offset"
+    META_OVERLAY_FRAME_DISK_CHUNK_END = "frame_disk_chunk_end"
+    META_OVERLAY_FRAME_MEMORY_CHUNK_END = "frame_memory_chunk_end"
+    META_OVERLAY_FRAME_COMPRESSION = "frame_compression"
+    META_OVERLAY_FRAME_SHA256 = "frame_sha256"
+    META_OVERLAY_FRAME_LEAVES = "frame_leaves"
+    META_OVERLAY_MERKLE_ROOT = "merkle_root"
+    META_OVERLAY_STATISTICS = "overlay_statistics"
+    META_OVERLAY_STAT_ITEMS = "delta_items"
+    META_OVERLAY_STAT_DISCARDED = "discarded"
+    META_OVERLAY_STAT_CREATION_MODE = "creation_mode"
+    META_POST_COPY = "post_copy"
+    META_POST_COPY_RESUME = "post_copy_resume"
+
+    # acks of post-copy handoff from the destination. High bit distinguishes
+    # them from the size of received data
+    POST_COPY_ACK_RESUMED = 0x8000000000000010
+    POST_COPY_ACK_DEMAND = 0x8000000000000020
+    POST_COPY_ACK_FINISHED = 0x8000000000000030
 
     MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
     QEMU_BIN_PATH = which("cloudlet_qemu-system-x86_64")
@@ -95,11 +162,18 @@ class Const(object):
     # global configuration files
     CLOUDLET_DB_SCHEMA = os.path.join(CONFIGURATION_DIR, "schema.sql")
     BASEVM_PACKAGE_SCHEMA = os.path.join(CONFIGURATION_DIR, "package.xsd")
+    FREE_MEMORY_PROFILE = os.path.join(CONFIGURATION_DIR,
+                                       "free-memory-profile.json")
     TEMPLATE_XML = os.path.join(CONFIGURATION_DIR, "VM_TEMPLATE.xml")
     TEMPLATE_OVF = os.path.join(CONFIGURATION_DIR, "ovftransport.iso")
     CHUNK_SIZE = 4096
     LIBVIRT_HEADER_SIZE = CHUNK_SIZE*2
 
+    # content-defined chunking of disk (average size is about 2K + 4K)
+    CDC_MIN_CHUNK_SIZE = 2048
+    CDC_AVG_CHUNK_BITS = 12
+    CDC_MAX_CHUNK_SIZE = 16384
+
     @staticmethod
     def _check_path(name, path):
         if not os.path.exists(path):
@@ -133,6 +207,12 @@ class Const(object):
         dir_path = os.path.dirname(base_disk_path)
         return os.path.join(dir_path, image_name+Const.BASE_HASH_VALUE)
 
+    @staticmethod
+    def get_base_cdcpath(base_disk_path):
+        image_name = os.path.splitext(os.path.basename(base_disk_path))[0]
+        dir_path = os.path.dirname(base_disk_path)
+        return os.path.join(dir_path, image_name+Const.BASE_DISK_CDC_META)
+
 
 class Options(object):
 
@@ -142,6 +222,10 @@ class Options(object):
         self.XRAY_SUPPORT = False
         self.DISK_ONLY = False
         self.ZIP_CONTAINER = False
+        # "fixed", "cdc" (needs CDC meta of base disk)
+        self.DISK_CHUNKING = "fixed"
+        # blobs are split into independently compressed frames
+        self.FRAME_SUPPORT = True
 
     def __str__(self):
         return pprint.pformat(self.__dict__)
@@ -162,6 +246,9 @@ class VMOverlayCreationMode(object):
     # only used for experiement. If it's bigger than 0, adaptation use this
     # value to transmit over the network
     USE_STATIC_NETWORK_BANDWIDTH = -1
+    # bandwidth shaping of handoff. Not bigger than 0 means no limit
+    HANDOFF_SEND_RATE_Mbps = -1  # cap of each handoff
+    HANDOFF_HOST_RATE_Mbps = -1  # split evenly by concurrent handoffs
     MEASURE_AVERAGE_TIME = 2  # seconds
     MAX_THREAD_NUM = 4
     HANDOFF_DEST_PORT_DEFAULT = 8022
@@ -177,7 +264,15 @@ class VMOverlayCreationMode(object):
 
     LIVE_MIGRATION_FINISH_ASAP = 1
     LIVE_MIGRATION_FINISH_USE_SNAPSHOT_SIZE = 2
-    LIVE_MIGRATION_STOP = LIVE_MIGRATION_FINISH_USE_SNAPSHOT_SIZE
+    LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL = 3
+    LIVE_MIGRATION_STOP = LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL
+    # parameters of LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL
+    LIVE_MIGRATION_TARGET_DOWNTIME = 1.0  # seconds
+    LIVE_MIGRATION_MAX_ITERATION = 30
+    # stop when an iteration is not smaller than this ratio of the previous
+    LIVE_MIGRATION_MIN_SHRINK_RATIO = 0.9
+    # memory pages sent before resuming the VM at post-copy handoff
+    POST_COPY_MAX_WORKING_SET = 1024*64
 
     def __init__(self, num_cores=4):
 
@@ -196,11 +291,15 @@ class VMOverlayCreationMode(object):
         self.OPTIMIZATION_DEDUP_BASE_DISK = True
         self.OPTIMIZATION_DEDUP_BASE_MEMORY = True
         self.OPTIMIZATION_DEDUP_BASE_SELF = True
+        # delta against similar base chunk (needs similarity index of base)
+        self.OPTIMIZATION_DELTA_BASE_SIMILAR = False
 
         # "xdelta3", "bsdiff", "xor", "none"
         self.MEMORY_DIFF_ALGORITHM = "xdelta3"
         # "xdelta3", "bsdiff", "xor", "none"
         self.DISK_DIFF_ALGORITHM = "xdelta3"
+        # "fixed", "cdc" (needs CDC meta of base disk)
+        self.DISK_CHUNKING = "fixed"
         self.COMPRESSION_ALGORITHM_TYPE = Const.COMPRESSION_LZMA
         self.COMPRESSION_ALGORITHM_SPEED = 5  # 1 (fastest) ~ 9
 
@@ -310,6 +409,8 @@ class Synthesis_Const(object):
     TRANSFER_SIZE = 1024*16
     END_OF_FILE = "!!Overlay Transfer End Marker"
     ERROR_OCCURED = "!!Overlay Transfer Error Marker"
+    END_OF_SEGMENT = "!!Overlay Segment End Marker"
+    STORED_SEGMENT = "!!Overlay Stored Segment Marker"
 
     # Synthesis Server
     LOCAL_IPADDRESS = 'localhost'
@@ -10,3 +10,35 @@ def cython_xor_vectorised(char *a,char *b):
     for i in range(512):
         (<unsigned long long *>c)[i]=(<unsigned long long *>a)[i]^(<unsigned long long *>b)[i]
     return c[:4096]
+
+def cython_cdc_cutpoints(bytes data, gear_table, int min_size, int avg_bits,
+                         int max_size, int window_size):
+    # gear rolling hash of content-defined chunking. 64 bit arithmetic
+    # wraps around like the masked hash of the Python version
+    cdef unsigned long long gear[256]
+    cdef unsigned long long boundary_mask = \
+        ((<unsigned long long>1 << avg_bits) - 1) << (64 - avg_bits)
+    cdef unsigned long long rolling_hash
+    cdef const unsigned char *buf = data
+    cdef Py_ssize_t data_len = len(data)
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t end, min_end, cut, index
+    cdef int i
+    for i in range(256):
+        gear[i] = gear_table[i]
+    cut_list = list()
+    while start < data_len:
+        end = min(start + max_size, data_len)
+        min_end = start + min_size
+        cut = end
+        rolling_hash = 0
+        index = max(start, min_end - window_size)
+        while index < end:
+            rolling_hash = (rolling_hash << 1) + gear[buf[index]]
+            if index >= min_end and (rolling_hash & boundary_mask) == 0:
+                cut = index
+                break
+            index += 1
+        cut_list.append(cut)
+        start = cut
+    return cut_list
@@ -29,6 +29,7 @@ from ..configuration import Const
 from sqlalchemy.orm import sessionmaker
 
 from table_def import create_db
+from table_def import upgrade_db
 from table_def import BaseVM, OverlayVM, User, Session
 
 
@@ -45,6 +46,7 @@ class DBConnector(object):
 
         # mapping existing DB to class
         self.engine = sqlalchemy.create_engine('sqlite:///%s' % Const.CLOUDLET_DB, echo=False)
+        upgrade_db(self.engine)
         session_maker = sessionmaker(bind=self.engine)
         self.session = session_maker()
 
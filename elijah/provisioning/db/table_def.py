@@ -39,10 +39,13 @@ class BaseVM(Base):
 
     disk_path = Column(String, primary_key=True)
     hash_value = Column(String, unique=True, nullable=False)
+    # hash value of the base VM that this base VM is derived from
+    parent_hash_value = Column(String, nullable=True)
 
-    def __init__(self, disk_path, hash_value):
+    def __init__(self, disk_path, hash_value, parent_hash_value=None):
         self.disk_path = disk_path
         self.hash_value = hash_value
+        self.parent_hash_value = parent_hash_value
 
 
 class Session(Base):
@@ -148,3 +151,13 @@ def create_db(db_path):
     engine = create_engine('sqlite:///%s' % db_path, echo=False)
     Base.metadata.create_all(engine)
 
+
+def upgrade_db(engine):
+    # add columns introduced after the DB file is created
+    base_vm_columns = [row[1] for row in
+                       engine.execute("PRAGMA table_info(%s)" %
+                                      BaseVM.__tablename__)]
+    if "parent_hash_value" not in base_vm_columns:
+        engine.execute("ALTER TABLE %s ADD COLUMN parent_hash_value VARCHAR" %
+                       BaseVM.__tablename__)
+
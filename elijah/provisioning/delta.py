@@ -17,18 +17,23 @@ import tool
 import os
 import random
 import select
+import zlib
 import threading
 import traceback
 import multiprocessing
+import tempfile
 import Queue
 from operator import itemgetter
 from hashlib import sha256
+from cStringIO import StringIO
 from lzma import LZMACompressor
 
 import process_manager
+import similarity
 from configuration import Const
 import log as logging
 import collections
+import msgpack
 
 
 LOG = logging.getLogger(__name__)
@@ -55,6 +60,7 @@ class DeltaItem(object):
     REF_BSDIFF          = 0x70
     REF_SELF_HASH       = 0x80
     REF_XOR             = 0x90
+    REF_BASE_SIMILAR    = 0xA0
 
     def __init__(self, delta_type, offset, offset_len, hash_value, ref_id,
                  data_len=0, data=None, live_seq=0):
@@ -84,6 +90,21 @@ class DeltaItem(object):
     def __getitem__(self, item):
         return self.__dict__[item]
 
+    @staticmethod
+    def get_chunk_range(offset, length, chunk_size):
+        # fixed size chunks that (offset, length) spans
+        return xrange(offset/chunk_size,
+                      (offset+length+chunk_size-1)/chunk_size)
+
+    def get_chunks(self, chunk_size):
+        return DeltaItem.get_chunk_range(self.offset, self.offset_len,
+                                         chunk_size)
+
+    def is_chunk_aligned(self, chunk_size):
+        # content-defined chunk can cover only a part of a fixed size chunk
+        return self.offset % chunk_size == 0 and \
+            self.offset_len == chunk_size
+
     def get_serialized(self, with_hashvalue=False):
         # offset        : unsigned long long
         # offset_length : unsigned short
@@ -96,7 +117,9 @@ class DeltaItem(object):
         if self.ref_id == DeltaItem.REF_RAW or \
                 self.ref_id == DeltaItem.REF_XDELTA or \
                 self.ref_id == DeltaItem.REF_XOR or \
-                self.ref_id == DeltaItem.REF_BSDIFF:
+                self.ref_id == DeltaItem.REF_BSDIFF or \
+                self.ref_id == DeltaItem.REF_BASE_SIMILAR:
+            # REF_BASE_SIMILAR data has reference position at its head
             data += struct.pack("!Q", self.data_len)
             if self.data_len != 0:
                 data += struct.pack("!%ds" % self.data_len, self.data)
@@ -118,7 +141,7 @@ class DeltaItem(object):
         if with_hashvalue:
             LOG.debug("hash size is %d" % len(self.hash_value))
             if self.hash_value and (len(self.hash_value) > 0):
-                data += struct.pack("!%ds" % len(self.hash_value), self.hashvalue)
+                data += struct.pack("!%ds" % len(self.hash_value), self.hash_value)
 
         return data
 
@@ -138,7 +161,8 @@ class DeltaItem(object):
         if ref_id == DeltaItem.REF_RAW or \
                 ref_id == DeltaItem.REF_XDELTA or \
                 ref_id == DeltaItem.REF_XOR or \
-                ref_id == DeltaItem.REF_BSDIFF:
+                ref_id == DeltaItem.REF_BSDIFF or \
+                ref_id == DeltaItem.REF_BASE_SIMILAR:
             data_len = struct.unpack("!Q", stream.read(8))[0]
             data = stream.read(data_len)
         elif ref_id == DeltaItem.REF_BASE_DISK or \
@@ -164,11 +188,206 @@ class DeltaItem(object):
         return item
 
 
+class IndexedDeltaList(object):
+    '''Read-only list of DeltaItem backed by a memory-mapped file.
+
+    Items are unpacked only when accessed, so that a large overlay can be
+    inspected without loading every chunk. A file of the indexed format has
+    (header, data region, fixed-width index), so that it can be written as
+    a stream. For a file of plain serialized items, the index is built by
+    scanning item headers.
+    '''
+    MAGIC = "CLDLIDX1"
+    # magic, item count, offset of the index, flags
+    HEADER = struct.Struct("!8sQQB")
+    FLAG_HASHVALUE = 0x01
+    # offset, offset_len, delta type | ref_id, live_seq,
+    # offset of the serialized item, size of the serialized item
+    INDEX_ENTRY = struct.Struct("!QHBHQI")
+
+    def __init__(self, f_path, with_hashvalue=False):
+        self.fd = open(f_path, "rb")
+        self.mm = None
+        self.index_data = ''
+        self.index_start = 0
+        self.item_count = 0
+        self.with_hashvalue = with_hashvalue
+        self._position_dict = None
+        if os.fstat(self.fd.fileno()).st_size == 0:
+            return
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[0:len(self.MAGIC)] == self.MAGIC:
+            (magic, self.item_count, self.index_start, flags) = \
+                self.HEADER.unpack_from(self.mm, 0)
+            self.with_hashvalue = bool(flags & self.FLAG_HASHVALUE)
+            self.index_data = self.mm
+        else:
+            self.index_data = self._scan_items(self.mm, 0, len(self.mm),
+                                               with_hashvalue)
+            self.item_count = len(self.index_data)/self.INDEX_ENTRY.size
+
+    @staticmethod
+    def get_data_range(fd):
+        '''Return (start, end, hash value flag) of serialized items at the
+        file. Plain serialized items take the whole file and the flag is None
+        '''
+        fd.seek(0)
+        header = fd.read(IndexedDeltaList.HEADER.size)
+        if header[0:len(IndexedDeltaList.MAGIC)] != IndexedDeltaList.MAGIC:
+            fd.seek(0, os.SEEK_END)
+            return (0, fd.tell(), None)
+        (magic, item_count, index_start, flags) = \
+            IndexedDeltaList.HEADER.unpack(header)
+        return (IndexedDeltaList.HEADER.size, index_start,
+                bool(flags & IndexedDeltaList.FLAG_HASHVALUE))
+
+    @staticmethod
+    def begin_file(fd):
+        # header is written again with the index at finish_file
+        fd.write(IndexedDeltaList.HEADER.pack(IndexedDeltaList.MAGIC, 0, 0,
+                                              0))
+
+    @staticmethod
+    def finish_file(fd, index_data=None, with_hashvalue=False):
+        '''Append the index to serialized items written after begin_file.
+        The index is built by scanning them unless index_data is given
+        '''
+        fd.flush()
+        index_start = fd.tell()
+        if index_data is None:
+            mm = mmap.mmap(fd.fileno(), index_start, access=mmap.ACCESS_READ)
+            try:
+                index_data = IndexedDeltaList._scan_items(
+                    mm, IndexedDeltaList.HEADER.size, index_start,
+                    with_hashvalue)
+            finally:
+                mm.close()
+        fd.write(index_data)
+        flags = 0
+        if with_hashvalue:
+            flags |= IndexedDeltaList.FLAG_HASHVALUE
+        fd.seek(0)
+        fd.write(IndexedDeltaList.HEADER.pack(
+            IndexedDeltaList.MAGIC,
+            len(index_data)/IndexedDeltaList.INDEX_ENTRY.size, index_start,
+            flags))
+        fd.seek(0, os.SEEK_END)
+
+    @staticmethod
+    def _scan_items(stream_data, pos, end, with_hashvalue=False):
+        # build index of serialized items without reading their data
+        entry_list = list()
+        while pos < end:
+            item_start = pos
+            (offset, offset_len, ref_info) = \
+                struct.unpack_from("!QHB", stream_data, pos)
+            pos += 11
+            ref_id = ref_info & 0xF0
+            delta_type = ref_info & 0x0F
+            if ref_id == DeltaItem.REF_RAW or \
+                    ref_id == DeltaItem.REF_XDELTA or \
+                    ref_id == DeltaItem.REF_XOR or \
+                    ref_id == DeltaItem.REF_BSDIFF or \
+                    ref_id == DeltaItem.REF_BASE_SIMILAR:
+                data_len = struct.unpack_from("!Q", stream_data, pos)[0]
+                pos += 8 + data_len
+            elif ref_id == DeltaItem.REF_BASE_DISK or \
+                    ref_id == DeltaItem.REF_BASE_MEM or \
+                    ref_id == DeltaItem.REF_SELF:
+                pos += 8
+            elif ref_id == DeltaItem.REF_SELF_HASH:
+                pos += 32
+            live_seq = 0
+            if delta_type == DeltaItem.DELTA_DISK_LIVE or\
+                    delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+                live_seq = struct.unpack_from("!H", stream_data, pos)[0]
+                pos += 2
+            if with_hashvalue:
+                pos += 32
+            if pos > end:
+                raise DeltaError("Truncated delta item at %ld" % item_start)
+            entry_list.append(IndexedDeltaList.INDEX_ENTRY.pack(
+                offset, offset_len, ref_info, live_seq, item_start,
+                pos - item_start))
+        return ''.join(entry_list)
+
+    def __len__(self):
+        return self.item_count
+
+    def get_entry(self, position):
+        '''Return (offset, offset_len, delta type, ref_id, live_seq) of the
+        item without unpacking its data
+        '''
+        (offset, offset_len, ref_info, live_seq, item_offset, item_size) = \
+            self.INDEX_ENTRY.unpack_from(
+                self.index_data,
+                self.index_start + position*self.INDEX_ENTRY.size)
+        return (offset, offset_len, ref_info & 0x0F, ref_info & 0xF0,
+                live_seq)
+
+    def get_item_size(self, position):
+        # size of the serialized item
+        return self.INDEX_ENTRY.unpack_from(
+            self.index_data,
+            self.index_start + position*self.INDEX_ENTRY.size)[5]
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in xrange(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if position < 0 or position >= len(self):
+            raise IndexError("delta list index out of range")
+        item_offset = self.INDEX_ENTRY.unpack_from(
+            self.index_data,
+            self.index_start + position*self.INDEX_ENTRY.size)[4]
+        self.mm.seek(item_offset)
+        return DeltaItem.unpack_stream(self.mm,
+                                       with_hashvalue=self.with_hashvalue)
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self[position]
+
+    def iter_headers(self):
+        # delta items without data and hash value
+        for position in xrange(len(self)):
+            (offset, offset_len, delta_type, ref_id, live_seq) = \
+                self.get_entry(position)
+            yield DeltaItem(delta_type, offset, offset_len, None, ref_id,
+                            live_seq=live_seq)
+
+    def get(self, index, default=None):
+        '''Return the last delta item of DeltaItem.index like a dictionary
+        built from the list
+        '''
+        if self._position_dict is None:
+            self._position_dict = dict()
+            for position in xrange(len(self)):
+                (offset, offset_len, delta_type, ref_id, live_seq) = \
+                    self.get_entry(position)
+                self._position_dict[
+                    DeltaItem.get_index(delta_type, offset)] = position
+        position = self._position_dict.get(index, None)
+        if position is None:
+            return default
+        return self[position]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.fd.close()
+
+
 class DeltaList(object):
     @staticmethod
-    def tofile(delta_list, f_path, with_hashvalue=False):
+    def tofile(delta_list, f_path, with_hashvalue=False, indexed=False):
         if len(delta_list) == 0 or type(delta_list[0]) != DeltaItem:
             raise MemoryError("Need list of DeltaItem")
+        if indexed:
+            DeltaList._tofile_indexed(delta_list, f_path, with_hashvalue)
+            return
 
         fd = open(f_path, "wb")
         # Write list if delta item
@@ -178,23 +397,59 @@ class DeltaList(object):
         fd.close()
 
     @staticmethod
-    def fromfile(f_path):
-        delta_list = []
-        fd = open(f_path, "rb")
-        while True:
-            new_item = DeltaItem.unpack_stream(fd)
-            if not new_item:
-                break
-            delta_list.append(new_item)
+    def _tofile_indexed(delta_list, f_path, with_hashvalue=False):
+        index_list = list()
+        fd = open(f_path, "w+b")
+        IndexedDeltaList.begin_file(fd)
+        # data region is the same as the plain serialized items
+        item_offset = IndexedDeltaList.HEADER.size
+        for item in delta_list:
+            item_bytes = item.get_serialized(with_hashvalue=with_hashvalue)
+            fd.write(item_bytes)
+            index_list.append(IndexedDeltaList.INDEX_ENTRY.pack(
+                item.offset, item.offset_len, item.delta_type | item.ref_id,
+                item.live_seq or 0, item_offset, len(item_bytes)))
+            item_offset += len(item_bytes)
+        IndexedDeltaList.finish_file(fd, ''.join(index_list), with_hashvalue)
         fd.close()
-        return delta_list 
 
     @staticmethod
-    def from_stream(stream,delta_times):
+    def fromfile(f_path, with_hashvalue=False):
+        # items are unpacked lazily from the memory-mapped file.
+        # with_hashvalue is needed only for plain serialized items
+        return IndexedDeltaList(f_path, with_hashvalue=with_hashvalue)
+
+    @staticmethod
+    def from_file_stream(f_path, delta_times=None, with_hashvalue=False):
+        '''Yield delta items of the file in order, reading it sequentially.
+        with_hashvalue is needed only for plain serialized items
+        '''
+        fd = open(f_path, "rb")
+        try:
+            (data_start, data_end, flag) = \
+                IndexedDeltaList.get_data_range(fd)
+            if flag is not None:
+                with_hashvalue = flag
+            fd.seek(data_start)
+            while fd.tell() < data_end:
+                start = time.time()
+                new_item = DeltaItem.unpack_stream(
+                    fd, with_hashvalue=with_hashvalue)
+                if delta_times is not None:
+                    delta_times['unpack'] += (time.time() - start)
+                if new_item == None:
+                    break
+                yield new_item
+        finally:
+            fd.close()
+
+    @staticmethod
+    def from_stream(stream, delta_times=None):
         while True:
             start = time.time()
             new_item = DeltaItem.unpack_stream(stream)
-            delta_times['unpack'] += (time.time() - start)
+            if delta_times is not None:
+                delta_times['unpack'] += (time.time() - start)
             if new_item == None:
                 raise StopIteration()
             yield new_item
@@ -227,7 +482,7 @@ class DeltaList(object):
         fd.close()
 
     @staticmethod
-    def get_self_delta(delta_list):
+    def get_self_delta(delta_list, chunk_size=None):
         if len(delta_list) == 0:
             LOG.debug("Nothing to compare. Length is 0")
             delta_list.sort(key=itemgetter('offset'))
@@ -243,10 +498,16 @@ class DeltaList(object):
         matching = 0
         for delta_item in delta_list[1:]:
             if delta_item.hash_value == pivot.hash_value:
+                if chunk_size is not None and \
+                        not delta_item.is_chunk_aligned(chunk_size):
+                    # a part of a fixed size chunk stays with the other
+                    # parts of the chunk rather than with its reference
+                    continue
                 if delta_item.ref_id == DeltaItem.REF_XDELTA or \
                         delta_item.ref_id == DeltaItem.REF_RAW or \
                         delta_item.ref_id == DeltaItem.REF_XOR or \
-                        delta_item.ref_id == DeltaItem.REF_BSDIFF:
+                        delta_item.ref_id == DeltaItem.REF_BSDIFF or \
+                        delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
                     # same data/hash
                     # save reference start offset
                     delta_item.ref_id = DeltaItem.REF_SELF
@@ -352,7 +613,8 @@ class DeltaList(object):
                     disk_from_base_mem += 1
             elif delta_item.ref_id == DeltaItem.REF_XDELTA or \
                 delta_item.ref_id == DeltaItem.REF_XOR or \
-                delta_item.ref_id == DeltaItem.REF_BSDIFF:
+                delta_item.ref_id == DeltaItem.REF_BSDIFF or \
+                delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
                 if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
                         (delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE):
                     memory_from_xdelta += 1
@@ -453,7 +715,8 @@ def diff_with_deltalist(delta_list, const_deltalist, ref_id):
                 ((delta.ref_id == DeltaItem.REF_XDELTA) or \
                  (delta.ref_id == DeltaItem.REF_RAW) or \
                  (delta.ref_id == DeltaItem.REF_XOR) or \
-                 (delta.ref_id == DeltaItem.REF_BSDIFF)):
+                 (delta.ref_id == DeltaItem.REF_BSDIFF) or \
+                 (delta.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             if delta.offset_len != const_delta.offset_len:
                 message = "Hash is same but length is different %d != %d" % \
                         (delta.offset_len, const_delta.offset_len)
@@ -492,7 +755,8 @@ def diff_with_hashlist(base_hashlist, delta_list, ref_id):
                 ((delta.ref_id == DeltaItem.REF_XDELTA) or \
                  (delta.ref_id == DeltaItem.REF_RAW) or \
                  (delta.ref_id == DeltaItem.REF_XOR) or \
-                 (delta.ref_id == DeltaItem.REF_BSDIFF)):
+                 (delta.ref_id == DeltaItem.REF_BSDIFF) or \
+                 (delta.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             matching_count += 1
             #LOG.debug("page %ld is matching base %ld" % (s_start, start))
             delta.ref_id = ref_id
@@ -506,7 +770,8 @@ def diff_with_hashlist(base_hashlist, delta_list, ref_id):
 
 def create_overlay(memory_deltalist, memory_chunk_size,
         disk_deltalist, disk_chunk_size,
-        basedisk_hashlist=None, basemem_hashlist=None):
+        basedisk_hashlist=None, basemem_hashlist=None,
+        hash_type=Const.CHUNK_HASH_DEFAULT):
 
     if memory_chunk_size != disk_chunk_size:
         raise DeltaError("Expect same chunk size for Disk and Memory")
@@ -516,7 +781,8 @@ def create_overlay(memory_deltalist, memory_chunk_size,
     #Memory
     # Create Base Memory from meta file
     LOG.debug("2-1.Find zero page")
-    zero_hash = sha256(struct.pack("!s", chr(0x00))*chunk_size).digest()
+    zero_hash = tool.chunk_hash(struct.pack("!s", chr(0x00))*chunk_size,
+                                hash_type)
     zero_hash_list = [(-1, chunk_size, zero_hash)]
     diff_with_hashlist(zero_hash_list, delta_list, ref_id=DeltaItem.REF_ZEROS)
 
@@ -527,7 +793,7 @@ def create_overlay(memory_deltalist, memory_chunk_size,
 
     # 3.find shared within self
     LOG.debug("3.get delta from itself")
-    DeltaList.get_self_delta(delta_list)
+    DeltaList.get_self_delta(delta_list, chunk_size)
 
     return delta_list
 
@@ -541,9 +807,20 @@ class Recovered_delta(multiprocessing.Process):
     def __init__(self, base_disk, base_mem, overlay_path, 
                  output_mem_path, output_mem_size, 
                  output_disk_path, output_disk_size, chunk_size,
-                 out_pipename=None, time_queue=None, deltalist_savepath=None):
+                 out_pipename=None, time_queue=None, deltalist_savepath=None,
+                 parent_overlay_paths=None, residue_hashlist_path=None,
+                 overlay_id=None, base_mappings=None,
+                 hash_type=Const.CHUNK_HASH_DEFAULT):
         ''' recover delta list using base disk/memory
         Args:
+            hash_type : chunk hash of the overlay, which hashes the
+                recovered chunks
+            base_mappings : (raw disk, raw memory) of the base VM already
+                mapped by the caller, which is kept open at finish()
+            parent_overlay_paths : delta lists of the previous residues in
+                the chain, which are recovered before overlay_path in order
+            residue_hashlist_path : save hash list of the recovered chunks
+                to create a residue chained to this overlay
         '''
 
         if base_disk == None and base_mem == None:
@@ -559,6 +836,11 @@ class Recovered_delta(multiprocessing.Process):
         self.base_disk = base_disk
         self.base_mem = base_mem
         self.deltalist_savepath = deltalist_savepath
+        self.parent_overlay_paths = parent_overlay_paths or list()
+        self.residue_hashlist_path = residue_hashlist_path
+        self.overlay_id = overlay_id
+        self.base_mappings = base_mappings
+        self.hash_type = hash_type
 
         self.base_disk_fd = None
         self.base_mem_fd = None
@@ -571,6 +853,9 @@ class Recovered_delta(multiprocessing.Process):
         self.recovered_delta_dict = dict()
         self.recovered_hash_dict = dict()
         self.live_migration_iteration_dict = dict()
+        # recovered bytes of disk chunks partially covered by delta item
+        self.partial_chunk_dict = dict()
+        self.residue_hash_dict = dict()
 
         multiprocessing.Process.__init__(self)
         #threading.Thread.__init__(self)
@@ -580,18 +865,51 @@ class Recovered_delta(multiprocessing.Process):
 
         # initialize reference data to use mmap
         count = 0
-        self.base_disk_fd = open(self.base_disk, "rb")
-        self.raw_disk = mmap.mmap(self.base_disk_fd.fileno(), 0, prot=mmap.PROT_READ)
-        self.base_mem_fd = open(self.base_mem, "rb")
-        self.raw_mem = mmap.mmap(self.base_mem_fd.fileno(), 0, prot=mmap.PROT_READ)
+        if self.base_mappings is not None:
+            (self.raw_disk, self.raw_mem) = self.base_mappings
+        else:
+            self.base_disk_fd = open(self.base_disk, "rb")
+            self.raw_disk = mmap.mmap(self.base_disk_fd.fileno(), 0, prot=mmap.PROT_READ)
+            self.base_mem_fd = open(self.base_mem, "rb")
+            self.raw_mem = mmap.mmap(self.base_mem_fd.fileno(), 0, prot=mmap.PROT_READ)
         self.out_pipe = open(self.out_pipename, "w")
         self.recover_mem_fd = open(self.output_mem_path, "wrb")
         self.recover_disk_fd = open(self.output_disk_path, "wrb")
-        overlay_stream = open(self.overlay_path, "r")
         delta_counter = collections.Counter()
         delta_times = collections.Counter()
+        for overlay_path in self.parent_overlay_paths:
+            count += self._recover_overlay(overlay_path, delta_counter,
+                                           delta_times)
+            # self reference and iteration number are valid only within
+            # each residue
+            self.recovered_delta_dict.clear()
+            self.live_migration_iteration_dict.clear()
+        count += self._recover_overlay(self.overlay_path, delta_counter,
+                                       delta_times)
+        if self.residue_hashlist_path is not None:
+            save_residue_hashlist(self.residue_hashlist_path,
+                                  self.overlay_id, self.residue_hash_dict,
+                                  self.hash_type)
+        LOG.debug("Delta metrics: ")
+        LOG.debug("="*50)
+        LOG.debug(delta_counter)
+        LOG.debug(delta_times)
+        LOG.debug("Total captured time: %d" % (sum(delta_times.values())))
+        self.out_pipe.write(str(Recovered_delta.END_OF_PIPE) + "\n")
+        self.out_pipe.close()
+        end_time = time.time()
+
+        if self.time_queue != None: 
+            self.time_queue.put({'start_time':start_time, 'end_time':end_time})
+        LOG.info("[Delta] : (%s)-(%s)=(%s), delta %ld chunks" % \
+                (start_time, end_time, (end_time-start_time), count))
+        self.finish()
+
+    def _recover_overlay(self, overlay_path, delta_counter, delta_times):
+        count = 0
         unresolved_deltaitem_list = []
-        for delta_item in DeltaList.from_stream(overlay_stream, delta_times):
+        for delta_item in DeltaList.from_file_stream(overlay_path,
+                                                     delta_times):
             #LOG.debug("[Delta] proceesing %d" % count)
             ret = self.recover_item(delta_item, delta_counter, delta_times)
             if ret == None:
@@ -611,20 +929,7 @@ class Recovered_delta(multiprocessing.Process):
                 raise MemoryError(msg)
             self.process_deltaitem(delta_item, delta_counter, delta_times)
             count += 1
-        LOG.debug("Delta metrics: ")
-        LOG.debug("="*50)
-        LOG.debug(delta_counter)
-        LOG.debug(delta_times)
-        LOG.debug("Total captured time: %d" % (sum(delta_times.values())))
-        self.out_pipe.write(str(Recovered_delta.END_OF_PIPE) + "\n")
-        self.out_pipe.close()
-        end_time = time.time()
-
-        if self.time_queue != None: 
-            self.time_queue.put({'start_time':start_time, 'end_time':end_time})
-        LOG.info("[Delta] : (%s)-(%s)=(%s), delta %ld chunks" % \
-                (start_time, end_time, (end_time-start_time), count))
-        self.finish()
+        return count
 
     def recover_item(self, delta_item, delta_counter, delta_times):
         if type(delta_item) != DeltaItem:
@@ -636,13 +941,17 @@ class Recovered_delta(multiprocessing.Process):
         if (delta_item.ref_id == DeltaItem.REF_RAW):
             recover_data = delta_item.data
         elif (delta_item.ref_id == DeltaItem.REF_ZEROS):
-            recover_data = self.zero_data
+            if delta_item.offset_len == self.chunk_size:
+                recover_data = self.zero_data
+            else:
+                recover_data = chr(0x00) * delta_item.offset_len
         elif (delta_item.ref_id == DeltaItem.REF_BASE_MEM):
             offset = delta_item.data
-            recover_data = self.raw_mem[offset:offset+self.chunk_size]
+            recover_data = self.raw_mem[offset:offset+delta_item.offset_len]
         elif (delta_item.ref_id == DeltaItem.REF_BASE_DISK):
+            # content-defined chunk can have different length
             offset = delta_item.data
-            recover_data = self.raw_disk[offset:offset+self.chunk_size]
+            recover_data = self.raw_disk[offset:offset+delta_item.offset_len]
         elif delta_item.ref_id == DeltaItem.REF_SELF:
             ref_index = delta_item.data
             self_ref_delta_item = self.recovered_delta_dict.get(ref_index, None)
@@ -695,6 +1004,17 @@ class Recovered_delta(multiprocessing.Process):
             else:
                 raise DeltaError("Delta type should be either disk or memory")
             recover_data = tool.cython_xor(base_data, patch_data)
+        elif delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
+            (ref_source, ref_offset, patch_data) = \
+                    similarity.unpack_similar_patch(delta_item.data)
+            patch_original_size = delta_item.offset_len
+            if ref_source == DeltaItem.REF_BASE_MEM:
+                base_data = self.raw_mem[ref_offset:ref_offset+patch_original_size]
+            elif ref_source == DeltaItem.REF_BASE_DISK:
+                base_data = self.raw_disk[ref_offset:ref_offset+patch_original_size]
+            else:
+                raise DeltaError("Similar reference should be either base disk or memory")
+            recover_data = tool.merge_data(base_data, patch_data, len(base_data)*5)
         else:
             raise MemoryError("Cannot recover: invalid referce id %d" % delta_item.ref_id)
 
@@ -710,13 +1030,33 @@ class Recovered_delta(multiprocessing.Process):
 
         if delta_item.hash_value == None or len(delta_item.hash_value) == 0:
             start_time = time.time()
-            delta_item.hash_value = sha256(recover_data).digest()
+            delta_item.hash_value = tool.chunk_hash(recover_data,
+                                                    self.hash_type)
             delta_counter['sha'] += 1
             delta_times['sha'] += (time.time() - start_time)
         return delta_item
 
+    def get_recovered_disk_chunks(self, delta_item):
+        # content-defined chunk can cover only a part of a fixed size chunk,
+        # so report the chunk after it is entirely recovered
+        if delta_item.is_chunk_aligned(self.chunk_size):
+            return [delta_item.offset/self.chunk_size]
+        recovered_chunks = list()
+        end_offset = delta_item.offset + delta_item.offset_len
+        for chunk in delta_item.get_chunks(self.chunk_size):
+            chunk_start = max(chunk*self.chunk_size, delta_item.offset)
+            chunk_end = min((chunk+1)*self.chunk_size, end_offset)
+            recovered_size = self.partial_chunk_dict.get(chunk, 0) +\
+                (chunk_end-chunk_start)
+            if recovered_size >= self.chunk_size:
+                self.partial_chunk_dict.pop(chunk, None)
+                recovered_chunks.append(chunk)
+            else:
+                self.partial_chunk_dict[chunk] = recovered_size
+        return recovered_chunks
+
     def process_deltaitem(self, delta_item, delta_counter, delta_times):
-        overlay_chunk_id = None
+        overlay_chunk_ids = list()
         if len(delta_item.data) != delta_item.offset_len:
             msg = "recovered size is not same as page size, %ld != %ld" % \
                     (len(delta_item.data), delta_item.offset_len)
@@ -742,8 +1082,8 @@ class Recovered_delta(multiprocessing.Process):
                 delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
             self.recover_mem_fd.seek(delta_item.offset)
             self.recover_mem_fd.write(delta_item.data)
-            overlay_chunk_id = format("%d:%ld" %
-                (Recovered_delta.FUSE_INDEX_MEMORY, long(delta_item.offset / self.chunk_size)))
+            overlay_chunk_ids.append(format("%d:%ld" %
+                (Recovered_delta.FUSE_INDEX_MEMORY, long(delta_item.offset / self.chunk_size))))
             start_time = time.time()
             self.recover_mem_fd.flush()
             delta_times['flush'] += (time.time() - start_time)
@@ -751,8 +1091,9 @@ class Recovered_delta(multiprocessing.Process):
                 delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
             self.recover_disk_fd.seek(delta_item.offset)
             self.recover_disk_fd.write(delta_item.data)
-            overlay_chunk_id = format("%d:%ld" %
-                (Recovered_delta.FUSE_INDEX_DISK, long(delta_item.offset / self.chunk_size)))
+            for chunk in self.get_recovered_disk_chunks(delta_item):
+                overlay_chunk_ids.append(format("%d:%ld" %
+                    (Recovered_delta.FUSE_INDEX_DISK, long(chunk))))
             start_time = time.time()
             self.recover_disk_fd.flush()
             delta_times['flush'] += (time.time() - start_time)
@@ -760,8 +1101,12 @@ class Recovered_delta(multiprocessing.Process):
         delta_times['seekwrite'] += (time.time() - start_time)
         # update the latest item for each memory page or disk block
         self.live_migration_iteration_dict[delta_item.index] = delta_item
+        if self.residue_hashlist_path is not None:
+            self.residue_hash_dict[delta_item.index] = \
+                (delta_item.hash_value, delta_item.offset_len)
 
-        self.out_pipe.write(overlay_chunk_id + '\n')
+        for overlay_chunk_id in overlay_chunk_ids:
+            self.out_pipe.write(overlay_chunk_id + '\n')
         self.out_pipe.flush()
 
 
@@ -772,12 +1117,16 @@ class Recovered_delta(multiprocessing.Process):
         self.recovered_hash_dict = None
         self.live_migration_iteration_dict.clear()
         self.live_migration_iteration_dict = None
+        self.residue_hash_dict.clear()
         if self.base_disk_fd is not None:
             self.base_disk_fd.close()
             self.base_disk_fd = None
         if self.base_mem_fd is not None:
             self.base_mem_fd.close()
             self.base_mem_fd = None
+        # mapping of the caller is shared with the other recoveries
+        if self.base_mappings is not None:
+            self.raw_disk = self.raw_mem = None
         if self.raw_disk is not None:
             self.raw_disk.close()
             self.raw_disk = None
@@ -803,7 +1152,8 @@ def deduplicate_deltaitem(hash_dict, delta_item, ref_id):
         if ((delta_item.ref_id == DeltaItem.REF_XDELTA) or \
             (delta_item.ref_id == DeltaItem.REF_RAW) or \
             (delta_item.ref_id == DeltaItem.REF_XOR) or \
-            (delta_item.ref_id == DeltaItem.REF_BSDIFF)):
+            (delta_item.ref_id == DeltaItem.REF_BSDIFF) or \
+            (delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             delta_item.ref_id = ref_id
             delta_item.data_len = 8
             delta_item.data = ref_offset
@@ -816,7 +1166,10 @@ class DeltaDedup(process_manager.ProcWorker):
                  disk_deltalist_queue, disk_chunk_size,
                  merged_deltalist_queue,
                  overlay_creation_mode,
-                 basedisk_hashdict=None, basemem_hashdict=None):
+                 basedisk_hashdict=None, basemem_hashdict=None,
+                 residue_hashdict=None, post_copy_scheduler=None,
+                 resume_pipe=None, demand_queue=None,
+                 hash_type=Const.CHUNK_HASH_DEFAULT):
         self.memory_deltalist_queue = memory_deltalist_queue
         self.memory_chunk_size = memory_chunk_size
         self.disk_deltalist_queue = disk_deltalist_queue
@@ -825,6 +1178,15 @@ class DeltaDedup(process_manager.ProcWorker):
         self.overlay_creation_mode = overlay_creation_mode
         self.basedisk_hashdict = basedisk_hashdict
         self.basemem_hashdict= basemem_hashdict
+        # residue is chained to the previous residue when it is given
+        self.residue_hashdict = residue_hashdict
+        # post-copy handoff holds back memory pages out of the working set
+        self.post_copy_scheduler = post_copy_scheduler
+        # sending end of the pipe signalling the resume to the transfer
+        self.resume_pipe = resume_pipe
+        self.demand_queue = demand_queue
+        # chunk hash of the base VM hash dicts
+        self.hash_type = hash_type
 
         self.self_hashdict = dict()
         self.self_hashset = set()
@@ -871,8 +1233,12 @@ class DeltaDedup(process_manager.ProcWorker):
             chunk_size = self.disk_chunk_size
 
             zero_hash_dict = dict()
-            zero_hash = sha256(struct.pack("!s", chr(0x00))*chunk_size).digest()
+            zero_hash = tool.chunk_hash(
+                struct.pack("!s", chr(0x00))*chunk_size, self.hash_type)
             zero_hash_dict[zero_hash] = long(-1)
+            residue_filter = None
+            if self.residue_hashdict is not None:
+                residue_filter = ChainedResidueFilter(self.residue_hashdict)
             is_memory_finished = False
             is_disk_finished = False
             while is_memory_finished == False or is_disk_finished == False:
@@ -898,6 +1264,12 @@ class DeltaDedup(process_manager.ProcWorker):
                     else:   # control message
                         continue
 
+                    if residue_filter is not None:
+                        deltaitem_list = residue_filter.filter_deltalist(
+                            deltaitem_list)
+                        if len(deltaitem_list) == 0:
+                            continue
+
                     if is_first_recv == False:
                         is_first_recv = True
                         time_first_recv = time.time()
@@ -940,7 +1312,8 @@ class DeltaDedup(process_manager.ProcWorker):
                             if ((delta_item.ref_id == DeltaItem.REF_XDELTA)\
                                 or (delta_item.ref_id == DeltaItem.REF_RAW)\
                                 or (delta_item.ref_id == DeltaItem.REF_XOR)\
-                                or (delta_item.ref_id == DeltaItem.REF_BSDIFF)):
+                                or (delta_item.ref_id == DeltaItem.REF_BSDIFF)\
+                                or (delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR)):
                                 if delta_item.hash_value in self.self_hashset:
                                     delta_item.ref_id = delta_item.REF_SELF_HASH
                                     delta_item.data_len = 32
@@ -959,7 +1332,12 @@ class DeltaDedup(process_manager.ProcWorker):
                     self.in_size += indata_size_cur
                     self.out_size += outdata_size_cur
                     time_process_finish = time.clock()
-                    self.merged_deltalist_queue.put(deltaitem_list)
+                    if self.post_copy_scheduler is not None:
+                        deltaitem_list = \
+                            self.post_copy_scheduler.schedule_deltalist(
+                                deltaitem_list)
+                    if len(deltaitem_list) > 0:
+                        self.merged_deltalist_queue.put(deltaitem_list)
 
                     # measurement
                     total_process_time_cur = (time_process_finish-time_process_start)
@@ -975,6 +1353,16 @@ class DeltaDedup(process_manager.ProcWorker):
 
                         cur_wall_time = time.time()
                         self.measure_history.append((cur_wall_time, self.monitor_total_time_block_cur.value, self.monitor_total_ratio_block_cur.value))
+            if residue_filter is not None:
+                reverted_deltalist = residue_filter.get_reverted_deltalist()
+                if len(reverted_deltalist) > 0:
+                    self.merged_deltalist_queue.put(reverted_deltalist)
+                LOG.debug("Chained residue: %d identical to previous, "
+                          "%d reverted to base" %
+                          (residue_filter.filtered_count,
+                           len(reverted_deltalist)))
+            if self.post_copy_scheduler is not None:
+                self._push_post_copy()
             self.is_processing_alive.value = False
             self.finish_processing_input.value = True
             self.monitor_is_alive = False
@@ -1013,8 +1401,34 @@ class DeltaDedup(process_manager.ProcWorker):
             LOG.error(str(e))
             LOG.error("failed at %s" % str(traceback.format_exc()))
 
+    def _push_post_copy(self):
+        # VM state is final. Destination can resume the VM from here
+        scheduler = self.post_copy_scheduler
+        self.resume_pipe.send(scheduler.resume_chunks)
+        LOG.debug("Post-copy: resume with %d chunks, %d pages deferred" %
+                  (len(scheduler.resume_chunks),
+                   len(scheduler.deferred_dict)))
+        while scheduler.has_deferred():
+            is_busy = self.merged_deltalist_queue.qsize() >= \
+                PostCopyScheduler.PUSH_BACKLOG
+            demanded_list = list()
+            try:
+                if is_busy:
+                    demanded_list.append(self.demand_queue.get(timeout=0.01))
+                while True:
+                    demanded_list.append(self.demand_queue.get_nowait())
+            except Queue.Empty:
+                pass
+            push_count = 0 if is_busy else PostCopyScheduler.PUSH_SIZE
+            deltaitem_list = scheduler.pop_deferred_deltalist(
+                demanded_list, push_count)
+            if len(deltaitem_list) > 0:
+                self.merged_deltalist_queue.put(deltaitem_list)
+        scheduler.close()
+
     @staticmethod
-    def memory_import_hashdict(meta_path):
+    def memory_import_hashdict(meta_path,
+                               hash_type=Const.CHUNK_HASH_DEFAULT):
         fd = open(meta_path, "rb")
 
         # Read Hash Item List
@@ -1025,19 +1439,27 @@ class DeltaDedup(process_manager.ProcWorker):
             data = fd.read(8+4+32) # start_offset, length, hash
             if not data:
                 break
+            if count == 1 and tool.check_hash_meta_header(
+                    data, meta_path, hash_type):
+                continue
             item = tuple(struct.unpack("!qI32s", data))
             hash_dict[item[2]] = item[0]
         fd.close()
         return hash_dict
 
     @staticmethod
-    def disk_import_hashdict(base_meta):
+    def disk_import_hashdict(base_meta, hash_type=Const.CHUNK_HASH_DEFAULT):
         hash_dict = dict()
         fd = open(base_meta, "rb")
+        count = 0
         while True:
+            count += 1
             data = fd.read(8+4+32) # start_offset, length, hash
             if not data:
                 break
+            if count == 1 and tool.check_hash_meta_header(
+                    data, base_meta, hash_type):
+                continue
             item = tuple(struct.unpack("!qI32s", data))
             hash_dict[item[2]] = item[0]
         fd.close()
@@ -1133,10 +1555,174 @@ def reorder_deltalist(access_list, chunk_size, delta_list):
 
 
 
-def _save_blob(start_index, delta_list, self_ref_dict, blob_name, blob_size, statistics=None):
+_STAT_DELTA_TYPE_NAME = {
+    DeltaItem.DELTA_MEMORY: "memory",
+    DeltaItem.DELTA_MEMORY_LIVE: "memory",
+    DeltaItem.DELTA_DISK: "disk",
+    DeltaItem.DELTA_DISK_LIVE: "disk",
+}
+_STAT_REF_NAME = {
+    DeltaItem.REF_RAW: "raw",
+    DeltaItem.REF_XDELTA: "xdelta",
+    DeltaItem.REF_SELF: "self",
+    DeltaItem.REF_BASE_DISK: "base_disk",
+    DeltaItem.REF_BASE_MEM: "base_mem",
+    DeltaItem.REF_ZEROS: "zeros",
+    DeltaItem.REF_BSDIFF: "bsdiff",
+    DeltaItem.REF_SELF_HASH: "self_hash",
+    DeltaItem.REF_XOR: "xor",
+    DeltaItem.REF_BASE_SIMILAR: "base_similar",
+}
+
+
+def add_item_statistics(item_stats, delta_item, serialized_size):
+    # item_stats is {delta type name: {ref name: [count, bytes]}}, which is
+    # saved at the overlay meta without any conversion
+    type_name = _STAT_DELTA_TYPE_NAME.get(delta_item.delta_type, "unknown")
+    ref_name = _STAT_REF_NAME.get(delta_item.ref_id, "unknown")
+    ref_stats = item_stats.setdefault(type_name, dict())
+    counter = ref_stats.setdefault(ref_name, [0, 0])
+    counter[0] += 1
+    counter[1] += serialized_size
+
+
+def merge_item_statistics(item_stats, other_stats):
+    for type_name, ref_stats in other_stats.iteritems():
+        for ref_name, (count, size) in ref_stats.iteritems():
+            counter = item_stats.setdefault(type_name, dict()).setdefault(
+                ref_name, [0, 0])
+            counter[0] += count
+            counter[1] += size
+
+
+def get_overlay_statistics(item_stats, creation_mode,
+                           mem_discarded=0, disk_discarded=0):
+    """Return statistics section of the overlay meta.
+
+    It summarizes the delta items at overlay creation, so that the content
+    of an overlay can be inspected without decompressing its blobs.
+    """
+    return {
+        Const.META_OVERLAY_STAT_ITEMS: item_stats,
+        Const.META_OVERLAY_STAT_DISCARDED: {
+            "memory": long(mem_discarded),
+            "disk": long(disk_discarded)},
+        Const.META_OVERLAY_STAT_CREATION_MODE: creation_mode,
+    }
+
+
+def is_incompressible(delta_item):
+    '''Return True if the delta item looks like already compressed or
+    encrypted data, which gains nothing from LZMA but burns the most CPU
+    '''
+    data = delta_item.data
+    if not isinstance(data, str) or \
+            len(data) < Const.COMPRESSION_BYPASS_MIN_SIZE:
+        return False
+    # trial of zlib level 1 at the prefix runs at C speed, which is far
+    # cheaper than the LZMA it saves
+    sample = data[:Const.COMPRESSION_BYPASS_SAMPLE_SIZE]
+    comp_size = len(zlib.compress(sample, 1))
+    return comp_size >= len(sample)*Const.COMPRESSION_BYPASS_RATIO
+
+
+class _BlobFrame(object):
+    # chunks of a frame being built at a blob. comp_option is None for a
+    # stored frame
+    def __init__(self, comp_option):
+        self.comp_option = comp_option
+        self._reset()
+
+    def _reset(self):
+        if self.comp_option != None:
+            self.comp = LZMACompressor(options=self.comp_option)
+        else:
+            self.comp = None
+        self.comp_data = ''
+        self.raw_size = 0
+        self.memory_offset_list = list()
+        self.disk_offset_list = list()
+
+    def add(self, delta_item, delta_bytes):
+        if self.comp != None:
+            comp_delta_bytes = self.comp.compress(delta_bytes)
+        else:
+            comp_delta_bytes = delta_bytes
+        self.comp_data += comp_delta_bytes
+        self.raw_size += len(delta_bytes)
+        if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+                delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+            self.memory_offset_list.append(delta_item.offset)
+        elif delta_item.delta_type == DeltaItem.DELTA_DISK or\
+                delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
+            self.disk_offset_list.append(
+                (delta_item.offset, delta_item.offset_len))
+        else:
+            raise DeltaError("Delta should be either memory or disk")
+        return len(comp_delta_bytes)
+
+    def flush(self, comp_data, frame_list, frame_raw_start,
+              memory_offset_list, disk_offset_list):
+        # append the frame to the blob and start a new frame
+        frame_data = self.comp_data
+        if self.comp != None:
+            frame_data += self.comp.flush()
+            comp_type = Const.COMPRESSION_LZMA
+        else:
+            comp_type = Const.COMPRESSION_NONE
+        memory_offset_list.extend(self.memory_offset_list)
+        disk_offset_list.extend(self.disk_offset_list)
+        frame_list.append((len(comp_data), len(frame_data), frame_raw_start,
+                           len(disk_offset_list), len(memory_offset_list),
+                           comp_type))
+        self._reset()
+        return comp_data + frame_data
+
+
+def _get_straddle_groups(delta_list, chunk_size):
+    '''Return ({position of the first item: [other items]}, positions of the
+    other items) of disk items covering a part of the same fixed size
+    chunk. Those items are saved together, so that each chunk is listed at
+    a single segment and recovered entirely from it
+    '''
+    parent = dict()
+
+    def find(position):
+        while parent[position] != position:
+            parent[position] = parent[parent[position]]
+            position = parent[position]
+        return position
+
+    chunk_position = dict()
+    for position, delta_item in enumerate(delta_list):
+        if delta_item.ref_id == DeltaItem.REF_SELF or \
+                delta_item.is_chunk_aligned(chunk_size):
+            continue
+        if delta_item.delta_type != DeltaItem.DELTA_DISK and \
+                delta_item.delta_type != DeltaItem.DELTA_DISK_LIVE:
+            continue
+        parent[position] = position
+        for chunk in delta_item.get_chunks(chunk_size):
+            # first item of the group is the root
+            root = find(chunk_position.setdefault(chunk, position))
+            own_root = find(position)
+            if root != own_root:
+                parent[max(root, own_root)] = min(root, own_root)
+
+    group_dict = dict()
+    for position in sorted(parent.keys()):
+        root = find(position)
+        if root != position:
+            group_dict.setdefault(root, list()).append(delta_list[position])
+    member_set = set([position for position in parent.keys()
+                      if find(position) != position])
+    return group_dict, member_set
+
+
+def _save_blob(start_index, delta_list, self_ref_dict, blob_name, blob_size,
+               statistics=None, frame_size=None, straddle_groups=None):
     # mode = 2 indicates LZMA_SYNC_FLUSH, which show all output right after input
     comp_option = {'format':'xz', 'level':9}
-    comp = LZMACompressor(options=comp_option)
     disk_offset_list = list()
     memory_offset_list= list()
     comp_data = ''
@@ -1144,78 +1730,106 @@ def _save_blob(start_index, delta_list, self_ref_dict, blob_name, blob_size, sta
     index = start_index
     item_count = 0
 
+    # blob is a sequence of independent xz streams (frames) when frame_size
+    # is given. Incompressible chunks are grouped at stored frames as
+    # CompChildProc does, so that switching between them does not restart
+    # the xz stream. Each frame is (compressed offset, compressed size,
+    # uncompressed offset, end index of disk offsets, end index of memory
+    # offsets, compression type)
+    frame_list = list()
+    frame_raw_start = 0
+    comp_frame = _BlobFrame(comp_option)
+    stored_frame = _BlobFrame(None)
+
     memory_overlay_size = 0
     disk_overlay_size = 0
-    
+    item_stats = dict()
+    (group_dict, member_set) = straddle_groups or (dict(), set())
+
     while index < len(delta_list):
         delta_item = delta_list[index]
 
-        if delta_item.ref_id != DeltaItem.REF_SELF:
-            # Those deduped chunks will be put right after original data
-            # using deduped_list
-            delta_bytes = delta_item.get_serialized()
-            original_length += len(delta_bytes)
-            comp_delta_bytes = comp.compress(delta_bytes)
-            comp_data += comp_delta_bytes
-            item_count += 1
-            if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
-                    delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
-                memory_offset_list.append(delta_item.offset)
-                memory_overlay_size += len(comp_delta_bytes)
-            elif delta_item.delta_type == DeltaItem.DELTA_DISK or\
-                delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
-                disk_offset_list.append(delta_item.offset)
-                disk_overlay_size += len(comp_delta_bytes)
+        if delta_item.ref_id != DeltaItem.REF_SELF and \
+                index not in member_set:
+            if is_incompressible(delta_item):
+                frame = stored_frame
             else:
-                raise DeltaError("Delta should be either memory or disk")
-
-            # remove dependece getting required index by finding reference
-            deduped_list = self_ref_dict.get(delta_item.index, None)
-            if deduped_list != None:
-                #LOG.debug("moving %d deduped delta item" % (len(deduped_list)))
-                for deduped_item in deduped_list:
-                    deduped_bytes = deduped_item.get_serialized()
-                    original_length += len(deduped_bytes)
-                    comp_deduped_bytes = comp.compress(deduped_bytes)
-                    comp_data += comp_deduped_bytes
-                    item_count += 1
-                    if deduped_item.delta_type == DeltaItem.DELTA_MEMORY or\
-                            deduped_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
-                        memory_offset_list.append(deduped_item.offset)
-                        memory_overlay_size += len(comp_deduped_bytes)
-                    elif deduped_item.delta_type == DeltaItem.DELTA_DISK or\
-                        deduped_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
-                        disk_offset_list.append(deduped_item.offset)
-                        disk_overlay_size += len(comp_deduped_bytes)
-                    else:
-                        raise DeltaError("Delta should be either memory or disk")
-            
-        if len(comp_data) >= blob_size:
-            LOG.debug("savefile for %s(%ld delta item) %ld --> %ld" % \
-                    (blob_name, item_count, original_length, len(comp_data)))
-            comp_data += comp.flush()
-            blob_file = open(blob_name, "w+b")
-            blob_file.write(comp_data)
-            blob_file.close()
-            if statistics != None:
-                statistics['item_count'] = item_count
-            return index, memory_offset_list, disk_offset_list
+                frame = comp_frame
+
+            # Those deduped chunks will be put right after original data
+            # using deduped_list, so that they are always in the same frame.
+            # So are the other parts of the fixed size chunks it covers
+            item_list = list()
+            for group_item in [delta_item] + group_dict.get(index, list()):
+                item_list.append(group_item)
+                deduped_list = self_ref_dict.get(group_item.index, None)
+                if deduped_list != None:
+                    item_list += deduped_list
+            for item in item_list:
+                delta_bytes = item.get_serialized()
+                original_length += len(delta_bytes)
+                comp_size = frame.add(item, delta_bytes)
+                item_count += 1
+                add_item_statistics(item_stats, item, len(delta_bytes))
+                if item.delta_type == DeltaItem.DELTA_MEMORY or\
+                        item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+                    memory_overlay_size += comp_size
+                else:
+                    disk_overlay_size += comp_size
+
+            if frame_size != None and frame.raw_size >= frame_size:
+                frame_raw_size = frame.raw_size
+                comp_data = frame.flush(
+                    comp_data, frame_list, frame_raw_start,
+                    memory_offset_list, disk_offset_list)
+                frame_raw_start += frame_raw_size
+
+        if len(comp_data) + len(comp_frame.comp_data) + \
+                len(stored_frame.comp_data) >= blob_size:
+            break
         index += 1
 
-    comp_data += comp.flush()
-    if len(comp_data) > 0 :
-        blob_file = open(blob_name, "w+b")
-        blob_file.write(comp_data)
-        blob_file.close()
-        if statistics != None:
-            statistics['item_count'] = item_count
-        return index, memory_offset_list, disk_offset_list
-    else:
+    if comp_frame.raw_size > 0 or len(frame_list) == 0:
+        frame_raw_size = comp_frame.raw_size
+        comp_data = comp_frame.flush(
+            comp_data, frame_list, frame_raw_start, memory_offset_list,
+            disk_offset_list)
+        frame_raw_start += frame_raw_size
+    if stored_frame.raw_size > 0:
+        comp_data = stored_frame.flush(
+            comp_data, frame_list, frame_raw_start, memory_offset_list,
+            disk_offset_list)
+    if len(comp_data) == 0:
         raise DeltaError("LZMA compression is zero")
 
+    LOG.debug("savefile for %s(%ld delta item, %d frames) %ld --> %ld" % \
+            (blob_name, item_count, len(frame_list), original_length,
+             len(comp_data)))
+    blob_file = open(blob_name, "w+b")
+    blob_file.write(comp_data)
+    blob_file.close()
+    if statistics != None:
+        statistics['sha256'] = sha256(comp_data).hexdigest()
+        statistics['frame_sha256'] = [
+            sha256(comp_data[frame[0]:frame[0]+frame[1]]).hexdigest()
+            for frame in frame_list]
+        # leaves let a large segment be verified while it is received
+        leaf_size = Const.OVERLAY_MERKLE_LEAF_SIZE
+        statistics['leaf_size'] = leaf_size
+        statistics['leaves'] = get_leaf_digests(comp_data, leaf_size)
+        statistics['frame_leaves'] = [
+            get_leaf_digests(comp_data[frame[0]:frame[0]+frame[1]],
+                             leaf_size)
+            for frame in frame_list]
+        statistics['item_count'] = item_count
+        statistics['raw_size'] = original_length
+        statistics['items'] = item_stats
+    return index, memory_offset_list, disk_offset_list, frame_list
+
 
 def divide_blobs(delta_list, overlay_path, blob_size_kb, 
-        disk_chunk_size, memory_chunk_size):
+        disk_chunk_size, memory_chunk_size, frame_size_kb=None,
+        ret_statistics=None):
     # save delta list into multiple files with LZMA compression
     start_time = time.time()
 
@@ -1230,7 +1844,12 @@ def divide_blobs(delta_list, overlay_path, blob_size_kb,
                 self_ref_dict[ref_index] = list()
             self_ref_dict[ref_index].append(delta_item)
 
+    straddle_groups = _get_straddle_groups(delta_list, disk_chunk_size)
+
     blob_size = blob_size_kb*1024
+    frame_size = None
+    if frame_size_kb != None:
+        frame_size = frame_size_kb*1024
     blob_number = 1
     overlay_list = list()
     statistics = dict()
@@ -1239,23 +1858,66 @@ def divide_blobs(delta_list, overlay_path, blob_size_kb,
     blob_output_size = 0
     while index < len(delta_list):
         blob_name = "%s_%d.xz" % (overlay_path, blob_number)
-        end_index, memory_offsets, disk_offsets = \
-                _save_blob(index, delta_list, self_ref_dict, blob_name, blob_size, statistics)
+        end_index, memory_offsets, disk_offsets, frame_list = \
+                _save_blob(index, delta_list, self_ref_dict, blob_name,
+                           blob_size, statistics, frame_size,
+                           straddle_groups)
         index = (end_index+1)
         blob_number += 1
         if statistics.get('item_count', None) != None:
             comp_counter += statistics.get('item_count')
-
-        memory_chunks = [offset/memory_chunk_size for offset in memory_offsets]
-        disk_chunks = [offset/disk_chunk_size for offset in disk_offsets]
+        if ret_statistics != None:
+            merge_item_statistics(ret_statistics, statistics['items'])
+
+        memory_chunks = list()
+        disk_chunks = list()
+        frames = list()
+        memory_index = 0
+        disk_index = 0
+        has_stored_frame = False
+        for frame_index, (comp_offset, comp_size, raw_offset, disk_end,
+                          memory_end, comp_type) in enumerate(frame_list):
+            memory_chunks.extend([offset/memory_chunk_size for offset in
+                                  memory_offsets[memory_index:memory_end]])
+            # content-defined disk chunk can span several fixed size chunks
+            for (offset, offset_len) in disk_offsets[disk_index:disk_end]:
+                disk_chunks.extend(DeltaItem.get_chunk_range(
+                    offset, offset_len, disk_chunk_size))
+            frames.append({
+                Const.META_OVERLAY_FRAME_OFFSET: comp_offset,
+                Const.META_OVERLAY_FRAME_SIZE: comp_size,
+                Const.META_OVERLAY_FRAME_RAW_OFFSET: raw_offset,
+                Const.META_OVERLAY_FRAME_DISK_CHUNK_END: len(disk_chunks),
+                Const.META_OVERLAY_FRAME_MEMORY_CHUNK_END: len(memory_chunks),
+                Const.META_OVERLAY_FRAME_COMPRESSION: comp_type,
+                Const.META_OVERLAY_FRAME_SHA256:
+                    statistics['frame_sha256'][frame_index],
+            })
+            if len(statistics['frame_leaves'][frame_index]) > 1:
+                frames[-1][Const.META_OVERLAY_FRAME_LEAVES] = \
+                    statistics['frame_leaves'][frame_index]
+            if comp_type == Const.COMPRESSION_NONE:
+                has_stored_frame = True
+            memory_index = memory_end
+            disk_index = disk_end
         file_size = os.path.getsize(blob_name)
         blob_dict = {
             Const.META_OVERLAY_FILE_NAME:os.path.basename(blob_name),
             Const.META_OVERLAY_FILE_COMPRESSION: Const.COMPRESSION_LZMA,
             Const.META_OVERLAY_FILE_SIZE:file_size,
+            Const.META_OVERLAY_FILE_RAW_SIZE: statistics['raw_size'],
+            Const.META_OVERLAY_FILE_SHA256: statistics['sha256'],
             Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
             Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks
         }
+        # stored frames are only found with the frame index
+        if frame_size != None or has_stored_frame:
+            blob_dict[Const.META_OVERLAY_FILE_FRAMES] = frames
+        elif len(statistics['leaves']) > 1:
+            blob_dict[Const.META_OVERLAY_FILE_LEAVES] = statistics['leaves']
+        blob_dict[Const.META_OVERLAY_FILE_LEAF_SIZE] = statistics['leaf_size']
+        blob_dict[Const.META_OVERLAY_FILE_MERKLE_ROOT] = \
+            get_blob_merkle_root(blob_dict)
         overlay_list.append(blob_dict)
         blob_output_size += file_size
     end_time = time.time()
@@ -1265,6 +1927,212 @@ def divide_blobs(delta_list, overlay_path, blob_size_kb,
     return overlay_list
 
 
+def get_segment_name(blob_name, frame_index):
+    return "%s#%d" % (blob_name, frame_index)
+
+
+def get_overlay_segments(blob_info_list):
+    '''Return (segment name, blob name, offset, size) of each overlay piece
+    that can be fetched and decompressed independently. A blob without
+    frame index is a single segment named after the blob
+    '''
+    segments = list()
+    for blob_info in blob_info_list:
+        blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+        frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+        if not frames:
+            segments.append((blob_name, blob_name, 0,
+                             blob_info[Const.META_OVERLAY_FILE_SIZE]))
+            continue
+        for frame_index, frame in enumerate(frames):
+            segments.append((get_segment_name(blob_name, frame_index),
+                             blob_name,
+                             frame[Const.META_OVERLAY_FRAME_OFFSET],
+                             frame[Const.META_OVERLAY_FRAME_SIZE]))
+    return segments
+
+
+def merkle_root(digest_list):
+    '''Return the root of the Merkle tree over the hex digests. A node is
+    sha256 of its two children, and the last node of an odd level is
+    promoted to the upper level
+    '''
+    if len(digest_list) == 0:
+        return None
+    level = [digest.decode("hex") for digest in digest_list]
+    while len(level) > 1:
+        upper_level = [sha256(level[index] + level[index+1]).digest()
+                       for index in xrange(0, len(level)-1, 2)]
+        if len(level) % 2 == 1:
+            upper_level.append(level[-1])
+        level = upper_level
+    return level[0].encode("hex")
+
+
+def get_leaf_digests(data, leaf_size):
+    '''Return sha256 hex digests of the leaves of the segment data, which
+    is cut at every leaf_size bytes
+    '''
+    return [sha256(data[offset:offset+leaf_size]).hexdigest()
+            for offset in xrange(0, max(len(data), 1), leaf_size)]
+
+
+def get_segment_digest(data, leaf_size=None):
+    '''Return the digest of the segment data to compare with the one at
+    get_segment_digests, which is the Merkle root over its leaves
+    '''
+    if leaf_size is None:
+        return sha256(data).hexdigest()
+    return merkle_root(get_leaf_digests(data, leaf_size))
+
+
+def get_segment_leaves(blob_info_list):
+    '''Return dictionary from segment name to (leaf size, leaf digests) of
+    the segment larger than a leaf
+    '''
+    leaf_dict = dict()
+    for blob_info in blob_info_list:
+        blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+        leaf_size = blob_info.get(Const.META_OVERLAY_FILE_LEAF_SIZE, None)
+        if leaf_size is None:
+            continue
+        frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+        if not frames:
+            leaves = blob_info.get(Const.META_OVERLAY_FILE_LEAVES, None)
+            if leaves:
+                leaf_dict[blob_name] = (leaf_size, leaves)
+            continue
+        for frame_index, frame in enumerate(frames):
+            leaves = frame.get(Const.META_OVERLAY_FRAME_LEAVES, None)
+            if leaves:
+                leaf_dict[get_segment_name(blob_name, frame_index)] = \
+                    (leaf_size, leaves)
+    return leaf_dict
+
+
+def get_segment_digests(blob_info_list):
+    '''Return dictionary from segment name to its sha256 hex digest, or
+    the Merkle root over its leaves for the segment larger than a leaf.
+    Segment of the old overlay without digest is not in the dictionary
+    '''
+    digest_dict = dict()
+    for blob_info in blob_info_list:
+        blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+        frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+        if not frames:
+            digest = blob_info.get(Const.META_OVERLAY_FILE_SHA256, None)
+            if digest is not None:
+                digest_dict[blob_name] = digest
+            continue
+        for frame_index, frame in enumerate(frames):
+            digest = frame.get(Const.META_OVERLAY_FRAME_SHA256, None)
+            if digest is not None:
+                digest_dict[get_segment_name(blob_name, frame_index)] = digest
+    for (segment_name, (leaf_size, leaves)) in \
+            get_segment_leaves(blob_info_list).iteritems():
+        digest_dict[segment_name] = merkle_root(leaves)
+    return digest_dict
+
+
+def get_blob_merkle_root(blob_info):
+    '''Return the Merkle root over the segments of the blob, or None if
+    any segment does not have its digest
+    '''
+    digest_dict = get_segment_digests([blob_info])
+    segments = get_overlay_segments([blob_info])
+    if len(digest_dict) != len(segments):
+        return None
+    return merkle_root([digest_dict[segment[0]] for segment in segments])
+
+
+def get_overlay_merkle_root(blob_info_list):
+    '''Return the Merkle root of the overlay, whose leaves are the roots of
+    its blobs
+    '''
+    root_list = [get_blob_merkle_root(blob_info)
+                 for blob_info in blob_info_list]
+    if None in root_list:
+        return None
+    return merkle_root(root_list)
+
+
+def check_overlay_merkle(meta_info):
+    '''Check that the segment digests at the meta chain up to the Merkle
+    root of the overlay, so that a segment verified with its own digest
+    is a part of the overlay. Return False for the old overlay without the
+    Merkle root
+    '''
+    overlay_root = meta_info.get(Const.META_OVERLAY_MERKLE_ROOT, None)
+    if overlay_root is None:
+        return False
+    blob_info_list = meta_info[Const.META_OVERLAY_FILES]
+    for blob_info in blob_info_list:
+        # root of each blob is optional since the overlay root covers it
+        blob_root = blob_info.get(Const.META_OVERLAY_FILE_MERKLE_ROOT, None)
+        if blob_root is not None and \
+                blob_root != get_blob_merkle_root(blob_info):
+            msg = "Merkle root mismatch at overlay blob: %s" % \
+                blob_info[Const.META_OVERLAY_FILE_NAME]
+            raise DeltaError(msg)
+    if overlay_root != get_overlay_merkle_root(blob_info_list):
+        raise DeltaError("Merkle root mismatch at overlay meta")
+    return True
+
+
+def get_segment_compression(blob_info_list):
+    '''Return dictionary from segment name to its compression type. Frame
+    without compression type follows the compression of the blob
+    '''
+    compression_dict = dict()
+    for blob_info in blob_info_list:
+        blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+        blob_comp_type = blob_info.get(Const.META_OVERLAY_FILE_COMPRESSION,
+                                       Const.COMPRESSION_LZMA)
+        frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+        if not frames:
+            compression_dict[blob_name] = blob_comp_type
+            continue
+        for frame_index, frame in enumerate(frames):
+            compression_dict[get_segment_name(blob_name, frame_index)] = \
+                frame.get(Const.META_OVERLAY_FRAME_COMPRESSION, blob_comp_type)
+    return compression_dict
+
+
+def get_chunk_segment_dict(blob_info_list):
+    '''Return dictionaries from disk chunk and memory chunk number to the
+    list of segments having the chunk
+    '''
+    disk_chunk_dict = dict()
+    memory_chunk_dict = dict()
+    for blob_info in blob_info_list:
+        blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+        disk_chunks = blob_info[Const.META_OVERLAY_FILE_DISK_CHUNKS]
+        memory_chunks = blob_info[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
+        frames = blob_info.get(Const.META_OVERLAY_FILE_FRAMES, None)
+        if not frames:
+            segment_list = [(blob_name, len(disk_chunks), len(memory_chunks))]
+        else:
+            segment_list = [
+                (get_segment_name(blob_name, frame_index),
+                 frame[Const.META_OVERLAY_FRAME_DISK_CHUNK_END],
+                 frame[Const.META_OVERLAY_FRAME_MEMORY_CHUNK_END])
+                for frame_index, frame in enumerate(frames)]
+
+        disk_start = 0
+        memory_start = 0
+        for (segment_name, disk_end, memory_end) in segment_list:
+            for (chunk_dict, chunks) in \
+                    ((disk_chunk_dict, disk_chunks[disk_start:disk_end]),
+                     (memory_chunk_dict, memory_chunks[memory_start:memory_end])):
+                for chunk in chunks:
+                    segment_names = chunk_dict.setdefault(chunk, list())
+                    if segment_name not in segment_names:
+                        segment_names.append(segment_name)
+            disk_start = disk_end
+            memory_start = memory_end
+    return disk_chunk_dict, memory_chunk_dict
+
+
 def discard_free_chunks(merged_modified_list, chunk_size, disk_discard, memory_discard):
     removing_item = list()
     if disk_discard == None:
@@ -1387,7 +2255,8 @@ def residue_merge_deltalist(old_deltalist, new_deltalist):
     return ret_deltalist
 
 
-def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
+def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem,
+                            hash_type=Const.CHUNK_HASH_DEFAULT):
     '''return new_detlalist = deltalist1 - deltalist2
 
     At this point, all delta items should be either 1) RAW of 2) XDELTA.
@@ -1400,9 +2269,15 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
             overlay.
     '''
 
-    old_deltadict = dict()
-    for item in old_deltalist:
-        old_deltadict[item.index] = item
+    if isinstance(old_deltalist, IndexedDeltaList):
+        # look up by index without loading every item of the old overlay
+        old_deltadict = old_deltalist
+        old_header_list = old_deltalist.iter_headers()
+    else:
+        old_deltadict = dict()
+        for item in old_deltalist:
+            old_deltadict[item.index] = item
+        old_header_list = old_deltalist
     new_deltadict = dict()
     for item in new_deltalist:
         new_deltadict[item.index] = item
@@ -1433,7 +2308,7 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
 
     # exists at previous overlay, but not in current overlay
     # --> chunks that are converted to original
-    for item in old_deltalist:
+    for item in old_header_list:
         if item.delta_type == DeltaItem.DELTA_DISK or\
                 item.delta_type == DeltaItem.DELTA_DISK_LIVE:
             continue
@@ -1448,7 +2323,7 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
             base_mem_fd = open(base_mem, "r")
             base_mem_fd.seek(item.offset)
             base_mem_data = base_mem_fd.read(Const.CHUNK_SIZE)
-            base_mem_hash = sha256(base_mem_data).digest()
+            base_mem_hash = tool.chunk_hash(base_mem_data, hash_type)
             data_len = len(base_mem_data)
             if len(base_mem_data) == Const.CHUNK_SIZE:
                 msg = "Error, This is not possible.\n\
@@ -1472,3 +2347,199 @@ def residue_diff_deltalists(old_deltalist, new_deltalist, base_mem):
     LOG.debug("  reverted back         : %d" % (statics_reverted))
 
     return ret_deltalist
+
+
+class ChainedResidueFilter(object):
+    """Leave only the delta items that differ from the previous residue.
+
+    residue_hashdict is {delta item index: (hash value, length)} of the VM
+    state that the destination can recover from the chain of previous
+    residues. Memory pages of the chain that are not in the new snapshot
+    are reverted to the base VM.
+    """
+
+    def __init__(self, residue_hashdict):
+        self.residue_hashdict = residue_hashdict
+        # hash value of each chunk at the destination after this residue
+        self.sent_hashdict = dict()
+        for index, (hash_value, length) in residue_hashdict.iteritems():
+            self.sent_hashdict[index] = hash_value
+        self.seen_memory_set = set()
+        self.filtered_count = 0
+
+    def filter_deltalist(self, deltaitem_list):
+        ret_deltalist = list()
+        for delta_item in deltaitem_list:
+            if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+                    delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+                self.seen_memory_set.add(delta_item.index)
+            if self.sent_hashdict.get(delta_item.index, None) ==\
+                    delta_item.hash_value:
+                self.filtered_count += 1
+                continue
+            self.sent_hashdict[delta_item.index] = delta_item.hash_value
+            ret_deltalist.append(delta_item)
+        return ret_deltalist
+
+    def get_reverted_deltalist(self):
+        # memory pages identical to the base VM do not make delta item
+        ret_deltalist = list()
+        for index, (hash_value, length) in self.residue_hashdict.iteritems():
+            # see DeltaItem.get_index
+            if (index & 0x01) != DeltaItem.DELTA_MEMORY:
+                continue
+            if index in self.seen_memory_set:
+                continue
+            offset = index >> 1
+            ret_deltalist.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, offset, length, hash_value=None,
+                ref_id=DeltaItem.REF_BASE_MEM, data_len=8, data=offset))
+        return ret_deltalist
+
+
+def save_residue_hashlist(hashlist_path, overlay_id, hash_dict,
+                          hash_type=Const.CHUNK_HASH_DEFAULT):
+    # hash_dict: {delta item index: (hash value, length)}
+    hashlist = {
+        Const.META_OVERLAY_ID: overlay_id,
+        Const.META_CHUNK_HASH: hash_type,
+        "chunks": hash_dict,
+    }
+    with open(hashlist_path, "wb") as fd:
+        fd.write(msgpack.packb(hashlist))
+
+
+def load_residue_hashlist(hashlist_path, hash_type=Const.CHUNK_HASH_DEFAULT):
+    with open(hashlist_path, "rb") as fd:
+        hashlist = msgpack.unpackb(fd.read())
+    list_hash_type = hashlist.get(Const.META_CHUNK_HASH,
+                                  Const.CHUNK_HASH_SHA256)
+    if list_hash_type != hash_type:
+        msg = "Hash list of the previous residue uses %s chunk hash, not %s" %\
+            (list_hash_type, hash_type)
+        raise DeltaError(msg)
+    hash_dict = dict()
+    for index, (hash_value, length) in hashlist["chunks"].iteritems():
+        hash_dict[long(index)] = (hash_value, length)
+    return hashlist[Const.META_OVERLAY_ID], hash_dict
+
+
+class PostCopyScheduler(object):
+    """Order delta items for the post-copy handoff.
+
+    Disk chunks and memory pages in the working set are sent before the VM
+    resumes at the destination. Other memory pages are held back until the
+    VM state is final, and then pushed in the background with the pages
+    demanded by the destination first.
+    """
+    # number of item lists waiting at the next stage before pushing more
+    PUSH_BACKLOG = 4
+    PUSH_SIZE = 256
+
+    def __init__(self, working_set):
+        # working_set: delta item indexes of the memory pages
+        self.working_set = set(working_set)
+        # {delta item index: [live seq, offset, length, number of items]} of
+        # the latest items. Destination waits for them after resuming the VM
+        self.resume_chunks = dict()
+        # every version of a page is held since a later item can refer any
+        # of them by its hash value. Items are spilled to a temporary file,
+        # and {delta item index: [(file offset, size, hash value)]} is kept
+        self.deferred_dict = dict()
+        self.deferred_hashdict = dict()
+        self.deferred_file = None
+        self.push_order = None
+
+    def _spill(self, delta_item):
+        if self.deferred_file is None:
+            self.deferred_file = tempfile.TemporaryFile(
+                prefix="cloudlet-postcopy-")
+        data = delta_item.get_serialized()
+        self.deferred_file.seek(0, os.SEEK_END)
+        position = (self.deferred_file.tell(), len(data),
+                    delta_item.hash_value)
+        self.deferred_file.write(data)
+        self.deferred_dict.setdefault(delta_item.index, list()).append(
+            position)
+
+    def _load(self, position):
+        (file_offset, size, hash_value) = position
+        self.deferred_file.seek(file_offset)
+        delta_item = DeltaItem.unpack_stream(
+            StringIO(self.deferred_file.read(size)))
+        delta_item.hash_value = hash_value
+        return delta_item
+
+    def _record(self, delta_item):
+        live_seq = delta_item.live_seq or 0
+        chunk_info = self.resume_chunks.get(delta_item.index, None)
+        if chunk_info is None or chunk_info[0] < live_seq:
+            self.resume_chunks[delta_item.index] = \
+                [live_seq, delta_item.offset, delta_item.offset_len, 1]
+        elif chunk_info[0] == live_seq:
+            chunk_info[3] += 1
+
+    def _is_deferred(self, delta_item):
+        if delta_item.delta_type != DeltaItem.DELTA_MEMORY and\
+                delta_item.delta_type != DeltaItem.DELTA_MEMORY_LIVE:
+            return False
+        return delta_item.index not in self.working_set
+
+    def _pop_reference(self, delta_item):
+        # deferred item that should be sent before the given item
+        ref_index = None
+        if delta_item.ref_id == DeltaItem.REF_SELF:
+            ref_index = delta_item.data
+        elif delta_item.ref_id == DeltaItem.REF_SELF_HASH:
+            ref_index = self.deferred_hashdict.get(delta_item.data, None)
+        if ref_index is None:
+            return list()
+        return self.pop_deferred(ref_index)
+
+    def pop_deferred(self, index):
+        position_list = self.deferred_dict.pop(index, None)
+        if position_list is None:
+            return list()
+        deltaitem_list = [self._load(position) for position in position_list]
+        ret_deltalist = list()
+        for delta_item in deltaitem_list:
+            if self.deferred_hashdict.get(delta_item.hash_value) == index:
+                del self.deferred_hashdict[delta_item.hash_value]
+        for delta_item in deltaitem_list:
+            ret_deltalist += self._pop_reference(delta_item)
+            ret_deltalist.append(delta_item)
+        return ret_deltalist
+
+    def schedule_deltalist(self, deltaitem_list):
+        # return items to send now
+        ret_deltalist = list()
+        for delta_item in deltaitem_list:
+            self._record(delta_item)
+            if self._is_deferred(delta_item):
+                self._spill(delta_item)
+                if delta_item.hash_value:
+                    self.deferred_hashdict[delta_item.hash_value] = \
+                        delta_item.index
+                continue
+            ret_deltalist += self._pop_reference(delta_item)
+            ret_deltalist.append(delta_item)
+        return ret_deltalist
+
+    def has_deferred(self):
+        return len(self.deferred_dict) > 0
+
+    def pop_deferred_deltalist(self, demanded_list, count):
+        # demanded pages first, and then in the order of the offset
+        ret_deltalist = list()
+        for index in demanded_list:
+            ret_deltalist += self.pop_deferred(index)
+        if self.push_order is None:
+            self.push_order = sorted(self.deferred_dict.keys(), reverse=True)
+        while len(ret_deltalist) < count and len(self.push_order) > 0:
+            ret_deltalist += self.pop_deferred(self.push_order.pop())
+        return ret_deltalist
+
+    def close(self):
+        if self.deferred_file is not None:
+            self.deferred_file.close()
+            self.deferred_file = None
@@ -28,6 +28,8 @@ import multiprocessing
 import select
 import Queue
 import traceback
+import bisect
+import heapq
 from math import ceil
 from hashlib import sha256
 from operator import itemgetter
@@ -38,6 +40,8 @@ from . import process_manager
 from .delta import DeltaItem
 from .delta import DeltaList
 from .delta import Recovered_delta
+from .similarity import SimilarityIndex
+from . import similarity
 from .progressbar import AnimatedProgressBar
 from .configuration import Const
 from .configuration import VMOverlayCreationMode
@@ -51,7 +55,8 @@ class DiskError(Exception):
     pass
 
 
-def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
+def hashing(disk_path, meta_path, chunk_size=4096, window_size=512,
+            hash_type=Const.CHUNK_HASH_DEFAULT):
 
     prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
     total_iteration = os.path.getsize(disk_path)/window_size
@@ -76,9 +81,9 @@ def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
             prog_bar.show_progress()
         iter_count += 1
 
-        hashed_data = sha256(data).digest()
+        hashed_data = tool.chunk_hash(data, hash_type)
         if hash_dic.get(hashed_data) is None:
-            hash_dic[hashed_data] = (hashed_data, s_offset, data_len)
+            hash_dic[hashed_data] = (s_offset, data_len)
 
         added_data = disk_file.read(window_size)
         if (not added_data) or len(added_data) != window_size:
@@ -87,15 +92,289 @@ def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
         data = data[window_size:] + added_data
         entire_hashing.update(added_data)
 
-    for hashed_data, s_offset, data_len in list(hash_dic.values()):
+    _write_hash_meta(out_file, hash_dic, hash_type)
+    disk_file.close()
+    out_file.close()
+
+    return entire_hashing.hexdigest()
+
+
+def _write_hash_meta(out_file, hash_dic, hash_type):
+    # sort by offset to have the same meta file for the same disk
+    hash_items = sorted(hash_dic.iteritems(), key=lambda item: item[1][0])
+    out_file.write(tool.get_hash_meta_header(hash_type))
+    for hashed_data, (s_offset, data_len) in hash_items:
         out_file.write(struct.pack("!QI%ds" % len(hashed_data),
                                    s_offset, data_len, hashed_data))
+
+
+def incremental_hashing(disk_path, meta_path, base_disk_path, base_meta_path,
+                        modified_chunks, chunk_size=4096, window_size=512,
+                        read_size=1024*1024*16, prefix_size=64,
+                        hash_type=Const.CHUNK_HASH_DEFAULT):
+    """Hash disk that is derived from the base disk by changing
+    modified_chunks, reusing hash meta of the base disk.
+    Only sliding windows overlapping modified chunks are hashed. A hash
+    whose first window at the base disk is modified is looked up again
+    from that window while reading the disk for the hash value, comparing
+    the first prefix_size bytes before hashing the window.
+    Returns the same hash value and meta file as hashing().
+    hash_type is the chunk hash of the base meta, which the meta keeps.
+    """
+    if chunk_size % window_size != 0:
+        raise DiskError("chunk size should be multiple of window size")
+    disk_size = os.path.getsize(disk_path)
+    base_size = os.path.getsize(base_disk_path)
+    if disk_size < chunk_size:
+        raise DiskError("invalid raw disk size")
+    last_window = (disk_size-chunk_size)/window_size*window_size
+    hash_end = last_window + chunk_size
+
+    # windows overlapping changed chunks
+    changed_chunks = set(modified_chunks)
+    if disk_size != base_size:
+        changed_chunks.update(xrange(min(disk_size, base_size)/chunk_size,
+                                     (disk_size+chunk_size-1)/chunk_size))
+    modified_windows = set()
+    for chunk in changed_chunks:
+        start_window = max(0, (chunk-1)*chunk_size + window_size)
+        end_window = min(last_window, (chunk+1)*chunk_size - window_size)
+        modified_windows.update(xrange(start_window, end_window+1,
+                                       window_size))
+
+    hash_dic = dict()
+    lost_dic = dict()
+    for (s_offset, data_len, hashed_data) in base_hashlist(base_meta_path,
+                                                           hash_type):
+        if s_offset in modified_windows or s_offset > last_window:
+            lost_dic[hashed_data] = s_offset
+        else:
+            hash_dic[hashed_data] = (s_offset, data_len)
+
+    # hash modified windows reading each contiguous run at once
+    disk_file = open(disk_path, "rb")
+    max_run_windows = read_size/window_size
+    window_runs = get_chunk_runs(
+        [s_offset/window_size for s_offset in modified_windows],
+        max_count=max_run_windows)
+    for (start, count) in window_runs:
+        run_offset = start*window_size
+        disk_file.seek(run_offset)
+        data = disk_file.read((count-1)*window_size + chunk_size)
+        for index in xrange(count):
+            hashed_data = tool.chunk_hash(
+                data[index*window_size:index*window_size+chunk_size],
+                hash_type)
+            s_offset = run_offset + index*window_size
+            prev_item = hash_dic.get(hashed_data)
+            if prev_item is None or prev_item[0] > s_offset:
+                hash_dic[hashed_data] = (s_offset, chunk_size)
+
+    # lost hash can be at any unmodified window after its base window, but
+    # not after the modified window that already has it
+    pending_dic = dict()
+    prefix_dic = dict()
+    prefix_of = dict()
+    base_file = open(base_disk_path, "rb")
+    for hashed_data, s_offset in lost_dic.iteritems():
+        found_item = hash_dic.get(hashed_data)
+        if found_item is not None and found_item[0] <= s_offset:
+            continue
+        pending_dic[hashed_data] = found_item[0] if found_item else hash_end
+        base_file.seek(s_offset)
+        prefix = base_file.read(prefix_size)
+        prefix_dic.setdefault(prefix, set()).add(hashed_data)
+        prefix_of[hashed_data] = prefix
+    base_file.close()
+    if len(pending_dic) > 0:
+        scan_offset = min([lost_dic[item] for item in pending_dic])
+    else:
+        scan_offset = hash_end
+    LOG.debug("rehash %d windows, look up %d hashes again from %ld" %
+              (len(modified_windows), len(pending_dic), scan_offset))
+
+    entire_hashing = sha256()
+    disk_file.seek(0)
+    read_offset = 0
+    data = ''
+    data_offset = 0
+    while read_offset < hash_end:
+        added_data = disk_file.read(min(read_size, hash_end-read_offset))
+        if not added_data:
+            raise DiskError("invalid raw disk size")
+        entire_hashing.update(added_data)
+        read_offset += len(added_data)
+        if len(pending_dic) == 0:
+            continue
+
+        data += added_data
+        if scan_offset > data_offset:
+            skip_size = min(scan_offset-data_offset, len(data))
+            data = data[skip_size:]
+            data_offset += skip_size
+        while scan_offset + chunk_size <= read_offset and \
+                len(pending_dic) > 0:
+            start = scan_offset - data_offset
+            hash_set = prefix_dic.get(data[start:start+prefix_size])
+            if hash_set:
+                hashed_data = tool.chunk_hash(data[start:start+chunk_size],
+                                              hash_type)
+                if hashed_data in hash_set:
+                    prev_item = hash_dic.get(hashed_data)
+                    if prev_item is None or prev_item[0] > scan_offset:
+                        hash_dic[hashed_data] = (scan_offset, chunk_size)
+                    hash_set.remove(hashed_data)
+                    del pending_dic[hashed_data]
+            scan_offset += window_size
+
+        # modified window before scan_offset already has the first one
+        for hashed_data, end_offset in pending_dic.items():
+            if end_offset < scan_offset:
+                prefix_dic[prefix_of[hashed_data]].remove(hashed_data)
+                del pending_dic[hashed_data]
     disk_file.close()
-    out_file.close()
 
+    out_file = open(meta_path, "w+b")
+    _write_hash_meta(out_file, hash_dic, hash_type)
+    out_file.close()
     return entire_hashing.hexdigest()
 
 
+# random table for gear rolling hash of content-defined chunking
+CDC_GEAR_TABLE = [struct.unpack("!Q", sha256(str(i)).digest()[:8])[0]
+                  for i in xrange(256)]
+CDC_WINDOW_SIZE = 64
+
+
+def cdc_cutpoints(data,
+                  min_size=Const.CDC_MIN_CHUNK_SIZE,
+                  avg_bits=Const.CDC_AVG_CHUNK_BITS,
+                  max_size=Const.CDC_MAX_CHUNK_SIZE):
+    """Get end offsets of content-defined chunks of data
+    Boundary depends only on the last CDC_WINDOW_SIZE bytes, so the same
+    content is chunked at the same boundaries regardless of its offset.
+    The last chunk always ends at the end of data.
+    """
+    # hash runs over every byte of the modified disk, so it is done at
+    # the native helper
+    return tool.cython_cdc_cutpoints(data, CDC_GEAR_TABLE, min_size,
+                                     avg_bits, max_size, CDC_WINDOW_SIZE)
+
+
+def cdc_hashing(disk_path, meta_path, read_size=1024*1024*16,
+                hash_type=Const.CHUNK_HASH_DEFAULT):
+    """Hash content-defined chunks of the base disk
+    Meta file has the same (offset, length, hash) record as disk hashing,
+    so it can be loaded with DeltaDedup.disk_import_hashdict
+    """
+    disk_file = open(disk_path, "rb")
+    out_file = open(meta_path, "w+b")
+    hash_dic = dict()
+    data = ''
+    data_offset = 0
+    while True:
+        added_data = disk_file.read(read_size)
+        data += added_data
+        cut_list = cdc_cutpoints(data)
+        if added_data:
+            # last chunk can be continued at the next read
+            cut_list = cut_list[:-1]
+        start = 0
+        for cut in cut_list:
+            hashed_data = tool.chunk_hash(data[start:cut], hash_type)
+            if hash_dic.get(hashed_data) is None:
+                hash_dic[hashed_data] = (data_offset+start, cut-start)
+            start = cut
+        data = data[start:]
+        data_offset += start
+        if not added_data:
+            break
+
+    out_file.write(tool.get_hash_meta_header(hash_type))
+    for hashed_data, (s_offset, data_len) in hash_dic.iteritems():
+        out_file.write(struct.pack("!QI%ds" % len(hashed_data),
+                                   s_offset, data_len, hashed_data))
+    disk_file.close()
+    out_file.close()
+    return len(hash_dic)
+
+
+def get_chunk_runs(chunk_list, max_count=4096):
+    """Merge chunk numbers into (start chunk, # of chunks) of contiguous runs
+    """
+    run_list = list()
+    for chunk in sorted(set(chunk_list)):
+        if len(run_list) > 0 and run_list[-1][1] < max_count and\
+                run_list[-1][0] + run_list[-1][1] == chunk:
+            run_list[-1][1] += 1
+        else:
+            run_list.append([chunk, 1])
+    return [(start, count) for (start, count) in run_list]
+
+
+def get_adjacent_runs(chunk_list, max_count=4096):
+    """Merge adjacent chunk numbers into (start chunk, # of chunks) keeping
+    the order of chunk_list, so that the chunks of the runs are the same as
+    chunk_list
+    """
+    run_list = list()
+    for chunk in chunk_list:
+        if len(run_list) > 0 and run_list[-1][1] < max_count and\
+                run_list[-1][0] + run_list[-1][1] == chunk:
+            run_list[-1][1] += 1
+        else:
+            run_list.append([chunk, 1])
+    return [(start, count) for (start, count) in run_list]
+
+
+def read_modified_chunks(modified_fd, chunk_list, chunk_size,
+                         cdc_hashdict=None,
+                         hash_type=Const.CHUNK_HASH_DEFAULT):
+    """Read modified disk and return (offset, data, hash, base_offset) list
+    Without cdc_hashdict, each chunk is returned as it is and base_offset is
+    always None. With cdc_hashdict, contiguous modified chunks are
+    re-chunked at content-defined boundaries and base_offset is the
+    offset of the same chunk at the base disk if there is.
+    """
+    chunk_data_list = list()
+    if cdc_hashdict is None:
+        # read adjacent chunks with a single read, since a read per chunk
+        # is a round trip to the kernel (and to FUSE for the resumed disk)
+        for (start_chunk, chunk_count) in get_adjacent_runs(chunk_list):
+            run_offset = start_chunk * chunk_size
+            modified_fd.seek(run_offset)
+            run_data = modified_fd.read(chunk_count * chunk_size)
+            for start in xrange(0, chunk_count * chunk_size, chunk_size):
+                data = run_data[start:start+chunk_size]
+                chunk_data_list.append(
+                    (run_offset+start, data,
+                     tool.chunk_hash(data, hash_type), None))
+        return chunk_data_list
+
+    for (start_chunk, chunk_count) in get_chunk_runs(chunk_list):
+        run_offset = start_chunk * chunk_size
+        modified_fd.seek(run_offset)
+        run_data = modified_fd.read(chunk_count * chunk_size)
+        start = 0
+        for cut in cdc_cutpoints(run_data):
+            data = run_data[start:cut]
+            hash_value = tool.chunk_hash(data, hash_type)
+            chunk_data_list.append(
+                (run_offset+start, data, hash_value,
+                 cdc_hashdict.get(hash_value, None)))
+            start = cut
+    return chunk_data_list
+
+
+def load_cdc_hashdict(basedisk_path, hash_type=Const.CHUNK_HASH_DEFAULT):
+    cdc_meta = Const.get_base_cdcpath(basedisk_path)
+    if not os.path.exists(cdc_meta):
+        LOG.warning("No CDC meta for %s, use fixed size chunking" %
+                    basedisk_path)
+        return None
+    return delta.DeltaDedup.disk_import_hashdict(cdc_meta, hash_type)
+
+
 def _pack_hashlist(hash_list):
     # pack hash list
     original_length = len(hash_list)
@@ -106,18 +385,78 @@ def _pack_hashlist(hash_list):
          1.0 * len(hash_list) / original_length))
 
 
+class DiscardIndex(object):
+    """TRIM discarded chunk ranges indexed with sorted disjoint ranges.
+
+    Ranges are added in the order of the QEMU log, and the later range
+    overrides the discard time of the earlier one. The result is the same
+    as updating a dictionary of every chunk number in the log order, but
+    it keeps only the ranges and finds a chunk with binary search.
+    """
+
+    def __init__(self, range_list=None):
+        self.start_list = list()
+        self.end_list = list()
+        self.time_list = list()
+        self.chunk_count = 0
+        if range_list:
+            self._build(range_list)
+
+    def _build(self, range_list):
+        # (start, end, sequence in the log, time) of each valid range
+        range_list = sorted([
+            (start, end, seq, event_time)
+            for seq, (start, end, event_time) in enumerate(range_list)
+            if start < end])
+        positions = sorted(set(
+            [item[0] for item in range_list] +
+            [item[1] for item in range_list]))
+        active_heap = list()
+        range_index = 0
+        for index, position in enumerate(positions[:-1]):
+            while range_index < len(range_list) and\
+                    range_list[range_index][0] == position:
+                (start, end, seq, event_time) = range_list[range_index]
+                heapq.heappush(active_heap, (-seq, end, event_time))
+                range_index += 1
+            # the latest range in the log covering the position is on top
+            while len(active_heap) > 0 and active_heap[0][1] <= position:
+                heapq.heappop(active_heap)
+            if len(active_heap) == 0:
+                continue
+            next_position = positions[index+1]
+            event_time = active_heap[0][2]
+            if len(self.end_list) > 0 and self.end_list[-1] == position and\
+                    self.time_list[-1] == event_time:
+                self.end_list[-1] = next_position
+            else:
+                self.start_list.append(position)
+                self.end_list.append(next_position)
+                self.time_list.append(event_time)
+            self.chunk_count += (next_position - position)
+
+    def get(self, chunk, default=None):
+        index = bisect.bisect_right(self.start_list, chunk) - 1
+        if index >= 0 and chunk < self.end_list[index]:
+            return self.time_list[index]
+        return default
+
+    def __len__(self):
+        return self.chunk_count
+
+
 def parse_qemu_log(qemu_logfile, chunk_size):
     """Get TRIM result
-    Element of dictionary has (chunk_%:discarded_time) format
+    DiscardIndex gives discarded_time of a chunk
     Note that DMA Memory Address should be sift 4096*2 bytes because
     of libvirt(4096) and KVM(4096) header offset
-    :return dma_dict, discard_dict
+    :return dma_dict, discard_index
     """
     MEM_SIFT_OFFSET = 4096+4096
     if (qemu_logfile is None) or (not os.path.exists(qemu_logfile)):
-        return dict(), dict()
+        return dict(), DiscardIndex()
 
-    discard_dict = dict()
+    discard_range_list = list()
     dma_dict = dict()
     lines = open(qemu_logfile, "r").read().split("\n")
     discard_counter = 0
@@ -164,10 +503,12 @@ def parse_qemu_log(qemu_logfile, chunk_size):
             total_founded_discard += (total_sec_len*512)
 
             start_chunk_num = int(ceil(start_chunk_num))
-            for chunk_num in xrange(start_chunk_num, end_chunk_num):
-                discard_dict[chunk_num] = event_time
-                discard_counter += 1
+            if start_chunk_num < end_chunk_num:
+                discard_range_list.append(
+                    (start_chunk_num, end_chunk_num, event_time))
+                discard_counter += (end_chunk_num - start_chunk_num)
 
+    discard_dict = DiscardIndex(discard_range_list)
     if mal_aligned_sector != 0:
         LOG.warning(
             "Lost %d bytes from mal-alignment" % (mal_aligned_sector*512))
@@ -196,7 +537,9 @@ def create_disk_deltalist(modified_disk,
                           trim_dict=None, dma_dict=None,
                           apply_discard=True,
                           used_blocks_dict=None,
-                          ret_statistics=None):
+                          ret_statistics=None,
+                          cdc_hashdict=None,
+                          hash_type=Const.CHUNK_HASH_DEFAULT):
     """get disk delta
     :param base_diskmeta : hash list of base disk
     :param base_disk: path to base VM disk
@@ -205,6 +548,9 @@ def create_disk_deltalist(modified_disk,
     :param overlay_path : path to destination of overlay disk
     :param dma_dict : dma information,
     :param dma_dict[disk_chunk] = {'time':time, 'memory_chunk':memory chunk number, 'read': True if read from disk'}
+    :param cdc_hashdict : hash dict of CDC meta of base disk. Modified
+    chunks are re-chunked with content-defined chunking if it is given
+    :param hash_type : chunk hash of the base disk meta
     """
     base_fd = open(basedisk_path, "rb")
     base_mmap = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
@@ -223,6 +569,7 @@ def create_disk_deltalist(modified_disk,
     # get modified page
     LOG.debug("1.get modified disk page")
     delta_list = list()
+    chunk_list = list()
     for index, chunk in enumerate(modified_chunk_dict.keys()):
         offset = chunk * chunk_size
         ctime = modified_chunk_dict[chunk]
@@ -251,17 +598,30 @@ def create_disk_deltalist(modified_disk,
             # only apply when it is true
             if apply_discard:
                 continue
-
-        # check file system
-        modified_fd.seek(offset)
-        data = modified_fd.read(chunk_size)
+        chunk_list.append(chunk)
+
+    # check file system
+    chunk_data_list = read_modified_chunks(modified_fd, chunk_list,
+                                           chunk_size, cdc_hashdict,
+                                           hash_type)
+    for (offset, data, hash_value, base_offset) in chunk_data_list:
+        if base_offset is not None:
+            # same content-defined chunk at the base disk
+            delta_item = DeltaItem(DeltaItem.DELTA_DISK,
+                                   offset, len(data),
+                                   hash_value=hash_value,
+                                   ref_id=DeltaItem.REF_BASE_DISK,
+                                   data_len=8,
+                                   data=long(base_offset))
+            delta_list.append(delta_item)
+            continue
         source_data = base_mmap[offset:offset+len(data)]
         try:
             patch = tool.diff_data(source_data, data, 2*len(source_data))
             if len(patch) < len(data):
                 delta_item = DeltaItem(DeltaItem.DELTA_DISK,
                                        offset, len(data),
-                                       hash_value=sha256(data).digest(),
+                                       hash_value=hash_value,
                                        ref_id=DeltaItem.REF_XDELTA,
                                        data_len=len(patch),
                                        data=patch)
@@ -271,7 +631,7 @@ def create_disk_deltalist(modified_disk,
             #LOG.info("xdelta failed, so save it as raw (%s)" % str(e))
             delta_item = DeltaItem(DeltaItem.DELTA_DISK,
                                    offset, len(data),
-                                   hash_value=sha256(data).digest(),
+                                   hash_value=hash_value,
                                    ref_id=DeltaItem.REF_RAW,
                                    data_len=len(data),
                                    data=data)
@@ -287,16 +647,22 @@ def create_disk_deltalist(modified_disk,
     return delta_list
 
 
-def base_hashlist(base_meta):
+def base_hashlist(base_meta, hash_type=Const.CHUNK_HASH_DEFAULT):
     hash_list = list()
     fd = open(base_meta, "rb")
+    is_first = True
     while True:
         header = fd.read(8+4)
         if not header:
             break
         offset, length = struct.unpack("!QI", header)
-        sha256 = fd.read(32)
-        hash_list.append((offset, length, sha256))
+        hash_value = fd.read(32)
+        if is_first:
+            is_first = False
+            if tool.check_hash_meta_header(header+hash_value, base_meta,
+                                           hash_type):
+                continue
+        hash_list.append((offset, length, hash_value))
     return hash_list
 
 
@@ -309,7 +675,8 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
                  overlay_mode,
                  trim_dict=None, dma_dict=None,
                  apply_discard=True,
-                 used_blocks_dict=None):
+                 used_blocks_dict=None,
+                 hash_type=Const.CHUNK_HASH_DEFAULT):
         """get disk delta
         :param base_diskmeta : hash list of base disk
         :param base_disk: path to base VM disk
@@ -318,6 +685,7 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
         :param overlay_path : path to destination of overlay disk
         :param dma_dict : dma information,
         :param dma_dict[disk_chunk] = {'time':time, 'memory_chunk':memory chunk number, 'read': True if read from disk'}
+        :param hash_type : chunk hash of the base disk meta
         """
         self.modified_disk = modified_disk
         self.modified_chunk_queue = modified_chunk_queue
@@ -328,10 +696,18 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
         self.dma_dict = dma_dict
         self.apply_discard = apply_discard
         self.used_blocks_dict = used_blocks_dict
+        self.hash_type = hash_type
         self.proc_list = list()
         self.overlay_mode = overlay_mode
         self.num_proc = VMOverlayCreationMode.MAX_THREAD_NUM
         self.diff_algorithm = overlay_mode.DISK_DIFF_ALGORITHM
+        self.similarity_index = None
+        if getattr(overlay_mode, "OPTIMIZATION_DELTA_BASE_SIMILAR", False):
+            self.similarity_index = SimilarityIndex.load(
+                basedisk_path, chunk_size)
+        self.cdc_hashdict = None
+        if getattr(overlay_mode, "DISK_CHUNKING", "fixed") == "cdc":
+            self.cdc_hashdict = load_cdc_hashdict(basedisk_path, hash_type)
 
         super(CreateDiskDeltalist, self).__init__(target=self.create_disk_deltalist)
 
@@ -388,7 +764,10 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
                                      self.diff_algorithm,
                                      self.basedisk_path,
                                      self.modified_disk,
-                                     self.chunk_size)
+                                     self.chunk_size,
+                                     similarity_index=self.similarity_index,
+                                     cdc_hashdict=self.cdc_hashdict,
+                                     hash_type=self.hash_type)
             diff_proc.start()
             self.proc_list.append((diff_proc, command_queue, mode_queue))
 
@@ -620,7 +999,9 @@ def recover_disk(base_disk, base_mem, overlay_mem,
 class DiskDiffProc(multiprocessing.Process):
 
     def __init__(self, command_queue, task_queue, mode_queue, deltalist_queue,
-                 diff_algorithm, basedisk_path, modified_disk, chunk_size):
+                 diff_algorithm, basedisk_path, modified_disk, chunk_size,
+                 similarity_index=None, cdc_hashdict=None,
+                 hash_type=Const.CHUNK_HASH_DEFAULT):
         self.command_queue = command_queue
         self.task_queue = task_queue
         self.mode_queue = mode_queue
@@ -629,6 +1010,9 @@ class DiskDiffProc(multiprocessing.Process):
         self.basedisk_path = basedisk_path
         self.modified_disk = modified_disk
         self.chunk_size = chunk_size
+        self.similarity_index = similarity_index
+        self.cdc_hashdict = cdc_hashdict
+        self.hash_type = hash_type
 
         # shared variables between processes
         self.child_process_time_total = multiprocessing.RawValue(
@@ -645,7 +1029,8 @@ class DiskDiffProc(multiprocessing.Process):
     def process_diff(self):
         base_fd = open(self.basedisk_path, "rb")
         base_mmap = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
-        modified_fd = open(self.modified_disk, "rb")
+        # chunks are read in large runs, so stdio buffer is not needed
+        modified_fd = open(self.modified_disk, "rb", 0)
 
         time_process_total_time = float(0)
         child_total_block = 0
@@ -684,12 +1069,25 @@ class DiskDiffProc(multiprocessing.Process):
                 child_cur_block_count = 0
                 indata_size_cur = 0
                 outdata_size_cur = 0
-                for chunk in task_list:
-                    offset = chunk * self.chunk_size
-                    # check file system
-                    modified_fd.seek(offset)
-                    data = modified_fd.read(self.chunk_size)
+                # check file system
+                chunk_data_list = read_modified_chunks(
+                    modified_fd, task_list, self.chunk_size,
+                    self.cdc_hashdict, self.hash_type)
+                for (offset, data, hash_value, base_offset) in chunk_data_list:
                     chunk_data_len = len(data)
+                    if base_offset is not None:
+                        # same content-defined chunk at the base disk
+                        indata_size_cur += (chunk_data_len+11)
+                        outdata_size_cur += (8+11)
+                        child_cur_block_count += 1
+                        delta_item = DeltaItem(DeltaItem.DELTA_DISK,
+                                               offset, chunk_data_len,
+                                               hash_value=hash_value,
+                                               ref_id=DeltaItem.REF_BASE_DISK,
+                                               data_len=8,
+                                               data=long(base_offset))
+                        deltaitem_list.append(delta_item)
+                        continue
                     source_data = base_mmap[offset:offset+chunk_data_len]
                     try:
                         if self.diff_algorithm == "xdelta3":
@@ -706,6 +1104,9 @@ class DiskDiffProc(multiprocessing.Process):
                                 msg = "bsdiff patch is bigger than origianl"
                                 raise IOError(msg)
                         elif self.diff_algorithm == "xor":
+                            if chunk_data_len != self.chunk_size:
+                                msg = "xor needs fixed size chunk"
+                                raise IOError(msg)
                             diff_data = tool.cython_xor(source_data, data)
                             diff_type = DeltaItem.REF_XOR
                             if len(diff_data) > chunk_data_len:
@@ -721,13 +1122,24 @@ class DiskDiffProc(multiprocessing.Process):
                         diff_data = data
                         diff_type = DeltaItem.REF_RAW
 
+                    # try delta against similar chunk at different offset
+                    if self.similarity_index is not None and len(diff_data) >\
+                            chunk_data_len*SimilarityIndex.DELTA_RATIO_THRESHOLD:
+                        similar_data = similarity.diff_with_similar(
+                            self.similarity_index, base_mmap,
+                            DeltaItem.REF_BASE_DISK, data, offset,
+                            len(diff_data))
+                        if similar_data is not None:
+                            diff_data = similar_data
+                            diff_type = DeltaItem.REF_BASE_SIMILAR
+
                     diff_data_len = len(diff_data)
                     indata_size_cur += (chunk_data_len+11)
                     outdata_size_cur += (diff_data_len+11)
                     child_cur_block_count += 1
                     delta_item = DeltaItem(DeltaItem.DELTA_DISK,
                                            offset, len(data),
-                                           hash_value=sha256(data).digest(),
+                                           hash_value=hash_value,
                                            ref_id=diff_type,
                                            data_len=diff_data_len,
                                            data=diff_data)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""Free memory page oracle
+
+Find free page frames of the guest in a memory snapshot so that they can be
+excluded from the overlay. Kernel profiles matching the guest memory size are
+tried in order and the first one that knows the guest wins. A profile has the
+kernel symbol addresses (pglist_data and mem_map) and, optionally, the struct
+layout to walk the buddy allocator free lists. Without the layout, the free
+page scanner binary is used.
+
+Page content heuristics (poison pattern, zero-filled page) do not prove that
+a page is free, since a page in use can have the same content and the kernel
+checks the poison pattern at allocation. Pages matching them are kept in the
+overlay, and only sent without diff against the base VM.
+
+Profiles are read from Const.FREE_MEMORY_PROFILE (JSON) if it exists:
+
+  {
+    "heuristics": ["poison"],
+    "kernels": [
+      {"name": "linux-3.2-i386", "mem_size_mb": 4096,
+       "pglist_addr": "c1840a80", "pgn0_addr": "f1000000",
+       "layout": {"page_offset": "c0000000", "pointer_size": 4, ...}}
+    ]
+  }
+
+See KernelWalkOracle.LAYOUT_FIELDS for the layout.
+"""
+
+import os
+import mmap
+import json
+import struct
+import subprocess
+
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class FreeMemoryError(Exception):
+    pass
+
+
+PAGE_SIZE = 4096
+
+# profiles of the kernels that are used by the base VMs that we distribute
+DEFAULT_PROFILE = {
+    "heuristics": ["poison"],
+    "kernels": [
+        {"name": "ubuntu-12.04-i386-1GB", "mem_size_mb": 1024,
+         "pglist_addr": "c1840a80", "pgn0_addr": "f73fd000"},
+        {"name": "ubuntu-12.04-i386-2GB", "mem_size_mb": 2048,
+         "pglist_addr": "c1840a80", "pgn0_addr": "f553c000"},
+    ]
+}
+
+
+def _to_long(value):
+    if isinstance(value, basestring):
+        return long(value, 16)
+    return long(value)
+
+
+class FreePageOracle(object):
+    name = "none"
+
+    def get_free_pfns(self, snapshot_path, mem_size_mb, mem_offset):
+        """Return set of free page frame numbers of pc.ram
+        Page frame number starts from the beginning of pc.ram, which is at
+        mem_offset of the snapshot. Return None if it cannot tell.
+        """
+        return None
+
+
+class ScanBinaryOracle(FreePageOracle):
+
+    def __init__(self, name, pglist_addr, pgn0_addr):
+        self.name = "scanner(%s)" % name
+        self.pglist_addr = pglist_addr
+        self.pgn0_addr = pgn0_addr
+
+    def get_free_pfns(self, snapshot_path, mem_size_mb, mem_offset):
+        if not os.path.exists(Const.FREE_MEMORY_BIN_PATH):
+            LOG.warning("Cannot find free page scanner at %s" %
+                        Const.FREE_MEMORY_BIN_PATH)
+            return None
+        free_pfn_list = _get_free_pfn_list(snapshot_path, self.pglist_addr,
+                                           self.pgn0_addr, mem_size_mb,
+                                           mem_offset)
+        if not free_pfn_list:
+            return None
+        return set([long(page) for page in free_pfn_list])
+
+
+class KernelWalkOracle(FreePageOracle):
+    # page_offset           : start of kernel direct mapping (virt - phys)
+    # pointer_size          : 4 or 8
+    # nr_zones              : MAX_NR_ZONES
+    # zone_size             : sizeof(struct zone)
+    # zone_free_area_offset : offsetof(struct zone, free_area)
+    # max_order             : MAX_ORDER
+    # free_area_size        : sizeof(struct free_area)
+    # nr_migratetypes       : MIGRATE_TYPES
+    # page_struct_size      : sizeof(struct page)
+    # page_lru_offset       : offsetof(struct page, lru)
+    LAYOUT_FIELDS = [
+        "page_offset", "pointer_size", "nr_zones", "zone_size",
+        "zone_free_area_offset", "max_order", "free_area_size",
+        "nr_migratetypes", "page_struct_size", "page_lru_offset"]
+    # optional, offsetof(struct pglist_data, node_zones)
+    NODE_ZONES_OFFSET = "node_zones_offset"
+
+    def __init__(self, name, pglist_addr, pgn0_addr, layout):
+        missing = [key for key in self.LAYOUT_FIELDS if key not in layout]
+        if len(missing) > 0:
+            msg = "Missing layout of %s: %s" % (name, ", ".join(missing))
+            raise FreeMemoryError(msg)
+        self.name = "kernel(%s)" % name
+        self.pglist_addr = _to_long(pglist_addr)
+        self.pgn0_addr = _to_long(pgn0_addr)
+        self.layout = dict([(key, _to_long(value))
+                            for (key, value) in layout.iteritems()])
+        if self.layout["pointer_size"] == 4:
+            self.pointer_fmt = "<I"
+        elif self.layout["pointer_size"] == 8:
+            self.pointer_fmt = "<Q"
+        else:
+            raise FreeMemoryError("Invalid pointer size %d" %
+                                  self.layout["pointer_size"])
+
+    def get_free_pfns(self, snapshot_path, mem_size_mb, mem_offset):
+        snapshot_fd = open(snapshot_path, "rb")
+        raw_data = mmap.mmap(snapshot_fd.fileno(), 0, prot=mmap.PROT_READ)
+        try:
+            return self._walk_free_area(raw_data, mem_size_mb*1024*1024,
+                                        mem_offset)
+        except FreeMemoryError as e:
+            LOG.warning("Cannot walk free list with %s: %s" %
+                        (self.name, str(e)))
+            return None
+        finally:
+            raw_data.close()
+            snapshot_fd.close()
+
+    def _read_pointer(self, raw_data, mem_size, mem_offset, vaddr):
+        paddr = vaddr - self.layout["page_offset"]
+        pointer_size = self.layout["pointer_size"]
+        if paddr < 0 or paddr + pointer_size > mem_size:
+            raise FreeMemoryError("Invalid address 0x%x" % vaddr)
+        file_offset = mem_offset + paddr
+        return struct.unpack(self.pointer_fmt,
+                             raw_data[file_offset:file_offset+pointer_size])[0]
+
+    def _walk_free_area(self, raw_data, mem_size, mem_offset):
+        layout = self.layout
+        total_pages = mem_size/PAGE_SIZE
+        list_head_size = 2*layout["pointer_size"]
+        node_zones = self.pglist_addr + layout.get(self.NODE_ZONES_OFFSET, 0)
+        free_pfns = set()
+        for zone in xrange(layout["nr_zones"]):
+            free_area = node_zones + zone*layout["zone_size"] +\
+                layout["zone_free_area_offset"]
+            for order in xrange(layout["max_order"]):
+                block_pages = 1 << order
+                for migratetype in xrange(layout["nr_migratetypes"]):
+                    list_head = free_area + order*layout["free_area_size"] +\
+                        migratetype*list_head_size
+                    entry = self._read_pointer(raw_data, mem_size,
+                                               mem_offset, list_head)
+                    visited = 0
+                    while entry != list_head:
+                        page_addr = entry - layout["page_lru_offset"]
+                        pfn, remain = divmod(page_addr - self.pgn0_addr,
+                                             layout["page_struct_size"])
+                        if remain != 0 or pfn < 0 or\
+                                pfn + block_pages > total_pages:
+                            msg = "Invalid page struct at 0x%x" % page_addr
+                            raise FreeMemoryError(msg)
+                        free_pfns.update(xrange(pfn, pfn + block_pages))
+                        visited += 1
+                        if visited > total_pages:
+                            raise FreeMemoryError("Loop at free list")
+                        entry = self._read_pointer(raw_data, mem_size,
+                                                   mem_offset, entry)
+        return free_pfns
+
+
+class HeuristicOracle(FreePageOracle):
+    """Match the content of freed page. It cannot tell free pages, so
+    get_free_pfns() returns None
+    """
+    # content of freed page
+    #   poison : CONFIG_PAGE_POISONING (PAGE_POISON)
+    #   zero   : init_on_free. Note that zero page can be in use as well
+    PATTERNS = {
+        "poison": chr(0xaa) * PAGE_SIZE,
+        "zero": chr(0x00) * PAGE_SIZE,
+    }
+
+    def __init__(self, heuristics):
+        unknown = [item for item in heuristics if item not in self.PATTERNS]
+        if len(unknown) > 0:
+            raise FreeMemoryError("Unknown heuristics: %s" % ", ".join(unknown))
+        self.name = "heuristic(%s)" % ",".join(heuristics)
+        self.patterns = dict([(self.PATTERNS[item], item)
+                              for item in heuristics])
+
+    def match(self, data):
+        # return name of the matching heuristic, or None
+        return self.patterns.get(data, None)
+
+
+def load_profile(profile_path=None):
+    if profile_path is None:
+        profile_path = Const.FREE_MEMORY_PROFILE
+    if not os.path.exists(profile_path):
+        return DEFAULT_PROFILE
+    try:
+        profile = json.loads(open(profile_path, "r").read())
+    except ValueError as e:
+        msg = "Invalid free memory profile at %s: %s" % (profile_path, str(e))
+        raise FreeMemoryError(msg)
+    profile.setdefault("heuristics", DEFAULT_PROFILE["heuristics"])
+    profile.setdefault("kernels", list())
+    return profile
+
+
+def get_oracles(mem_size_mb, profile):
+    oracle_list = list()
+    for kernel in profile.get("kernels", list()):
+        mem_size_list = kernel.get("mem_size_mb")
+        if not isinstance(mem_size_list, list):
+            mem_size_list = [mem_size_list]
+        if mem_size_mb not in mem_size_list:
+            continue
+        name = kernel.get("name", "unknown")
+        try:
+            if kernel.get("layout", None) is not None:
+                oracle = KernelWalkOracle(name, kernel["pglist_addr"],
+                                          kernel["pgn0_addr"],
+                                          kernel["layout"])
+            else:
+                oracle = ScanBinaryOracle(name, kernel["pglist_addr"],
+                                          kernel["pgn0_addr"])
+        except (KeyError, ValueError, FreeMemoryError) as e:
+            LOG.warning("Skip invalid kernel profile %s: %s" % (name, str(e)))
+            continue
+        oracle_list.append(oracle)
+    return oracle_list
+
+
+def get_free_pfn_dict(snapshot_path, mem_size_mb, mem_offset,
+                      profile_path=None):
+    """Get free page of the memory snapshot
+    :param mem_size_mb: size of pc.ram in MB
+    :param mem_offset: file offset of pc.ram at the snapshot
+    :return (free_pfn_dict, coverage): free_pfn_dict has page number from
+    the beginning of the snapshot file ({page_number: True}) or None
+    """
+    total_pages = mem_size_mb*1024*1024/PAGE_SIZE
+    coverage = {
+        "method": None,
+        "total_pages": total_pages,
+        "free_pages": 0,
+        "free_ratio": 0.0,
+    }
+    profile = load_profile(profile_path)
+    for oracle in get_oracles(mem_size_mb, profile):
+        free_pfns = oracle.get_free_pfns(snapshot_path, mem_size_mb,
+                                         mem_offset)
+        if free_pfns is None:
+            continue
+        coverage["method"] = oracle.name
+        coverage["free_pages"] = len(free_pfns)
+        if total_pages > 0:
+            coverage["free_ratio"] = float(len(free_pfns))/total_pages
+        LOG.info("Free memory: %s found %d/%d pages" %
+                 (oracle.name, len(free_pfns), total_pages))
+
+        # free_pfns starts from the pc.ram so add offset of of pc.ram
+        offset = mem_offset/PAGE_SIZE
+        free_pfn_aligned = dict(
+            [(long(page)+offset, True) for page in free_pfns])
+        return free_pfn_aligned, coverage
+
+    LOG.warning("No free memory oracle for %d MB memory" % mem_size_mb)
+    return None, coverage
+
+
+def _get_free_pfn_list(snapshot_path,
+                       pglist_addr,
+                       pgn0_addr,
+                       mem_size_gb,
+                       mem_offset):
+    """get list of free memory page number
+    """
+    BIN_PATH = Const.FREE_MEMORY_BIN_PATH
+    cmd = ["%s" % BIN_PATH,
+           "%s" % snapshot_path,
+           "%s" % pglist_addr,
+           "%s" % pgn0_addr,
+           "%d" % mem_size_gb,
+           "%d" % mem_offset,]
+    _PIPE = subprocess.PIPE
+    LOG.info("Start getting free memory pages")
+    proc = subprocess.Popen(cmd, close_fds=True,
+                            stdin=_PIPE, stdout=_PIPE, stderr=_PIPE)
+    out, err = proc.communicate()
+    if err:
+        LOG.warning("Error in getting free memory : %s" % str(err))
+        return list()
+    free_pfn_list = out.split("\n")
+    if len(free_pfn_list[-1].strip()) == 0:
+        free_pfn_list = free_pfn_list[:-1]
+    LOG.info("Free memory pages : %ld" % len(free_pfn_list))
+    LOG.info("Finish getting free memory pages")
+    return free_pfn_list
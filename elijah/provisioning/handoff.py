@@ -36,6 +36,7 @@ from tempfile import NamedTemporaryFile
 from tempfile import mkdtemp
 from xml.etree import ElementTree
 from urlparse import urlsplit
+from uuid import uuid4
 
 from . import memory
 from . import disk
@@ -50,6 +51,7 @@ from . import delta
 from .delta import DeltaList
 from .delta import DeltaItem
 from .tool import comp_lzma
+from . import tool
 from .progressbar import AnimatedProgressBar
 from .package import VMOverlayPackage
 from . import compression
@@ -87,15 +89,16 @@ class PreloadResidueData(native_threading.Thread):
     def __init__(self, base_diskmeta, base_memmeta):
         self.base_diskmeta = base_diskmeta
         self.base_memmeta = base_memmeta
+        self.chunk_hash = tool.read_hash_meta_type(base_memmeta)
         self.basedisk_hashdict = None
         self.basmem_hashdict = None
         native_threading.Thread.__init__(self, target=self.preloading)
 
     def preloading(self):
         self.basedisk_hashdict = delta.DeltaDedup.disk_import_hashdict(
-            self.base_diskmeta)
+            self.base_diskmeta, self.chunk_hash)
         self.basemem_hashdict = delta.DeltaDedup.memory_import_hashdict(
-            self.base_memmeta)
+            self.base_memmeta, self.chunk_hash)
 
 
 class VMMonitor(object):
@@ -227,8 +230,14 @@ class MemoryReadProcess(process_manager.ProcWorker):
             mem_snapshot_size, = struct.unpack(
                 memory.Memory.CHUNK_HEADER_FMT, memory_size_data)
             self.memory_snapshot_size.value = long(mem_snapshot_size+len(new_header))
-            self.result_queue.put(new_data)
-            self.total_write_size += len(new_data)
+
+            # read the rest into a preallocated buffer starting at the memory
+            # chunk boundary, so each element of the queue has whole chunks
+            chunk_size = memory.Memory.CHUNK_HEADER_SIZE + \
+                memory.Memory.RAM_PAGE_SIZE
+            read_buffer = memory.PageBuffer(
+                VMOverlayCreationMode.PIPE_ONE_ELEMENT_SIZE // chunk_size)
+            read_buffer.write(new_data)
             LOG.info("Memory snapshot size: %ld, header size: %ld at %f" %
                      (mem_snapshot_size, len(new_header), time.time()))
 
@@ -242,13 +251,14 @@ class MemoryReadProcess(process_manager.ProcWorker):
                     control_msg = self.control_queue.get()
                     self._handle_control_msg(control_msg)
                 if self.in_fd in input_ready:
-                    data = self.in_fd.read(
-                        VMOverlayCreationMode.PIPE_ONE_ELEMENT_SIZE)
-                    if data is None or len(data) <= 0:
+                    read_size = read_buffer.readinto(self.in_fd)
+                    if read_size is None or read_size <= 0:
                         break
-                    current_size = len(data)
+                    if not read_buffer.is_full():
+                        continue
+                    data = read_buffer.pop()
                     self.result_queue.put(data)
-                    self.total_write_size += current_size
+                    self.total_write_size += len(data)
                     # prog_bar.set_percent(100.0*self.total_write_size/mem_snapshot_size)
                     # prog_bar.show_progress()
 
@@ -260,6 +270,10 @@ class MemoryReadProcess(process_manager.ProcWorker):
                         prev_processed_time = cur_time
                         self.monitor_current_bw = (throughput/Const.CHUNK_SIZE)
             # prog_bar.finish()
+            if read_buffer.length > 0:
+                data = read_buffer.pop()
+                self.result_queue.put(data)
+                self.total_write_size += len(data)
         except Exception as e:
             sys.stdout.write("[MemorySnapshotting] Exception1n")
             sys.stderr.write(traceback.format_exc())
@@ -313,6 +327,146 @@ def save_mem_thread(machine, outputpath):
     LOG.debug("finish machine save")
 
 
+class DirtyRateModel(object):
+    """Decide when to stop live migration iterations by modeling the dirty
+    rate of the guest against the drain rate of the processing pipeline.
+
+    Pages sent at an iteration are dirtied between the requests of the
+    previous and this iteration, so the dirty rate is the iteration size over
+    that interval. The drain rate is measured only while the pipeline has
+    backlog. Migration stops when the expected downtime meets the target,
+    or when more iterations do not make the residue smaller.
+    """
+    WAIT = 0
+    ITERATE = 1
+    STOP = 2
+
+    def __init__(self, target_downtime, max_iteration, min_shrink_ratio,
+                 settle_time=0.5, smoothing=0.5):
+        self.target_downtime = target_downtime
+        self.max_iteration = max_iteration
+        self.min_shrink_ratio = min_shrink_ratio
+        self.settle_time = settle_time
+        self.smoothing = smoothing
+
+        self.dirty_rate = None
+        self.drain_busy_time = 0.0
+        self.drain_busy_size = 0
+        self.request_time_list = list()
+        self.iteration_size_dict = dict()
+        self.measured_iteration = 0
+        self.iter_num = 0
+        self.iter_size = 0
+        self.backlog_size = 0
+        self.last_growth_time = 0
+        self.prev_sample = None
+
+    def start(self, cur_time):
+        # the first iteration is requested when the migration starts
+        self.request_time_list = [cur_time]
+        self.last_growth_time = cur_time
+
+    def iteration_requested(self, cur_time):
+        self.request_time_list.append(cur_time)
+
+    @property
+    def requested_iteration(self):
+        return len(self.request_time_list) - 1
+
+    @property
+    def drain_rate(self):
+        if self.drain_busy_time <= 0 or self.drain_busy_size <= 0:
+            return None
+        return self.drain_busy_size/self.drain_busy_time
+
+    def update(self, cur_time, iter_num, iter_size, processed_size,
+               backlog_size):
+        """Add a sample of the migration
+        :param iter_num: iteration number of the pages being received
+        :param iter_size: received size of the iteration
+        :param processed_size: total memory size processed by the pipeline
+        :param backlog_size: received memory size that is not processed yet
+        """
+        if self.prev_sample is not None:
+            (prev_time, prev_processed_size, prev_backlog_size) = \
+                self.prev_sample
+            # pipeline runs at its speed only when it has something to do
+            if prev_backlog_size > 0 and cur_time > prev_time and \
+                    processed_size >= prev_processed_size:
+                self.drain_busy_time += (cur_time - prev_time)
+                self.drain_busy_size += (processed_size - prev_processed_size)
+        self.prev_sample = (cur_time, processed_size, backlog_size)
+
+        if iter_num != self.iter_num or iter_size > self.iter_size:
+            self.last_growth_time = cur_time
+        self.iter_num = iter_num
+        self.iter_size = iter_size
+        self.iteration_size_dict[iter_num] = iter_size
+        self.backlog_size = backlog_size
+
+    def _update_dirty_rate(self):
+        iteration = self.requested_iteration
+        if iteration == 0 or iteration == self.measured_iteration:
+            return
+        self.measured_iteration = iteration
+        interval = self.request_time_list[iteration] - \
+            self.request_time_list[iteration-1]
+        if interval <= 0:
+            return
+        dirty_rate = float(self.iteration_size_dict.get(iteration, 0)) / \
+            interval
+        if self.dirty_rate is None:
+            self.dirty_rate = dirty_rate
+        else:
+            self.dirty_rate = self.smoothing*dirty_rate + \
+                (1-self.smoothing)*self.dirty_rate
+
+    def expected_downtime(self, cur_time):
+        # time to drain the backlog and the pages dirtied since the last
+        # iteration, if the VM stops now
+        drain_rate = self.drain_rate
+        if drain_rate is None:
+            return None
+        dirty_size = (self.dirty_rate or 0) * \
+            (cur_time - self.request_time_list[-1])
+        return (self.backlog_size + dirty_size)/drain_rate
+
+    def decide(self, cur_time):
+        iteration = self.requested_iteration
+        # wait until the last iteration is received and drained
+        if self.iter_num < iteration and \
+                cur_time - self.request_time_list[-1] < self.settle_time:
+            return DirtyRateModel.WAIT
+        if cur_time - self.last_growth_time < self.settle_time:
+            return DirtyRateModel.WAIT
+        drain_rate = self.drain_rate
+        if drain_rate is None:
+            if self.backlog_size > 0:
+                return DirtyRateModel.WAIT
+            # pipeline is faster than the guest sends pages
+            return DirtyRateModel.STOP
+        if float(self.backlog_size)/drain_rate > self.target_downtime:
+            return DirtyRateModel.WAIT
+
+        self._update_dirty_rate()
+        if self.dirty_rate is None:
+            # need an iteration to know the dirty rate
+            return DirtyRateModel.ITERATE
+        if self.expected_downtime(cur_time) <= self.target_downtime:
+            return DirtyRateModel.STOP
+        if iteration >= self.max_iteration:
+            return DirtyRateModel.STOP
+        if self.dirty_rate >= drain_rate:
+            # residue does not converge
+            return DirtyRateModel.STOP
+        if iteration >= 2:
+            cur_size = self.iteration_size_dict.get(iteration, 0)
+            prev_size = self.iteration_size_dict.get(iteration-1, 0)
+            if cur_size > prev_size*self.min_shrink_ratio:
+                return DirtyRateModel.STOP
+        return DirtyRateModel.ITERATE
+
+
 class QmpThread(native_threading.Thread):
 
     def __init__(self, qmp_path, process_controller, memory_snapshot_queue,
@@ -327,6 +481,7 @@ class QmpThread(native_threading.Thread):
         self.fuse_stream_monitor = fuse_stream_monitor
         self.migration_stop_time = 0
         self.done_configuration = False
+        self.guest_running = True
         native_threading.Thread.__init__(self, target=self.control_migration)
 
     def config_migration(self):
@@ -334,6 +489,10 @@ class QmpThread(native_threading.Thread):
         ret = self.qmp.qmp_negotiate()
         if not ret:
             raise HandoffError("failed to connect to qmp channel")
+        for event_name in (qmp_af_unix.QmpAfUnix.EVENT_STOP,
+                           qmp_af_unix.QmpAfUnix.EVENT_RESUME,
+                           qmp_af_unix.QmpAfUnix.EVENT_MIGRATION):
+            self.qmp.subscribe(event_name, self._handle_qmp_event)
         ret = self.qmp.randomize_raw_live()  # randomize page output order
         if not ret:
             raise HandoffError("failed to randomize memory order")
@@ -436,14 +595,79 @@ class QmpThread(native_threading.Thread):
                     if len(iteration_issue_time_list) >= 5:
                         self.migration_stop_time = self._stop_migration()
                         break
+        elif VMOverlayCreationMode.LIVE_MIGRATION_STOP == VMOverlayCreationMode.LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL:
+            self._control_migration_dirty_rate()
 
         self.qmp.disconnect()
 
+    def _handle_qmp_event(self, event):
+        # called at the QMP reader thread
+        event_name = event.get("event")
+        if event_name == qmp_af_unix.QmpAfUnix.EVENT_STOP:
+            self.guest_running = False
+        elif event_name == qmp_af_unix.QmpAfUnix.EVENT_RESUME:
+            self.guest_running = True
+        LOG.debug("qemu_control\t%f\tevent %s\t%s" %
+                  (time.time(), event_name, str(event.get("data", ""))))
+
+    def _control_migration_dirty_rate(self, looping_period=0.1):
+        model = DirtyRateModel(
+            VMOverlayCreationMode.LIVE_MIGRATION_TARGET_DOWNTIME,
+            VMOverlayCreationMode.LIVE_MIGRATION_MAX_ITERATION,
+            VMOverlayCreationMode.LIVE_MIGRATION_MIN_SHRINK_RATIO)
+        model.start(time.time())
+        iterate_request = None
+        while(not self.stop.wait(looping_period)):
+            if iterate_request is not None and iterate_request.done():
+                if not iterate_request.is_success():
+                    LOG.warning("qemu_control\tfailed to iterate: %s" %
+                                str(iterate_request.response))
+                iterate_request = None
+            if not self.guest_running:
+                # no more dirty pages
+                LOG.debug("qemu_control\t%f\tguest is stopped" % time.time())
+                self.migration_stop_time = self._stop_migration()
+                break
+            iteration_info = self.process_controller.get_migration_iteration_info()
+            if iteration_info is None:
+                continue
+            (iter_num, iter_size, processed_size) = iteration_info
+            backlog_size = self.memory_snapshot_queue.qsize() *\
+                VMOverlayCreationMode.PIPE_ONE_ELEMENT_SIZE
+            cur_time = time.time()
+            model.update(cur_time, iter_num, iter_size, processed_size,
+                         backlog_size)
+            decision = model.decide(cur_time)
+            if decision == DirtyRateModel.WAIT:
+                continue
+            LOG.debug(
+                "qemu_control\t%f\titeration:%d\tdirty_rate:%s\tdrain_rate:%s\tdowntime:%s" %
+                (cur_time, model.requested_iteration, model.dirty_rate,
+                 model.drain_rate, model.expected_downtime(cur_time)))
+            if decision == DirtyRateModel.ITERATE:
+                LOG.debug(
+                    "qemu_control\t%f\trequest new iteration %d" %
+                    (time.time(), model.requested_iteration+1))
+                # do not wait for the response to keep watching the guest
+                try:
+                    iterate_request = self.qmp.iterate_raw_live(wait=False)
+                except qmp_af_unix.QmpError as e:
+                    LOG.error("qemu_control\t%s" % str(e))
+                    break
+                model.iteration_requested(time.time())
+            else:
+                self.migration_stop_time = self._stop_migration()
+                break
+
     def _stop_migration(self):
         LOG.debug(
             "qemu_control\tsent stop_raw_live signal at %f" %
             time.time())
         stop_time = self.qmp.stop_raw_live()
+        if stop_time is None or stop_time is True:
+            # STOP event is lost, so use the time it is given up
+            LOG.warning("qemu_control\tno STOP event for stop_raw_live")
+            stop_time = time.time()
         LOG.debug("qemu_control\tstop migration at %f" % stop_time)
         self.fuse_stream_monitor.terminate()
         return stop_time
@@ -487,6 +711,7 @@ class StreamSynthesisFile(native_threading.Thread):
         self.manager = multiprocessing.Manager()
         self.overlay_info = list()
         self.overlay_files = list()
+        self.item_stats = dict()
         self.overlay_info_path = os.path.join(
             self.temp_compfile_dir, "overlay-info")
         self.overlay_filenames = os.path.join(
@@ -518,7 +743,10 @@ class StreamSynthesisFile(native_threading.Thread):
                 (blob_comp_type,
                  compdata,
                  disk_chunks,
-                 memory_chunks) = comp_task
+                 memory_chunks,
+                 raw_size,
+                 item_stats) = comp_task
+                delta.merge_item_statistics(self.item_stats, item_stats)
                 blob_filename = os.path.join(
                     self.temp_compfile_dir, "%s-stream-%d" %
                     (Const.OVERLAY_FILE_PREFIX, comp_file_counter))
@@ -530,8 +758,13 @@ class StreamSynthesisFile(native_threading.Thread):
                     Const.META_OVERLAY_FILE_NAME: os.path.basename(blob_filename),
                     Const.META_OVERLAY_FILE_COMPRESSION: blob_comp_type,
                     Const.META_OVERLAY_FILE_SIZE: os.path.getsize(blob_filename),
+                    Const.META_OVERLAY_FILE_RAW_SIZE: raw_size,
+                    Const.META_OVERLAY_FILE_SHA256:
+                        hashlib.sha256(compdata).hexdigest(),
                     Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
                     Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks}
+                blob_dict[Const.META_OVERLAY_FILE_MERKLE_ROOT] = \
+                    delta.get_blob_merkle_root(blob_dict)
                 self.overlay_files.append(blob_filename)
                 self.overlay_info.append(blob_dict)
                 time_process_end = time.time()
@@ -550,7 +783,10 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
                       base_image, base_mem, base_memmeta,
                       basedisk_hashdict, basemem_hashdict,
                       modified_disk, modified_mem_queue,
-                      merged_deltalist_queue, process_controller):
+                      merged_deltalist_queue, process_controller,
+                      residue_hashdict=None, post_copy_scheduler=None,
+                      resume_pipe=None, demand_queue=None,
+                      chunk_hash=Const.CHUNK_HASH_DEFAULT):
 
     INFO = _MonitoringInfo
     free_memory_dict = getattr(monitoring_info, INFO.MEMORY_FREE_BLOCKS, None)
@@ -574,7 +810,8 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
             base_mem,
             overlay_mode,
             options.FREE_SUPPORT,
-            free_memory_dict)
+            free_memory_dict,
+            hash_type=chunk_hash)
         memory_deltalist_proc.start()
         if overlay_mode.PROCESS_PIPELINED == False:
             _waiting_to_finish(process_controller, "CreateMemoryDeltalist")
@@ -592,7 +829,8 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
                                                    trim_dict,
                                                    dma_dict,
                                                    apply_discard,
-                                                   used_blocks_dict)
+                                                   used_blocks_dict,
+                                                   hash_type=chunk_hash)
     disk_deltalist_proc.start()
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "CreateDiskDeltalist")
@@ -607,7 +845,12 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
         merged_deltalist_queue,
         overlay_mode,
         basedisk_hashdict=basedisk_hashdict,
-        basemem_hashdict=basemem_hashdict)
+        basemem_hashdict=basemem_hashdict,
+        residue_hashdict=residue_hashdict,
+        post_copy_scheduler=post_copy_scheduler,
+        resume_pipe=resume_pipe,
+        demand_queue=demand_queue,
+        hash_type=chunk_hash)
     dedup_proc.start()
     time_merge_delta = time.time()
 
@@ -686,6 +929,21 @@ def save_mem_snapshot(conn, machine, output_queue, **kwargs):
     return memory_read_proc
 
 
+def get_working_set(memory_access_list,
+                    max_chunks=VMOverlayCreationMode.POST_COPY_MAX_WORKING_SET):
+    # memory chunks accessed most recently by the running VM
+    working_set = list()
+    accessed_set = set()
+    for chunk in reversed(list(memory_access_list)):
+        if chunk in accessed_set:
+            continue
+        accessed_set.add(chunk)
+        working_set.append(chunk)
+        if len(working_set) >= max_chunks:
+            break
+    return working_set
+
+
 def _waiting_to_finish(process_controller, worker_name):
     while True:
         worker_info = process_controller.process_infos.get(worker_name, None)
@@ -698,15 +956,26 @@ def _waiting_to_finish(process_controller, worker_name):
 
 
 def _generate_overlaymeta(overlay_metapath, overlay_info, base_hashvalue,
-                          launchdisk_size, launchmem_size):
+                          launchdisk_size, launchmem_size, statistics=None,
+                          overlay_id=None, parent_overlay_id=None,
+                          chunk_hash=Const.CHUNK_HASH_DEFAULT):
     # create metadata
     fout = open(overlay_metapath, "wrb")
 
     meta_dict = dict()
     meta_dict[Const.META_BASE_VM_SHA256] = base_hashvalue
+    meta_dict[Const.META_CHUNK_HASH] = chunk_hash
+    meta_dict[Const.META_OVERLAY_ID] = overlay_id or uuid4().hex
+    if parent_overlay_id is not None:
+        meta_dict[Const.META_PARENT_OVERLAY_ID] = parent_overlay_id
     meta_dict[Const.META_RESUME_VM_DISK_SIZE] = long(launchdisk_size)
     meta_dict[Const.META_RESUME_VM_MEMORY_SIZE] = long(launchmem_size)
     meta_dict[Const.META_OVERLAY_FILES] = overlay_info
+    merkle_root = delta.get_overlay_merkle_root(overlay_info)
+    if merkle_root is not None:
+        meta_dict[Const.META_OVERLAY_MERKLE_ROOT] = merkle_root
+    if statistics is not None:
+        meta_dict[Const.META_OVERLAY_STATISTICS] = statistics
 
     serialized = msgpack.packb(meta_dict)
     fout.write(serialized)
@@ -770,7 +1039,10 @@ class HandoffDataSend(object):
                   options, handoff_addr, overlay_mode,      # handoff configuration
                   fuse_mountpoint, qemu_logpath,            # running VM instance
                   qmp_channel_path, vm_id,                  # running VM instance
-                  dirty_disk_chunks, libvirt_conn_addr):    # running VM instance
+                  dirty_disk_chunks, libvirt_conn_addr,     # running VM instance
+                  residue_hashlist_path=None,               # chained residue
+                  post_copy_working_set=None,               # post-copy
+                  send_rate_mbps=None, host_rate_mbps=None):  # shaping
         self.base_vm_paths = base_vm_paths
         self.basevm_sha256_hash = basevm_sha256_hash
         self.basedisk_hashdict = basedisk_hashdict
@@ -785,6 +1057,16 @@ class HandoffDataSend(object):
         self.libvirt_conn_addr = libvirt_conn_addr
         self.vm_id = vm_id
         self.dirty_disk_chunks = dirty_disk_chunks
+        # hash list of the VM state at the destination. Residue only has
+        # chunks changed from that state when it is given
+        self.residue_hashlist_path = residue_hashlist_path
+        # memory chunks sent before resuming VM at the destination. The VM
+        # is resumed after every chunk arrives when it is not given
+        self.post_copy_working_set = post_copy_working_set
+        # sending rate cap of this handoff and uplink rate of the host shared
+        # by concurrent handoffs in Mbps
+        self.send_rate_mbps = send_rate_mbps
+        self.host_rate_mbps = host_rate_mbps
 
     def to_file(self, filename):
         serialized_buf = dict()
@@ -813,7 +1095,13 @@ class HandoffDataSend(object):
                 handoff_data_dict['qmp_channel_path'],
                 handoff_data_dict['vm_id'],
                 handoff_data_dict['dirty_disk_chunks'],
-                handoff_data_dict['libvirt_conn_addr']
+                handoff_data_dict['libvirt_conn_addr'],
+                residue_hashlist_path=handoff_data_dict.get(
+                    'residue_hashlist_path', None),
+                post_copy_working_set=handoff_data_dict.get(
+                    'post_copy_working_set', None),
+                send_rate_mbps=handoff_data_dict.get('send_rate_mbps', None),
+                host_rate_mbps=handoff_data_dict.get('host_rate_mbps', None)
             )
             handoff_data._load_vm_data()
             return handoff_data
@@ -900,7 +1188,7 @@ def perform_handoff(handoff_data):
     overlay_mode = handoff_data.overlay_mode
     if overlay_mode is None:
         NUM_CPU_CORES = 2   # set CPU affinity
-        VMOverlayCreationMode.LIVE_MIGRATION_STOP = VMOverlayCreationMode.LIVE_MIGRATION_FINISH_USE_SNAPSHOT_SIZE
+        VMOverlayCreationMode.LIVE_MIGRATION_STOP = VMOverlayCreationMode.LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL
         overlay_mode = VMOverlayCreationMode.get_pipelined_multi_process_finite_queue(
             num_cores=NUM_CPU_CORES)
         overlay_mode.COMPRESSION_ALGORITHM_TYPE = Const.COMPRESSION_GZIP
@@ -932,6 +1220,41 @@ def perform_handoff(handoff_data):
         raise HandoffError(msg)
     (base_disk, base_mem, base_diskmeta, base_memmeta) =\
         handoff_data.base_vm_paths
+    # chunks are compared with the base VM using its chunk hash. It is
+    # given to each step, since other sessions of the process can use a
+    # Base VM of a different chunk hash
+    chunk_hash = tool.read_hash_meta_type(base_memmeta)
+    overlay_id = uuid4().hex
+    parent_overlay_id = None
+    residue_hashdict = None
+    if getattr(handoff_data, "residue_hashlist_path", None) is not None:
+        parent_overlay_id, residue_hashdict = delta.load_residue_hashlist(
+            handoff_data.residue_hashlist_path, chunk_hash)
+        if parent_overlay_id is None:
+            msg = "Previous residue does not have overlay ID"
+            raise HandoffError(msg)
+        LOG.info("* Chained residue to %s (%d chunks)" %
+                 (parent_overlay_id, len(residue_hashdict)))
+    migration_url = urlsplit(handoff_data.handoff_addr)
+    post_copy_scheduler = None
+    resume_recv_pipe = None
+    resume_send_pipe = None
+    demand_queue = None
+    post_copy_working_set = getattr(handoff_data, "post_copy_working_set",
+                                    None)
+    if post_copy_working_set is not None:
+        if migration_url.scheme != "tcp":
+            msg = "Post-copy handoff needs tcp destination: %s" % \
+                handoff_data.handoff_addr
+            raise HandoffError(msg)
+        post_copy_scheduler = delta.PostCopyScheduler(
+            [DeltaItem.get_index(DeltaItem.DELTA_MEMORY,
+                                 chunk*Const.CHUNK_SIZE)
+             for chunk in post_copy_working_set])
+        (resume_recv_pipe, resume_send_pipe) = multiprocessing.Pipe(False)
+        demand_queue = multiprocessing.Queue()
+        LOG.info("* Post-copy handoff with %d memory chunks of working set"
+                 % len(post_copy_working_set))
 
     # start CPU Monitor
     if CPU_MONITORING:
@@ -982,7 +1305,12 @@ def perform_handoff(handoff_data):
                                    handoff_data._resumed_disk,
                                    memory_snapshot_queue,
                                    residue_deltalist_queue,
-                                   process_controller)
+                                   process_controller,
+                                   residue_hashdict=residue_hashdict,
+                                   post_copy_scheduler=post_copy_scheduler,
+                                   resume_pipe=resume_send_pipe,
+                                   demand_queue=demand_queue,
+                                   chunk_hash=chunk_hash)
     time_dedup = time.time()
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "DeltaDedup")
@@ -997,7 +1325,6 @@ def perform_handoff(handoff_data):
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "CompressProc")
 
-    migration_url = urlsplit(handoff_data.handoff_addr)
     if migration_url.scheme == "tcp":
         from .stream_client import StreamSynthesisClient
         url_value = migration_url.netloc.split(":")
@@ -1023,11 +1350,29 @@ def perform_handoff(handoff_data):
 
         metadata = dict()
         metadata[Const.META_BASE_VM_SHA256] = handoff_data.basevm_sha256_hash
+        metadata[Const.META_CHUNK_HASH] = chunk_hash
         metadata[Const.META_RESUME_VM_DISK_SIZE] = resume_disk_size
         metadata[Const.META_RESUME_VM_MEMORY_SIZE] = resume_memory_size
+        metadata[Const.META_OVERLAY_ID] = overlay_id
+        if parent_overlay_id is not None:
+            metadata[Const.META_PARENT_OVERLAY_ID] = parent_overlay_id
+        if post_copy_scheduler is not None:
+            metadata[Const.META_POST_COPY] = True
+        # statistics of the items are merged at the destination from the
+        # blob headers, like the overlay meta of the file path
+        metadata[Const.META_OVERLAY_STAT_CREATION_MODE] = \
+            dict(overlay_mode.__dict__)
         time_network_start = time.time()
+        send_rate_mbps = getattr(handoff_data, "send_rate_mbps", None) or \
+            VMOverlayCreationMode.HANDOFF_SEND_RATE_Mbps
+        host_rate_mbps = getattr(handoff_data, "host_rate_mbps", None) or \
+            VMOverlayCreationMode.HANDOFF_HOST_RATE_Mbps
         client = StreamSynthesisClient(migration_dest_ip, migration_dest_port,
-                                       metadata, compdata_queue)
+                                       metadata, compdata_queue,
+                                       resume_pipe=resume_recv_pipe,
+                                       demand_queue=demand_queue,
+                                       send_rate_mbps=send_rate_mbps,
+                                       host_rate_mbps=host_rate_mbps)
         client.start()
         client.join()
         cpu_stat_end = psutil.cpu_times(percpu=True)
@@ -1120,13 +1465,21 @@ def perform_handoff(handoff_data):
 
         overlay_info, overlay_files = synthesis_file.get_overlay_info()
         overlay_metapath = os.path.join(os.getcwd(), Const.OVERLAY_META)
+        # creation mode is the one at the start. Compression of each blob
+        # can differ by adaptation and is recorded at its own entry
+        statistics = delta.get_overlay_statistics(
+            synthesis_file.item_stats, dict(overlay_mode.__dict__))
         overlay_metafile = _generate_overlaymeta(
             overlay_metapath,
             overlay_info,
             handoff_data.basevm_sha256_hash,
             os.path.getsize(
                 handoff_data._resumed_disk),
-            resume_memory_size)
+            resume_memory_size,
+            statistics=statistics,
+            overlay_id=overlay_id,
+            parent_overlay_id=parent_overlay_id,
+            chunk_hash=chunk_hash)
 
         # packaging VM overlay into a single zip file
         VMOverlayPackage.create(
@@ -29,7 +29,6 @@ import multiprocessing
 import traceback
 import ctypes
 from optparse import OptionParser
-from hashlib import sha256
 
 from . import tool
 from . import memory_util
@@ -39,6 +38,9 @@ from .progressbar import AnimatedProgressBar
 from .delta import DeltaItem
 from .delta import DeltaList
 from .delta import Recovered_delta
+from .similarity import SimilarityIndex
+from . import similarity
+from . import free_memory
 from . import process_manager
 from . import log as logging
 
@@ -56,18 +58,7 @@ class Memory(object):
     HASH_FILE_VERSION = 0x00000001
 
     # kvm-qemu constant (version 1.0.0)
-    RAM_MAGIC = 0x5145564d
-    RAM_VERSION = 0x00000003
     RAM_PAGE_SIZE = (1 << 12)
-    RAM_ID_STRING = "pc.ram"
-    RAM_ID_LENGTH = len(RAM_ID_STRING)
-    RAM_SAVE_FLAG_COMPRESS = 0x02
-    RAM_SAVE_FLAG_MEM_SIZE = 0x04
-    RAM_SAVE_FLAG_PAGE = 0x08
-    RAM_SAVE_FLAG_RAW = 0x40
-    RAM_SAVE_FLAG_EOS = 0x10
-    RAM_SAVE_FLAG_CONTINUE = 0x20
-    BLK_MIG_FLAG_EOS = 0x02
 
     # header format for each memory page
     CHUNK_HEADER_FMT = "=Q"
@@ -77,30 +68,13 @@ class Memory(object):
     CHUNK_POS_MASK = (1 << ITER_SEQ_SHIFT) - 1
     ITER_SEQ_MASK = ((1 << (CHUNK_HEADER_SIZE * 8)) - 1) - CHUNK_POS_MASK
 
-    def __init__(self):
+    def __init__(self, hash_type=Const.CHUNK_HASH_DEFAULT):
+        self.hash_type = hash_type
         self.hash_list = []
         self.raw_file = ''
         self.raw_filesize = 0
         self.raw_mmap = None
-
-    @staticmethod
-    def _seek_string(f, string):
-        # return: index of end of the found string
-        start_index = f.tell()
-        memdata = ''
-        while True:
-            memdata = f.read(Memory.RAM_PAGE_SIZE)
-            if not memdata:
-                raise MemoryError("Cannot find %s from give memory snapshot" %
-                                  Memory.RAM_ID_STRING)
-
-            ram_index = memdata.find(Memory.RAM_ID_STRING)
-            if ram_index:
-                if ord(memdata[ram_index-1]) == len(string):
-                    position = start_index + ram_index
-                    f.seek(position)
-                    return position
-            start_index += len(memdata)
+        self.free_memory_coverage = None
 
     def _get_mem_hash(self, fin, end_offset, hash_list, **kwargs):
         """
@@ -121,7 +95,9 @@ class Memory(object):
         while total_size != ram_offset:
             data = fin.read(Memory.RAM_PAGE_SIZE)
             if not diff:
-                hash_list.append((ram_offset, len(data), sha256(data).digest()))
+                hash_list.append(
+                    (ram_offset, len(data),
+                     tool.chunk_hash(data, self.hash_type)))
             else:
                 # compare input with hash or corresponding base memory, save
                 # only when it is different
@@ -131,7 +107,8 @@ class Memory(object):
                 else:
                     self_hash_value = None
 
-                if self_hash_value != sha256(data).digest():
+                hash_value = tool.chunk_hash(data, self.hash_type)
+                if self_hash_value != hash_value:
                     is_free_memory = False
                     if (free_pfn_dict is not None) and \
                             (free_pfn_dict.get(long(ram_offset/Memory.RAM_PAGE_SIZE), None) == 1):
@@ -155,7 +132,7 @@ class Memory(object):
                                     DeltaItem.DELTA_MEMORY,
                                     ram_offset,
                                     len(data),
-                                    hash_value=sha256(data).digest(),
+                                    hash_value=hash_value,
                                     ref_id=DeltaItem.REF_XDELTA,
                                     data_len=len(patch),
                                     data=patch)
@@ -168,7 +145,7 @@ class Memory(object):
                                 DeltaItem.DELTA_MEMORY,
                                 ram_offset,
                                 len(data),
-                                hash_value=sha256(data).digest(),
+                                hash_value=hash_value,
                                 ref_id=DeltaItem.REF_RAW,
                                 data_len=len(data),
                                 data=data)
@@ -188,52 +165,26 @@ class Memory(object):
 
     @staticmethod
     def _seek_to_end_of_ram(fin):
-        # get ram total length
-        position = Memory._seek_string(fin, Memory.RAM_ID_STRING)
-        memory_start_offset = position-(1+8)
-        fin.seek(memory_start_offset)
-        total_mem_size = long(struct.unpack(">Q", fin.read(8))[0])
-        if total_mem_size & Memory.RAM_SAVE_FLAG_MEM_SIZE == 0:
-            raise MemoryError("invalid header format: no total memory size")
-        total_mem_size = total_mem_size & ~0xfff
-
-        # get ram length information
-        read_ramlen_size = 0
-        ram_info = dict()
-        while total_mem_size > read_ramlen_size:
-            id_string_len = ord(struct.unpack(">s", fin.read(1))[0])
-            id_string, mem_size = struct.unpack(">%dsQ" % id_string_len,
-                                                fin.read(id_string_len+8))
-            ram_info[id_string] = {"length": mem_size}
-            read_ramlen_size += mem_size
-
-        read_mem_size = 0
-        while total_mem_size != read_mem_size:
-            raw_ram_flag = struct.unpack(">Q", fin.read(8))[0]
-            if raw_ram_flag & Memory.RAM_SAVE_FLAG_EOS:
-                raise MemoryError("Error, Not Fully load yet")
-                break
-            if raw_ram_flag & Memory.RAM_SAVE_FLAG_RAW == 0:
-                raise MemoryError("Error, invalid ram save flag raw\n")
-
-            id_string_len = ord(struct.unpack(">s", fin.read(1))[0])
-            id_string = struct.unpack(">%ds" %
-                                      id_string_len,
-                                      fin.read(id_string_len))[0]
-            padding_len = fin.tell() & (Memory.RAM_PAGE_SIZE-1)
-            padding_len = Memory.RAM_PAGE_SIZE-padding_len
-            fin.read(padding_len)
-
-            cur_offset = fin.tell()
-            block_info = ram_info.get(id_string)
-            if not block_info:
-                raise MemoryError("Unknown memory block : %s", id_string)
-            block_info['offset'] = cur_offset
-            memory_size = block_info['length']
-            fin.seek(cur_offset + memory_size)
-            read_mem_size += memory_size
-
-        return fin.tell(), ram_info
+        # fin is at the end of libvirt header
+        parser = memory_util._QemuRamParser(fin, offset=fin.tell())
+        for page in parser.iter_pages(read_raw=False):
+            pass
+        fin.seek(parser.end_offset)
+        return parser.end_offset, parser
+
+    @staticmethod
+    def _check_libvirt_header(fin):
+        libvirt_mem_hdr = memory_util._QemuMemoryHeader(fin)
+        libvirt_mem_hdr.seek_body(fin)
+        libvirt_header_len = fin.tell()
+        if ((libvirt_header_len % Memory.RAM_PAGE_SIZE) != 0):
+            msg = "Error description:\n"
+            msg += "libvirt header length : %ld\n" % (libvirt_header_len)
+            msg += "This happends when resiude generated multiple times\n"
+            msg += "It's not easy to fix since header length change will make VM's memory snapshot size\n"
+            msg += "different from base VM"
+            raise MemoryError(msg)
+        return libvirt_header_len
 
     def _load_file(self, filepath, **kwargs):
         """Load KVM Memory snapshot file and
@@ -249,16 +200,7 @@ class Memory(object):
         # Sanity check
         fin = open(filepath, "rb")
         file_size = os.path.getsize(filepath)
-        libvirt_mem_hdr = memory_util._QemuMemoryHeader(fin)
-        libvirt_mem_hdr.seek_body(fin)
-        libvirt_header_len = fin.tell()
-        if ((libvirt_header_len % Memory.RAM_PAGE_SIZE) != 0):
-            msg = "Error description:\n"
-            msg += "libvirt header length : %ld\n" % (libvirt_header_len)
-            msg += "This happends when resiude generated multiple times\n"
-            msg += "It's not easy to fix since header length change will make VM's memory snapshot size\n"
-            msg += "different from base VM"
-            raise MemoryError(msg)
+        libvirt_header_len = Memory._check_libvirt_header(fin)
 
         # get memory meta data from snapshot
         fin.seek(libvirt_header_len)
@@ -268,16 +210,27 @@ class Memory(object):
             # case for getting modified memory list
             if apply_free_memory:
                 # get free memory list
-                ram_end_offset, ram_info = Memory._seek_to_end_of_ram(fin)
-                if ram_end_offset == Memory.RAM_PAGE_SIZE:
-                    LOG.debug("end offset: %ld" % (ram_end_offset))
-                    raise MemoryError("ram header+data is not aligned with page size")
-                mem_size_mb = ram_info.get('pc.ram').get('length')/1024/1024
-                mem_abs_offset = ram_info.get('pc.ram').get('offset')
-                self.free_pfn_dict = get_free_pfn_dict(filepath, mem_size_mb,
-                                                       mem_abs_offset)
+                try:
+                    ram_end_offset, ram_parser = \
+                        Memory._seek_to_end_of_ram(fin)
+                except memory_util.MachineGenerationError as e:
+                    raise MemoryError(str(e))
+                main_block = ram_parser.get_main_block()
+                if main_block is None or main_block.offset is None:
+                    # guest memory is not contiguous at the snapshot
+                    LOG.warning("Cannot find guest memory for free memory")
+                    self.free_pfn_dict = None
+                    self.free_memory_coverage = None
+                else:
+                    mem_size_mb = main_block.length/1024/1024
+                    self.free_pfn_dict, self.free_memory_coverage = \
+                        free_memory.get_free_pfn_dict(filepath, mem_size_mb,
+                                                      main_block.offset)
+                    LOG.info("Free memory coverage: %s" %
+                             str(self.free_memory_coverage))
             else:
                 self.free_pfn_dict = None
+                self.free_memory_coverage = None
 
             fin.seek(0)
             freed_counter = self._get_mem_hash(
@@ -297,21 +250,22 @@ class Memory(object):
         return hash_list
 
     @staticmethod
-    def import_from_metafile(meta_path, raw_path):
+    def import_from_metafile(meta_path, raw_path,
+                             hash_type=Const.CHUNK_HASH_DEFAULT):
         # Regenerate KVM Base Memory DS from existing meta file
         if (not os.path.exists(raw_path)) or (not os.path.exists(meta_path)):
             msg = "Cannot import from hash file, No raw file at : %s" % raw_path
             raise MemoryError(msg)
 
-        memory = Memory()
+        memory = Memory(hash_type)
         memory.raw_file = open(raw_path, "rb")
         memory.raw_filesize = os.path.getsize(raw_path)
-        hashlist = Memory.import_hashlist(meta_path)
+        hashlist = Memory.import_hashlist(meta_path, hash_type)
         memory.hash_list = hashlist
         return memory
 
     @staticmethod
-    def import_hashlist(meta_path):
+    def import_hashlist(meta_path, hash_type=Const.CHUNK_HASH_DEFAULT):
         fd = open(meta_path, "rb")
 
         # Read Hash Item List
@@ -322,6 +276,9 @@ class Memory(object):
             data = fd.read(8+4+32)  # start_offset, length, hash
             if not data:
                 break
+            if count == 1 and tool.check_hash_meta_header(
+                    data, meta_path, hash_type):
+                continue
             value = tuple(struct.unpack("!qI32s", data))
             hash_list.append(value)
         fd.close()
@@ -339,6 +296,7 @@ class Memory(object):
 
     def export_to_file(self, f_path):
         fd = open(f_path, "wb")
+        fd.write(tool.get_hash_meta_header(self.hash_type))
         # Write hash item list
         for (start_offset, length, data) in self.hash_list:
             # save it as little endian format
@@ -366,24 +324,65 @@ class Memory(object):
         if free_memory_info is not None:
             free_memory_info['free_pfn_dict'] = self.free_pfn_dict
             free_memory_info['freed_counter'] = self.freed_counter
+            free_memory_info['coverage'] = self.free_memory_coverage
         return hash_list
 
 
-def base_hashlist(base_memmeta_path):
+def base_hashlist(base_memmeta_path, hash_type=Const.CHUNK_HASH_DEFAULT):
     # get the hash list from the meta file
-    hashlist = Memory.import_hashlist(base_memmeta_path)
+    hashlist = Memory.import_hashlist(base_memmeta_path, hash_type)
     return hashlist
 
 
-def hashing(filepath):
+def hashing(filepath, hash_type=Const.CHUNK_HASH_DEFAULT):
     # Contstuct KVM Base Memory DS from KVM migrated memory
     # filepath  : input KVM Memory Snapshot file path
-    memory = Memory()
+    # hash_type : chunk hash of the hash list
+    memory = Memory(hash_type)
     hash_list = memory._load_file(filepath)
     memory.hash_list = hash_list
     return memory
 
 
+def incremental_hashing(filepath, base_memmeta, modified_pages,
+                        hash_type=Const.CHUNK_HASH_DEFAULT):
+    # Contstuct KVM Base Memory DS of the memory snapshot that is derived from
+    # the base memory by changing modified_pages. Only those pages are hashed
+    # and hash of the others are from the base memory meta, which gives the
+    # same hash list as hashing(filepath)
+    # filepath  : input KVM Memory Snapshot file path
+    # base_memmeta : memory meta file of the base memory
+    # modified_pages : page numbers changed from the base memory
+    # hash_type : chunk hash of the base memory meta
+    memory = Memory(hash_type)
+    base_hashlist = Memory.import_hashlist(base_memmeta, hash_type)
+    modified_pages = set(modified_pages)
+    file_size = os.path.getsize(filepath)
+    fin = open(filepath, "rb")
+    Memory._check_libvirt_header(fin)
+
+    hash_list = list()
+    rehash_counter = 0
+    for ram_offset in xrange(0, file_size, Memory.RAM_PAGE_SIZE):
+        page_number = ram_offset/Memory.RAM_PAGE_SIZE
+        page_size = min(Memory.RAM_PAGE_SIZE, file_size-ram_offset)
+        if (page_number not in modified_pages) and\
+                (page_number < len(base_hashlist)) and\
+                (base_hashlist[page_number][0] == ram_offset) and\
+                (base_hashlist[page_number][1] == page_size):
+            hash_list.append(base_hashlist[page_number])
+            continue
+        fin.seek(ram_offset)
+        data = fin.read(page_size)
+        hash_list.append(
+            (ram_offset, len(data), tool.chunk_hash(data, hash_type)))
+        rehash_counter += 1
+    fin.close()
+    LOG.debug("rehash %d pages out of %d" % (rehash_counter, len(hash_list)))
+    memory.hash_list = hash_list
+    return memory
+
+
 def _process_cmd(argv):
     COMMANDS = ['hashing', 'delta', 'recover']
     USAGE = "Usage: %prog " + "[%s] [option]" % '|'.join(COMMANDS)
@@ -421,16 +420,19 @@ def _process_cmd(argv):
 def create_memory_deltalist(modified_mempath,
                             basemem_meta=None, basemem_path=None,
                             apply_free_memory=True,
-                            free_memory_info=None):
+                            free_memory_info=None,
+                            hash_type=Const.CHUNK_HASH_DEFAULT):
     """get memory delta
     :param modified_mempath: file path for modified memory
     :param basemem_meta: hashlist file for base mem
     :param basemem_path: raw base memory path
     :param freed_counter_ret : return pointer for freed counter
+    :param hash_type: chunk hash of the base memory meta
     """
 
     # Create Base Memory from meta file
-    base = Memory.import_from_metafile(basemem_meta, basemem_path)
+    base = Memory.import_from_metafile(basemem_meta, basemem_path,
+                                       hash_type)
 
     # get modified page
     LOG.debug("1.get modified page list")
@@ -445,11 +447,13 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
     def __init__(self, modified_mem_queue, deltalist_queue,
                  basemem_meta, basemem_path, overlay_mode,
                  apply_free_memory=True,
-                 free_memory_info=None):
+                 free_memory_info=None,
+                 hash_type=Const.CHUNK_HASH_DEFAULT):
         self.modified_mem_queue = modified_mem_queue
         self.deltalist_queue = deltalist_queue
         self.basemem_meta = basemem_meta
-        self.memory_hashlist = Memory.import_hashlist(basemem_meta)
+        self.hash_type = hash_type
+        self.memory_hashlist = Memory.import_hashlist(basemem_meta, hash_type)
         self.apply_free_memory = apply_free_memory
         self.free_memory_info = free_memory_info
         self.basemem_path = basemem_path
@@ -457,9 +461,27 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         self.overlay_mode = overlay_mode
         self.num_proc = VMOverlayCreationMode.MAX_THREAD_NUM
         self.diff_algorithm = overlay_mode.MEMORY_DIFF_ALGORITHM
+        self.similarity_index = None
+        if getattr(overlay_mode, "OPTIMIZATION_DELTA_BASE_SIMILAR", False):
+            self.similarity_index = SimilarityIndex.load(
+                basemem_path, Memory.RAM_PAGE_SIZE)
+        # free page cannot be found from the kernel in streaming. Pages
+        # matching the heuristics are sent without diff instead
+        self.free_page_oracle = None
+        if apply_free_memory:
+            try:
+                heuristics = free_memory.load_profile().get("heuristics")
+                if heuristics:
+                    self.free_page_oracle = free_memory.HeuristicOracle(
+                        heuristics)
+            except free_memory.FreeMemoryError as e:
+                LOG.warning("Cannot use free memory heuristics: %s" % str(e))
 
         self.monitor_current_iteration = multiprocessing.RawValue(
             ctypes.c_ulong, 0)
+        # received size of the current iteration
+        self.monitor_current_iteration_size = multiprocessing.RawValue(
+            ctypes.c_ulong, 0)
 
         super(CreateMemoryDeltalist, self).__init__(
             target=self.create_memory_deltalist)
@@ -517,8 +539,8 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
             offset = index*Memory.RAM_PAGE_SIZE
             base_memory_fd.seek(offset)
             base_data = base_memory_fd.read(Memory.RAM_PAGE_SIZE)
-            chunk_hashvalue = sha256(data).digest()
-            base_hashvalue = sha256(base_data).digest()
+            chunk_hashvalue = tool.chunk_hash(data, self.hash_type)
+            base_hashvalue = tool.chunk_hash(base_data, self.hash_type)
             if chunk_hashvalue == base_hashvalue:
                 continue
             try:
@@ -562,25 +584,29 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         self.deltalist_queue.put(delta_list)
         return header_in_size, header_out_size
 
-    def chunks(self, l, n):
-        ret_chunks = list()
-        for index in range(0, len(l), n):
-            chunked_data = l[index:index+n]
-            chunked_data_size = len(chunked_data)
-            if chunked_data_size == n:
-                header = chunked_data[0:Memory.CHUNK_HEADER_SIZE]
-                blob_offset, = struct.unpack(Memory.CHUNK_HEADER_FMT, header)
-                iter_seq = (blob_offset & Memory.ITER_SEQ_MASK) >> Memory.ITER_SEQ_SHIFT
-                if iter_seq != self.iteration_seq:
-                    msg = "adaptation\tqemu_control\tstart iteration\t%f\t%d\t%d\t%d" % (
-                        time.time(), self.iteration_seq, iter_seq, self.iteration_size)
-                    self.iteration_seq = iter_seq
-                    LOG.debug(msg)
-                    self.iteration_size = 0
-                    self.monitor_current_iteration.value = iter_seq
-            ret_chunks.append(chunked_data)
-            self.iteration_size += chunked_data_size
-        return ret_chunks
+    def whole_chunks(self, data, n):
+        # MemoryReadProcess sends only whole chunks except the end of the
+        # snapshot, where libvirt randomly adds string starting with
+        # 'LibvirtQemudSave'. Drop such a partial chunk.
+        data_size = len(data) - (len(data) % n)
+        if data_size != len(data):
+            LOG.debug("[Memory] drop partial chunk of %d bytes" %
+                      (len(data) - data_size))
+            data = data[:data_size]
+        for index in xrange(0, data_size, n):
+            blob_offset, = struct.unpack_from(
+                Memory.CHUNK_HEADER_FMT, data, index)
+            iter_seq = (blob_offset & Memory.ITER_SEQ_MASK) >> Memory.ITER_SEQ_SHIFT
+            if iter_seq != self.iteration_seq:
+                msg = "adaptation\tqemu_control\tstart iteration\t%f\t%d\t%d\t%d" % (
+                    time.time(), self.iteration_seq, iter_seq, self.iteration_size)
+                self.iteration_seq = iter_seq
+                LOG.debug(msg)
+                self.iteration_size = 0
+                self.monitor_current_iteration.value = iter_seq
+            self.iteration_size += n
+        self.monitor_current_iteration_size.value = self.iteration_size
+        return data
 
     @staticmethod
     def averaged_value(measure_hist, cur_time):
@@ -629,9 +655,13 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         self.in_size += header_in_size
         self.out_size += header_out_size
 
-        memory_page_list = list()
-        memory_data = fin.data_buffer[Const.LIBVIRT_HEADER_SIZE:]
-        memory_page_list += self.chunks(memory_data, memory_chunk_size)
+        # each element of the list is a string of whole memory chunks, which
+        # is passed to the child processes without splitting into pages
+        memory_data_list = list()
+        memory_data = self.whole_chunks(
+            fin.data_buffer[Const.LIBVIRT_HEADER_SIZE:], memory_chunk_size)
+        if len(memory_data) > 0:
+            memory_data_list.append(memory_data)
         memory_data_queue = fin.data_queue
 
         # launch child processes
@@ -652,15 +682,18 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
                 self.memory_hashlist,
                 libvirt_header_offset,
                 self.free_pfn_dict,
-                self.apply_free_memory)
+                self.apply_free_memory,
+                similarity_index=self.similarity_index,
+                free_page_oracle=self.free_page_oracle,
+                hash_type=self.hash_type)
             diff_proc.start()
             self.proc_list.append((diff_proc, command_queue, mode_queue))
 
         freed_page_counter = 0
-        is_end_of_stream = False
-        while is_end_of_stream == False and len(memory_page_list) != 0:
+        is_end_of_stream = fin.closed
+        while is_end_of_stream == False:
             # get data from the stream
-            if len(memory_page_list) < 2:  # empty or partial data
+            if len(memory_data_list) == 0:
 
                 input_fd = [self.control_queue._reader.fileno(),
                             memory_data_queue._reader.fileno()]
@@ -684,21 +717,14 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
                         is_end_of_stream = True
                         continue
                     else:
-                        required_length = 0
-                        if len(memory_page_list) == 1:  # handle partial data
-                            last_data = memory_page_list.pop(0)
-                            required_length = memory_chunk_size-len(last_data)
-                            last_data += recved_data[0:required_length]
-                            memory_page_list.append(last_data)
-                        memory_page_list += self.chunks(
-                            recved_data[
-                                required_length:],
-                            memory_chunk_size)
-
-            if len(memory_page_list) > 1:
-                tasks = memory_page_list[0:-1]
-                memory_page_list = memory_page_list[-1:]
-                self.task_queue.put(tasks)
+                        memory_data = self.whole_chunks(recved_data,
+                                                        memory_chunk_size)
+                        if len(memory_data) > 0:
+                            memory_data_list.append(memory_data)
+
+            if len(memory_data_list) > 0:
+                self.task_queue.put(memory_data_list)
+                memory_data_list = list()
 
             total_process_time = 0
             total_block_count = 0
@@ -753,14 +779,6 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
                 self.monitor_total_input_size_cur.value = cur_insize
                 self.monitor_total_output_size_cur.value = cur_outsize
 
-        # send last memory page
-        # libvirt randomly add string starting with 'LibvirtQemudSave'
-        # Therefore, process the last memory page only when it's aligned
-        if len(memory_page_list) > 0 and len(memory_page_list[0]) == (Memory.RAM_PAGE_SIZE + Memory.CHUNK_HEADER_SIZE):
-            LOG.debug("[Memory][child] send last data to child: %d" %
-                      len(memory_page_list))
-            #select.select([], [self.task_queue._writer.fileno()], [])
-            self.task_queue.put(memory_page_list)
         self.finish_processing_input.value = True
 
         # send end meesage to every process
@@ -890,56 +908,52 @@ def recover_memory(base_disk,
 
 
 def get_free_pfn_dict(snapshot_path, mem_size, mem_offset):
-    if mem_size == 1024:
-        pglist_addr = 'c1840a80'
-        pgn0_addr = 'f73fd000'
-    elif mem_size == 2048:
-        pglist_addr = 'c1840a80'
-        pgn0_addr = 'f553c000'
-    else:
-        LOG.error("Error, memory size %ld KB is not valid" % (mem_size))
-        return None
-
-    free_pfn_list = _get_free_pfn_list(snapshot_path, pglist_addr, pgn0_addr,
-                                       mem_size, mem_offset)
-    if free_pfn_list:
-        # free_pfn_list starts from the pc.ram so add offset of of pc.ram
-        offset = (mem_offset)/Memory.RAM_PAGE_SIZE
-        free_pfn_aligned = dict(
-            [(long(page)+offset, True) for page in free_pfn_list])
-        return free_pfn_aligned
-    else:
-        return None
-
-
-def _get_free_pfn_list(snapshot_path,
-                       pglist_addr,
-                       pgn0_addr,
-                       mem_size_gb,
-                       mem_offset):
-    """get list of free memory page number
+    free_pfn_dict, coverage = free_memory.get_free_pfn_dict(
+        snapshot_path, mem_size, mem_offset)
+    LOG.info("Free memory coverage: %s" % str(coverage))
+    return free_pfn_dict
+
+
+class PageBuffer(object):
+    """Preallocated buffer that memory snapshot is read into with readinto.
+
+    The buffer is an anonymous mmap, so it is page aligned, and its size is
+    a multiple of the memory chunk (page with its header). As long as the
+    data starts at a chunk boundary, every full buffer has only whole
+    chunks.
     """
-    BIN_PATH = Const.FREE_MEMORY_BIN_PATH
-    cmd = ["%s" % BIN_PATH,
-           "%s" % snapshot_path,
-           "%s" % pglist_addr,
-           "%s" % pgn0_addr,
-           "%d" % mem_size_gb,
-           "%d" % mem_offset,]
-    _PIPE = subprocess.PIPE
-    LOG.info("Start getting free memory pages")
-    proc = subprocess.Popen(cmd, close_fds=True,
-                            stdin=_PIPE, stdout=_PIPE, stderr=_PIPE)
-    out, err = proc.communicate()
-    if err:
-        LOG.warning("Error in getting free memory : %s" % str(err))
-        return list()
-    free_pfn_list = out.split("\n")
-    if len(free_pfn_list[-1].strip()) == 0:
-        free_pfn_list = free_pfn_list[:-1]
-    LOG.info("Free memory pages : %ld" % len(free_pfn_list))
-    LOG.info("Finish getting free memory pages")
-    return free_pfn_list
+
+    def __init__(self, chunk_count,
+                 chunk_size=Memory.CHUNK_HEADER_SIZE + Memory.RAM_PAGE_SIZE):
+        self.size = chunk_size * max(1, chunk_count)
+        self.buffer_mmap = mmap.mmap(-1, self.size)
+        self.view = memoryview(
+            (ctypes.c_char * self.size).from_buffer(self.buffer_mmap))
+        self.length = 0
+
+    def write(self, data):
+        data_len = len(data)
+        if self.length + data_len > self.size:
+            msg = "Not enough space at the buffer: %d + %d > %d" % (
+                self.length, data_len, self.size)
+            raise MemoryError(msg)
+        self.view[self.length:self.length + data_len] = data
+        self.length += data_len
+
+    def readinto(self, fin):
+        read_size = fin.readinto(self.view[self.length:])
+        if read_size:
+            self.length += read_size
+        return read_size
+
+    def is_full(self):
+        return self.length == self.size
+
+    def pop(self):
+        # string is required to send the data through the queue
+        data = self.view[:self.length].tobytes()
+        self.length = 0
+        return data
 
 
 class SeekablePipe(object):
@@ -986,7 +1000,8 @@ class MemoryDiffProc(multiprocessing.Process):
     def __init__(self, command_queue, task_queue, mode_queue, deltalist_queue,
                  diff_algorithm, basemem_path, base_hashlist_length,
                  memory_hashlist, libvirt_header_offset,
-                 free_pfn_dict, apply_free_memory):
+                 free_pfn_dict, apply_free_memory, similarity_index=None,
+                 free_page_oracle=None, hash_type=Const.CHUNK_HASH_DEFAULT):
         self.command_queue = command_queue
         self.task_queue = task_queue
         self.mode_queue = mode_queue
@@ -998,6 +1013,9 @@ class MemoryDiffProc(multiprocessing.Process):
         self.libvirt_header_offset = libvirt_header_offset
         self.free_pfn_dict = free_pfn_dict
         self.apply_free_memory = apply_free_memory
+        self.similarity_index = similarity_index
+        self.free_page_oracle = free_page_oracle
+        self.hash_type = hash_type
 
         # shared variables between processes
         self.child_process_time_total = multiprocessing.RawValue(
@@ -1011,6 +1029,18 @@ class MemoryDiffProc(multiprocessing.Process):
 
         super(MemoryDiffProc, self).__init__(target=self.process_diff)
 
+    @staticmethod
+    def _iter_pages(memory_data_list):
+        # slice each page out of the received string only once
+        chunk_size = Memory.CHUNK_HEADER_SIZE + Memory.RAM_PAGE_SIZE
+        for memory_data in memory_data_list:
+            for offset in xrange(0, len(memory_data), chunk_size):
+                ram_offset, = struct.unpack_from(
+                    Memory.CHUNK_HEADER_FMT, memory_data, offset)
+                page_offset = offset + Memory.CHUNK_HEADER_SIZE
+                yield ram_offset, memory_data[
+                    page_offset:page_offset + Memory.RAM_PAGE_SIZE]
+
     def process_diff(self):
         self.raw_file = open(self.basemem_path, "rb")
         self.raw_mmap = mmap.mmap(
@@ -1060,21 +1090,16 @@ class MemoryDiffProc(multiprocessing.Process):
                     msg = "Invalid data at memory_chunk_list: %d" % memory_chunk_list
                     LOG.error(msg)
                     continue
-                for data in memory_chunk_list:
+                for (ram_offset, data) in self._iter_pages(memory_chunk_list):
                     # header parsing
-                    ram_offset, = struct.unpack(
-                        Memory.CHUNK_HEADER_FMT,
-                        data[0:Memory.CHUNK_HEADER_SIZE])
                     iter_seq = (ram_offset & Memory.ITER_SEQ_MASK) >> Memory.ITER_SEQ_SHIFT
                     ram_offset = (ram_offset & Memory.CHUNK_POS_MASK) + self.libvirt_header_offset
 
-                    # get data
-                    data = data[Memory.CHUNK_HEADER_SIZE:]
                     chunk_data_len = len(data)
                     hash_list_index = ram_offset/Memory.RAM_PAGE_SIZE
 
                     is_modified = True
-                    chunk_hashvalue = sha256(data).digest()
+                    chunk_hashvalue = tool.chunk_hash(data, self.hash_type)
                     # compare with base VM if it's the first iteration
                     if iter_seq == 0:
                         self_hash_value = None
@@ -1087,6 +1112,17 @@ class MemoryDiffProc(multiprocessing.Process):
                     else:
                         delta_type = DeltaItem.DELTA_MEMORY_LIVE
 
+                    diff_algorithm = self.diff_algorithm
+                    is_pattern_page = is_modified and\
+                        self.free_page_oracle is not None and\
+                        self.free_page_oracle.match(data) is not None
+                    if is_pattern_page:
+                        # page filled with the pattern of freed page can be
+                        # in use, so send it without diff. Zero page becomes
+                        # REF_ZEROS and the others are deduplicated by hash
+                        freed_page_counter += 1
+                        diff_algorithm = "none"
+
                     if is_modified:
                         try:
                             # get diff compared to the base VM
@@ -1098,27 +1134,27 @@ class MemoryDiffProc(multiprocessing.Process):
                                     ram_offset, ram_offset+chunk_data_len, self.raw_filesize)
                                 # LOG.debug(msg)
                                 raise IOError(msg)
-                            if self.diff_algorithm == "xdelta3":
+                            if diff_algorithm == "xdelta3":
                                 diff_data = tool.diff_data(
                                     source_data, data, 2 * len(source_data))
                                 diff_type = DeltaItem.REF_XDELTA
                                 if len(diff_data) > chunk_data_len:
                                     msg = "xdelta3 patch is bigger than origianl"
                                     raise IOError(msg)
-                            elif self.diff_algorithm == "bsdiff":
+                            elif diff_algorithm == "bsdiff":
                                 diff_data = tool.diff_data_bsdiff(
                                     source_data, data)
                                 diff_type = DeltaItem.REF_BSDIFF
                                 if len(diff_data) > chunk_data_len:
                                     msg = "bsdiff patch is bigger than origianl"
                                     raise IOError(msg)
-                            elif self.diff_algorithm == "xor":
+                            elif diff_algorithm == "xor":
                                 diff_data = tool.cython_xor(source_data, data)
                                 diff_type = DeltaItem.REF_XOR
                                 if len(diff_data) > len(data):
                                     msg = "xor patch is bigger than origianl"
                                     raise IOError(msg)
-                            elif self.diff_algorithm == "none":
+                            elif diff_algorithm == "none":
                                 diff_data = data
                                 diff_type = DeltaItem.REF_RAW
                             else:
@@ -1128,6 +1164,18 @@ class MemoryDiffProc(multiprocessing.Process):
                             diff_data = data
                             diff_type = DeltaItem.REF_RAW
 
+                        # try delta against similar page at different offset
+                        if self.similarity_index is not None and\
+                                not is_pattern_page and len(diff_data) >\
+                                chunk_data_len*SimilarityIndex.DELTA_RATIO_THRESHOLD:
+                            similar_data = similarity.diff_with_similar(
+                                self.similarity_index, self.raw_mmap,
+                                DeltaItem.REF_BASE_MEM, data, ram_offset,
+                                len(diff_data))
+                            if similar_data is not None:
+                                diff_data = similar_data
+                                diff_type = DeltaItem.REF_BASE_SIMILAR
+
                         diff_data_len = len(diff_data)
                         indata_size_cur += (chunk_data_len+11)
                         outdata_size_cur += (diff_data_len+11)
@@ -1210,7 +1258,8 @@ if __name__ == "__main__":
             basemem_meta=meta_path,
             basemem_path=raw_path)
         DeltaList.statistics(mem_deltalist)
-        DeltaList.tofile(mem_deltalist, modi_mem_path + ".delta")
+        DeltaList.tofile(mem_deltalist, modi_mem_path + ".delta",
+                         indexed=True)
     elif command == "recover":
         if (not settings.base_file) or (not settings.delta_file):
             sys.stderr.write("Error, Cannot find base/delta file. See help\n")
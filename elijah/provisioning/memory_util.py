@@ -20,6 +20,8 @@
 
 from __future__ import division
 import struct
+import zlib
+import collections
 from . import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -175,6 +177,260 @@ class _QemuMemoryHeaderData(_QemuMemoryHeader):
         return header_binary
 
 
+class _QemuRamBlock(object):
+
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+        # file offset of the block data when the block is saved as a whole
+        # (RAM_SAVE_FLAG_RAW). None when it is saved page by page
+        self.offset = None
+
+
+class _QemuRamParser(object):
+    '''Streaming parser of RAM at QEMU memory snapshot (migration stream)
+
+    It reads the stream only forward, so the stream can be a pipe. RAM
+    section is made of page records of each RAM block (pc.ram, vga.vram,
+    rom regions, ...). Page records of the same block as the previous one
+    have RAM_SAVE_FLAG_CONTINUE without the block name. Live migration
+    repeats page records at SECTION_PART of the RAM section, and the RAM
+    ends at the end of SECTION_END, which device state follows.
+    Cloudlet QEMU saves each block as a whole with RAM_SAVE_FLAG_RAW,
+    where the block data is aligned to the page at the file.
+    '''
+    VM_FILE_MAGIC = 0x5145564d
+    VM_FILE_VERSION = 0x00000003
+
+    VM_EOF = 0x00
+    VM_SECTION_START = 0x01
+    VM_SECTION_PART = 0x02
+    VM_SECTION_END = 0x03
+    VM_SECTION_FULL = 0x04
+
+    RAM_SAVE_FLAG_ZERO = 0x02   # called RAM_SAVE_FLAG_COMPRESS at QEMU 1.x
+    RAM_SAVE_FLAG_MEM_SIZE = 0x04
+    RAM_SAVE_FLAG_PAGE = 0x08
+    RAM_SAVE_FLAG_EOS = 0x10
+    RAM_SAVE_FLAG_CONTINUE = 0x20
+    RAM_SAVE_FLAG_RAW = 0x40
+    RAM_SAVE_FLAG_COMPRESS_PAGE = 0x100
+    RAM_SAVE_FLAG_MASK = 0xfff
+    BLK_MIG_FLAG_EOS = 0x02
+
+    PAGE_SIZE = 4096
+    READ_SIZE = 1024*1024
+
+    def __init__(self, f, offset=0):
+        '''
+        :param f: file object positioned at offset
+        :param offset: file offset of the current position of f
+        '''
+        self.f = f
+        self.offset = offset
+        self.blocks = collections.OrderedDict()
+        self.end_offset = None
+        self._buf = ''
+        self._buf_pos = 0
+        self._block = None
+        self._section_names = dict()
+
+    def _read(self, size):
+        if len(self._buf) - self._buf_pos < size:
+            data = [self._buf[self._buf_pos:]]
+            remain_size = size - len(data[0])
+            while remain_size > 0:
+                read_data = self.f.read(max(remain_size, self.READ_SIZE))
+                if not read_data:
+                    raise MachineGenerationError(
+                        "Memory snapshot ends at %d" % self.offset)
+                data.append(read_data)
+                remain_size -= len(read_data)
+            self._buf = ''.join(data)
+            self._buf_pos = 0
+        data = self._buf[self._buf_pos:self._buf_pos+size]
+        self._buf_pos += size
+        self.offset += size
+        return data
+
+    def _skip(self, size):
+        buffered_size = len(self._buf) - self._buf_pos
+        if size <= buffered_size:
+            self._buf_pos += size
+            self.offset += size
+            return
+        self._buf = ''
+        self._buf_pos = 0
+        self.offset += buffered_size
+        size -= buffered_size
+        try:
+            self.f.seek(self.offset + size)
+        except (AttributeError, IOError):
+            # not seekable stream
+            while size > 0:
+                data = self.f.read(min(size, self.READ_SIZE))
+                if not data:
+                    raise MachineGenerationError(
+                        "Memory snapshot ends at %d" % self.offset)
+                size -= len(data)
+                self.offset += len(data)
+            return
+        self.offset += size
+
+    def _read_string(self):
+        length = ord(self._read(1))
+        return self._read(length)
+
+    def read_libvirt_header(self):
+        data = self._read(_QemuMemoryHeader.HEADER_LENGTH)
+        xml_len = struct.unpack(_QemuMemoryHeader.HEADER_FORMAT, data)[2]
+        data += self._read(xml_len)
+        return _QemuMemoryHeaderData(data)
+
+    def _read_section_header(self):
+        # returns (section type, section name)
+        section_type = ord(self._read(1))
+        if section_type == self.VM_EOF:
+            return section_type, None
+        section_id = struct.unpack(">I", self._read(4))[0]
+        if section_type in (self.VM_SECTION_START, self.VM_SECTION_FULL):
+            name = self._read_string()
+            instance_id, version_id = struct.unpack(">II", self._read(8))
+            self._section_names[section_id] = name
+        elif section_type in (self.VM_SECTION_PART, self.VM_SECTION_END):
+            name = self._section_names.get(section_id, None)
+        else:
+            raise MachineGenerationError(
+                "Unknown section type 0x%x at %d" %
+                (section_type, self.offset-1))
+        return section_type, name
+
+    def _skip_block_section(self):
+        # block migration is not used, so only end of the section is here
+        flags = struct.unpack(">Q", self._read(8))[0]
+        if flags != self.BLK_MIG_FLAG_EOS:
+            raise MachineGenerationError(
+                "Block migration data at memory snapshot")
+
+    def _next_ram_section(self):
+        # returns True at the start of the RAM section, or False at the
+        # end of the RAM
+        while True:
+            section_offset = self.offset
+            section_type, name = self._read_section_header()
+            if name == "block" and section_type != self.VM_SECTION_FULL:
+                self._skip_block_section()
+            elif name == "ram" and section_type != self.VM_SECTION_FULL:
+                return section_type
+            else:
+                self.end_offset = section_offset
+                return None
+
+    def _read_block_list(self, total_length):
+        read_length = 0
+        while read_length < total_length:
+            name = self._read_string()
+            length = struct.unpack(">Q", self._read(8))[0]
+            self.blocks[name] = _QemuRamBlock(name, length)
+            read_length += length
+
+    def _get_block(self, flags):
+        if flags & self.RAM_SAVE_FLAG_CONTINUE:
+            if self._block is None:
+                raise MachineGenerationError(
+                    "Continued page without RAM block at %d" % self.offset)
+            return self._block
+        name = self._read_string()
+        self._block = self.blocks.get(name, None)
+        if self._block is None:
+            raise MachineGenerationError("Unknown RAM block: %s" % name)
+        return self._block
+
+    def _is_raw_finished(self):
+        for block in self.blocks.itervalues():
+            if block.offset is None:
+                return False
+        return True
+
+    def iter_pages(self, read_raw=True):
+        '''Read RAM of the memory snapshot after the libvirt header
+        Yields (RAM block, offset in the block, file offset, page data).
+        File offset is None for zero and compressed pages. Pages of the raw
+        block are read only when read_raw is True, and otherwise skipped.
+        '''
+        magic, version = struct.unpack(">II", self._read(8))
+        if magic != self.VM_FILE_MAGIC:
+            raise MachineGenerationError("Invalid QEMU snapshot magic")
+        if version != self.VM_FILE_VERSION:
+            raise MachineGenerationError(
+                "Unknown QEMU snapshot version %d" % version)
+        section_type = self._next_ram_section()
+        if section_type != self.VM_SECTION_START:
+            raise MachineGenerationError("No RAM at memory snapshot")
+
+        while True:
+            header = struct.unpack(">Q", self._read(8))[0]
+            flags = header & self.RAM_SAVE_FLAG_MASK
+            addr = header & ~self.RAM_SAVE_FLAG_MASK
+            if flags & self.RAM_SAVE_FLAG_MEM_SIZE:
+                self._read_block_list(addr)
+                continue
+            if flags & self.RAM_SAVE_FLAG_EOS:
+                if section_type == self.VM_SECTION_END:
+                    self.end_offset = self.offset
+                    break
+                section_type = self._next_ram_section()
+                if section_type is None:
+                    break
+                continue
+
+            block = self._get_block(flags)
+            if addr + self.PAGE_SIZE > block.length and \
+                    not flags & self.RAM_SAVE_FLAG_RAW:
+                raise MachineGenerationError(
+                    "Page at 0x%x is out of RAM block %s" %
+                    (addr, block.name))
+            if flags & self.RAM_SAVE_FLAG_ZERO:
+                yield (block, addr, None, self._read(1)*self.PAGE_SIZE)
+            elif flags & self.RAM_SAVE_FLAG_COMPRESS_PAGE:
+                length = struct.unpack(">I", self._read(4))[0]
+                yield (block, addr, None,
+                       zlib.decompress(self._read(length)))
+            elif flags & self.RAM_SAVE_FLAG_PAGE:
+                file_offset = self.offset
+                yield (block, addr, file_offset, self._read(self.PAGE_SIZE))
+            elif flags & self.RAM_SAVE_FLAG_RAW:
+                # cloudlet QEMU pads a full page at the aligned position
+                padding_len = self.PAGE_SIZE - \
+                    (self.offset & (self.PAGE_SIZE-1))
+                self._skip(padding_len)
+                block.offset = self.offset
+                if read_raw:
+                    for block_offset in xrange(0, block.length,
+                                               self.PAGE_SIZE):
+                        file_offset = self.offset
+                        data = self._read(
+                            min(self.PAGE_SIZE, block.length-block_offset))
+                        yield (block, block_offset, file_offset, data)
+                else:
+                    self._skip(block.length)
+                # raw blocks are followed by the device state
+                if self._is_raw_finished():
+                    self.end_offset = self.offset
+                    break
+            else:
+                raise MachineGenerationError(
+                    "Invalid RAM save flag 0x%x at %d" %
+                    (flags, self.offset-8))
+
+    def get_main_block(self):
+        '''Returns RAM block of the guest physical memory'''
+        block = self.blocks.get("pc.ram", None)
+        if block is None and len(self.blocks) > 0:
+            block = max(self.blocks.values(), key=lambda item: item.length)
+        return block
+
+
 def copy_memory(in_path, out_path, xml):
     # Recompress if possible
     fin = open(in_path)
@@ -25,18 +25,24 @@ import os
 import re
 import requests
 import struct
-import shutil
+import threading
 import urlparse
+from hashlib import sha256
 from lxml import etree
-from tempfile import mkdtemp
 from urlparse import urlsplit
 from urllib import pathname2url
 import zipfile
+import zlib
 from lxml.builder import ElementMaker
 import sys
-import subprocess
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from .configuration import Const
+from .progressbar import AnimatedProgressBar
+from . import similarity
 from . import log as logging
 from .db.api import DBConnector
 from .db.table_def import BaseVM
@@ -356,7 +362,10 @@ class _FileFile(file):
         total_read = 0
         try:
             while total_read < size:
-                data = self.read(chunk_size)
+                data = self.read(min(chunk_size, size-total_read))
+                if not data:
+                    break
+                total_read += len(data)
                 yield data
         except:
             raise StopIteration()
@@ -394,8 +403,14 @@ class _PackageObject(object):
         self.offset = info.header_offset + header_len + name_len + extra_len
         self.size = info.file_size
 
-    def iter_content(self, chunk_size):
-        return self._fh.iter_content(self.offset, self.size, chunk_size)
+    def iter_content(self, chunk_size, offset=0, size=None):
+        # (offset, size) selects a byte range inside of the object
+        if size is None:
+            size = self.size - offset
+        if offset < 0 or offset + size > self.size:
+            raise BadPackageError('Invalid range (%d, %d) of "%s"' %
+                                  (offset, size, self.url))
+        return self._fh.iter_content(self.offset + offset, size, chunk_size)
 
 
 class VMOverlayPackage(object):
@@ -437,12 +452,15 @@ class VMOverlayPackage(object):
         self.metadata = self.zip_overlay.read(self.metafile)
         return self.metadata
 
-    def read_blob(self, blobname):
-        return self.zip_overlay.read(blobname)
+    def read_blob(self, blobname, offset=0, size=None):
+        if offset == 0 and size is None:
+            return self.zip_overlay.read(blobname)
+        # range of the stored member is read without the rest of it
+        return ''.join(self.iter_blob(blobname, 1024*1024, offset, size))
 
-    def iter_blob(self, blobname, chunk_size):
+    def iter_blob(self, blobname, chunk_size, offset=0, size=None):
         package_blob = _PackageObject(self.zip_overlay, blobname)
-        return package_blob.iter_content(chunk_size)
+        return package_blob.iter_content(chunk_size, offset, size)
 
     @classmethod
     def create(cls, outfilename, metafile, blobfiles):
@@ -455,6 +473,217 @@ class VMOverlayPackage(object):
         zip.close()
 
 
+def _deflate_block(data, comp_level, is_last):
+    # raw deflate stream of each block ends at the byte boundary, so
+    # concatenating them gives a single deflate stream
+    compressor = zlib.compressobj(comp_level, zlib.DEFLATED, -15)
+    comp_data = compressor.compress(data)
+    if is_last:
+        comp_data += compressor.flush(zlib.Z_FINISH)
+    else:
+        comp_data += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return comp_data
+
+
+class _ParallelZipWriter(object):
+
+    '''Write files into a zip file deflating blocks of each file in
+    parallel. Output is a standard zip with a deflated member per file.
+    Headers and the central directory are written here, since zipfile
+    does not take data compressed elsewhere.'''
+
+    LOCAL_HEADER_FMT = '<4s5H3I2H'
+    CENTRAL_DIR_FMT = '<4s6H3I5H2I'
+    END_OF_DIR_FMT = '<4s4H2IH'
+    ZIP64_END_OF_DIR_FMT = '<4sQ2H2I4Q'
+    ZIP64_LOCATOR_FMT = '<4sIQI'
+    ZIP64_LIMIT = (1 << 31) - 1
+    VERSION = 20
+    ZIP64_VERSION = 45
+    FLAG_UTF8 = 0x800
+
+    def __init__(self, outfile, comment='', comp_level=9, num_threads=None,
+                 block_size=1024*1024, total_size=0):
+        self.fp = open(outfile, "wb")
+        self.comment = comment
+        self.comp_level = comp_level
+        self.num_threads = num_threads or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.total_size = total_size
+        self.written_size = 0
+        # (name, flag bits, dos time, dos date, external attr, CRC,
+        # compressed size, size, header offset) for the central directory
+        self.member_list = list()
+        self.prog_bar = AnimatedProgressBar(end=100, width=80,
+                                            stdout=sys.stdout)
+        # zlib releases GIL while compressing
+        self.pool = ThreadPool(self.num_threads)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.prog_bar.finish()
+        self._write_central_dir()
+        self.fp.close()
+
+    def _update_progress(self, size):
+        self.written_size += size
+        if self.total_size > 0:
+            self.prog_bar.set_percent(
+                100.0*self.written_size/self.total_size)
+            self.prog_bar.show_progress()
+
+    @staticmethod
+    def _get_dos_time(mtime):
+        date_time = time.localtime(mtime)
+        dos_time = (date_time[3] << 11) | (date_time[4] << 5) | \
+            (date_time[5] // 2)
+        dos_date = ((max(date_time[0], 1980) - 1980) << 9) | \
+            (date_time[1] << 5) | date_time[2]
+        return dos_time, dos_date
+
+    @staticmethod
+    def _encode_name(arcname):
+        if isinstance(arcname, unicode):
+            return arcname.encode('utf-8'), _ParallelZipWriter.FLAG_UTF8
+        return arcname, 0
+
+    def _write_local_header(self, name, flag_bits, dos_time, dos_date, crc,
+                            compress_size, file_size, zip64):
+        if zip64:
+            # sizes are at the zip64 extra field
+            extra = struct.pack('<2H2Q', 0x0001, 16, file_size,
+                                compress_size)
+            (compress_size, file_size) = (0xffffffff, 0xffffffff)
+            version = self.ZIP64_VERSION
+        else:
+            extra = ''
+            version = self.VERSION
+        self.fp.write(struct.pack(
+            self.LOCAL_HEADER_FMT, 'PK\003\004', version, flag_bits,
+            zipfile.ZIP_DEFLATED, dos_time, dos_date, crc, compress_size,
+            file_size, len(name), len(extra)))
+        self.fp.write(name)
+        self.fp.write(extra)
+
+    def write(self, filepath, arcname):
+        '''Returns (size, sha256 hex digest) of the file'''
+        st = os.stat(filepath)
+        (name, flag_bits) = self._encode_name(arcname)
+        (dos_time, dos_date) = self._get_dos_time(st.st_mtime)
+        header_offset = self.fp.tell()
+        # header is written again with CRC and sizes after the data. Its
+        # length depends on the zip64 extra field, so it is decided here
+        zip64 = st.st_size * 1.05 > self.ZIP64_LIMIT
+        self._write_local_header(name, flag_bits, dos_time, dos_date, 0, 0,
+                                 0, zip64)
+
+        # keep bounded number of blocks in flight and write them in order
+        crc = 0
+        compress_size = 0
+        hashing = sha256()
+        file_size = 0
+        pending = deque()
+        max_pending = self.num_threads*2
+        with open(filepath, "rb") as in_file:
+            data = in_file.read(self.block_size)
+            while True:
+                next_data = in_file.read(self.block_size)
+                is_last = len(next_data) == 0
+                file_size += len(data)
+                crc = zlib.crc32(data, crc) & 0xffffffff
+                hashing.update(data)
+                pending.append((len(data), self.pool.apply_async(
+                    _deflate_block, (data, self.comp_level, is_last))))
+                while len(pending) >= max_pending or \
+                        (is_last and len(pending) > 0):
+                    (block_size, result) = pending.popleft()
+                    comp_data = result.get()
+                    compress_size += len(comp_data)
+                    self.fp.write(comp_data)
+                    self._update_progress(block_size)
+                if is_last:
+                    break
+                data = next_data
+
+        if not zip64:
+            if file_size > self.ZIP64_LIMIT:
+                raise BadPackageError('File size has increased during compressing')
+            if compress_size > self.ZIP64_LIMIT:
+                raise BadPackageError('Compressed size larger than uncompressed size')
+        # seek backwards and write file header with correct CRC and sizes
+        position = self.fp.tell()
+        self.fp.seek(header_offset, 0)
+        self._write_local_header(name, flag_bits, dos_time, dos_date, crc,
+                                 compress_size, file_size, zip64)
+        self.fp.seek(position, 0)
+        self.member_list.append(
+            (name, flag_bits, dos_time, dos_date,
+             (st.st_mode & 0xFFFF) << 16L, crc, compress_size, file_size,
+             header_offset))
+        return file_size, hashing.hexdigest()
+
+    def writestr(self, arcname, data):
+        '''Write a member from the data in memory, like the manifest'''
+        (name, flag_bits) = self._encode_name(arcname)
+        (dos_time, dos_date) = self._get_dos_time(time.time())
+        header_offset = self.fp.tell()
+        crc = zlib.crc32(data) & 0xffffffff
+        comp_data = _deflate_block(data, self.comp_level, True)
+        zip64 = len(data) > self.ZIP64_LIMIT or \
+            len(comp_data) > self.ZIP64_LIMIT
+        self._write_local_header(name, flag_bits, dos_time, dos_date, crc,
+                                 len(comp_data), len(data), zip64)
+        self.fp.write(comp_data)
+        self.member_list.append(
+            (name, flag_bits, dos_time, dos_date, 0600 << 16L, crc,
+             len(comp_data), len(data), header_offset))
+
+    def _write_central_dir(self):
+        dir_offset = self.fp.tell()
+        for (name, flag_bits, dos_time, dos_date, external_attr, crc,
+             compress_size, file_size, header_offset) in self.member_list:
+            extra = ''
+            version = self.VERSION
+            if file_size > self.ZIP64_LIMIT or \
+                    compress_size > self.ZIP64_LIMIT or \
+                    header_offset > self.ZIP64_LIMIT:
+                extra = struct.pack('<2H3Q', 0x0001, 24, file_size,
+                                    compress_size, header_offset)
+                (file_size, compress_size, header_offset) = \
+                    (0xffffffff, 0xffffffff, 0xffffffff)
+                version = self.ZIP64_VERSION
+            # made by unix, so that the mode at the external attribute is
+            # restored
+            self.fp.write(struct.pack(
+                self.CENTRAL_DIR_FMT, 'PK\001\002', (3 << 8) | version,
+                version, flag_bits, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                crc, compress_size, file_size, len(name), len(extra), 0, 0,
+                0, external_attr, header_offset))
+            self.fp.write(name)
+            self.fp.write(extra)
+        dir_end = self.fp.tell()
+        dir_size = dir_end - dir_offset
+        count = len(self.member_list)
+
+        if count >= 0xffff or dir_offset > self.ZIP64_LIMIT or \
+                dir_size > self.ZIP64_LIMIT:
+            self.fp.write(struct.pack(
+                self.ZIP64_END_OF_DIR_FMT, 'PK\006\006',
+                struct.calcsize(self.ZIP64_END_OF_DIR_FMT) - 12,
+                self.ZIP64_VERSION, self.ZIP64_VERSION, 0, 0, count, count,
+                dir_size, dir_offset))
+            self.fp.write(struct.pack(
+                self.ZIP64_LOCATOR_FMT, 'PK\006\007', 0, dir_end, 1))
+            count = min(count, 0xffff)
+            dir_offset = min(dir_offset, 0xffffffff)
+            dir_size = min(dir_size, 0xffffffff)
+        self.fp.write(struct.pack(
+            self.END_OF_DIR_FMT, 'PK\005\006', 0, 0, count, count,
+            dir_size, dir_offset, len(self.comment)))
+        self.fp.write(self.comment)
+
+
 class BaseVMPackage(object):
     NS = 'http://opencloudlet.org/xmlns/vmsynthesis/package'
     NSP = '{' + NS + '}'
@@ -498,6 +727,15 @@ class BaseVMPackage(object):
                 zip, tree.find(self.NSP + 'disk_hash').get('path'))
             self.memory_hash = _PackageObject(
                 zip, tree.find(self.NSP + 'memory_hash').get('path'))
+            # similarity index exists only at the newer package
+            self.disk_simindex = None
+            self.memory_simindex = None
+            if tree.find(self.NSP + 'disk_simindex') is not None:
+                self.disk_simindex = _PackageObject(
+                    zip, tree.find(self.NSP + 'disk_simindex').get('path'))
+            if tree.find(self.NSP + 'memory_simindex') is not None:
+                self.memory_simindex = _PackageObject(
+                    zip, tree.find(self.NSP + 'memory_simindex').get('path'))
         except etree.XMLSyntaxError as e:
             raise BadPackageError('Manifest XML does not validate', str(e))
         except (zipfile.BadZipfile, _HttpError) as e:
@@ -510,46 +748,113 @@ class BaseVMPackage(object):
 
     @classmethod
     def create(cls, outfile, basevm_hashvalue,
-               base_disk, base_memory, disk_hash, memory_hash):
-        # Generate manifest XML
+               base_disk, base_memory, disk_hash, memory_hash,
+               comp_level=9, num_threads=None, disk_simindex=None,
+               memory_simindex=None):
+        # compress members in the process using all the cores instead of
+        # single threaded zip command
+        filelist = [base_disk, base_memory, disk_hash, memory_hash]
+        for filepath in (disk_simindex, memory_simindex):
+            if filepath is not None:
+                filelist.append(filepath)
+        total_size = sum([os.path.getsize(path) for path in filelist])
+        writer = _ParallelZipWriter(outfile,
+                                    comment='Cloudlet package for base VM',
+                                    comp_level=comp_level,
+                                    num_threads=num_threads,
+                                    total_size=total_size)
+        LOG.info("Start compressing with %d threads" % writer.num_threads)
+        member_info = dict()
+        try:
+            for filepath in filelist:
+                basename = os.path.basename(filepath)
+                LOG.info("Zipping %s (%ld bytes) into %s" %
+                         (basename, os.path.getsize(filepath), outfile))
+                member_info[filepath] = writer.write(filepath, basename)
+        except Exception:
+            writer.close()
+            raise
+
+        # Generate manifest XML having checksum of each member
+        def resource(element, filepath):
+            (size, checksum) = member_info[filepath]
+            return element(path=os.path.basename(filepath), size=str(size),
+                           sha256=checksum)
         e = ElementMaker(namespace=cls.NS, nsmap={None: cls.NS})
-        tree = e.image(
-            e.disk(path=os.path.basename(base_disk)),
-            e.memory(path=os.path.basename(base_memory)),
-            e.disk_hash(path=os.path.basename(disk_hash)),
-            e.memory_hash(path=os.path.basename(memory_hash)),
-            hash_value=str(basevm_hashvalue),
-        )
+        resources = [
+            resource(e.disk, base_disk),
+            resource(e.memory, base_memory),
+            resource(e.disk_hash, disk_hash),
+            resource(e.memory_hash, memory_hash),
+        ]
+        if disk_simindex is not None:
+            resources.append(resource(e.disk_simindex, disk_simindex))
+        if memory_simindex is not None:
+            resources.append(resource(e.memory_simindex, memory_simindex))
+        tree = e.image(*resources, hash_value=str(basevm_hashvalue))
         cls.schema.assertValid(tree)
         xml = etree.tostring(tree, encoding='UTF-8', pretty_print=True,
                              xml_declaration=True)
-        zip = zipfile.ZipFile(outfile, 'w', zipfile.ZIP_DEFLATED, True)
-        zip.comment = 'Cloudlet package for base VM'
-        zip.writestr(cls.MANIFEST_FILENAME, xml)
-        zip.close()
+        writer.writestr(cls.MANIFEST_FILENAME, xml)
+        writer.close()
+
 
-        # zip library bug at python 2.7.3
-        # see more at http://bugs.python.org/issue9720
-
-        #filelist = [base_disk, base_memory, disk_hash, memory_hash]
-        # for filepath in filelist:
-        #    basename = os.path.basename(filepath)
-        #    filesize = os.path.getsize(filepath)
-        #    LOG.info("Zipping %s (%ld bytes) into %s" % (basename, filesize, outfile))
-        #    zip.write(filepath, basename)
-        # zip.close()
-
-        cmd = ['zip', '-j', '-9']
-        cmd += ["%s" % outfile]
-        cmd += [str(base_disk),str(base_memory),str(disk_hash),str(memory_hash)]
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, close_fds=True)
-        LOG.info("Start compressing")
-        LOG.info("%s" % ' '.join(cmd))
-        for line in iter(proc.stdout.readline, ''):
-            line = line.replace('\r', '')
-            sys.stdout.write(line)
-            sys.stdout.flush()
+class _MemberImportThread(threading.Thread):
+
+    '''Stream a member of the zip file to the target path, verifying its
+    CRC-32 and sha256 checksum, and optionally hashing the first hash_size
+    bytes.'''
+
+    def __init__(self, zip_path, member_name, target_path, hash_size=None,
+                 checksum=None, chunk_size=1024*1024):
+        self.zip_path = zip_path
+        self.member_name = member_name
+        self.target_path = target_path
+        self.hash_size = hash_size
+        self.checksum = checksum
+        self.chunk_size = chunk_size
+        self.hash_value = None
+        self.exception = None
+        threading.Thread.__init__(self)
+
+    def run(self):
+        try:
+            self._import_member()
+        except Exception as e:
+            self.exception = e
+
+    def _import_member(self):
+        # each thread has its own file object to read in parallel
+        zip = zipfile.ZipFile(_FileFile("file:///%s" % self.zip_path), 'r')
+        try:
+            member = zip.open(self.member_name)
+            hashing = sha256() if self.hash_size is not None else None
+            hashed_size = 0
+            checksum = sha256() if self.checksum is not None else None
+            with open(self.target_path, "wb") as out_file:
+                while True:
+                    # CRC-32 is checked at the end of the member
+                    data = member.read(self.chunk_size)
+                    if not data:
+                        break
+                    out_file.write(data)
+                    if checksum is not None:
+                        checksum.update(data)
+                    if hashing is not None and hashed_size < self.hash_size:
+                        hash_data = data[:self.hash_size-hashed_size]
+                        hashing.update(hash_data)
+                        hashed_size += len(hash_data)
+            if hashing is not None:
+                self.hash_value = hashing.hexdigest()
+            if checksum is not None and \
+                    checksum.hexdigest() != self.checksum:
+                raise BadPackageError('Member "%s" has wrong checksum' %
+                                      self.member_name)
+        except (zipfile.BadZipfile, zlib.error) as e:
+            raise BadPackageError('Member "%s" is corrupted' %
+                                  self.member_name, str(e))
+        finally:
+            zip.close()
 
 
 class PackagingUtil(object):
@@ -574,13 +879,22 @@ class PackagingUtil(object):
     def export_basevm(output_path, basevm_path, basevm_hashvalue):
         (base_diskmeta, base_mempath, base_memmeta) = \
             Const.get_basepath(basevm_path)
+        # similarity index is optional, and built only at the newer base VM
+        simindex_list = list()
+        for base_path in (basevm_path, base_mempath):
+            index_path = similarity.get_index_path(base_path)
+            if not os.path.exists(index_path):
+                index_path = None
+            simindex_list.append(index_path)
         BaseVMPackage.create(
             output_path,
             basevm_hashvalue,
             basevm_path,
             base_mempath,
             base_diskmeta,
-            base_memmeta)
+            base_memmeta,
+            disk_simindex=simindex_list[0],
+            memory_simindex=simindex_list[1])
 
     @staticmethod
     def _get_basevm_attribute(zipped_file):
@@ -601,21 +915,41 @@ class PackagingUtil(object):
         diskhash_name = tree.find(BaseVMPackage.NSP + 'disk_hash').get('path')
         memoryhash_name = tree.find(
             BaseVMPackage.NSP + 'memory_hash').get('path')
+        # similarity index exists only at the newer package
+        simindex_names = list()
+        for tag in ('disk_simindex', 'memory_simindex'):
+            element = tree.find(BaseVMPackage.NSP + tag)
+            if element is not None:
+                simindex_names.append(element.get('path'))
+            else:
+                simindex_names.append(None)
+        # checksum of each member exists only at the newer package
+        checksums = dict()
+        for element in tree.iterchildren(tag=etree.Element):
+            checksums[element.get('path')] = element.get('sha256')
         zip.close()
 
-        return base_hashvalue, disk_name, memory_name, diskhash_name, memoryhash_name
+        return base_hashvalue, disk_name, memory_name, diskhash_name, \
+            memoryhash_name, checksums, simindex_names
+
+    @staticmethod
+    def _get_disk_hash_size(disk_size, chunk_size=4096, window_size=512):
+        # hash value of the base VM covers the disk up to the end of the last
+        # sliding window of disk hashing
+        if disk_size < chunk_size:
+            return disk_size
+        return (disk_size-chunk_size)/window_size*window_size + chunk_size
 
     @staticmethod
     def import_basevm(filename):
         filename = os.path.abspath(filename)
-        (base_hashvalue, disk_name, memory_name, diskhash_name, memoryhash_name) = \
+        (base_hashvalue, disk_name, memory_name, diskhash_name,
+         memoryhash_name, checksums, simindex_names) = \
             PackagingUtil._get_basevm_attribute(filename)
 
         # check duplica
         base_vm_dir = os.path.join(
             os.path.dirname(Const.BASE_VM_DIR), base_hashvalue)
-        temp_dir = mkdtemp(prefix="cloudlet-base-")
-        disk_tmp_path = os.path.join(temp_dir, disk_name)
         disk_target_path = os.path.join(base_vm_dir, disk_name)
         dbconn, matching_basevm = PackagingUtil._get_matching_basevm(
             disk_path=disk_target_path, hash_value=base_hashvalue)
@@ -624,28 +958,58 @@ class PackagingUtil(object):
                    "Delete existing Base VM using command. "
                    "See more 'cloudlet --help'")
             raise ImportBaseError(msg)
-        if not os.path.exists(base_vm_dir):
+        is_new_dir = not os.path.exists(base_vm_dir)
+        if is_new_dir:
             LOG.info("create directory for base VM")
             os.makedirs(base_vm_dir)
 
-        # decompress
-        LOG.info("Decompressing Base VM to temp directory at %s" % temp_dir)
-        zipbase = zipfile.ZipFile(_FileFile("file:///%s" % filename), 'r')
-        zipbase.extractall(temp_dir)
-        shutil.move(disk_tmp_path, disk_target_path)
+        # decompress each member to its place in parallel
         (target_diskhash, target_memory, target_memoryhash) = \
             Const.get_basepath(disk_target_path, check_exist=False)
-        path_list = {
-            os.path.join(temp_dir, memory_name): target_memory,
-            os.path.join(temp_dir, diskhash_name): target_diskhash,
-            os.path.join(temp_dir, memoryhash_name): target_memoryhash,
-            }
-
-        LOG.info("Place base VM to a right directory")
-        for (src, dest) in path_list.iteritems():
-            shutil.move(src, dest)
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        zipbase = zipfile.ZipFile(_FileFile("file:///%s" % filename), 'r')
+        disk_size = zipbase.getinfo(disk_name).file_size
+        zipbase.close()
+        import_threads = [
+            _MemberImportThread(
+                filename, disk_name, disk_target_path,
+                hash_size=PackagingUtil._get_disk_hash_size(disk_size),
+                checksum=checksums.get(disk_name)),
+            _MemberImportThread(filename, memory_name, target_memory,
+                                checksum=checksums.get(memory_name)),
+            _MemberImportThread(filename, diskhash_name, target_diskhash,
+                                checksum=checksums.get(diskhash_name)),
+            _MemberImportThread(filename, memoryhash_name, target_memoryhash,
+                                checksum=checksums.get(memoryhash_name)),
+            ]
+        for (simindex_name, base_path) in zip(
+                simindex_names, (disk_target_path, target_memory)):
+            if simindex_name is not None:
+                import_threads.append(_MemberImportThread(
+                    filename, simindex_name,
+                    similarity.get_index_path(base_path),
+                    checksum=checksums.get(simindex_name)))
+        LOG.info("Decompressing Base VM to %s" % base_vm_dir)
+        for import_thread in import_threads:
+            import_thread.start()
+        for import_thread in import_threads:
+            import_thread.join()
+
+        # verify before registering it
+        try:
+            for import_thread in import_threads:
+                if import_thread.exception is not None:
+                    raise import_thread.exception
+            if import_threads[0].hash_value != base_hashvalue:
+                msg = "Hash value of the Base VM disk does not match: %s" % \
+                    import_threads[0].hash_value
+                raise ImportBaseError(msg)
+        except Exception:
+            for import_thread in import_threads:
+                if os.path.exists(import_thread.target_path):
+                    os.unlink(import_thread.target_path)
+            if is_new_dir and len(os.listdir(base_vm_dir)) == 0:
+                os.rmdir(base_vm_dir)
+            raise
 
         # add to DB
         LOG.info("Register New Base to DB")
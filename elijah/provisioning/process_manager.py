@@ -301,6 +301,16 @@ class ProcessManager(threading.Thread):
         iteration_num = worker.monitor_current_iteration.value
         return iteration_num
 
+    def get_migration_iteration_info(self):
+        # (current iteration, received size of the current iteration,
+        #  memory size processed by the pipeline)
+        worker = self.process_list.get("CreateMemoryDeltalist", None)
+        if worker is None:
+            return None
+        return (worker.monitor_current_iteration.value,
+                worker.monitor_current_iteration_size.value,
+                worker.monitor_total_input_size.value)
+
     def get_network_speed(self):
         if self.migration_dest.startswith("network"):
             # Only used for experiement.  If it's bigger than 0, adaptation use 
@@ -315,6 +325,11 @@ class ProcessManager(threading.Thread):
                 if worker_info['is_processing_alive'].value == False:
                     return None
                 network_bw = worker.monitor_network_bw.value
+                # adaptation chooses mode for the bandwidth granted by
+                # the shaping, which is known before the measurement
+                shaped_bw = worker.monitor_shaped_bw.value
+                if shaped_bw > 0 and (network_bw <= 0 or network_bw > shaped_bw):
+                    network_bw = shaped_bw
                 if network_bw <= 0:
                     return None
                 return network_bw  # mbps
@@ -22,105 +22,248 @@ import sys
 import socket
 import json
 import time
-import select
+import Queue
 
+# to work with OpenStack's eventlet
+try:
+    from eventlet import patcher
+    if patcher.is_monkey_patched("thread"):
+        native_threading = patcher.original("threading")
+    else:
+        raise ImportError("threading is not monkey-patched")
+except ImportError as e:
+    import threading
+    native_threading = threading
 
-class QmpAfUnix:
+
+class QmpError(Exception):
+    pass
+
+
+class QmpRequest(object):
+    """Pending QMP command. The response is matched by the command id.
+    """
+
+    def __init__(self, request_id, command, callback=None):
+        self.request_id = request_id
+        self.command = command
+        self.callback = callback
+        self.response = None
+        self._done = native_threading.Event()
+
+    def set_response(self, response):
+        self.response = response
+        self._done.set()
+        if self.callback is not None:
+            self.callback(response)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        # returns response, or None at timeout or disconnection
+        self._done.wait(timeout)
+        return self.response
+
+    def is_success(self, timeout=None):
+        response = self.wait(timeout)
+        return response is not None and "return" in response
+
+
+class QmpAfUnix(object):
+    """QMP client over AF_UNIX socket.
+    Commands are sent without waiting for the response, so several commands
+    can be in flight. A reader thread matches responses by id and delivers
+    events to the subscribers, or keeps them to be waited for.
+    """
+    EVENT_STOP = "STOP"
+    EVENT_RESUME = "RESUME"
+    EVENT_MIGRATION = "MIGRATION"
+    # seconds to wait for the STOP event after stop-raw-live
+    STOP_EVENT_TIMEOUT = 10
 
     def __init__(self, s_name):
         self.s_name = s_name
+        self.sock = None
+        self.greeting = None
+        self._request_id = 0
+        self._request_dict = dict()
+        self._subscriber_dict = dict()
+        self._event_queue_dict = dict()
+        self._lock = native_threading.Lock()
+        self._greeting_received = native_threading.Event()
+        self._closed = False
+        self._reader = None
 
     def connect(self):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.connect(self.s_name)
+        self._closed = False
+        self._reader = native_threading.Thread(target=self._read_messages)
+        self._reader.daemon = True
+        self._reader.start()
 
     def disconnect(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.sock.close()
+        if self._reader is not None and \
+                self._reader is not native_threading.current_thread():
+            self._reader.join()
+        self.sock = None
+        self._reader = None
+
+    def _read_messages(self):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            buf += data
+            # QEMU separates messages with new line, but do not rely on it
+            while True:
+                buf = buf.lstrip()
+                if len(buf) == 0:
+                    break
+                try:
+                    message, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                self._handle_message(message)
+
+        # wake up all the waiting requests and events
+        with self._lock:
+            self._closed = True
+            request_list = self._request_dict.values()
+            self._request_dict.clear()
+            event_queue_list = self._event_queue_dict.values()
+        for request in request_list:
+            request.set_response(None)
+        for event_queue in event_queue_list:
+            event_queue.put(None)
+        self._greeting_received.set()
+
+    def _handle_message(self, message):
+        if "QMP" in message:
+            self.greeting = message
+            self._greeting_received.set()
+        elif "event" in message:
+            event_name = message["event"]
+            with self._lock:
+                subscribers = list(self._subscriber_dict.get(event_name, []))
+                event_queue = self._event_queue_dict.setdefault(
+                    event_name, Queue.Queue())
+            event_queue.put(message)
+            for callback in subscribers:
+                callback(message)
+        elif "id" in message:
+            with self._lock:
+                request = self._request_dict.pop(message["id"], None)
+            if request is not None:
+                request.set_response(message)
+        else:
+            sys.stderr.write("Unexpected QMP message: %s\n" % str(message))
+
+    def subscribe(self, event_name, callback):
+        with self._lock:
+            self._subscriber_dict.setdefault(event_name, list()).append(callback)
+
+    def unsubscribe(self, event_name, callback):
+        with self._lock:
+            subscribers = self._subscriber_dict.get(event_name, [])
+            if callback in subscribers:
+                subscribers.remove(callback)
+
+    def wait_event(self, event_name, timeout=None):
+        # returns the oldest event that is not waited yet, or None at timeout
+        # or disconnection
+        with self._lock:
+            event_queue = self._event_queue_dict.setdefault(
+                event_name, Queue.Queue())
+            if self._closed and event_queue.empty():
+                return None
+        try:
+            return event_queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def execute(self, command, arguments=None, callback=None):
+        # send command and return QmpRequest without waiting for the response
+        with self._lock:
+            self._request_id += 1
+            request = QmpRequest(self._request_id, command, callback)
+            if self._closed:
+                raise QmpError("Cannot send %s: disconnected" % command)
+            self._request_dict[request.request_id] = request
+        json_cmd = {"execute": command, "id": request.request_id}
+        if arguments is not None:
+            json_cmd["arguments"] = arguments
+        try:
+            self.sock.sendall(json.dumps(json_cmd))
+        except socket.error as e:
+            with self._lock:
+                self._request_dict.pop(request.request_id, None)
+            raise QmpError("Cannot send %s: %s" % (command, str(e)))
+        return request
 
     # first we need to negotiate qmp capabilities before
     # issuing commands.
     # returns True on success, False otherwise
     def qmp_negotiate(self):
         # qemu provides capabilities information first
-        select.select([self.sock], [], [])
-        capabilities = json.loads(self.sock.recv(1024))
-
-        json_cmd = json.dumps({"execute": "qmp_capabilities"})
-        self.sock.sendall(json_cmd)
-        response = json.loads(self.sock.recv(1024))
-        if "return" in response:
-            return True
-        else:
+        self._greeting_received.wait()
+        if self.greeting is None:
             return False
+        return self.execute("qmp_capabilities").is_success()
 
-    # returns True on success, False otherwise
-    def stop_raw_live(self):
-        json_cmd = json.dumps({"execute": "stop-raw-live"})
-        self.sock.sendall(json_cmd)
-        select.select([self.sock], [], [])
-        response = json.loads(self.sock.recv(1024))
-        if "return" not in response:
+    # returns time stamp of STOP event, True if stopped without the event,
+    # or None if STOP event is not arrived in timeout
+    def stop_raw_live(self, timeout=STOP_EVENT_TIMEOUT):
+        # ignore STOP events before this request
+        with self._lock:
+            if not self._closed:
+                self._event_queue_dict[self.EVENT_STOP] = Queue.Queue()
+        request = self.execute("stop-raw-live")
+        if not request.is_success():
             return True
 
-        # wait for QEVENT_STOP in next 10 responses
-        try:
-            for i in range(10):
-                select.select([self.sock], [], [])
-                recved_data = self.sock.recv(1024)
-                response = json.loads(recved_data)
-                if "event" in response and response["event"] == "STOP":
-                    timestamp = response["timestamp"]
-                    ts = float(timestamp["seconds"]) + \
-                        float(timestamp["microseconds"]) / 1000000
-                    return ts
-        except ValueError as e:
-            sys.stderr.write(str(e) + "\n")
-            pass
+        response = self.wait_event(self.EVENT_STOP, timeout=timeout)
+        if response is None:
+            return None
+        timestamp = response["timestamp"]
+        ts = float(timestamp["seconds"]) + \
+            float(timestamp["microseconds"]) / 1000000
+        return ts
 
-        return None
-
-    # returns True on success, False otherwise
-    def iterate_raw_live(self):
-        try:
-            json_cmd = json.dumps({"execute": "iterate-raw-live"})
-            self.sock.sendall(json_cmd)
-            select.select([self.sock], [], [])
-            recved_data = self.sock.recv(1024)
-            response = json.loads(recved_data)
-            if "return" in response:
-                return True
-            else:
-                return False
-        except Exception as e:
-            sys.stderr.write(str(e) + "\n")
-            sys.stderr.write(recved_data)
-            pass
+    # returns True on success, False otherwise.
+    # returns QmpRequest without waiting for the response if wait is False
+    def iterate_raw_live(self, wait=True):
+        if not wait:
+            return self.execute("iterate-raw-live")
+        return self._execute_once("iterate-raw-live")
 
     # returns True on success, False otherwise
     def randomize_raw_live(self):
-        json_cmd = json.dumps({"execute": "randomize-raw-live"})
-        self.sock.sendall(json_cmd)
-        try:
-            recved_data = self.sock.recv(1024)
-            response = json.loads(recved_data)
-            if "return" in response:
-                return True
-            else:
-                return False
-        except Exception as e:
-            sys.stderr.write(str(e) + "\n")
-            sys.stderr.write(recved_data)
-            pass
+        return self._execute_once("randomize-raw-live")
 
     # returns True on success, False otherwise
     def unrandomize_raw_live(self):
-        json_cmd = json.dumps({"execute": "unrandomize-raw-live"})
-        self.sock.sendall(json_cmd)
-        select.select([self.sock], [], [])
-        response = json.loads(self.sock.recv(1024))
-        if "return" in response:
-            return True
-        else:
+        return self._execute_once("unrandomize-raw-live")
+
+    def _execute_once(self, command):
+        try:
+            return self.execute(command).is_success()
+        except QmpError as e:
+            sys.stderr.write(str(e) + "\n")
             return False
 
     def stop_raw_live_once(self):
@@ -0,0 +1,211 @@
+#
+# cloudlet-recovery context pool
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+import os
+import mmap
+import math
+import time
+import shutil
+import threading
+import collections
+from tempfile import mkdtemp
+
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RecoveryPoolError(Exception):
+    pass
+
+
+def _map_file(path):
+    with open(path, "rb") as fd:
+        return mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+
+
+class RecoveryContext(object):
+    '''Files that a recovery of the launch VM needs before it recovers the
+    first chunk. The read-only mapping of the base disk and memory is
+    shared by the contexts of the base VM, and the recovery processes
+    inherit it at fork. Launch disk, launch memory and the named pipes are
+    made at the temp directory, which belongs to the session once taken
+    '''
+    OVERLAY_PIPE = "overlay_pipe"
+    LAUNCH_DISK = "launch-disk"
+    LAUNCH_MEMORY = "launch-mem"
+
+    def __init__(self, base_disk, base_mem, base_mappings):
+        self.base_disk = base_disk
+        self.base_mem = base_mem
+        # (raw disk, raw memory) mapped read-only
+        self.base_mappings = base_mappings
+        self.temp_dir = mkdtemp(prefix="cloudlet-recovery-")
+        self.overlay_pipe = os.path.join(self.temp_dir, self.OVERLAY_PIPE)
+        # overlay stream from the decompression, and the chunks recovered
+        # for FUSE
+        os.mkfifo(self.overlay_pipe)
+        self.fuse_pipe = self.overlay_pipe + ".fifo"
+        os.mkfifo(self.fuse_pipe)
+        self.launch_disk = os.path.join(self.temp_dir, self.LAUNCH_DISK)
+        self.launch_mem = os.path.join(self.temp_dir, self.LAUNCH_MEMORY)
+        for path in (self.launch_disk, self.launch_mem):
+            open(path, "wb").close()
+
+    def close(self):
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+
+class RecoveryContextPool(object):
+    '''Keep ready recovery contexts for each registered base VM. The number
+    of contexts follows the request rate of the base VM, so that the
+    requests arriving within RECOVERY_POOL_HORIZON seconds find a ready
+    one. Contexts taken from the pool are made again at a background thread
+    '''
+    # weight of the latest interval at the moving average
+    RATE_WEIGHT = 0.3
+
+    def __init__(self, min_size=Const.RECOVERY_POOL_MIN_SIZE,
+                 max_size=Const.RECOVERY_POOL_MAX_SIZE,
+                 horizon=Const.RECOVERY_POOL_HORIZON, background=True):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.horizon = horizon
+        self.background = background
+        self.lock = threading.Lock()
+        # base disk --> (base memory, (raw disk, raw memory))
+        self.base_dict = dict()
+        # base disk --> ready contexts
+        self.context_dict = dict()
+        # base disk --> [time of the last request, averaged interval]
+        self.rate_dict = dict()
+        self.filling_set = set()
+
+    def register(self, base_disk, base_mem):
+        with self.lock:
+            if base_disk in self.base_dict:
+                return
+            base_mappings = (_map_file(base_disk), _map_file(base_mem))
+            self.base_dict[base_disk] = (base_mem, base_mappings)
+            self.context_dict[base_disk] = collections.deque()
+            self.rate_dict[base_disk] = [None, None]
+        self.fill(base_disk)
+        LOG.info("Recovery contexts are ready for %s" % base_disk)
+
+    def get_target_size(self, base_disk):
+        interval = self.rate_dict[base_disk][1]
+        if interval is None:
+            return self.min_size
+        if interval <= 0:
+            return self.max_size
+        target_size = int(math.ceil(self.horizon / interval))
+        return max(self.min_size, min(self.max_size, target_size))
+
+    def _update_rate(self, base_disk):
+        now = time.time()
+        rate = self.rate_dict[base_disk]
+        if rate[0] is not None:
+            interval = now - rate[0]
+            if rate[1] is None:
+                rate[1] = interval
+            else:
+                rate[1] = self.RATE_WEIGHT*interval + \
+                    (1-self.RATE_WEIGHT)*rate[1]
+        rate[0] = now
+
+    def _new_context(self, base_disk):
+        (base_mem, base_mappings) = self.base_dict[base_disk]
+        return RecoveryContext(base_disk, base_mem, base_mappings)
+
+    def get(self, base_disk):
+        '''Return a ready context of the base VM. Caller owns the context,
+        and its temp directory is removed with the session
+        '''
+        with self.lock:
+            if base_disk not in self.base_dict:
+                raise RecoveryPoolError("Base VM is not registered: %s" %
+                                        base_disk)
+            self._update_rate(base_disk)
+            context_list = self.context_dict[base_disk]
+            context = None
+            if len(context_list) > 0:
+                context = context_list.popleft()
+            else:
+                LOG.info("No ready recovery context for %s" % base_disk)
+                context = self._new_context(base_disk)
+            if self.background:
+                if base_disk not in self.filling_set:
+                    self.filling_set.add(base_disk)
+                    fill_thread = threading.Thread(target=self.fill,
+                                                   args=(base_disk,))
+                    fill_thread.daemon = True
+                    fill_thread.start()
+        if not self.background:
+            self.fill(base_disk)
+        return context
+
+    def fill(self, base_disk):
+        '''Make contexts of the base VM up to its target size, or close the
+        contexts beyond it once the requests slow down
+        '''
+        try:
+            while True:
+                with self.lock:
+                    context_list = self.context_dict.get(base_disk, None)
+                    if context_list is None:
+                        return
+                    target_size = self.get_target_size(base_disk)
+                    if len(context_list) > target_size:
+                        context_list.pop().close()
+                        continue
+                    if len(context_list) == target_size:
+                        return
+                context = self._new_context(base_disk)
+                with self.lock:
+                    if base_disk in self.context_dict:
+                        self.context_dict[base_disk].append(context)
+                        continue
+                context.close()
+                return
+        finally:
+            with self.lock:
+                self.filling_set.discard(base_disk)
+
+    def get_state(self):
+        '''Return ready contexts, target size and averaged request interval
+        of each base VM
+        '''
+        with self.lock:
+            return dict((base_disk, {
+                "ready": len(self.context_dict[base_disk]),
+                "target": self.get_target_size(base_disk),
+                "interval": self.rate_dict[base_disk][1]})
+                for base_disk in self.base_dict)
+
+    def close(self):
+        with self.lock:
+            for context_list in self.context_dict.itervalues():
+                for context in context_list:
+                    context.close()
+            for (base_mem, base_mappings) in self.base_dict.itervalues():
+                for raw_data in base_mappings:
+                    raw_data.close()
+            self.context_dict.clear()
+            self.base_dict.clear()
+            self.rate_dict.clear()
@@ -25,12 +25,18 @@ import sys
 import time
 import SocketServer
 import socket
-import tempfile
 import struct
 import shutil
 import threading
+import tempfile
+from hashlib import sha256
 
 import synthesis as synthesis
+import delta
+from admission import AdmissionController
+from admission import AdmissionError
+from admission import SessionCost
+from recovery_pool import RecoveryContextPool
 from package import VMOverlayPackage
 from db.api import DBConnector
 from db.table_def import BaseVM, Session, OverlayVM
@@ -149,11 +155,159 @@ class NetworkUtil(object):
         return msgpack.unpackb(data)
 
 
+def forward_segment(chunk_iter, out_queue, segment_name, segment_size,
+                    is_stored, digest=None, leaves=None, skip_size=0):
+    '''Put chunks of an overlay segment to out_queue, and return (read
+    size, chunk count, forwarded size, whether the segment matches its
+    digest). leaves is (leaf size, leaf digests) chaining up to the Merkle
+    root at the meta, and each leaf is forwarded once it is verified, so
+    that only the rest of a corrupted segment has to be forwarded at the
+    next fetch. Leaves before skip_size were forwarded at the earlier fetch
+    and are only verified. Segment up to a leaf is a single leaf, and the
+    larger one of the old overlay is forwarded as it arrives and fails at
+    corruption.
+    '''
+    chunk_iter = iter(chunk_iter)
+    (leaf_size, leaf_digests) = leaves or (None, None)
+    if leaf_digests is None and digest is not None and \
+            segment_size is not None and \
+            segment_size <= Cloudlet_Const.OVERLAY_MERKLE_LEAF_SIZE:
+        (leaf_size, leaf_digests) = (segment_size, [digest])
+    hash_value = None
+    if leaf_digests is None and digest is not None:
+        hash_value = sha256()
+    if is_stored and leaf_digests is None:
+        out_queue.put(Synthesis_Const.STORED_SEGMENT)
+    read_count = 0
+    chunk_count = 0
+    forwarded_size = skip_size
+    is_valid = True
+    leaf_index = 0
+    leaf_data = ''
+    while True:
+        chunk = next(chunk_iter, None)
+        if chunk:
+            read_count += len(chunk)
+            chunk_count += 1
+        if leaf_digests is None:
+            if not chunk:
+                break
+            if hash_value is not None:
+                hash_value.update(chunk)
+            out_queue.put(chunk)
+            continue
+        if not is_valid:
+            # rest of the corrupted segment is read but not forwarded
+            if not chunk:
+                break
+            continue
+        if chunk:
+            leaf_data += chunk
+        # last leaf can be shorter than the others
+        while len(leaf_data) >= leaf_size or (not chunk and leaf_data):
+            leaf = leaf_data[:leaf_size]
+            leaf_data = leaf_data[leaf_size:]
+            if leaf_index >= len(leaf_digests) or \
+                    sha256(leaf).hexdigest() != leaf_digests[leaf_index]:
+                LOG.warning("Corrupted overlay segment: %s at %d" %
+                            (segment_name, leaf_index*leaf_size))
+                is_valid = False
+                break
+            if leaf_index*leaf_size >= skip_size:
+                if is_stored and leaf_index == 0:
+                    out_queue.put(Synthesis_Const.STORED_SEGMENT)
+                out_queue.put(leaf)
+                forwarded_size += len(leaf)
+            leaf_index += 1
+        if not chunk:
+            break
+
+    if leaf_digests is not None and is_valid and \
+            leaf_index != len(leaf_digests):
+        LOG.warning("Truncated overlay segment: %s" % segment_name)
+        is_valid = False
+    if hash_value is not None and hash_value.hexdigest() != digest:
+        msg = "Corrupted overlay segment: %s" % segment_name
+        raise RapidSynthesisError(msg)
+    if not is_valid:
+        return read_count, chunk_count, forwarded_size, False
+    # each segment is an independent compressed stream
+    out_queue.put(Synthesis_Const.END_OF_SEGMENT)
+    return read_count, chunk_count, forwarded_size, True
+
+
+def get_request_segments(blob_info_list, frame_support=True):
+    '''Return (request names, {request name: size}, {request name:
+    [(segment name, offset, size)]}) of the overlay fetched from the
+    client. Client without frame support is asked for the whole blob, and
+    its response is split into the frames of the blob
+    '''
+    request_list = list()
+    request_size = dict()
+    request_segments = dict()
+    for (segment_name, blob_name, offset, size) in \
+            delta.get_overlay_segments(blob_info_list):
+        if frame_support:
+            (request_name, offset) = (segment_name, 0)
+        else:
+            request_name = blob_name
+        if request_name not in request_segments:
+            request_list.append(request_name)
+            request_size[request_name] = 0
+            request_segments[request_name] = list()
+        request_segments[request_name].append((segment_name, offset, size))
+        request_size[request_name] = max(request_size[request_name],
+                                         offset + size)
+    return request_list, request_size, request_segments
+
+
+class _SegmentSpool(object):
+    '''Queue holding verified segments at a temporary file, while the rest
+    of a partly forwarded segment is fetched again. Decompressor takes a
+    segment at a time, so the others wait for it
+    '''
+    def __init__(self):
+        self.spool_file = tempfile.TemporaryFile(prefix="cloudlet-segment-")
+        # marker, or size of the chunk at the file
+        self.item_list = list()
+
+    def put(self, item):
+        if item == Synthesis_Const.STORED_SEGMENT or \
+                item == Synthesis_Const.END_OF_SEGMENT:
+            self.item_list.append(item)
+            return
+        self.spool_file.write(item)
+        self.item_list.append(len(item))
+
+    def mark(self):
+        return (len(self.item_list), self.spool_file.tell())
+
+    def rollback(self, mark):
+        (item_count, file_offset) = mark
+        del self.item_list[item_count:]
+        self.spool_file.seek(file_offset)
+        self.spool_file.truncate()
+
+    def flush(self, out_queue):
+        self.spool_file.seek(0)
+        for item in self.item_list:
+            if isinstance(item, (int, long)):
+                out_queue.put(self.spool_file.read(item))
+            else:
+                out_queue.put(item)
+        self.rollback((0, 0))
+
+    def close(self):
+        self.spool_file.close()
+
+
 class NetworkStepThread(threading.Thread):
     MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, network_handler, overlay_urls, overlay_urls_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            stored_segments=None, segment_digests=None,
+            segment_leaves=None, request_segments=None):
         self.network_handler = network_handler
         self.read_stream = network_handler.rfile
         self.overlay_urls = overlay_urls
@@ -162,19 +316,80 @@ class NetworkStepThread(threading.Thread):
         self.out_queue = out_queue
         self.time_queue = time_queue
         self.chunk_size = chunk_size
+        # segments saved without compression
+        self.stored_segments = stored_segments or set()
+        # segment name --> sha256 hex digest or Merkle root of its leaves
+        self.segment_digests = segment_digests or dict()
+        # segment name --> (leaf size, leaf digests)
+        self.segment_leaves = segment_leaves or dict()
+        # request name --> [(segment name, offset, size)] at the response.
+        # Request is the segment itself if not listed
+        self.request_segments = request_segments or dict()
+        self.segment_requests = dict()
+        for (request_name, segment_list) in self.request_segments.items():
+            for segment in segment_list:
+                self.segment_requests[segment[0]] = request_name
         threading.Thread.__init__(self, target=self.receive_overlay_blobs)
 
     def exception_handler(self):
         self.out_queue.put(Synthesis_Const.ERROR_OCCURED)
         self.time_queue.put({'start_time':-1, 'end_time':-1, "bw_mbps":0})
 
+    def _iter_segment(self, blob_size):
+        read_count = 0
+        while read_count < blob_size:
+            read_min_size = min(self.chunk_size, blob_size-read_count)
+            chunk = self.read_stream.read(read_min_size)
+            if not chunk:
+                break
+            read_count += len(chunk)
+            yield chunk
+
+    def _forward_response(self, blob_url, blob_size, out_queue, skip_size):
+        # forward the segments at the response, and return (read size,
+        # chunk count, forwarded size, whether every segment is valid).
+        # Segments after a corrupted one are read but not forwarded
+        segment_list = self.request_segments.get(
+            blob_url, [(blob_url, 0, blob_size)])
+        read_count = 0
+        chunk_count = 0
+        forwarded_size = 0
+        is_valid = True
+        for (segment_name, offset, size) in segment_list:
+            if not is_valid:
+                break
+            if offset + size <= skip_size:
+                # segment forwarded at the earlier fetch
+                forwarded_size = offset + size
+                continue
+            for chunk in self._iter_segment(offset - read_count):
+                read_count += len(chunk)
+            (read_size, segment_chunks, segment_forwarded, is_valid) = \
+                forward_segment(
+                    self._iter_segment(size), out_queue, segment_name,
+                    size, segment_name in self.stored_segments,
+                    self.segment_digests.get(segment_name, None),
+                    self.segment_leaves.get(segment_name, None),
+                    max(0, skip_size - offset))
+            read_count += read_size
+            chunk_count += segment_chunks
+            forwarded_size = offset + segment_forwarded
+        for chunk in self._iter_segment(blob_size - read_count):
+            read_count += len(chunk)
+        return read_count, chunk_count, forwarded_size, is_valid
+
     @wrap_process_fault
     def receive_overlay_blobs(self):
         total_read_size = 0
         counter = 0
         index = 0 
         finished_url = dict()
+        refetch_count = dict()
         requesting_list = list()
+        # segment forwarded in part --> its forwarded size
+        partial_url = None
+        partial_size = 0
+        spool = None
         out_of_order_count = 0
         total_urls_count = len(self.overlay_urls)
         start_time = time.time()
@@ -183,7 +398,12 @@ class NetworkStepThread(threading.Thread):
             #request to client until it becomes more than MAX_REQUEST_SIZE
             while True:
                 requesting_size = sum([self.overlay_urls_size[item] for item in requesting_list])
-                if requesting_size > self.MAX_REQUEST_SIZE or len(self.overlay_urls) == 0:
+                if partial_url is not None:
+                    # nothing else is requested until the rest of the
+                    # partly forwarded segment arrives
+                    if partial_url not in self.overlay_urls:
+                        break
+                elif requesting_size > self.MAX_REQUEST_SIZE or len(self.overlay_urls) == 0:
                     # Enough requesting list or nothing left to request
                     break;
 
@@ -192,13 +412,18 @@ class NetworkStepThread(threading.Thread):
                 while not self.demanding_queue.empty():
                     # demanding_queue can have multiple same request
                     demanding_url = self.demanding_queue.get()
+                    demanding_url = self.segment_requests.get(
+                        demanding_url, demanding_url)
                     if (finished_url.get(demanding_url, False) == False) and \
                             (demanding_url not in requesting_list):
                         urgent_overlay_url = demanding_url
                         break
 
                 requesting_overlay = None
-                if urgent_overlay_url != None:
+                if partial_url is not None:
+                    requesting_overlay = partial_url
+                    self.overlay_urls.remove(requesting_overlay)
+                elif urgent_overlay_url != None:
                     requesting_overlay = urgent_overlay_url
                     out_of_order_count += 1
                     if requesting_overlay in self.overlay_urls:
@@ -232,21 +457,42 @@ class NetworkStepThread(threading.Thread):
 
             finished_url[blob_url] = True
             requesting_list.remove(blob_url)
-            read_count = 0
-            while read_count < blob_size:
-                read_min_size = min(self.chunk_size, blob_size-read_count)
-                chunk = self.read_stream.read(read_min_size)
-                read_size = len(chunk)
-                if chunk:
-                    self.out_queue.put(chunk)
-                else:
-                    break
-
-                counter += 1
-                read_count += read_size
+            out_queue = self.out_queue
+            skip_size = 0
+            if blob_url == partial_url:
+                skip_size = partial_size
+            elif partial_url is not None:
+                # segment requested before the refetch waits at the spool
+                out_queue = spool
+                spool_mark = spool.mark()
+            (read_count, chunk_count, forwarded_size, is_valid) = \
+                self._forward_response(blob_url, blob_size, out_queue,
+                                       skip_size)
+            counter += chunk_count
             total_read_size += read_count
             index += 1
-
+            if not is_valid:
+                # request only the corrupted segment again
+                refetch_count[blob_url] = refetch_count.get(blob_url, 0) + 1
+                if refetch_count[blob_url] > \
+                        Cloudlet_Const.OVERLAY_REFETCH_COUNT:
+                    msg = "Overlay segment is corrupted again: %s" % blob_url
+                    raise RapidSynthesisError(msg)
+                del finished_url[blob_url]
+                self.overlay_urls.insert(0, blob_url)
+                if out_queue is spool:
+                    spool.rollback(spool_mark)
+                elif forwarded_size > 0:
+                    partial_url = blob_url
+                    partial_size = forwarded_size
+                    if spool is None:
+                        spool = _SegmentSpool()
+            elif blob_url == partial_url:
+                partial_url = None
+                spool.flush(self.out_queue)
+
+        if spool is not None:
+            spool.close()
         self.out_queue.put(Synthesis_Const.END_OF_FILE)
         end_time = time.time()
         time_delta= end_time-start_time
@@ -289,6 +535,7 @@ class DecompStepProc(Process):
         start_time = time.time()
         data_size = 0
         counter = 0
+        is_stored_segment = False
 
         while True:
             chunk = self.input_queue.get()
@@ -296,8 +543,30 @@ class DecompStepProc(Process):
                 break
             if chunk == Synthesis_Const.ERROR_OCCURED:
                 break;
+            if chunk == Synthesis_Const.STORED_SEGMENT:
+                # incompressible chunks are passed through until the end of
+                # the segment
+                is_stored_segment = True
+                self.input_queue.task_done()
+                continue
+            if chunk == Synthesis_Const.END_OF_SEGMENT:
+                if is_stored_segment:
+                    is_stored_segment = False
+                    self.input_queue.task_done()
+                    continue
+                # start new decompressor for the next segment
+                decomp_chunk = self.decompressor.flush()
+                self.decompressor = LZMADecompressor()
+                self.input_queue.task_done()
+                self.output_queue.write(decomp_chunk)
+                if self.temp_overlay_file:
+                    self.temp_overlay_file.write(decomp_chunk)
+                continue
             data_size = data_size + len(chunk)
-            decomp_chunk = self.decompressor.decompress(chunk)
+            if is_stored_segment:
+                decomp_chunk = chunk
+            else:
+                decomp_chunk = self.decompressor.decompress(chunk)
 
             self.input_queue.task_done()
             self.output_queue.write(decomp_chunk)
@@ -323,9 +592,19 @@ class URLFetchStep(threading.Thread):
     MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, overlay_package, overlay_files, overlay_files_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            overlay_segments=None, stored_segments=None,
+            segment_digests=None, segment_leaves=None):
         self.overlay_files = overlay_files
         self.overlay_files_size = overlay_files_size
+        # segment name --> (blob name, offset, size)
+        self.overlay_segments = overlay_segments or dict()
+        # segments saved without compression
+        self.stored_segments = stored_segments or set()
+        # segment name --> sha256 hex digest or Merkle root of its leaves
+        self.segment_digests = segment_digests or dict()
+        # segment name --> (leaf size, leaf digests)
+        self.segment_leaves = segment_leaves or dict()
         self.overlay_package = overlay_package
         self.demanding_queue = demanding_queue
         self.out_queue = out_queue
@@ -367,14 +646,29 @@ class URLFetchStep(threading.Thread):
 
             finished_url[requesting_overlay] = True
             read_count = 0
-            for chunk in self.overlay_package.iter_blob(requesting_overlay, \
-                    self.chunk_size):
-                read_size = len(chunk)
-                if chunk:
-                    self.out_queue.put(chunk)
-                else:
-                    break
+            (blob_name, offset, size) = self.overlay_segments.get(
+                requesting_overlay, (requesting_overlay, 0, None))
+            # corrupted segment is read again with a new request, and its
+            # leaves forwarded at the earlier read are skipped
+            forwarded_size = 0
+            for retry in xrange(Cloudlet_Const.OVERLAY_REFETCH_COUNT+1):
+                (read_size, chunk_count, forwarded_size, is_valid) = \
+                    forward_segment(
+                        self.overlay_package.iter_blob(
+                            blob_name, self.chunk_size, offset, size),
+                        self.out_queue, requesting_overlay, size,
+                        requesting_overlay in self.stored_segments,
+                        self.segment_digests.get(requesting_overlay, None),
+                        self.segment_leaves.get(requesting_overlay, None),
+                        forwarded_size)
+                counter += chunk_count
                 read_count += read_size
+                if is_valid:
+                    break
+            else:
+                msg = "Overlay segment is corrupted again: %s" % \
+                    requesting_overlay
+                raise RapidSynthesisError(msg)
 
             # request overlay blob
             total_read_size += read_count
@@ -489,18 +783,48 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         new_overlayvm = OverlayVM(session_id, base_path)
         self.server.dbconn.add_item(new_overlayvm)
 
+        # segment digests chain up to the Merkle root at the meta
+        try:
+            delta.check_overlay_merkle(meta_info)
+        except delta.DeltaError as e:
+            self.ret_fail(str(e))
+            return
+        segment_digests = delta.get_segment_digests(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES])
+        segment_leaves = delta.get_segment_leaves(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES])
+
+        # requests are handled one by one at this server, so the session
+        # does not wait for the sessions of this server to be closed
+        try:
+            self.server.admission.admit(
+                session_id, SessionCost.from_meta(meta_info), timeout=0)
+        except AdmissionError as e:
+            self.ret_fail(str(e))
+            return
+
         # start synthesis process
         url_manager = Manager()
         overlay_urls = url_manager.list()
         overlay_urls_size = url_manager.dict()
-        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
-            url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
-            size = blob[Cloudlet_Const.META_OVERLAY_FILE_SIZE]
-            overlay_urls.append(url)
-            overlay_urls_size[url] = size
+        # request overlay by segment, which is either a whole blob or an
+        # independently compressed frame of the blob. Old client serves
+        # only the whole blob
+        (request_list, request_size, request_segments) = \
+            get_request_segments(
+                meta_info[Cloudlet_Const.META_OVERLAY_FILES],
+                message.get(Protocol.KEY_SEGMENT_FRAME, False))
+        overlay_urls.extend(request_list)
+        overlay_urls_size.update(request_size)
+        stored_segments = set([
+            url for (url, comp_type) in delta.get_segment_compression(
+                meta_info[Cloudlet_Const.META_OVERLAY_FILES]).iteritems()
+            if comp_type == Cloudlet_Const.COMPRESSION_NONE])
         LOG.info("  - %s" % str(pformat(self.synthesis_option)))
         LOG.info("  - Base VM     : %s" % base_path)
-        LOG.info("  - Blob count  : %d" % len(overlay_urls))
+        LOG.info("  - Blob count  : %d" % len(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES]))
+        LOG.info("  - Segments    : %d" % len(overlay_urls))
         if overlay_urls == None:
             self.ret_fail("No overlay info listed")
             return
@@ -513,9 +837,10 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         # create named pipe to convert queue to stream
         time_transfer = Queue(); time_decomp = Queue();
         time_delta = Queue(); time_fuse = Queue();
-        self.tmp_overlay_dir = tempfile.mkdtemp()
-        self.overlay_pipe = os.path.join(self.tmp_overlay_dir, 'overlay_pipe')
-        os.mkfifo(self.overlay_pipe)
+        # temp directory and pipes of the session are ready at the pool
+        recovery_context = self.server.recovery_pool.get(base_path)
+        self.tmp_overlay_dir = recovery_context.temp_dir
+        self.overlay_pipe = recovery_context.overlay_pipe
 
         # save overlay decomp result for measurement
         temp_overlay_file = None
@@ -529,13 +854,17 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         download_process = NetworkStepThread(self, 
                     overlay_urls, overlay_urls_size, demanding_queue, 
                     download_queue, time_transfer, Synthesis_Const.TRANSFER_SIZE, 
-                    )
+                    stored_segments=stored_segments,
+                    segment_digests=segment_digests,
+                    segment_leaves=segment_leaves,
+                    request_segments=request_segments)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
                 )
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        recovery_context=recovery_context)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -579,6 +908,9 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             time_end_resume = time.time()
             self.send_synthesis_done()
 
+        # only the resumed VM takes the resources after its recovery
+        self.server.admission.update(session_id, SessionCost(
+            memory=meta_info[Cloudlet_Const.META_RESUME_VM_MEMORY_SIZE]))
         end_time = time.time()
 
         # printout result
@@ -679,18 +1011,47 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         new_overlayvm = OverlayVM(session_id, base_path)
         self.server.dbconn.add_item(new_overlayvm)
 
+        # segment digests chain up to the Merkle root at the meta
+        try:
+            delta.check_overlay_merkle(meta_info)
+        except delta.DeltaError as e:
+            self.ret_fail(str(e))
+            return
+        segment_digests = delta.get_segment_digests(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES])
+        segment_leaves = delta.get_segment_leaves(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES])
+
+        # requests are handled one by one at this server, so the session
+        # does not wait for the sessions of this server to be closed
+        try:
+            self.server.admission.admit(
+                session_id, SessionCost.from_meta(meta_info), timeout=0)
+        except AdmissionError as e:
+            self.ret_fail(str(e))
+            return
+
         # start synthesis process
         url_manager = Manager()
         overlay_urls = url_manager.list()
         overlay_urls_size = url_manager.dict()
-        for blob in meta_info[Cloudlet_Const.META_OVERLAY_FILES]:
-            url = blob[Cloudlet_Const.META_OVERLAY_FILE_NAME]
-            size = blob[Cloudlet_Const.META_OVERLAY_FILE_SIZE]
+        overlay_segments = dict()
+        # request overlay by segment, which is either a whole blob or an
+        # independently compressed frame of the blob
+        for (url, blob_name, offset, size) in delta.get_overlay_segments(
+                meta_info[Cloudlet_Const.META_OVERLAY_FILES]):
             overlay_urls.append(url)
             overlay_urls_size[url] = size
+            overlay_segments[url] = (blob_name, offset, size)
+        stored_segments = set([
+            url for (url, comp_type) in delta.get_segment_compression(
+                meta_info[Cloudlet_Const.META_OVERLAY_FILES]).iteritems()
+            if comp_type == Cloudlet_Const.COMPRESSION_NONE])
         LOG.info("  - %s" % str(pformat(self.synthesis_option)))
         LOG.info("  - Base VM     : %s" % base_path)
-        LOG.info("  - Blob count  : %d" % len(overlay_urls))
+        LOG.info("  - Blob count  : %d" % len(
+            meta_info[Cloudlet_Const.META_OVERLAY_FILES]))
+        LOG.info("  - Segments    : %d" % len(overlay_urls))
         if overlay_urls == None:
             self.ret_fail("No overlay info listed")
             return
@@ -703,9 +1064,10 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         # create named pipe to convert queue to stream
         time_transfer = Queue(); time_decomp = Queue();
         time_delta = Queue(); time_fuse = Queue();
-        self.tmp_overlay_dir = tempfile.mkdtemp()
-        self.overlay_pipe = os.path.join(self.tmp_overlay_dir, 'overlay_pipe')
-        os.mkfifo(self.overlay_pipe)
+        # temp directory and pipes of the session are ready at the pool
+        recovery_context = self.server.recovery_pool.get(base_path)
+        self.tmp_overlay_dir = recovery_context.temp_dir
+        self.overlay_pipe = recovery_context.overlay_pipe
 
         # save overlay decomp result for measurement
         temp_overlay_file = None
@@ -718,13 +1080,18 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         download_queue = JoinableQueue()
         download_process = URLFetchStep(overlay_package, overlay_urls, 
                 overlay_urls_size, demanding_queue, download_queue, 
-                time_transfer, Synthesis_Const.TRANSFER_SIZE, )
+                time_transfer, Synthesis_Const.TRANSFER_SIZE,
+                overlay_segments=overlay_segments,
+                stored_segments=stored_segments,
+                segment_digests=segment_digests,
+                segment_leaves=segment_leaves)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
                 )
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        recovery_context=recovery_context)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -768,6 +1135,9 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             time_end_resume = time.time()
             self.send_synthesis_done()
 
+        # only the resumed VM takes the resources after its recovery
+        self.server.admission.update(session_id, SessionCost(
+            memory=meta_info[Cloudlet_Const.META_RESUME_VM_MEMORY_SIZE]))
         end_time = time.time()
 
         # printout result
@@ -799,14 +1169,16 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
         LOG.info("[SOCKET] waiting for client exit message")
 
     def _handle_get_resource_info(self, message):
+        resource = dict()
         if hasattr(self.server, 'resource_monitor'):
             resource = self.server.resource_monitor.get_static_resource()
             resource.update(self.server.resource_monitor.get_dynamic_resource())
-            # send response
-            pay_load = {Protocol.KEY_PAYLOAD: resource}
-            self.ret_success(Protocol.MESSAGE_COMMAND_GET_RESOURCE_INFO, pay_load)
-        else:
-            self.ret_fail("resource function is not implemented")
+        # running and waiting sessions of the host
+        resource[Protocol.KEY_ADMISSION_STATE] = \
+            self.server.admission.get_state()
+        # send response
+        pay_load = {Protocol.KEY_PAYLOAD: resource}
+        self.ret_success(Protocol.MESSAGE_COMMAND_GET_RESOURCE_INFO, pay_load)
 
     def _handle_session_create(self, message):
         new_session = Session()
@@ -835,6 +1207,7 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             LOG.info(msg)
             session_resource.deallocate()
             del session_resources[my_session_id]
+        self.server.admission.release(my_session_id)
 
         LOG.info("  - %s" % str(pformat(message)))
         self.ret_success(Protocol.MESSAGE_COMMAND_FINISH)
@@ -904,6 +1277,8 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             # close session if synthesis failed
             if command == Protocol.MESSAGE_COMMAND_SEND_META:
                 self.force_session_close()
+            self.server.admission.release(
+                message.get(Protocol.KEY_SESSION_ID, None))
             sys.stderr.write(traceback.format_exc())
             sys.stderr.write("%s" % str(e))
             sys.stderr.write("handler raises exception\n")
@@ -983,6 +1358,12 @@ class SynthesisServer(SocketServer.TCPServer):
         settings, args = SynthesisServer.process_command_line(args)
         self.dbconn = DBConnector()
         self.basevm_list = self.check_basevm()
+        self.admission = AdmissionController()
+        self.recovery_pool = RecoveryContextPool()
+        for each_basevm in self.basevm_list:
+            (base_diskmeta, base_mempath, base_memmeta) = \
+                Cloudlet_Const.get_basepath(each_basevm.disk_path)
+            self.recovery_pool.register(each_basevm.disk_path, base_mempath)
 
         Synthesis_Const.LOCAL_IPADDRESS = "0.0.0.0"
         server_address = (Synthesis_Const.LOCAL_IPADDRESS, Synthesis_Const.SERVER_PORT_NUMBER)
@@ -1075,6 +1456,8 @@ class SynthesisServer(SocketServer.TCPServer):
             except Exception as e:
                 msg = "Failed to deallocate resources for Session : %s" % str(session_id)
                 LOG.warning(msg)
+        if hasattr(self, 'recovery_pool'):
+            self.recovery_pool.close()
         LOG.info("[TERMINATE] Finish synthesis server connection")
 
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Author: Kiryong Ha <krha@cmu.edu>
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+"""Super-feature (min-hash) index of base VM chunks
+
+A changed chunk that has no exact hash match in the base VM is often a
+relocated or slightly modified copy of some other base chunk (e.g. guest
+page cache churn). This module finds such a "similar" base chunk so that
+the chunk can be delta-encoded against it instead of being sent as raw data.
+
+Each chunk is summarized by NUM_FEATURES min-hash features computed with
+one-permutation hashing over its 8-byte words, and the features are grouped
+into NUM_SUPER_FEATURES super-features. Two chunks sharing any super-feature
+are very likely to be similar.
+
+Index of a base VM has several entries per chunk, so it is kept as an array
+of (super-feature, offset) records sorted by super-feature and looked up with
+bisect, rather than as a Python object per entry.
+"""
+
+import os
+import mmap
+import struct
+import zlib
+import bisect
+from array import array
+
+from . import tool
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SimilarityError(Exception):
+    pass
+
+
+class _SortedRecords(object):
+    # super-features of the sorted records at the buffer, as a sequence
+    # for bisect
+    def __init__(self, buf, start, count):
+        self.buf = buf
+        self.start = start
+        self.count = count
+        self.item_size = struct.calcsize(SimilarityIndex.INDEX_ITEM_FMT)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        return struct.unpack_from(
+            "!Q", self.buf, self.start + position*self.item_size)[0]
+
+    def get_offset(self, position):
+        return struct.unpack_from(
+            "!Q", self.buf, self.start + position*self.item_size + 8)[0]
+
+    def iteritems(self):
+        for position in xrange(self.count):
+            yield (self[position], self.get_offset(position))
+
+
+class SimilarityIndex(object):
+    INDEX_FILE_MAGIC = 0x51a1a41d
+    INDEX_FILE_VERSION = 0x00000002
+    INDEX_HEADER_FMT = "!IIII"       # magic, version, chunk size, # of items
+    INDEX_ITEM_FMT = "!QQ"           # super-feature, chunk offset
+    # sorted by super-feature
+
+    NUM_FEATURES = 12
+    NUM_SUPER_FEATURES = 3
+    FEATURE_PER_SUPER_FEATURE = NUM_FEATURES/NUM_SUPER_FEATURES
+    HASH_MULTIPLIER = 0x9E3779B97F4A7C15L
+    HASH_MASK = 0xFFFFFFFFFFFFFFFFL
+
+    # only use similar chunk when aligned delta is bigger than this ratio
+    DELTA_RATIO_THRESHOLD = 0.5
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        # super-features being added are kept at the bucket of their
+        # top bits as (lower 24 bits, chunk number) arrays, and sorted a
+        # bucket at a time
+        self.bucket_dict = dict()
+        self.records = None
+
+    def __len__(self):
+        return len(self._get_records())
+
+    @staticmethod
+    def super_features(data):
+        """Return super-features of the chunk or None if the chunk does not
+        have enough distinct content (e.g. zero page) to be summarized
+        """
+        word_count = len(data)/8
+        if word_count == 0:
+            return None
+        words = set(struct.unpack("=%dQ" % word_count, data[:word_count*8]))
+        if len(words) < SimilarityIndex.NUM_FEATURES:
+            return None
+
+        # one-permutation hashing: the smallest hash value at each bucket is
+        # the feature of the bucket
+        multiplier = SimilarityIndex.HASH_MULTIPLIER
+        mask = SimilarityIndex.HASH_MASK
+        hashed = sorted([(word*multiplier) & mask for word in words])
+        num_features = SimilarityIndex.NUM_FEATURES
+        features = [None] * num_features
+        found = 0
+        for value in hashed:
+            bucket = value % num_features
+            if features[bucket] is None:
+                features[bucket] = value
+                found += 1
+                if found == num_features:
+                    break
+        if found != num_features:
+            return None
+
+        sf_list = list()
+        per_sf = SimilarityIndex.FEATURE_PER_SUPER_FEATURE
+        for sf_index in xrange(SimilarityIndex.NUM_SUPER_FEATURES):
+            group = features[sf_index*per_sf:(sf_index+1)*per_sf]
+            packed = struct.pack("!%dQ" % per_sf, *group)
+            sf_value = zlib.crc32(packed) & 0xFFFFFFFF
+            sf_list.append(long((sf_index << 32) | sf_value))
+        return sf_list
+
+    def add(self, data, offset):
+        if offset % self.chunk_size != 0:
+            raise SimilarityError("Offset is not aligned to the chunk size")
+        sf_list = SimilarityIndex.super_features(data)
+        if sf_list is None:
+            return False
+        for sf_value in sf_list:
+            bucket = self.bucket_dict.get(sf_value >> 24, None)
+            if bucket is None:
+                bucket = (array('I'), array('I'))
+                self.bucket_dict[sf_value >> 24] = bucket
+            bucket[0].append(sf_value & 0xFFFFFF)
+            bucket[1].append(offset/self.chunk_size)
+        self.records = None
+        return True
+
+    def _iter_sorted(self):
+        # the first chunk is kept for each super-feature
+        for bucket_key in sorted(self.bucket_dict.keys()):
+            (sf_array, chunk_array) = self.bucket_dict[bucket_key]
+            prev_sf_value = None
+            for (sf_low, chunk) in sorted(zip(sf_array, chunk_array)):
+                sf_value = (bucket_key << 24) | sf_low
+                if sf_value != prev_sf_value:
+                    yield (sf_value, long(chunk)*self.chunk_size)
+                prev_sf_value = sf_value
+
+    def _get_records(self):
+        if self.records is None:
+            buf = ''.join([struct.pack(SimilarityIndex.INDEX_ITEM_FMT,
+                                       sf_value, offset)
+                           for (sf_value, offset) in self._iter_sorted()])
+            self.records = _SortedRecords(
+                buf, 0, len(buf)/struct.calcsize(
+                    SimilarityIndex.INDEX_ITEM_FMT))
+        return self.records
+
+    def iteritems(self):
+        return self._get_records().iteritems()
+
+    def get(self, sf_value):
+        records = self._get_records()
+        position = bisect.bisect_left(records, sf_value)
+        if position == len(records) or records[position] != sf_value:
+            return None
+        return records.get_offset(position)
+
+    def find(self, data, exclude_offset=None):
+        """Return offset of the most similar base chunk or None
+        """
+        sf_list = SimilarityIndex.super_features(data)
+        if sf_list is None:
+            return None
+        candidates = dict()
+        for sf_value in sf_list:
+            offset = self.get(sf_value)
+            if offset is None or offset == exclude_offset:
+                continue
+            candidates[offset] = candidates.get(offset, 0) + 1
+        if len(candidates) == 0:
+            return None
+        return max(candidates.iteritems(), key=lambda item: item[1])[0]
+
+    @staticmethod
+    def build(base_path, chunk_size, header_size=0):
+        """Create index for every chunk of the base disk or memory snapshot
+        """
+        index = SimilarityIndex(chunk_size)
+        base_fd = open(base_path, "rb")
+        filesize = os.path.getsize(base_path)
+        if filesize == 0:
+            base_fd.close()
+            return index
+        raw_data = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
+        for offset in xrange(header_size, filesize, chunk_size):
+            data = raw_data[offset:offset+chunk_size]
+            if len(data) != chunk_size:
+                break
+            index.add(data, offset)
+        raw_data.close()
+        base_fd.close()
+        return index
+
+    def tofile(self, index_path):
+        # records are written a bucket at a time, and the count is updated
+        # at the end
+        header_size = struct.calcsize(SimilarityIndex.INDEX_HEADER_FMT)
+        fd = open(index_path, "wb")
+        fd.write(chr(0x00) * header_size)
+        item_count = 0
+        if self.records is not None:
+            item_list = self.records.iteritems()
+        else:
+            item_list = self._iter_sorted()
+        for (sf_value, offset) in item_list:
+            fd.write(struct.pack(SimilarityIndex.INDEX_ITEM_FMT,
+                                 sf_value, offset))
+            item_count += 1
+        fd.seek(0)
+        fd.write(struct.pack(SimilarityIndex.INDEX_HEADER_FMT,
+                             SimilarityIndex.INDEX_FILE_MAGIC,
+                             SimilarityIndex.INDEX_FILE_VERSION,
+                             self.chunk_size,
+                             item_count))
+        fd.close()
+
+    @staticmethod
+    def fromfile(index_path):
+        """Map the sorted records of the index file. Entries are read at
+        lookup
+        """
+        fd = open(index_path, "rb")
+        header_size = struct.calcsize(SimilarityIndex.INDEX_HEADER_FMT)
+        magic, version, chunk_size, item_count = struct.unpack(
+            SimilarityIndex.INDEX_HEADER_FMT, fd.read(header_size))
+        if magic != SimilarityIndex.INDEX_FILE_MAGIC or\
+                version != SimilarityIndex.INDEX_FILE_VERSION:
+            fd.close()
+            raise SimilarityError("Invalid similarity index at %s" % index_path)
+
+        index = SimilarityIndex(chunk_size)
+        item_size = struct.calcsize(SimilarityIndex.INDEX_ITEM_FMT)
+        if os.path.getsize(index_path) != header_size + item_count*item_size:
+            fd.close()
+            raise SimilarityError(
+                "Truncated similarity index at %s" % index_path)
+        if item_count == 0:
+            buf = ''
+        else:
+            buf = mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+        fd.close()
+        index.records = _SortedRecords(buf, header_size, item_count)
+        return index
+
+    @staticmethod
+    def load(base_path, chunk_size):
+        """Load index of the base file if it is available, None otherwise
+        """
+        index_path = get_index_path(base_path)
+        if not os.path.exists(index_path):
+            LOG.info("No similarity index for %s" % base_path)
+            return None
+        try:
+            index = SimilarityIndex.fromfile(index_path)
+        except (IOError, struct.error, SimilarityError) as e:
+            LOG.warning("Cannot load similarity index: %s" % str(e))
+            return None
+        if index.chunk_size != chunk_size:
+            LOG.warning("Similarity index has different chunk size: %d != %d" %
+                        (index.chunk_size, chunk_size))
+            return None
+        return index
+
+
+def get_index_path(base_path):
+    return base_path + Const.BASE_SIMILARITY_INDEX
+
+
+def pack_similar_patch(ref_source, ref_offset, patch):
+    # ref_source    : unsigned char (REF_BASE_DISK or REF_BASE_MEM)
+    # ref_offset    : unsigned long long
+    return struct.pack("!BQ", ref_source, ref_offset) + patch
+
+
+def unpack_similar_patch(data):
+    header_size = struct.calcsize("!BQ")
+    ref_source, ref_offset = struct.unpack("!BQ", data[:header_size])
+    return ref_source, ref_offset, data[header_size:]
+
+
+def diff_with_similar(index, raw_base, ref_source, data, offset,
+                      max_patch_size):
+    """Delta-encode data against the most similar base chunk
+
+    Return serialized patch (see pack_similar_patch) if it is smaller than
+    max_patch_size, None otherwise.
+    """
+    if index is None:
+        return None
+    ref_offset = index.find(data, exclude_offset=offset)
+    if ref_offset is None:
+        return None
+    source_data = raw_base[ref_offset:ref_offset+len(data)]
+    if len(source_data) != len(data):
+        return None
+    try:
+        patch = tool.diff_data(source_data, data, 2 * len(source_data))
+    except IOError as e:
+        return None
+    packed = pack_similar_patch(ref_source, ref_offset, patch)
+    if len(packed) >= max_patch_size:
+        return None
+    return packed
@@ -20,6 +20,8 @@
 
 import socket
 import os
+import errno
+import Queue
 import time
 import sys
 import struct
@@ -27,6 +29,7 @@ import threading
 import multiprocessing
 import msgpack
 import ctypes
+from hashlib import sha256
 
 #if os.path.exists("../provisioning"):
 #    sys.path.insert(0, "../../")
@@ -49,15 +52,140 @@ LOG = logging.getLogger(__name__)
 
 
 ACK_DATA_SIZE = 100*1024
+SHAPED_SEND_SIZE = 64*1024
 
 
 class StreamSynthesisClientError(Exception):
     pass
 
+
+class FairShareScheduler(object):
+    """Split the host uplink rate evenly among the concurrent handoffs.
+
+    Each handoff registers a file at a directory shared by the host, so
+    handoffs of different processes see the same number of flows.
+    """
+    def __init__(self, host_rate_mbps, flow_dir=Const.HANDOFF_FLOW_DIR,
+                 flow_id=None):
+        self.host_rate_mbps = float(host_rate_mbps)
+        self.flow_dir = flow_dir
+        if flow_id is None:
+            flow_id = "%d-%d" % (os.getpid(), id(self))
+        self.flow_path = os.path.join(self.flow_dir, flow_id)
+
+    def register(self):
+        if os.path.exists(self.flow_dir) is False:
+            try:
+                os.makedirs(self.flow_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(self.flow_path, "w") as flow_fd:
+            flow_fd.write("%d" % os.getpid())
+
+    def unregister(self):
+        if os.path.exists(self.flow_path):
+            os.remove(self.flow_path)
+
+    @staticmethod
+    def _is_alive(flow_path):
+        try:
+            pid = int(open(flow_path, "r").read())
+            if pid <= 0:
+                return False
+            os.kill(pid, 0)
+        except (IOError, ValueError):
+            return False
+        except OSError as e:
+            # process of other user is alive
+            return e.errno == errno.EPERM
+        return True
+
+    def get_share(self):
+        flow_count = 0
+        for flow_name in os.listdir(self.flow_dir):
+            flow_path = os.path.join(self.flow_dir, flow_name)
+            if flow_path == self.flow_path or self._is_alive(flow_path):
+                flow_count += 1
+            else:
+                # handoff terminated without unregistering
+                try:
+                    os.remove(flow_path)
+                except OSError:
+                    pass
+        return self.host_rate_mbps/max(flow_count, 1)
+
+
+class TokenBucket(object):
+    """Shape sending rate to rate_mbps, and to the fair share of the host
+    uplink when fair_share is given. Not bigger than 0 means no limit.
+    """
+    SHARE_REFRESH_INTERVAL = 0.5  # seconds
+    BURST_TIME = 0.05  # seconds
+
+    def __init__(self, rate_mbps=-1, fair_share=None):
+        self.rate_limit_mbps = rate_mbps
+        self.fair_share = fair_share
+        self.lock = threading.Lock()
+        self.rate_mbps = -1
+        self.time_share_updated = 0
+        self._update_rate()
+        self.tokens = self.burst_size
+        self.time_prev = time.time()
+
+    def _update_rate(self):
+        rate_mbps = self.rate_limit_mbps
+        if self.fair_share is not None:
+            share_mbps = self.fair_share.get_share()
+            if rate_mbps <= 0 or share_mbps < rate_mbps:
+                rate_mbps = share_mbps
+            self.time_share_updated = time.time()
+        self.rate_mbps = rate_mbps
+        self.rate_bytes = rate_mbps*1024*1024/8.0
+        self.burst_size = max(self.rate_bytes*self.BURST_TIME, 64*1024)
+
+    def get_rate(self):
+        return self.rate_mbps
+
+    def consume(self, size):
+        # block until size bytes are allowed. Debt of a large send is paid
+        # by sleeping, so the average rate is kept
+        with self.lock:
+            cur_time = time.time()
+            if self.fair_share is not None and \
+                    (cur_time - self.time_share_updated) > \
+                    self.SHARE_REFRESH_INTERVAL:
+                self._update_rate()
+            if self.rate_mbps <= 0:
+                return
+            self.tokens = min(
+                self.burst_size,
+                self.tokens + (cur_time - self.time_prev)*self.rate_bytes)
+            self.time_prev = cur_time
+            self.tokens -= size
+            if self.tokens < 0:
+                time.sleep(-self.tokens/self.rate_bytes)
+
+
+def shaped_sendall(sock, data, token_bucket=None):
+    if token_bucket is None:
+        sock.sendall(data)
+        return
+    for offset in xrange(0, len(data), SHAPED_SEND_SIZE):
+        piece = data[offset:offset+SHAPED_SEND_SIZE]
+        token_bucket.consume(len(piece))
+        sock.sendall(piece)
+
 class NetworkMeasurementThread(threading.Thread):
-    def __init__(self, sock, blob_sent_time_dict, monitor_network_bw, vm_resume_time_at_dest):
+    def __init__(self, sock, blob_sent_time_dict, monitor_network_bw,
+                 vm_resume_time_at_dest, demand_queue=None,
+                 monitor_shaped_bw=None):
         self.sock = sock
         self.blob_sent_time_dict = blob_sent_time_dict
+        self.demand_queue = demand_queue
+        # sending rate granted by the token bucket. Measured bandwidth does
+        # not go over it
+        self.monitor_shaped_bw = monitor_shaped_bw
 
         # shared memory
         self.monitor_network_bw = monitor_network_bw
@@ -89,6 +217,23 @@ class NetworkMeasurementThread(threading.Thread):
             return measure_history[-1][1]
         return sum_value/counter
 
+    def _handle_post_copy_ack(self, ack):
+        # VM at the destination can resume and demand memory pages at any
+        # time of the post-copy handoff
+        if ack == Const.POST_COPY_ACK_RESUMED:
+            data = self.sock.recv(8)
+            vm_resume_time = struct.unpack("!d", data)[0]
+            self.vm_resume_time_at_dest.value = float(vm_resume_time)
+            print "post-copy resume time: %f" % (vm_resume_time)
+        elif ack == Const.POST_COPY_ACK_DEMAND:
+            data = self.sock.recv(8)
+            index = struct.unpack("!Q", data)[0]
+            if self.demand_queue is not None:
+                self.demand_queue.put(index)
+        else:
+            return False
+        return True
+
 
     def receiving(self):
         ack_time_list = list()
@@ -108,6 +253,8 @@ class NetworkMeasurementThread(threading.Thread):
                     ack_recved_data = struct.unpack("!Q", ack_data)[0]
                     if ack_recved_data == 0x02:
                         break
+                    if self._handle_post_copy_ack(ack_recved_data):
+                        continue
                     if time_start == 0:
                         time_start = time.time()
                     time_recv_cur = time.time()
@@ -134,30 +281,49 @@ class NetworkMeasurementThread(threading.Thread):
                 if len(measure_bw_blob) > 0:
                     median_bw = measure_bw_blob[len(measure_bw_blob)/2]
                     measured_bw_list.append((time_recv_cur, median_bw))
-                self.monitor_network_bw.value = self.time_average(measured_bw_list,
-                                                                  time_start,
-                                                                  time_recv_cur)
+                network_bw = self.time_average(measured_bw_list,
+                                               time_start,
+                                               time_recv_cur)
+                if self.monitor_shaped_bw is not None and \
+                        self.monitor_shaped_bw.value > 0:
+                    network_bw = min(network_bw, self.monitor_shaped_bw.value)
+                self.monitor_network_bw.value = network_bw
             elif (ack == 0x10):
                 data = self.sock.recv(8)
                 vm_resume_time = struct.unpack("!d", data)[0]
                 self.vm_resume_time_at_dest.value = float(vm_resume_time)
                 print "migration resume time: %f" % (vm_resume_time)
                 break
+            elif (ack == Const.POST_COPY_ACK_FINISHED):
+                break
             else:
-                pass
+                self._handle_post_copy_ack(ack)
 
 
 class StreamSynthesisClient(process_manager.ProcWorker):
+    # seconds to wait for compressed data before checking the resume
+    RESUME_POLL_INTERVAL = 0.01
 
-    def __init__(self, remote_addr, remote_port, metadata, compdata_queue):
+    def __init__(self, remote_addr, remote_port, metadata, compdata_queue,
+                 resume_pipe=None, demand_queue=None,
+                 send_rate_mbps=VMOverlayCreationMode.HANDOFF_SEND_RATE_Mbps,
+                 host_rate_mbps=VMOverlayCreationMode.HANDOFF_HOST_RATE_Mbps):
         self.remote_addr = remote_addr
         self.remote_port = remote_port
         self.metadata = metadata
         self.compdata_queue = compdata_queue
+        # post-copy handoff. Receiving end of the pipe signalling the resume
+        self.resume_pipe = resume_pipe
+        self.demand_queue = demand_queue
+        # bandwidth shaping
+        self.send_rate_mbps = send_rate_mbps or -1
+        self.host_rate_mbps = host_rate_mbps or -1
 
         # measurement
         self.monitor_network_bw = multiprocessing.RawValue(ctypes.c_double, 0)
         self.monitor_network_bw.value = 0.0
+        self.monitor_shaped_bw = multiprocessing.RawValue(ctypes.c_double, 0)
+        self.monitor_shaped_bw.value = 0.0
         self.vm_resume_time_at_dest = multiprocessing.RawValue(ctypes.c_double, 0)
         self.time_finish_transmission = multiprocessing.RawValue(ctypes.c_double, 0)
 
@@ -182,11 +348,33 @@ class StreamSynthesisClient(process_manager.ProcWorker):
             msg = "failed to connect to %s" % str(address)
             raise StreamSynthesisClientError(msg)
         sock.setblocking(True)
+        fair_share = None
+        if self.host_rate_mbps > 0:
+            fair_share = FairShareScheduler(self.host_rate_mbps)
+            fair_share.register()
+        # flow file of this process stays at the host until it is
+        # unregistered, and keeps the share of the other flows reduced
+        try:
+            self._stream_blobs(sock, fair_share)
+        finally:
+            if fair_share is not None:
+                fair_share.unregister()
+        sys.stdout.write("Finish transmission. Waiting for finishing migration\n")
+        self.receive_thread.join()
+        sock.close()
+
+    def _stream_blobs(self, sock, fair_share):
+        self.token_bucket = None
+        if self.send_rate_mbps > 0 or fair_share is not None:
+            self.token_bucket = TokenBucket(self.send_rate_mbps, fair_share)
+            self.monitor_shaped_bw.value = self.token_bucket.get_rate()
         self.blob_sent_time_dict = dict()
         self.receive_thread = NetworkMeasurementThread(sock,
                                                        self.blob_sent_time_dict,
                                                        self.monitor_network_bw,
-                                                       self.vm_resume_time_at_dest)
+                                                       self.vm_resume_time_at_dest,
+                                                       demand_queue=self.demand_queue,
+                                                       monitor_shaped_bw=self.monitor_shaped_bw)
         self.receive_thread.start()
 
         # send header
@@ -201,30 +389,48 @@ class StreamSynthesisClient(process_manager.ProcWorker):
         # stream blob
         blob_counter = 0
         while True:
-            comp_task = self.compdata_queue.get()
+            if self.resume_pipe is None:
+                comp_task = self.compdata_queue.get()
+            elif self.resume_pipe.poll():
+                self._send_resume_header(sock)
+                continue
+            else:
+                try:
+                    comp_task = self.compdata_queue.get(
+                        timeout=self.RESUME_POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
             if self.is_first_recv == False:
                 self.is_first_recv = True
                 self.time_first_recv = time.time()
                 LOG.debug("[time] Transfer first input at : %f" % (self.time_first_recv))
             transfer_size = 0
             if comp_task == Const.QUEUE_SUCCESS_MESSAGE:
+                if self.resume_pipe is not None:
+                    self._send_resume_header(sock)
                 break
             if comp_task == Const.QUEUE_FAILED_MESSAGE:
                 sys.stderr.write("Failed to get compressed data\n")
                 break
-            (blob_comp_type, compdata, disk_chunks, memory_chunks) = comp_task
+            (blob_comp_type, compdata, disk_chunks, memory_chunks,
+             raw_size, item_stats) = comp_task
             blob_header_dict = {
                 Const.META_OVERLAY_FILE_COMPRESSION: blob_comp_type,
                 Const.META_OVERLAY_FILE_SIZE:len(compdata),
+                Const.META_OVERLAY_FILE_RAW_SIZE: raw_size,
+                Const.META_OVERLAY_FILE_SHA256: sha256(compdata).hexdigest(),
                 Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
-                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks,
+                Const.META_OVERLAY_STAT_ITEMS: item_stats,
                 }
             # send
             header = NetworkUtil.encoding(blob_header_dict)
             sock.sendall(struct.pack("!I", len(header)))
             sock.sendall(header)
             self.blob_sent_time_dict[blob_counter] = (time.time(), len(compdata))
-            sock.sendall(compdata)
+            shaped_sendall(sock, compdata, self.token_bucket)
+            if self.token_bucket is not None:
+                self.monitor_shaped_bw.value = self.token_bucket.get_rate()
             transfer_size += (4+len(header)+len(compdata))
             blob_counter += 1
 
@@ -239,6 +445,17 @@ class StreamSynthesisClient(process_manager.ProcWorker):
 
         self.is_processing_alive.value = False
         self.time_finish_transmission.value = time.time()
-        sys.stdout.write("Finish transmission. Waiting for finishing migration\n")
-        self.receive_thread.join()
-        sock.close()
+
+    def _send_resume_header(self, sock):
+        # destination resumes the VM when it gets this in the middle of
+        # blobs. Rest of the memory follows the header
+        resume_chunks = self.resume_pipe.recv()
+        self.resume_pipe.close()
+        self.resume_pipe = None
+        header = NetworkUtil.encoding({
+            Const.META_POST_COPY_RESUME: resume_chunks,
+            })
+        sock.sendall(struct.pack("!I", len(header)))
+        sock.sendall(header)
+        LOG.debug("[time] Post-copy resume header (%d chunks) at : %f" %
+                  (len(resume_chunks), time.time()))
@@ -27,29 +27,36 @@ import SocketServer
 import socket
 import signal
 import collections
-import tempfile
 import multiprocessing
 import threading
-from hashlib import sha256
+import Queue
 
 import shutil
+from hashlib import sha256
+from uuid import uuid4
 
 from server import NetworkUtil
 from synthesis_protocol import Protocol as Protocol
 from synthesis import run_fuse
 from synthesis import SynthesizedVM
 from synthesis import connect_vnc
+from cloudletfs import CloudletFS
 from handoff import HandoffDataRecv
 
 from db.api import DBConnector
 from db.table_def import BaseVM
 from configuration import Const as Cloudlet_Const
 from compression import DecompProc
+from admission import AdmissionController
+from admission import SessionCost
+from recovery_pool import RecoveryContextPool
 from pprint import pformat
 import log as logging
 import subprocess
 import mmap
 import tool
+import similarity
+import delta
 from delta import DeltaItem
 
 LOG = logging.getLogger(__name__)
@@ -65,7 +72,9 @@ class RecoverDeltaProc(multiprocessing.Process):
     def __init__(self, base_disk, base_mem,
                  decomp_delta_queue, output_mem_path,
                  output_disk_path, chunk_size,
-                 fuse_info_queue, analysis_queue):
+                 fuse_info_queue, analysis_queue, post_copy=False,
+                 base_mappings=None,
+                 hash_type=Cloudlet_Const.CHUNK_HASH_DEFAULT):
         if base_disk is None and base_mem is None:
             raise StreamSynthesisError("Need either base_disk or base_memory")
 
@@ -76,6 +85,10 @@ class RecoverDeltaProc(multiprocessing.Process):
         self.analysis_queue = analysis_queue
         self.base_disk = base_disk
         self.base_mem = base_mem
+        # (raw disk, raw memory) mapped at the recovery context pool
+        self.base_mappings = base_mappings
+        # chunk hash of the overlay of this session
+        self.hash_type = hash_type
 
         self.base_disk_fd = None
         self.base_mem_fd = None
@@ -89,6 +102,13 @@ class RecoverDeltaProc(multiprocessing.Process):
         self.recovered_hash_dict = dict()
         self.live_migration_iteration_dict = dict()
 
+        # post-copy handoff: {index: [live seq, number of items]} of the
+        # latest recovered items, and the chunks the resumed VM waits for
+        self.post_copy_seq_dict = dict() if post_copy else None
+        self.post_copy_pending = None
+        self.post_copy_chunk_pending = None
+        self.post_copy_valid_chunks = list()
+
         multiprocessing.Process.__init__(self, target=self.recover_deltaitem)
 
     def recover_deltaitem(self):
@@ -96,10 +116,13 @@ class RecoverDeltaProc(multiprocessing.Process):
 
         # initialize reference data to use mmap
         count = 0
-        self.base_disk_fd = open(self.base_disk, "rb")
-        self.raw_disk = mmap.mmap(self.base_disk_fd.fileno(), 0, prot=mmap.PROT_READ)
-        self.base_mem_fd = open(self.base_mem, "rb")
-        self.raw_mem = mmap.mmap(self.base_mem_fd.fileno(), 0, prot=mmap.PROT_READ)
+        if self.base_mappings is not None:
+            (self.raw_disk, self.raw_mem) = self.base_mappings
+        else:
+            self.base_disk_fd = open(self.base_disk, "rb")
+            self.raw_disk = mmap.mmap(self.base_disk_fd.fileno(), 0, prot=mmap.PROT_READ)
+            self.base_mem_fd = open(self.base_mem, "rb")
+            self.raw_mem = mmap.mmap(self.base_mem_fd.fileno(), 0, prot=mmap.PROT_READ)
         self.recover_mem_fd = open(self.output_mem_path, "wrb")
         self.recover_disk_fd = open(self.output_disk_path, "wrb")
         delta_counter = collections.Counter()
@@ -109,6 +132,10 @@ class RecoverDeltaProc(multiprocessing.Process):
             recv_data = self.decomp_delta_queue.get()
             if recv_data == Cloudlet_Const.QUEUE_SUCCESS_MESSAGE:
                 break
+            if type(recv_data) == tuple and \
+                    recv_data[0] == Cloudlet_Const.QUEUE_POST_COPY_MESSAGE:
+                self.start_post_copy(recv_data[1])
+                continue
 
             overlay_chunk_ids = list()
             # recv_data is a single blob so that it contains whole DeltaItem
@@ -130,6 +157,7 @@ class RecoverDeltaProc(multiprocessing.Process):
             self.recover_disk_fd.flush()
             delta_times['flush'] += (time.time() - start_time)
             #self.fuse_info_queue.put(overlay_chunk_ids)
+            self._feed_post_copy_chunks()
 
         self.analysis_queue.put("Handling (%d) unresolved delta items." % len(unresolved_deltaitem_list))
         overlay_chunk_ids = list()
@@ -148,6 +176,17 @@ class RecoverDeltaProc(multiprocessing.Process):
         self.recover_disk_fd = None
         #self.fuse_info_queue.put(overlay_chunk_ids)
         #self.fuse_info_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
+        if self.post_copy_pending is not None:
+            if len(self.post_copy_pending) > 0:
+                # do not let the VM wait forever for the missing chunks
+                self.analysis_queue.put(
+                    "Post-copy: %d chunks are not received" %
+                    len(self.post_copy_pending))
+                for index, (live_seq, offset, length, item_count) in \
+                        self.post_copy_pending.items():
+                    self._post_copy_validate(index, offset, length)
+            self._feed_post_copy_chunks()
+            self.fuse_info_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
         time_end = time.time()
         self.analysis_queue.put("="*50)
         self.analysis_queue.put("Delta metrics:")
@@ -167,13 +206,17 @@ class RecoverDeltaProc(multiprocessing.Process):
         if (delta_item.ref_id == DeltaItem.REF_RAW):
             recover_data = delta_item.data
         elif (delta_item.ref_id == DeltaItem.REF_ZEROS):
-            recover_data = self.zero_data
+            if delta_item.offset_len == self.chunk_size:
+                recover_data = self.zero_data
+            else:
+                recover_data = chr(0x00) * delta_item.offset_len
         elif (delta_item.ref_id == DeltaItem.REF_BASE_MEM):
             offset = delta_item.data
-            recover_data = self.raw_mem[offset:offset+self.chunk_size]
+            recover_data = self.raw_mem[offset:offset+delta_item.offset_len]
         elif (delta_item.ref_id == DeltaItem.REF_BASE_DISK):
+            # content-defined chunk can have different length
             offset = delta_item.data
-            recover_data = self.raw_disk[offset:offset+self.chunk_size]
+            recover_data = self.raw_disk[offset:offset+delta_item.offset_len]
         elif delta_item.ref_id == DeltaItem.REF_SELF:
             ref_index = delta_item.data
             self_ref_delta_item = self.recovered_delta_dict.get(ref_index, None)
@@ -226,6 +269,17 @@ class RecoverDeltaProc(multiprocessing.Process):
             else:
                 raise StreamSynthesisError("Delta type should be either disk or memory")
             recover_data = tool.cython_xor(base_data, patch_data)
+        elif delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
+            (ref_source, ref_offset, patch_data) = \
+                    similarity.unpack_similar_patch(delta_item.data)
+            patch_original_size = delta_item.offset_len
+            if ref_source == DeltaItem.REF_BASE_MEM:
+                base_data = self.raw_mem[ref_offset:ref_offset+patch_original_size]
+            elif ref_source == DeltaItem.REF_BASE_DISK:
+                base_data = self.raw_disk[ref_offset:ref_offset+patch_original_size]
+            else:
+                raise StreamSynthesisError("Similar reference should be either base disk or memory")
+            recover_data = tool.merge_data(base_data, patch_data, len(base_data)*5)
         else:
             raise StreamSynthesisError("Cannot recover: invalid referce id %d" % delta_item.ref_id)
 
@@ -249,11 +303,93 @@ class RecoverDeltaProc(multiprocessing.Process):
         if delta_item.hash_value is None or len(delta_item.hash_value) == 0:
             delta_counter['sha'] += 1
             start_time = time.time()
-            delta_item.hash_value = sha256(recover_data).digest()
+            delta_item.hash_value = tool.chunk_hash(recover_data,
+                                                    self.hash_type)
             delta_times['sha'] += (time.time() - start_time)
 
         return delta_item
 
+    def _get_fuse_chunks(self, index, offset, length):
+        # see DeltaItem.get_index
+        if (index & 0x01) == DeltaItem.DELTA_MEMORY:
+            fuse_index = RecoverDeltaProc.FUSE_INDEX_MEMORY
+        else:
+            fuse_index = RecoverDeltaProc.FUSE_INDEX_DISK
+        return [(fuse_index, chunk) for chunk in
+                DeltaItem.get_chunk_range(offset, length, self.chunk_size)]
+
+    def start_post_copy(self, resume_chunks):
+        """Make overlay maps of FUSE to resume the VM before every chunk
+        arrives. resume_chunks is {index: [live seq, offset, length, number of
+        items]} of the latest items that the sender has and will send.
+        """
+        self.recover_mem_fd.flush()
+        self.recover_disk_fd.flush()
+        self.post_copy_pending = dict()
+        self.post_copy_chunk_pending = collections.Counter()
+        overlay_chunks = list()
+        for index, (live_seq, offset, length, item_count) in \
+                resume_chunks.iteritems():
+            index = long(index)
+            fuse_chunks = self._get_fuse_chunks(index, offset, length)
+            overlay_chunks += fuse_chunks
+            recovered = self.post_copy_seq_dict.get(index, None)
+            if recovered is not None and (recovered[0] > live_seq or (
+                    recovered[0] == live_seq and recovered[1] >= item_count)):
+                continue
+            self.post_copy_pending[index] = \
+                [live_seq, offset, length, item_count]
+            for fuse_chunk in fuse_chunks:
+                self.post_copy_chunk_pending[fuse_chunk] += 1
+
+        overlay_maps = {RecoverDeltaProc.FUSE_INDEX_DISK: dict(),
+                        RecoverDeltaProc.FUSE_INDEX_MEMORY: dict()}
+        for fuse_chunk in overlay_chunks:
+            valid_bit = 0 if self.post_copy_chunk_pending[fuse_chunk] > 0 \
+                else 1
+            overlay_maps[fuse_chunk[0]][fuse_chunk[1]] = valid_bit
+        disk_overlay_map, memory_overlay_map = [
+            ','.join("%ld:%d" % item for item in
+                     sorted(overlay_maps[fuse_index].iteritems()))
+            for fuse_index in (RecoverDeltaProc.FUSE_INDEX_DISK,
+                               RecoverDeltaProc.FUSE_INDEX_MEMORY)]
+        self.analysis_queue.put("Post-copy: resume with %d chunks pending" %
+                                len(self.post_copy_chunk_pending))
+        self.fuse_info_queue.put((disk_overlay_map, memory_overlay_map))
+
+    def _update_post_copy(self, delta_item):
+        live_seq = delta_item.live_seq or 0
+        recovered = self.post_copy_seq_dict.get(delta_item.index, None)
+        if recovered is None or recovered[0] < live_seq:
+            recovered = [live_seq, 0]
+            self.post_copy_seq_dict[delta_item.index] = recovered
+        elif recovered[0] > live_seq:
+            return
+        recovered[1] += 1
+        if self.post_copy_pending is None:
+            return
+        pending = self.post_copy_pending.get(delta_item.index, None)
+        if pending is None:
+            return
+        (pending_seq, offset, length, item_count) = pending
+        if live_seq > pending_seq or \
+                (live_seq == pending_seq and recovered[1] >= item_count):
+            self._post_copy_validate(delta_item.index, offset, length)
+
+    def _post_copy_validate(self, index, offset, length):
+        del self.post_copy_pending[index]
+        for fuse_chunk in self._get_fuse_chunks(index, offset, length):
+            self.post_copy_chunk_pending[fuse_chunk] -= 1
+            if self.post_copy_chunk_pending[fuse_chunk] <= 0:
+                del self.post_copy_chunk_pending[fuse_chunk]
+                self.post_copy_valid_chunks.append("%d:%ld" % fuse_chunk)
+
+    def _feed_post_copy_chunks(self):
+        # chunks become valid at FUSE after they are written
+        if len(self.post_copy_valid_chunks) > 0:
+            self.fuse_info_queue.put(self.post_copy_valid_chunks)
+            self.post_copy_valid_chunks = list()
+
     @staticmethod
     def from_buffer(data, delta_counter, delta_times):
         offset = 0
@@ -285,7 +421,8 @@ class RecoverDeltaProc(multiprocessing.Process):
         if ref_id == DeltaItem.REF_RAW or \
                 ref_id == DeltaItem.REF_XDELTA or \
                 ref_id == DeltaItem.REF_XOR or \
-                ref_id == DeltaItem.REF_BSDIFF:
+                ref_id == DeltaItem.REF_BSDIFF or \
+                ref_id == DeltaItem.REF_BASE_SIMILAR:
             data_len = struct.unpack_from("!Q", stream, offset)[0]
             offset += struct.calcsize("!Q")
             data = stream[offset:offset+data_len]
@@ -359,6 +496,8 @@ class RecoverDeltaProc(multiprocessing.Process):
 
         # update the latest item for each memory page or disk block
         self.live_migration_iteration_dict[delta_item.index] = delta_item
+        if self.post_copy_seq_dict is not None:
+            self._update_post_copy(delta_item)
 
 
     def finish(self):
@@ -374,6 +513,9 @@ class RecoverDeltaProc(multiprocessing.Process):
         if self.base_mem_fd is not None:
             self.base_mem_fd.close()
             self.base_mem_fd = None
+        # mapping of the pool is shared with the other recoveries
+        if self.base_mappings is not None:
+            self.raw_disk = self.raw_mem = None
         if self.raw_disk is not None:
             self.raw_disk.close()
             self.raw_disk = None
@@ -503,10 +645,53 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             data_diff = cur_recv_size-prev_ack_sent_size
             if data_diff > ack_size or cur_recv_size >= recv_size:
                 ack_data = struct.pack("!Q", data_diff)
-                self.request.sendall(ack_data)
+                self._send_ack(ack_data)
                 prev_ack_sent_size = cur_recv_size
         return data
 
+    def _send_ack(self, ack_data):
+        # VM resumed by post-copy handoff sends acks from other threads
+        with self.ack_lock:
+            self.request.sendall(ack_data)
+
+    def _get_resume_time(self):
+        # since libvirt does not return immediately after resuming VM, we
+        # measure resume time directly from QEMU
+        actual_resume_time = 0
+        splited_log = open("/tmp/qemu_debug_messages", "r").read().split("\n")
+        for line in splited_log:
+            if line.startswith("INCOMING_FINISH"):
+                actual_resume_time = float(line.split(" ")[-1])
+        return actual_resume_time
+
+    def _post_copy_resumed(self, synthesized_vm, time_fuse_start):
+        synthesized_vm.join()
+        actual_resume_time = self._get_resume_time()
+        LOG.info("[time] post-copy resume time %f (%f ~ %f)" % (
+            actual_resume_time-time_fuse_start,
+            time_fuse_start,
+            actual_resume_time,
+        ))
+        ack_data = struct.pack("!Qd", Cloudlet_Const.POST_COPY_ACK_RESUMED,
+                               actual_resume_time)
+        self._send_ack(ack_data)
+
+    def _post_copy_demand(self, demand_queue):
+        # forward on-demand fetching of FUSE to the sender. Only memory pages
+        # are held back at the sender
+        while True:
+            request = demand_queue.get()
+            if request is None:
+                break
+            (overlay_type, chunk) = request
+            if overlay_type != CloudletFS.FUSE_TYPE_MEMORY:
+                continue
+            index = DeltaItem.get_index(DeltaItem.DELTA_MEMORY,
+                                        chunk*Cloudlet_Const.CHUNK_SIZE)
+            ack_data = struct.pack("!QQ", Cloudlet_Const.POST_COPY_ACK_DEMAND,
+                                   index)
+            self._send_ack(ack_data)
+
     def _check_validity(self, message):
         header_info = None
         requested_base = None
@@ -527,7 +712,11 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
 
         | header size | header | blob header size | blob header | blob data  |
         |  (4 bytes)  | (var)  | (4 bytes)        | (var bytes) | (var bytes)|
+
+        At post-copy handoff, a blob header without blob data tells that the
+        VM can resume while the rest of the blobs are received.
         '''
+        self.ack_lock = threading.Lock()
 
         analysis_mq = multiprocessing.Queue()
         analysis_proc = HandoffAnalysisProc(handoff_url=self.client_address[0],message_queue=analysis_mq)
@@ -561,6 +750,20 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
         synthesis_option, base_diskpath = self._check_validity(metadata)
         if base_diskpath is None:
             raise StreamSynthesisError("No matching base VM")
+        if metadata.get(Cloudlet_Const.META_PARENT_OVERLAY_ID, None):
+            # launch VM is recovered only from the base VM
+            msg = "Chained residue needs its previous residues (%s)" % \
+                metadata[Cloudlet_Const.META_PARENT_OVERLAY_ID]
+            raise StreamSynthesisError(msg)
+        # overlay without chunk hash is created with sha256. It is kept at
+        # this session, since other sessions can use a different one
+        chunk_hash = metadata.get(Cloudlet_Const.META_CHUNK_HASH,
+                                  Cloudlet_Const.CHUNK_HASH_SHA256)
+        tool.get_chunk_hash_function(chunk_hash)
+        post_copy = metadata.get(Cloudlet_Const.META_POST_COPY, False)
+        if post_copy and via_openstack:
+            raise StreamSynthesisError("Post-copy handoff is not supported "
+                                       "via OpenStack")
         if via_openstack:
             base_diskpath, base_mempath, base_diskmeta, base_memmeta = self.server.handoff_data.base_vm_paths
         else:
@@ -570,22 +773,35 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
         analysis_mq.put("Image Disk Size: %d" % launch_disk_size)
         analysis_mq.put("Image Memory Size: %d" % launch_memory_size)
         analysis_mq.put("=" * 50)
+
+        # wait until the host has resources to recover the VM. Blobs are
+        # not sent yet, so the cost is estimated from the VM size
+        decomp_proc_count = 4
+        self.admission_id = uuid4().hex
+        self.server.admission.admit(self.admission_id, SessionCost.from_meta(
+            metadata, decomp_proc_count=decomp_proc_count))
+        analysis_mq.put("Admitted with the resources of the host")
         # variables for FUSE
         if via_openstack:
             launch_disk = self.server.handoff_data.launch_diskpath
             launch_mem = self.server.handoff_data.launch_memorypath
+            base_mappings = None
         else:
-            temp_synthesis_dir = tempfile.mkdtemp(prefix="cloudlet-comp-")
-            launch_disk = os.path.join(temp_synthesis_dir, "launch-disk")
-            launch_mem = os.path.join(temp_synthesis_dir, "launch-mem")
+            recovery_context = self.server.recovery_pool.get(base_diskpath)
+            base_mappings = recovery_context.base_mappings
+            launch_disk = recovery_context.launch_disk
+            launch_mem = recovery_context.launch_mem
         memory_chunk_all = set()
         disk_chunk_all = set()
+        item_stats = dict()
 
         # start pipelining processes
         network_out_queue = multiprocessing.Queue()
         decomp_queue = multiprocessing.Queue()
         fuse_info_queue = multiprocessing.Queue()
-        decomp_proc = DecompProc(network_out_queue, decomp_queue, num_proc=4, analysis_queue=analysis_mq)
+        decomp_proc = DecompProc(network_out_queue, decomp_queue,
+                                 num_proc=decomp_proc_count,
+                                 analysis_queue=analysis_mq)
         decomp_proc.start()
         analysis_mq.put("Starting (%d) decompression processes..." % (decomp_proc.num_proc))
         delta_proc = RecoverDeltaProc(base_diskpath, base_mempath,
@@ -594,12 +810,16 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
                                     launch_disk,
                                     Cloudlet_Const.CHUNK_SIZE,
                                     fuse_info_queue,
-                                    analysis_mq)
+                                    analysis_mq,
+                                    post_copy=post_copy,
+                                    base_mappings=base_mappings,
+                                    hash_type=chunk_hash)
         delta_proc.start()
         analysis_mq.put("Starting delta recovery process...")
 
         # get each blob
         recv_blob_counter = 0
+        synthesized_vm = None
         while True:
             data = self._recv_all(4)
             if data is None or len(data) != 4:
@@ -608,6 +828,34 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             blob_header_size = struct.unpack("!I", data)[0]
             blob_header_raw = self._recv_all(blob_header_size)
             blob_header = NetworkUtil.decoding(blob_header_raw)
+            resume_chunks = blob_header.get(
+                Cloudlet_Const.META_POST_COPY_RESUME, None)
+            if post_copy and resume_chunks is not None:
+                # VM state at the sender is final. Resume the VM and wait for
+                # missing chunks at FUSE
+                analysis_mq.put("Post-copy resume received at %f" % (time.time()))
+                decomp_queue.put((Cloudlet_Const.QUEUE_POST_COPY_MESSAGE,
+                                  resume_chunks))
+                disk_overlay_map, memory_overlay_map = fuse_info_queue.get()
+                time_fuse_start = time.time()
+                demand_queue = Queue.Queue()
+                fuse = run_fuse(Cloudlet_Const.CLOUDLETFS_PATH, Cloudlet_Const.CHUNK_SIZE,
+                                base_diskpath, launch_disk_size, base_mempath, launch_memory_size,
+                                resumed_disk=launch_disk, disk_overlay_map=disk_overlay_map,
+                                resumed_memory=launch_mem, memory_overlay_map=memory_overlay_map,
+                                demanding_queue=demand_queue)
+                fuse_feeding_proc = FuseFeedingProc(fuse, fuse_info_queue)
+                fuse_feeding_proc.start()
+                demand_thread = threading.Thread(target=self._post_copy_demand,
+                                                 args=(demand_queue,))
+                demand_thread.daemon = True
+                demand_thread.start()
+                synthesized_vm = SynthesizedVM(launch_disk, launch_mem, fuse)
+                synthesized_vm.start()
+                resume_thread = threading.Thread(target=self._post_copy_resumed,
+                                                 args=(synthesized_vm, time_fuse_start))
+                resume_thread.start()
+                continue
             blob_size = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_SIZE)
             if blob_size is None:
                 raise StreamSynthesisError("Failed to receive blob")
@@ -620,11 +868,20 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
 
             # send ack right before getting the blob
             ack_data = struct.pack("!Q", 0x01)
-            self.request.send(ack_data)
+            self._send_ack(ack_data)
             compressed_blob = self._recv_all(blob_size, ack_size=200*1024)
             # send ack right after getting the blob
             ack_data = struct.pack("!Q", 0x02)
-            self.request.send(ack_data)
+            self._send_ack(ack_data)
+            # digest is not sent from the old client. Corrupted blob fails
+            # here before its chunks are recovered at the VM
+            blob_digest = blob_header.get(
+                Cloudlet_Const.META_OVERLAY_FILE_SHA256, None)
+            if blob_digest is not None and \
+                    sha256(compressed_blob).hexdigest() != blob_digest:
+                msg = "Corrupted overlay blob %d from the client" % \
+                    (recv_blob_counter+1)
+                raise StreamSynthesisError(msg)
 
             network_out_queue.put((blob_comp_type, compressed_blob))
             #TODO: remove the interweaving of the valid bit here
@@ -638,12 +895,36 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             else:
                 memory_chunk_all.update(blob_memory_chunk)
                 disk_chunk_all.update(blob_disk_chunk)
+            # old client does not send the statistics of the items
+            delta.merge_item_statistics(item_stats, blob_header.get(
+                Cloudlet_Const.META_OVERLAY_STAT_ITEMS, dict()))
             recv_blob_counter += 1
             analysis_mq.put("B,R,%d" % (recv_blob_counter))
 
         network_out_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
+        self.overlay_statistics = delta.get_overlay_statistics(
+            item_stats, metadata.get(
+                Cloudlet_Const.META_OVERLAY_STAT_CREATION_MODE, dict()))
+        for type_name in sorted(item_stats.keys()):
+            ref_stats = item_stats[type_name]
+            analysis_mq.put("Received %s delta items: %d (%d bytes)" % (
+                type_name,
+                sum([count for (count, size) in ref_stats.values()]),
+                sum([size for (count, size) in ref_stats.values()])))
+        LOG.info("overlay statistics: %s" % str(self.overlay_statistics))
         delta_proc.join()
         LOG.debug("%f\tdeltaproc join" % (time.time()))
+        # only the resumed VM takes the resources after its recovery
+        self.server.admission.update(
+            self.admission_id, SessionCost(memory=launch_memory_size))
+        if post_copy:
+            if synthesized_vm is None:
+                raise StreamSynthesisError("Post-copy resume is not received")
+            fuse_feeding_proc.join()
+            resume_thread.join()
+            demand_queue.put(None)
+            ack_data = struct.pack("!Q", Cloudlet_Const.POST_COPY_ACK_FINISHED)
+            self._send_ack(ack_data)
 
 
         analysis_mq.put("Adaptive VM Handoff Complete!")
@@ -666,7 +947,7 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             #TODO: after this will end up in stdout because the logger has a StreamHandler configured to use stdout
             sys.stdout.write("openstack\t%s\t%s\t%s\t%s" % (launch_disk_size, launch_memory_size, disk_overlay_map, memory_overlay_map))
 
-        else:
+        elif synthesized_vm is None:
             # We told to FUSE that we have everything ready, so we need to wait
             # until delta_proc finishes. we cannot start VM before delta_proc
             # finishes, because we don't know what will be modified in the future
@@ -683,14 +964,7 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             synthesized_vm.start()
             synthesized_vm.join()
 
-            # since libvirt does not return immediately after resuming VM, we
-            # measure resume time directly from QEMU
-            actual_resume_time = 0
-            splited_log = open("/tmp/qemu_debug_messages", "r").read().split("\n")
-            for line in splited_log:
-                if line.startswith("INCOMING_FINISH"):
-                    actual_resume_time = float(line.split(" ")[-1])
-
+            actual_resume_time = self._get_resume_time()
             LOG.info("[time] non-pipelined time %f (%f ~ %f ~ %f)" % (
                 actual_resume_time-time_fuse_start,
                 time_fuse_start,
@@ -702,6 +976,7 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             LOG.info("send ack to client: %d" % len(ack_data))
             self.request.sendall(ack_data)
 
+        if not via_openstack:
             connect_vnc(synthesized_vm.machine, True)
 
             signal.signal(signal.SIGUSR1, handlesig)
@@ -711,6 +986,13 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             synthesized_vm.monitor.join()
             synthesized_vm.terminate()
 
+    def finish(self):
+        # handoff session ends with the request, even when it failed
+        if getattr(self, 'admission_id', None) is not None:
+            self.server.admission.release(self.admission_id)
+            self.admission_id = None
+        SocketServer.StreamRequestHandler.finish(self)
+
     def terminate(self):
         # force terminate when something wrong in handling request
         # do not wait for joinining
@@ -739,6 +1021,8 @@ class StreamSynthesisServer(SocketServer.TCPServer):
                  timeout=None, handoff_datafile=None):
         self.port_number = port_number
         self.timeout = timeout
+        self.admission = AdmissionController()
+        self.recovery_pool = RecoveryContextPool()
         self._handoff_datafile = handoff_datafile
         if self._handoff_datafile:
             self.handoff_data = self._load_handoff_data(self._handoff_datafile)
@@ -749,6 +1033,11 @@ class StreamSynthesisServer(SocketServer.TCPServer):
         else:
             self.handoff_data = None
             self.basevm_list = self.check_basevm_from_db(DBConnector())
+            for each_basevm in self.basevm_list:
+                (base_diskmeta, base_mempath, base_memmeta) = \
+                    Cloudlet_Const.get_basepath(each_basevm['diskpath'])
+                self.recovery_pool.register(each_basevm['diskpath'],
+                                            base_mempath)
 
         server_address = ("0.0.0.0", self.port_number)
         self.allow_reuse_address = True
@@ -796,6 +1085,7 @@ class StreamSynthesisServer(SocketServer.TCPServer):
             except Exception as e:
                 msg = "Failed to deallocate resources for Session : %s" % str(session_id)
                 LOG.warning(msg)
+        self.recovery_pool.close()
 
     def check_basevm(self, base_vm_paths, hash_value):
         ret_list = list()
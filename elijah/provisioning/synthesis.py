@@ -49,6 +49,7 @@ from . import disk
 from . import cloudletfs
 from . import memory_util
 from . import delta
+from . import similarity
 from .db import api as db_api
 from .db import table_def as db_table
 from .configuration import Const
@@ -60,6 +61,7 @@ from .package import VMOverlayPackage
 from . import handoff
 from . import qmp_af_unix
 from .tool import comp_lzma
+from . import tool
 from . import compression
 from . import log as logging
 
@@ -248,6 +250,7 @@ class VM_Overlay(native_threading.Thread):
             nova_util=self.nova_util)
 
         # get overlay VM
+        discard_statistics = dict()
         overlay_deltalist = get_overlay_deltalist(
             monitoring_info,
             self.options,
@@ -255,7 +258,10 @@ class VM_Overlay(native_threading.Thread):
             self.base_mem,
             self.base_memmeta,
             self.modified_disk,
-            self.modified_mem.name)
+            self.modified_mem.name,
+            ret_statistics=discard_statistics)
+        chunk_hash = getattr(monitoring_info,
+                             OverlayMonitoringInfo.CHUNK_HASH)
 
         # create_overlayfile
         temp_dir = mkdtemp(prefix="cloudlet-overlay-")
@@ -269,7 +275,9 @@ class VM_Overlay(native_threading.Thread):
             os.path.getsize(self.modified_disk),
             os.path.getsize(self.modified_mem.name),
             overlay_metapath,
-            overlay_prefix)
+            overlay_prefix,
+            chunk_hash=chunk_hash,
+            **discard_statistics)
         # packaging VM overlay into a single zip file
         if self.options.ZIP_CONTAINER:
             self.overlay_zipfile = os.path.join(temp_dir, Const.OVERLAY_ZIP)
@@ -320,6 +328,7 @@ class OverlayMonitoringInfo(object):
     DISK_USED_BLOCKS = "disk_used_block"  # from xray support
     DISK_FREE_BLOCKS = "disk_free_block"
     MEMORY_FREE_BLOCKS = "memory_free_block"
+    CHUNK_HASH = "chunk_hash"  # from base VM hash meta
 
     def __init__(self, properties):
         for k, v in properties.iteritems():
@@ -478,6 +487,11 @@ def _update_overlay_meta(original_meta, new_path, blob_info=None):
 
     if blob_info:
         original_meta[Const.META_OVERLAY_FILES] = blob_info
+        merkle_root = delta.get_overlay_merkle_root(blob_info)
+        if merkle_root is not None:
+            original_meta[Const.META_OVERLAY_MERKLE_ROOT] = merkle_root
+        else:
+            original_meta.pop(Const.META_OVERLAY_MERKLE_ROOT, None)
     serialized = msgpack.packb(original_meta)
     fout.write(serialized)
     fout.close()
@@ -764,9 +778,11 @@ def _get_overlay_monitoring_info(conn, machine, options,
         save_mem_snapshot(conn, machine, modified_mem, nova_util=nova_util,
                           fuse_stream_monitor=fuse_stream_monitor)
 
-    # get hashlist of base memory and disk
-    basemem_hashlist = memory.base_hashlist(base_memmeta)
-    basedisk_hashlist = disk.base_hashlist(base_diskmeta)
+    # get hashlist of base memory and disk. Chunks are compared with the
+    # base VM using its chunk hash
+    chunk_hash = tool.read_hash_meta_type(base_memmeta)
+    basemem_hashlist = memory.base_hashlist(base_memmeta, chunk_hash)
+    basedisk_hashlist = disk.base_hashlist(base_diskmeta, chunk_hash)
 
     # get dma & discard information
     if options.TRIM_SUPPORT:
@@ -792,6 +808,7 @@ def _get_overlay_monitoring_info(conn, machine, options,
         fuse_stream_monitor.modified_chunk_dict
     info_dict[OverlayMonitoringInfo.DISK_FREE_BLOCKS] = trim_dict
     info_dict[OverlayMonitoringInfo.MEMORY_FREE_BLOCKS] = free_memory_dict
+    info_dict[OverlayMonitoringInfo.CHUNK_HASH] = chunk_hash
     monitoring_info = OverlayMonitoringInfo(info_dict)
     return monitoring_info
 
@@ -813,10 +830,13 @@ def get_libvirt_connection():
 def get_overlay_deltalist(monitoring_info, options,
                           base_image, base_mem,
                           base_memmeta, modified_disk,
-                          modified_mem, old_deltalist=None):
+                          modified_mem, old_deltalist=None,
+                          ret_statistics=None):
     """return overlay deltalist
     Get difference between base vm (base_image, base_mem) and
     launch vm (modified_disk, modified_mem) using monitoring information
+    :param old_deltalist: delta list of the previous overlay or path to
+        its file saved with hash values, whose items are looked up lazily
     """
 
     INFO = OverlayMonitoringInfo
@@ -826,7 +846,12 @@ def get_overlay_deltalist(monitoring_info, options,
     m_chunk_dict = getattr(monitoring_info, INFO.DISK_MODIFIED_BLOCKS, None)
     trim_dict = getattr(monitoring_info, INFO.DISK_FREE_BLOCKS, None)
     used_blocks_dict = getattr(monitoring_info, INFO.DISK_USED_BLOCKS, None)
+    chunk_hash = getattr(monitoring_info, INFO.CHUNK_HASH,
+                         Const.CHUNK_HASH_DEFAULT)
     dma_dict = dict()
+    cdc_hashdict = None
+    if getattr(options, "DISK_CHUNKING", "fixed") == "cdc":
+        cdc_hashdict = disk.load_cdc_hashdict(base_image, chunk_hash)
 
     LOG.info("Get memory delta")
     if options.DISK_ONLY:
@@ -837,10 +862,20 @@ def get_overlay_deltalist(monitoring_info, options,
             basemem_meta=base_memmeta,
             basemem_path=base_mem,
             apply_free_memory=options.FREE_SUPPORT,
-            free_memory_info=free_memory_dict)
-        if old_deltalist and len(old_deltalist) > 0:
+            free_memory_info=free_memory_dict,
+            hash_type=chunk_hash)
+        if isinstance(old_deltalist, basestring):
+            old_deltalist = DeltaList.fromfile(old_deltalist,
+                                               with_hashvalue=True)
+            try:
+                if len(old_deltalist) > 0:
+                    mem_deltalist = delta.residue_diff_deltalists(
+                        old_deltalist, mem_deltalist, base_mem, chunk_hash)
+            finally:
+                old_deltalist.close()
+        elif old_deltalist and len(old_deltalist) > 0:
             diff_deltalist = delta.residue_diff_deltalists(
-                old_deltalist, mem_deltalist, base_mem)
+                old_deltalist, mem_deltalist, base_mem, chunk_hash)
             mem_deltalist = diff_deltalist
 
     LOG.info("Get disk delta")
@@ -855,13 +890,16 @@ def get_overlay_deltalist(monitoring_info, options,
         apply_discard=True,
         dma_dict=dma_dict,
         used_blocks_dict=used_blocks_dict,
-        ret_statistics=disk_statistics)
+        ret_statistics=disk_statistics,
+        cdc_hashdict=cdc_hashdict,
+        hash_type=chunk_hash)
     LOG.info("Generate VM overlay using deduplication")
     merged_deltalist = delta.create_overlay(
         mem_deltalist, memory.Memory.RAM_PAGE_SIZE,
         disk_deltalist, Const.CHUNK_SIZE,
         basedisk_hashlist=basedisk_hashlist,
-        basemem_hashlist=basemem_hashlist)
+        basemem_hashlist=basemem_hashlist,
+        hash_type=chunk_hash)
     LOG.info("Print statistics")
     free_memory_dict = getattr(
         monitoring_info,
@@ -872,19 +910,30 @@ def get_overlay_deltalist(monitoring_info, options,
     DeltaList.statistics(merged_deltalist,
                          mem_discarded=free_pfn_counter,
                          disk_discarded=disk_discarded_count)
+    if ret_statistics is not None:
+        ret_statistics['mem_discarded'] = free_pfn_counter
+        ret_statistics['disk_discarded'] = disk_discarded_count
 
     return merged_deltalist
 
 
 def _create_overlay_meta(overlay_metafile, base_hash, modified_disksize,
-                         modified_memsize, blob_info):
+                         modified_memsize, blob_info, statistics=None,
+                         chunk_hash=Const.CHUNK_HASH_DEFAULT):
     fout = open(overlay_metafile, "wrb")
 
     meta_dict = dict()
     meta_dict[Const.META_BASE_VM_SHA256] = base_hash
+    meta_dict[Const.META_CHUNK_HASH] = chunk_hash
+    meta_dict[Const.META_OVERLAY_ID] = uuid4().hex
     meta_dict[Const.META_RESUME_VM_DISK_SIZE] = long(modified_disksize)
     meta_dict[Const.META_RESUME_VM_MEMORY_SIZE] = long(modified_memsize)
     meta_dict[Const.META_OVERLAY_FILES] = blob_info
+    merkle_root = delta.get_overlay_merkle_root(blob_info)
+    if merkle_root is not None:
+        meta_dict[Const.META_OVERLAY_MERKLE_ROOT] = merkle_root
+    if statistics is not None:
+        meta_dict[Const.META_OVERLAY_STATISTICS] = statistics
 
     serialized = msgpack.packb(meta_dict)
     fout.write(serialized)
@@ -897,27 +946,37 @@ def generate_overlayfile(overlay_deltalist,
                          launchdisk_size,
                          launchmem_size,
                          overlay_metapath,
-                         overlayfile_prefix):
+                         overlayfile_prefix,
+                         mem_discarded=0,
+                         disk_discarded=0,
+                         chunk_hash=Const.CHUNK_HASH_DEFAULT):
     ''' generate overlay metafile and file
+    :param chunk_hash: chunk hash of the base VM, which hashed the chunks
     :return: [overlay_metapath, [overlayfilepath1, overlayfilepath2]]
     '''
 
     # Compression
     LOG.info("[LZMA] Compressing overlay blobs (%s)", overlay_metapath)
+    item_stats = dict()
+    frame_size_kb = None
+    if getattr(options, "FRAME_SUPPORT", True):
+        frame_size_kb = Const.OVERLAY_FRAME_SIZE_KB
     blob_list = delta.divide_blobs(
         overlay_deltalist,
         overlayfile_prefix,
         Const.OVERLAY_BLOB_SIZE_KB,
         Const.CHUNK_SIZE,
-        memory.Memory.RAM_PAGE_SIZE)
+        memory.Memory.RAM_PAGE_SIZE,
+        frame_size_kb=frame_size_kb,
+        ret_statistics=item_stats)
+    statistics = delta.get_overlay_statistics(
+        item_stats, dict(options.to_dict()),
+        mem_discarded=mem_discarded, disk_discarded=disk_discarded)
 
     # create metadata
-    if not options.DISK_ONLY:
-        _create_overlay_meta(overlay_metapath, base_hashvalue,
-                             launchdisk_size, launchmem_size, blob_list)
-    else:
-        _create_overlay_meta(overlay_metapath, base_hashvalue,
-                             launchdisk_size, launchmem_size, blob_list)
+    _create_overlay_meta(overlay_metapath, base_hashvalue,
+                         launchdisk_size, launchmem_size, blob_list,
+                         statistics=statistics, chunk_hash=chunk_hash)
 
     overlay_files = [item[Const.META_OVERLAY_FILE_NAME] for item in blob_list]
     dirpath = os.path.dirname(overlayfile_prefix)
@@ -926,7 +985,47 @@ def generate_overlayfile(overlay_deltalist,
     return overlay_metapath, overlay_files
 
 
+def check_overlay_chain(meta_info_list):
+    '''check that each residue is chained to the previous overlay
+    :param meta_info_list: overlay meta from the oldest one
+    '''
+    for index, meta_info in enumerate(meta_info_list):
+        parent_id = meta_info.get(Const.META_PARENT_OVERLAY_ID, None)
+        if index == 0:
+            if parent_id is not None:
+                msg = "Need previous residue (%s) of the chain" % parent_id
+                raise CloudletGenerationError(msg)
+            continue
+        prev_meta_info = meta_info_list[index-1]
+        if parent_id is None or\
+                parent_id != prev_meta_info.get(Const.META_OVERLAY_ID, None):
+            msg = "Residue is not chained to the previous overlay (%s)" % \
+                prev_meta_info.get(Const.META_OVERLAY_ID, None)
+            raise CloudletGenerationError(msg)
+        if meta_info[Const.META_BASE_VM_SHA256] !=\
+                prev_meta_info[Const.META_BASE_VM_SHA256]:
+            raise CloudletGenerationError("Residues have different base VM")
+        if get_overlay_chunk_hash(meta_info) !=\
+                get_overlay_chunk_hash(prev_meta_info):
+            msg = "Residues have different chunk hash"
+            raise CloudletGenerationError(msg)
+
+
+def get_overlay_chunk_hash(meta_info):
+    # overlay without chunk hash is created with sha256
+    return meta_info.get(Const.META_CHUNK_HASH, Const.CHUNK_HASH_SHA256)
+
+
 def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
+    '''
+    :param kwargs-parent_deltalists: [(meta_info, overlay_file), ...] of the
+        previous residues in the chain from the oldest one
+    :param kwargs-residue_hashlist_path: save hash list of the recovered VM
+        to create a residue chained to this overlay
+    :param kwargs-recovery_context: RecoveryContext of the base VM from
+        the pool. Its launch files and pipe for FUSE are used, and the base
+        VM is not mapped again
+    '''
     base_mem = kwargs.get('base_mem', None)
     base_diskmeta = kwargs.get('base_diskmeta', None)
     base_memmeta = kwargs.get('base_memmeta', None)
@@ -934,21 +1033,31 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     if (not base_mem) or (not base_diskmeta) or (not base_memmeta):
         (base_diskmeta, base_mem, base_memmeta) = \
             Const.get_basepath(base_image, check_exist=True)
-    launch_mem = NamedTemporaryFile(
-        prefix="cloudlet-launch-mem-", delete=False)
-    launch_disk = NamedTemporaryFile(
-        prefix="cloudlet-launch-disk-", delete=False)
+    recovery_context = kwargs.pop('recovery_context', None)
+    base_mappings = None
+    if recovery_context is not None:
+        base_mem = recovery_context.base_mem
+        base_mappings = recovery_context.base_mappings
+        launch_mem_path = recovery_context.launch_mem
+        launch_disk_path = recovery_context.launch_disk
+    else:
+        launch_mem_path = NamedTemporaryFile(
+            prefix="cloudlet-launch-mem-", delete=False).name
+        launch_disk_path = NamedTemporaryFile(
+            prefix="cloudlet-launch-disk-", delete=False).name
 
     # Get modified list from overlay_meta
     vm_disk_size = meta_info[Const.META_RESUME_VM_DISK_SIZE]
     vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
+    parent_overlays = kwargs.get('parent_deltalists', None) or list()
     memory_chunks_all = set()
     disk_chunks_all = set()
-    for each_file in meta_info[Const.META_OVERLAY_FILES]:
-        memory_chunks = each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
-        disk_chunks = each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS]
-        memory_chunks_all.update(memory_chunks)
-        disk_chunks_all.update(disk_chunks)
+    for each_meta_info in [item[0] for item in parent_overlays] + [meta_info]:
+        for each_file in each_meta_info[Const.META_OVERLAY_FILES]:
+            memory_chunks = each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
+            disk_chunks = each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS]
+            memory_chunks_all.update(memory_chunks)
+            disk_chunks_all.update(disk_chunks)
 
     # make FUSE disk & memory
     kwargs['meta_info'] = meta_info
@@ -956,8 +1065,8 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     fuse = run_fuse(
         Const.CLOUDLETFS_PATH, Const.CHUNK_SIZE,
         base_image, vm_disk_size, base_mem, vm_memory_size,
-        resumed_disk=launch_disk.name, disk_chunks=disk_chunks_all,
-        resumed_memory=launch_mem.name, memory_chunks=memory_chunks_all,
+        resumed_disk=launch_disk_path, disk_chunks=disk_chunks_all,
+        resumed_memory=launch_mem_path, memory_chunks=memory_chunks_all,
         **kwargs
     )
     LOG.info("Start FUSE (%f s)" % (time()-time_start_fuse))
@@ -965,20 +1074,32 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
         (len(memory_chunks_all) + len(disk_chunks_all)))
 
     # Recover Modified Memory
-    named_pipename = overlay_file+".fifo"
-    os.mkfifo(named_pipename)
+    if recovery_context is not None:
+        named_pipename = recovery_context.fuse_pipe
+    else:
+        named_pipename = overlay_file+".fifo"
+        os.mkfifo(named_pipename)
 
     delta_proc = delta.Recovered_delta(base_image, base_mem, overlay_file,
-                                       launch_mem.name, vm_memory_size,
-                                       launch_disk.name, vm_disk_size,
+                                       launch_mem_path, vm_memory_size,
+                                       launch_disk_path, vm_disk_size,
                                        Const.CHUNK_SIZE,
-                                       out_pipename=named_pipename)
+                                       out_pipename=named_pipename,
+                                       parent_overlay_paths=[
+                                           item[1] for item in parent_overlays],
+                                       residue_hashlist_path=kwargs.get(
+                                           'residue_hashlist_path', None),
+                                       overlay_id=meta_info.get(
+                                           Const.META_OVERLAY_ID, None),
+                                       base_mappings=base_mappings,
+                                       hash_type=get_overlay_chunk_hash(
+                                           meta_info))
 
     fuse_thread = cloudletfs.FuseFeedingProc(
         fuse,
         named_pipename,
         delta.Recovered_delta.END_OF_PIPE)
-    return [launch_disk.name, launch_mem.name, fuse, delta_proc, fuse_thread]
+    return [launch_disk_path, launch_mem_path, fuse, delta_proc, fuse_thread]
 
 
 def run_fuse(bin_path, chunk_size, original_disk, fuse_disk_size,
@@ -1093,6 +1214,9 @@ class QmpThreadSerial(native_threading.Thread):
 
     def _stop_migration(self):
         stop_time = self.qmp.stop_raw_live()
+        if stop_time is None or stop_time is True:
+            LOG.warning("No STOP event for stop_raw_live")
+            stop_time = time()
         self.fuse_stream_monitor.terminate()
         return stop_time
 
@@ -1361,11 +1485,9 @@ def synthesis_statistics(meta_info, decomp_overlay_file,
                          mem_access_list, disk_access_list):
     start_time = time()
 
+    # delta items are looked up lazily from the memory-mapped overlay
     delta_list = DeltaList.fromfile(decomp_overlay_file)
     total_overlay_size = os.path.getsize(decomp_overlay_file)
-    delta_dic = dict()
-    for delta_item in delta_list:
-        delta_dic[delta_item.index] = delta_item
 
     overlay_mem_chunks = dict()
     overlay_disk_chunks = dict()
@@ -1381,13 +1503,13 @@ def synthesis_statistics(meta_info, decomp_overlay_file,
         for mem_chunk in memory_chunks:
             index = DeltaItem.get_index(
                 DeltaItem.DELTA_MEMORY, mem_chunk * memory.Memory.RAM_PAGE_SIZE)
-            chunk_size = len(delta_dic[index].get_serialized())
+            chunk_size = len(delta_list.get(index).get_serialized())
             overlay_mem_chunks[mem_chunk] = {
                 "blob_name": blob_name, 'chunk_size': chunk_size}
         for disk_chunk in disk_chunks:
             index = DeltaItem.get_index(
                 DeltaItem.DELTA_DISK, disk_chunk * Const.CHUNK_SIZE)
-            chunk_size = len(delta_dic[index].get_serialized())
+            chunk_size = len(delta_list.get(index).get_serialized())
             overlay_disk_chunks[disk_chunk] = {
                 "blob_name": blob_name, 'chunk_size': chunk_size}
         # (memory, memory_total, disk, disk_total)
@@ -1413,7 +1535,7 @@ def synthesis_statistics(meta_info, decomp_overlay_file,
                 DeltaItem.DELTA_MEMORY,
                 access_chunk *
                 memory.Memory.RAM_PAGE_SIZE)
-            chunk_size = len(delta_dic[index].get_serialized())
+            chunk_size = len(delta_list.get(index).get_serialized())
             blob_name = overlay_mem_chunks.get(access_chunk)['blob_name']
             chunk_size = overlay_mem_chunks.get(access_chunk)['chunk_size']
             access_per_blobs[blob_name]['mem_access'] += 1  # 0: memory
@@ -1426,13 +1548,14 @@ def synthesis_statistics(meta_info, decomp_overlay_file,
                 DeltaItem.DELTA_DISK,
                 access_chunk *
                 Const.CHUNK_SIZE)
-            chunk_size = len(delta_dic[index].get_serialized())
+            chunk_size = len(delta_list.get(index).get_serialized())
             blob_name = overlay_disk_chunks.get(access_chunk)['blob_name']
             chunk_size = overlay_disk_chunks.get(access_chunk)['chunk_size']
             access_per_blobs[blob_name]['disk_access'] += 1
             access_per_blobs[blob_name]['disk_access_size'] += chunk_size
             overlay_disk_access_count += 1
             overlay_disk_access_size += chunk_size
+    delta_list.close()
 
     LOG.debug("-------------------------------------------------")
     LOG.debug("## Synthesis Statistics (took %f seconds) ##" %
@@ -1511,16 +1634,34 @@ def _create_baseVM(conn, domain,
     # make memory snapshot
     # VM has to be paused first to perform stable disk hashing
     save_mem_snapshot(conn, domain, base_mempath, **kwargs)
+    chunk_hash = kwargs.get('chunk_hash', Const.CHUNK_HASH_DEFAULT)
     LOG.info("Start Base VM Memory hashing")
-    base_mem = memory.hashing(base_mempath)
+    base_mem = memory.hashing(base_mempath, chunk_hash)
     base_mem.export_to_file(base_memmeta)
     LOG.info("Finish Base VM Memory hashing")
 
     # generate disk hashing
     # TODO: need more efficient implementation, e.g. bisect
     LOG.info("Start Base VM Disk hashing")
-    base_hashvalue = disk.hashing(base_diskpath, base_diskmeta)
+    base_hashvalue = disk.hashing(base_diskpath, base_diskmeta,
+                                  hash_type=chunk_hash)
     LOG.info("Finish Base VM Disk hashing")
+
+    # super-feature index to find similar chunk at the base VM
+    if kwargs.get('similarity_index', False):
+        LOG.info("Start Base VM similarity indexing")
+        for base_path in (base_mempath, base_diskpath):
+            sim_index = similarity.SimilarityIndex.build(base_path,
+                                                         Const.CHUNK_SIZE)
+            sim_index.tofile(similarity.get_index_path(base_path))
+        LOG.info("Finish Base VM similarity indexing")
+
+    # index for content-defined chunking of disk overlay
+    if kwargs.get('disk_cdc', False):
+        LOG.info("Start Base VM Disk CDC hashing")
+        disk.cdc_hashing(base_diskpath, Const.get_base_cdcpath(base_diskpath),
+                         hash_type=chunk_hash)
+        LOG.info("Finish Base VM Disk CDC hashing")
     return base_hashvalue
 
 
@@ -1564,9 +1705,15 @@ def validate_handoffurl(handoff_url):
     return True
 
 
-def create_baseVM(disk_image_path):
+def create_baseVM(disk_image_path, disk_cdc=False, chunk_hash=None,
+                  similarity_index=False):
     # Create Base VM(disk, memory) snapshot using given VM disk image
     # :param disk_image_path : file path of the VM disk image
+    # :param disk_cdc : create index for content-defined chunking of disk
+    # :param similarity_index : create index of similar chunks of disk and
+    #   memory, used by OPTIMIZATION_DELTA_BASE_SIMILAR
+    # :param chunk_hash : hash of disk and memory chunks. It is recorded at
+    #   the hash meta and used for every overlay of the Base VM
     # :returns: (generated base VM disk path, generated base VM memory path)
 
     # Check DB
@@ -1575,6 +1722,8 @@ def create_baseVM(disk_image_path):
         Const.get_basepath(disk_image_path)
 
     # check sanity
+    chunk_hash = chunk_hash or Const.CHUNK_HASH_DEFAULT
+    tool.get_chunk_hash_function(chunk_hash)
     if not os.path.exists(Const.TEMPLATE_XML):
         raise CloudletGenerationError("Cannot find Base VM default XML at %s\n"
                                       % Const.TEMPLATE_XML)
@@ -1596,6 +1745,11 @@ def create_baseVM(disk_image_path):
         os.unlink(base_mempath)
     if os.path.exists(base_memmeta):
         os.unlink(base_memmeta)
+    for index_path in (Const.get_base_cdcpath(disk_image_path),
+                       similarity.get_index_path(disk_image_path),
+                       similarity.get_index_path(base_mempath)):
+        if os.path.exists(index_path):
+            os.unlink(index_path)
 
     # edit default XML to have new disk path
     conn = get_libvirt_connection()
@@ -1611,7 +1765,10 @@ def create_baseVM(disk_image_path):
                                         disk_image_path,
                                         base_mempath,
                                         base_diskmeta,
-                                        base_memmeta)
+                                        base_memmeta,
+                                        disk_cdc=disk_cdc,
+                                        similarity_index=similarity_index,
+                                        chunk_hash=chunk_hash)
     except Exception as e:
         LOG.error("failed at %s" % str(traceback.format_exc()))
         if machine is not None:
@@ -1635,6 +1792,162 @@ def create_baseVM(disk_image_path):
 
     return disk_image_path, base_mempath
 
+
+def _apply_overlay_chunks(base_path, recovered_path, output_path,
+                          output_size, chunks, chunk_size):
+    # copy base file and overwrite chunks recovered from the overlay
+    shutil.copyfile(base_path, output_path)
+    fout = open(output_path, "r+b")
+    fout.truncate(output_size)
+    frecovered = open(recovered_path, "rb")
+    for (start, count) in disk.get_chunk_runs(chunks):
+        offset = start*chunk_size
+        if offset >= output_size:
+            break
+        frecovered.seek(offset)
+        data = frecovered.read(min(count*chunk_size, output_size-offset))
+        fout.seek(offset)
+        fout.write(data.ljust(min(count*chunk_size, output_size-offset),
+                              chr(0x00)))
+    frecovered.close()
+    fout.close()
+
+
+def derive_baseVM(base_disk, overlay_path, new_disk_path,
+                  zip_container=False):
+    # Create new Base VM applying VM overlay to the Base VM without resuming
+    # the VM. Hash meta of the new Base VM is computed incrementally from
+    # the meta of the Base VM, hashing only the chunks in the overlay.
+    # :param base_disk : file path of the base disk of VM overlay
+    # :param overlay_path : file path of the VM overlay
+    # :param new_disk_path : file path of the disk of new Base VM
+    # :returns: (new base VM disk path, new base VM memory path)
+    base_disk = os.path.abspath(base_disk)
+    new_disk_path = os.path.abspath(new_disk_path)
+    (base_diskmeta, base_mempath, base_memmeta) = \
+        Const.get_basepath(base_disk, check_exist=True)
+    (new_diskmeta, new_mempath, new_memmeta) = \
+        Const.get_basepath(new_disk_path)
+    for path in (new_disk_path, new_diskmeta, new_mempath, new_memmeta):
+        if os.path.exists(path):
+            msg = "File exists at %s" % path
+            raise CloudletGenerationError(msg)
+
+    dbconn = db_api.DBConnector()
+    basevm_list = dbconn.list_item(db_table.BaseVM)
+    parent_basevm = None
+    for item in basevm_list:
+        if base_disk == item.disk_path:
+            parent_basevm = item
+            break
+    if parent_basevm is None:
+        msg = "Base VM is not registered at %s" % base_disk
+        raise CloudletGenerationError(msg)
+
+    overlay_filename = NamedTemporaryFile(prefix="cloudlet-overlay-file-")
+    if not zip_container:
+        if os.path.exists(overlay_path) == False:
+            msg = "VM overlay does not exist at %s" % overlay_path
+            raise CloudletGenerationError(msg)
+        meta_info = compression.decomp_overlay(overlay_path,
+                                               overlay_filename.name)
+    else:
+        meta_info = compression.decomp_overlayzip(overlay_path,
+                                                  overlay_filename.name)
+    if meta_info[Const.META_BASE_VM_SHA256] != parent_basevm.hash_value:
+        msg = "VM overlay is not created from the Base VM at %s" % base_disk
+        raise CloudletGenerationError(msg)
+
+    # recover modified chunks to the sparse files
+    vm_disk_size = meta_info[Const.META_RESUME_VM_DISK_SIZE]
+    vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
+    memory_chunks_all = set()
+    disk_chunks_all = set()
+    for each_file in meta_info[Const.META_OVERLAY_FILES]:
+        memory_chunks_all.update(each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS])
+        disk_chunks_all.update(each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS])
+    recovered_mem = NamedTemporaryFile(prefix="cloudlet-recover-mem-")
+    recovered_disk = NamedTemporaryFile(prefix="cloudlet-recover-disk-")
+    recovered_chunks = NamedTemporaryFile(prefix="cloudlet-recover-chunks-")
+    # new Base VM is hashed with the chunk hash of its parent, which
+    # should be the one of the overlay
+    chunk_hash = get_overlay_chunk_hash(meta_info)
+    delta_proc = delta.Recovered_delta(base_disk, base_mempath,
+                                       overlay_filename.name,
+                                       recovered_mem.name, vm_memory_size,
+                                       recovered_disk.name, vm_disk_size,
+                                       Const.CHUNK_SIZE,
+                                       out_pipename=recovered_chunks.name,
+                                       hash_type=chunk_hash)
+    delta_proc.run()
+    LOG.info("Recovered %ld disk chunks and %ld memory chunks" %
+             (len(disk_chunks_all), len(memory_chunks_all)))
+
+    try:
+        _apply_overlay_chunks(base_disk, recovered_disk.name, new_disk_path,
+                              vm_disk_size, disk_chunks_all, Const.CHUNK_SIZE)
+        _apply_overlay_chunks(base_mempath, recovered_mem.name, new_mempath,
+                              vm_memory_size, memory_chunks_all,
+                              Const.CHUNK_SIZE)
+
+        LOG.info("Start Base VM Memory hashing")
+        modified_pages = set()
+        for chunk in memory_chunks_all:
+            start_page = chunk*Const.CHUNK_SIZE/memory.Memory.RAM_PAGE_SIZE
+            end_page = ((chunk+1)*Const.CHUNK_SIZE-1) /\
+                memory.Memory.RAM_PAGE_SIZE
+            modified_pages.update(xrange(start_page, end_page+1))
+        new_mem = memory.incremental_hashing(new_mempath, base_memmeta,
+                                             modified_pages, chunk_hash)
+        new_mem.export_to_file(new_memmeta)
+        LOG.info("Finish Base VM Memory hashing")
+
+        LOG.info("Start Base VM Disk hashing")
+        new_hashvalue = disk.incremental_hashing(
+            new_disk_path, new_diskmeta, base_disk, base_diskmeta,
+            disk_chunks_all, chunk_size=Const.CHUNK_SIZE,
+            hash_type=chunk_hash)
+        LOG.info("Finish Base VM Disk hashing")
+
+        for item in basevm_list:
+            if new_hashvalue == item.hash_value:
+                msg = "Same Base VM exists at %s" % item.disk_path
+                raise CloudletGenerationError(msg)
+
+        # indexes are rebuilt only when the parent Base VM has them
+        for (parent_path, new_path) in ((base_mempath, new_mempath),
+                                        (base_disk, new_disk_path)):
+            if os.path.exists(similarity.get_index_path(parent_path)):
+                LOG.info("Start Base VM similarity indexing")
+                sim_index = similarity.SimilarityIndex.build(
+                    new_path, Const.CHUNK_SIZE)
+                sim_index.tofile(similarity.get_index_path(new_path))
+                LOG.info("Finish Base VM similarity indexing")
+        if os.path.exists(Const.get_base_cdcpath(base_disk)):
+            LOG.info("Start Base VM Disk CDC hashing")
+            disk.cdc_hashing(new_disk_path,
+                             Const.get_base_cdcpath(new_disk_path),
+                             hash_type=chunk_hash)
+            LOG.info("Finish Base VM Disk CDC hashing")
+    except Exception:
+        for path in (new_disk_path, new_diskmeta, new_mempath, new_memmeta,
+                     similarity.get_index_path(new_disk_path),
+                     similarity.get_index_path(new_mempath),
+                     Const.get_base_cdcpath(new_disk_path)):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+
+    # save the result to DB
+    new_basevm = db_table.BaseVM(new_disk_path, new_hashvalue,
+                                 parent_hash_value=parent_basevm.hash_value)
+    dbconn.add_item(new_basevm)
+
+    # write hashvalue to file
+    hashfile_path = Const.get_base_hashpath(new_disk_path)
+    open(hashfile_path, "w+").write(str(new_hashvalue) + "\n")
+    return new_disk_path, new_mempath
+
 def handlesig(signum, frame):
     LOG.info("Received signal(%d) to start handoff..." % signum)
 
@@ -1644,6 +1957,15 @@ def synthesis(base_disk, overlay_path, **kwargs):
     :param overlay_path: path to VM overlay file
     :param kwargs-disk_only: synthesis size VM with only disk image
     :param kwargs-handoff_url: return residue of changed portion
+    :param kwargs-parent_overlays: previous residues of overlay_path from the
+        oldest one, which are applied before overlay_path
+    :param kwargs-chained_residue: return residue of changed portion from
+        the VM recovered from overlay_path
+    :param kwargs-post_copy: resume VM at tcp handoff destination before the
+        memory out of the working set arrives
+    :param kwargs-send_rate: sending rate cap of tcp handoff in Mbps
+    :param kwargs-host_send_rate: uplink rate in Mbps split evenly by the
+        concurrent tcp handoffs of this host
     """
     if os.path.exists(base_disk) == False:
         msg = "Base disk does not exist at %s" % base_disk
@@ -1659,6 +1981,9 @@ def synthesis(base_disk, overlay_path, **kwargs):
         if parsed_handoff_url.scheme != "file" and parsed_handoff_url.scheme != "tcp":
             msg = "invalid handoff_url (%s). Only support file and tcp scheme" % handoff_url
             raise CloudletGenerationError(msg)
+        if kwargs.get('post_copy', False) and parsed_handoff_url.scheme != "tcp":
+            msg = "post-copy handoff needs tcp handoff_url (%s)" % handoff_url
+            raise CloudletGenerationError(msg)
 
     qemu_args = kwargs.get('qemu_args', False)
     overlay_mode = kwargs.get('overlay_mode', None)
@@ -1671,21 +1996,31 @@ def synthesis(base_disk, overlay_path, **kwargs):
 
     overlay_filename = NamedTemporaryFile(prefix="cloudlet-overlay-file-")
     decompe_time_s = time()
-    if not zip_container:
-        if os.path.exists(overlay_path) == False:
-            msg = "VM overlay does not exist at %s" % overlay_path
-            raise CloudletGenerationError(msg)
-        LOG.info("Decompressing VM overlay")
-        meta_info = compression.decomp_overlay(overlay_path,
-                                               overlay_filename.name)
-    else:
-        meta_info = compression.decomp_overlayzip(overlay_path,
-                                                  overlay_filename.name)
+    parent_deltalists = list()
+    parent_filenames = list()
+    for parent_path in kwargs.get('parent_overlays', None) or list():
+        parent_filename = NamedTemporaryFile(prefix="cloudlet-overlay-file-")
+        parent_filenames.append(parent_filename)
+        parent_meta_info = _decomp_overlay_file(
+            parent_path, parent_filename.name, zip_container)
+        parent_deltalists.append((parent_meta_info, parent_filename.name))
+    meta_info = _decomp_overlay_file(overlay_path, overlay_filename.name,
+                                     zip_container)
+    check_overlay_chain([item[0] for item in parent_deltalists] + [meta_info])
+
+    residue_hashlist_path = None
+    if handoff_url is not None and kwargs.get('chained_residue', False):
+        residue_hashlist_path = os.path.join(
+            mkdtemp(prefix="cloudlet-residue-hashlist-"), "hashlist")
 
     LOG.info("Decompression time : %f (s)" % (time()-decompe_time_s))
     LOG.info("Recovering launch VM")
+    recover_kwargs = dict(kwargs)
+    recover_kwargs['parent_deltalists'] = parent_deltalists
+    recover_kwargs['residue_hashlist_path'] = residue_hashlist_path
     launch_disk, launch_mem, fuse, delta_proc, fuse_thread = \
-        recover_launchVM(base_disk, meta_info, overlay_filename.name, **kwargs)
+        recover_launchVM(base_disk, meta_info, overlay_filename.name,
+                         **recover_kwargs)
     # resume VM
     LOG.info("Resume the launch VM")
     synthesized_VM = SynthesizedVM(
@@ -1734,6 +2069,10 @@ def synthesis(base_disk, overlay_path, **kwargs):
                 temp_dir = mkdtemp(prefix="cloudlet-residue-")
                 residue_zipfile = os.path.join(temp_dir, Const.OVERLAY_ZIP)
                 dest_handoff_url = "file://%s" % os.path.abspath(residue_zipfile)
+        post_copy_working_set = None
+        if kwargs.get('post_copy', False):
+            post_copy_working_set = handoff.get_working_set(
+                synthesized_VM.monitor.mem_access_chunk_list)
         handoff_ds = handoff.HandoffDataSend()
         LOG.debug("save data to file")
         handoff_ds.save_data(
@@ -1744,6 +2083,10 @@ def synthesis(base_disk, overlay_path, **kwargs):
             synthesized_VM.fuse.mountpoint, synthesized_VM.qemu_logfile,
             synthesized_VM.qmp_channel, synthesized_VM.machine.ID(),
             synthesized_VM.fuse.modified_disk_chunks, "qemu:///session",
+            residue_hashlist_path=residue_hashlist_path,
+            post_copy_working_set=post_copy_working_set,
+            send_rate_mbps=kwargs.get('send_rate', None),
+            host_rate_mbps=kwargs.get('host_send_rate', None),
         )
         if True:
             # using in-memory data structure
@@ -1779,6 +2122,19 @@ def synthesis(base_disk, overlay_path, **kwargs):
     synthesized_VM.monitor.terminate()
     synthesized_VM.monitor.join()
     synthesized_VM.terminate()
+    if residue_hashlist_path is not None:
+        shutil.rmtree(os.path.dirname(residue_hashlist_path), True)
+
+
+def _decomp_overlay_file(overlay_path, output_path, zip_container):
+    if not zip_container:
+        if os.path.exists(overlay_path) == False:
+            msg = "VM overlay does not exist at %s" % overlay_path
+            raise CloudletGenerationError(msg)
+        LOG.info("Decompressing VM overlay")
+        return compression.decomp_overlay(overlay_path, output_path)
+    else:
+        return compression.decomp_overlayzip(overlay_path, output_path)
 
 
 def info_vm_overlay(overlay_path):
@@ -1796,20 +2152,66 @@ def info_vm_overlay(overlay_path):
     modified_disk_chunk_count = 0
     modified_memory_chunk_count = 0
     comp_overlay_files = meta_info[Const.META_OVERLAY_FILES]
-    comp_overlay_files = [item for item in comp_overlay_files]
-    for comp_filename in comp_overlay_files:
+    for comp_file in comp_overlay_files:
         modified_disk_chunk_count += len(
-            item[Const.META_OVERLAY_FILE_DISK_CHUNKS])
+            comp_file[Const.META_OVERLAY_FILE_DISK_CHUNKS])
         modified_memory_chunk_count += len(
-            item[Const.META_OVERLAY_FILE_MEMORY_CHUNKS])
+            comp_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS])
     output = "VM overlay\t\t\t: %s\n" % overlay_path
     output += "Base VM ID\t\t\t: %s\n" % baseVMsha256
+    output += "Chunk hash\t\t\t: %s\n" % get_overlay_chunk_hash(meta_info)
     output += "# of modified disk chunk\t: %s\n" % modified_disk_chunk_count
     output += "# of modified memory chunk\t: %s\n" % modified_memory_chunk_count
     output += "VM disk size\t\t\t: %s bytes\n" % vm_disk_size
     output += "VM memory size\t\t\t: %s bytes\n" % vm_memory_size
+
+    # statistics section is written at overlay creation. Items of the older
+    # overlay are counted from the index of the decompressed overlay
+    statistics = meta_info.get(Const.META_OVERLAY_STATISTICS, None)
+    if statistics is None:
+        discarded = dict()
+        item_stats = _get_item_statistics(overlay_path)
+        creation_mode = dict()
+    else:
+        discarded = statistics[Const.META_OVERLAY_STAT_DISCARDED]
+        item_stats = statistics[Const.META_OVERLAY_STAT_ITEMS]
+        creation_mode = statistics[Const.META_OVERLAY_STAT_CREATION_MODE]
+    for comp_file in comp_overlay_files:
+        output += "Blob %s\t: %s -> %s bytes\n" % (
+            comp_file[Const.META_OVERLAY_FILE_NAME],
+            comp_file.get(Const.META_OVERLAY_FILE_RAW_SIZE, "-"),
+            comp_file[Const.META_OVERLAY_FILE_SIZE])
+    for type_name in sorted(item_stats.keys()):
+        ref_stats = item_stats[type_name]
+        total_count = sum([count for (count, size) in ref_stats.values()])
+        total_size = sum([size for (count, size) in ref_stats.values()])
+        output += "%s delta items\t\t: %d (%d bytes, %d discarded)\n" % (
+            type_name, total_count, total_size, discarded.get(type_name, 0))
+        for ref_name in sorted(ref_stats.keys()):
+            (count, size) = ref_stats[ref_name]
+            output += "  %-16s\t\t: %d (%d bytes)\n" % (
+                ref_name, count, size)
+    for key in sorted(creation_mode.keys()):
+        output += "Mode %s\t: %s\n" % (key, creation_mode[key])
     return output
 
 
+def _get_item_statistics(overlay_path):
+    # only headers of the items are read from the decompressed overlay
+    decomp_file = NamedTemporaryFile(prefix="cloudlet-overlay-file-")
+    try:
+        _decomp_overlay_file("file://%s" % overlay_path, decomp_file.name,
+                             True)
+        delta_list = DeltaList.fromfile(decomp_file.name)
+        item_stats = dict()
+        for position, delta_item in enumerate(delta_list.iter_headers()):
+            delta.add_item_statistics(item_stats, delta_item,
+                                      delta_list.get_item_size(position))
+        delta_list.close()
+    finally:
+        decomp_file.close()
+    return item_stats
+
+
 '''External API End
 '''
@@ -21,6 +21,9 @@
 import os
 import sys
 
+import ctypes
+import ctypes.util
+import errno
 import struct
 import socket
 import time
@@ -71,6 +74,8 @@ class Protocol(object):
     KEY_SESSION_ID = "session_id"
     KEY_REQUESTED_COMMAND = "requested_command"
     KEY_OVERLAY_URL = "overlay_url"
+    # client serves a frame of a blob named as 'blob#frame_index'
+    KEY_SEGMENT_FRAME = "segment_frame"
 
     # synthesis option
     KEY_SYNTHESIS_OPTION = "synthesis_option"
@@ -90,6 +95,64 @@ class ClientError(Exception):
     pass
 
 
+def _load_sendfile():
+    # python 2 does not have os.sendfile
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_sendfile = _load_sendfile()
+
+
+def _sendfile_range(sock, fd, offset, size):
+    # return bytes sent, which is less than size when the kernel does not
+    # support sendfile for the file and the socket
+    file_offset = ctypes.c_int64(offset)
+    end_offset = offset + size
+    while file_offset.value < end_offset:
+        sent = _sendfile(sock.fileno(), fd.fileno(), ctypes.byref(file_offset),
+                         end_offset - file_offset.value)
+        if sent > 0:
+            continue
+        if sent == 0:
+            break
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+            continue
+        if err == errno.EAGAIN:
+            select.select([], [sock], [])
+            continue
+        if err in (errno.EINVAL, errno.ENOSYS):
+            break
+        raise socket.error(err, os.strerror(err))
+    return file_offset.value - offset
+
+
+def send_file_range(sock, fd, offset, size, chunk_size=1024*1024):
+    '''Send size bytes of the file from offset. The kernel copies the data
+    from the page cache to the socket with sendfile(2), so a blob is not
+    read into the process. Remaining data is read and sent by chunk_size
+    where sendfile is not available
+    '''
+    sent_size = 0
+    if _sendfile is not None:
+        sent_size = _sendfile_range(sock, fd, offset, size)
+    fd.seek(offset + sent_size)
+    while sent_size < size:
+        data = fd.read(min(chunk_size, size - sent_size))
+        if not data:
+            raise ClientError("%s is shorter than %d bytes" %
+                              (fd.name, offset + size))
+        sock.sendall(data)
+        sent_size += len(data)
+
+
 class Client(object):
     RET_FAILED = 0
     RET_SUCCESS = 1
@@ -225,6 +288,7 @@ class Client(object):
             Protocol.KEY_COMMAND: Protocol.MESSAGE_COMMAND_SEND_META,
             Protocol.KEY_META_SIZE: len(meta_data),
             Protocol.KEY_SESSION_ID: session_id,
+            Protocol.KEY_SEGMENT_FRAME: True,
             }
         if len(self.synthesis_option) > 0:
             header_dict[Protocol.KEY_SYNTHESIS_OPTION] = self.synthesis_option
@@ -247,7 +311,8 @@ class Client(object):
             raise ClientError(msg)
 
         meta_info = Client.decoding(meta_data)
-        total_blob_count = len(meta_info['overlay_files'])
+        segment_dict = self._get_overlay_segments(meta_info)
+        total_blob_count = len(segment_dict)
         sent_blob_list = list()
         is_synthesis_finished = False
 
@@ -287,23 +352,24 @@ class Client(object):
 
             # send data
             for i in o_ready:
-                if (i == sock) and (len(sent_blob_list) < total_blob_count):
+                if i == sock:
                     # check request list
                     requested_uri = None
                     if len(blob_request_list) == 0:
                         continue
 
+                    # segment corrupted on the wire is requested again
                     requested_uri = blob_request_list.pop(0)
                     if requested_uri not in sent_blob_list:
                         sent_blob_list.append(requested_uri)
-                    else:
-                        msg = "sending duplicated blob: %s" % requested_uri
-                        raise ClientError(msg)
 
                     blob_name = os.path.basename(requested_uri)
-                    blob_size = self._get_overlay_blob_size(overlay_file,
-                                                            blob_name,
-                                                            is_zipped)
+                    blob_name, blob_offset, blob_size = segment_dict.get(
+                        blob_name, (blob_name, 0, None))
+                    if blob_size is None:
+                        blob_size = self._get_overlay_blob_size(overlay_file,
+                                                                blob_name,
+                                                                is_zipped)
                     segment_info = {
                         Protocol.KEY_COMMAND: Protocol.MESSAGE_COMMAND_SEND_OVERLAY,
                         Protocol.KEY_REQUEST_SEGMENT: requested_uri,
@@ -315,9 +381,8 @@ class Client(object):
                     header = Client.encoding(segment_info)
                     sock.sendall(struct.pack("!I", len(header)))
                     sock.sendall(header)
-                    sock.sendall(self._read_overlay_blob(overlay_file,
-                                                         blob_name,
-                                                         is_zipped))
+                    self._send_overlay_blob(sock, overlay_file, blob_name,
+                                            is_zipped, blob_offset, blob_size)
 
                     if len(sent_blob_list) == total_blob_count:
                         self.time_dict['send_header_end_time'] = time.time()
@@ -344,13 +409,74 @@ class Client(object):
         else:
             return open(filepath, "r").read()
 
-    def _read_overlay_blob(self, filepath, blobname, is_zipped):
+    def _get_overlay_segments(self, meta_info):
+        # segment is either a whole blob or an independently compressed
+        # frame of the blob named as 'blob#frame_index'.
+        # Use magic string to make this client independent
+        segment_dict = dict()
+        for blob in meta_info['overlay_files']:
+            blob_name = blob['overlay_name']
+            frames = blob.get('overlay_frames', None)
+            if not frames:
+                segment_dict[blob_name] = (blob_name, 0, None)
+                continue
+            for index, frame in enumerate(frames):
+                segment_name = "%s#%d" % (blob_name, index)
+                segment_dict[segment_name] = (
+                    blob_name, frame['frame_offset'], frame['frame_size'])
+        return segment_dict
+
+    def _get_overlay_blob_range(self, filepath, blobname, is_zipped):
+        # return (file path, offset, size) of the blob data, or None if
+        # the blob is compressed in the zip
         if is_zipped is True:
             zz = zipfile.ZipFile(filepath, "r")
-            return zz.read(blobname)
+            info = zz.getinfo(blobname)
+            if info.compress_type != zipfile.ZIP_STORED:
+                return None
+            # overlay package is not compressed (ZIP_STORED),
+            # so the member data is at the file after its local header
+            with open(filepath, "rb") as fd:
+                fd.seek(info.header_offset)
+                header = fd.read(zipfile.sizeFileHeader)
+            name_len, extra_len = struct.unpack("<2H", header[26:30])
+            return (filepath, info.header_offset + zipfile.sizeFileHeader +
+                    name_len + extra_len, info.file_size)
         else:
             blob_path = os.path.join(os.path.dirname(filepath), blobname)
-            return open(blob_path, 'r').read()
+            return (blob_path, 0, os.path.getsize(blob_path))
+
+    def _read_overlay_blob(self, filepath, blobname, is_zipped,
+                           offset=0, size=None):
+        blob_range = self._get_overlay_blob_range(filepath, blobname,
+                                                  is_zipped)
+        if blob_range is None:
+            if offset == 0 and size is None:
+                return zipfile.ZipFile(filepath, "r").read(blobname)
+            raise ClientError("%s is compressed in zip" % blobname)
+        blob_path, blob_offset, blob_size = blob_range
+        if size is None:
+            size = blob_size - offset
+        with open(blob_path, "rb") as fd:
+            fd.seek(blob_offset + offset)
+            return fd.read(size)
+
+    def _send_overlay_blob(self, sock, filepath, blobname, is_zipped,
+                           offset=0, size=None):
+        blob_range = self._get_overlay_blob_range(filepath, blobname,
+                                                  is_zipped)
+        if blob_range is None:
+            sock.sendall(self._read_overlay_blob(filepath, blobname,
+                                                 is_zipped, offset, size))
+            return
+        blob_path, blob_offset, blob_size = blob_range
+        if size is None:
+            size = blob_size - offset
+        if offset < 0 or offset + size > blob_size:
+            raise ClientError("Invalid range (%d, %d) of %s" %
+                              (offset, size, blobname))
+        with open(blob_path, "rb") as fd:
+            send_file_range(sock, fd, blob_offset + offset, size)
 
     def _get_overlay_blob_size(self, filepath, blobname, is_zipped):
         if is_zipped is True:
@@ -49,9 +49,12 @@ class Protocol(object):
     KEY_REQUEST_SEGMENT_SIZE = "blob_size"
     KEY_FAILED_REASON = "reasons"
     KEY_PAYLOAD = "payload"
+    KEY_ADMISSION_STATE = "admission_state"
     KEY_SESSION_ID = "session_id"
     KEY_REQUESTED_COMMAND = "requested_command"
     KEY_OVERLAY_URL = "overlay_url"
+    # client serves a frame of a blob named as 'blob#frame_index'
+    KEY_SEGMENT_FRAME = "segment_frame"
 
     # synthesis option
     KEY_SYNTHESIS_OPTION = "synthesis_option"
@@ -35,6 +35,7 @@ from lzma import LZMADecompressor
 import pyximport
 pyximport.install()
 from cython_xor import cython_xor
+from cython_xor import cython_cdc_cutpoints
 
 import msgpack
 from .configuration import Const
@@ -50,6 +51,98 @@ _HASH_CHUNKING_SIZE = 4012
 _LZMA_OPTION = {'format': 'xz', 'level': 9}
 
 
+class ChunkHashError(Exception):
+    pass
+
+
+def _blake2b_function():
+    # BLAKE2b is at hashlib since python 3.6, and at pyblake2 before that
+    try:
+        from hashlib import blake2b
+    except ImportError:
+        try:
+            from pyblake2 import blake2b
+        except ImportError:
+            return None
+    return lambda data: blake2b(data, digest_size=32)
+
+
+# hash function of each chunk hash type. Hash function returns a hash
+# object of 32 bytes digest
+_CHUNK_HASH_FUNCTIONS = {
+    Const.CHUNK_HASH_SHA256: sha256,
+    Const.CHUNK_HASH_BLAKE2B: _blake2b_function(),
+}
+
+# record at the head of hash meta telling its chunk hash. It has the same
+# format as (offset, length, hash) record, and the offset is -1 of
+# memory meta and the maximum of disk meta. There is no such record at
+# the meta hashed with sha256 to keep the meta of old base VM valid
+_HASH_META_RECORD = "!QI32s"
+_HASH_META_RECORD_SIZE = struct.calcsize(_HASH_META_RECORD)
+_HASH_META_HEADER_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+
+def register_chunk_hash(hash_type, hash_function):
+    if len(hash_type) > 32:
+        raise ChunkHashError("Too long chunk hash name: %s" % hash_type)
+    _CHUNK_HASH_FUNCTIONS[hash_type] = hash_function
+
+
+def get_chunk_hash_function(hash_type):
+    '''Returns hash function of hash_type. Chunk hash is given to each call
+    rather than kept at the process, since sessions of a server may use
+    base VMs of different chunk hashes'''
+    hash_function = _CHUNK_HASH_FUNCTIONS.get(hash_type, False)
+    if hash_function is False:
+        raise ChunkHashError("Unknown chunk hash: %s" % hash_type)
+    if hash_function is None:
+        msg = "Chunk hash %s is not available. Install pyblake2" % hash_type
+        raise ChunkHashError(msg)
+    return hash_function
+
+
+def chunk_hash(data, hash_type=Const.CHUNK_HASH_DEFAULT):
+    return get_chunk_hash_function(hash_type)(data).digest()
+
+
+def get_hash_meta_header(hash_type):
+    '''Returns header record of hash meta for hash_type chunk hash'''
+    if hash_type == Const.CHUNK_HASH_SHA256:
+        return ''
+    return struct.pack(_HASH_META_RECORD, _HASH_META_HEADER_OFFSET, 0,
+                       hash_type)
+
+
+def check_hash_meta_header(record, meta_path, hash_type):
+    '''Check chunk hash of the hash meta at its first record
+    :returns: True if the record is the header, not a hash item
+    '''
+    (offset, length, meta_hash_type) = struct.unpack(_HASH_META_RECORD,
+                                                     record)
+    if offset != _HASH_META_HEADER_OFFSET:
+        meta_hash_type = Const.CHUNK_HASH_SHA256
+    else:
+        meta_hash_type = meta_hash_type.rstrip(chr(0x00))
+    if meta_hash_type != hash_type:
+        msg = "Hash meta at %s uses %s chunk hash, not %s" % \
+            (meta_path, meta_hash_type, hash_type)
+        raise ChunkHashError(msg)
+    return offset == _HASH_META_HEADER_OFFSET
+
+
+def read_hash_meta_type(meta_path):
+    '''Returns chunk hash of the hash meta'''
+    with open(meta_path, "rb") as fd:
+        record = fd.read(_HASH_META_RECORD_SIZE)
+    if len(record) != _HASH_META_RECORD_SIZE:
+        return Const.CHUNK_HASH_SHA256
+    (offset, length, hash_type) = struct.unpack(_HASH_META_RECORD, record)
+    if offset != _HASH_META_HEADER_OFFSET:
+        return Const.CHUNK_HASH_SHA256
+    return hash_type.rstrip(chr(0x00))
+
+
 def diff_data(source_data, modi_data, buf_len):
     if len(source_data) == 0 or len(modi_data) == 0:
         raise IOError(
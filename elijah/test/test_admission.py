@@ -0,0 +1,162 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import multiprocessing
+import shutil
+import threading
+import time
+from tempfile import mkdtemp
+
+from elijah.provisioning.admission import AdmissionController
+from elijah.provisioning.admission import AdmissionError
+from elijah.provisioning.admission import SessionCost
+from elijah.provisioning.configuration import Const
+
+
+def _admit_and_exit(state_path, capacity):
+    # server process crashed without releasing its session
+    controller = AdmissionController(state_path, capacity, poll_interval=0.01)
+    controller.admit("crashed", SessionCost(cpu=1, memory=100))
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAdmission, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-admission-")
+        self.state_path = os.path.join(self.temp_dir, "admission-state")
+        self.capacity = SessionCost(cpu=2, memory=100, io=1000)
+        self.controller = self._controller()
+
+    def tearDown(self):
+        super(TestAdmission, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _controller(self, max_queue=Const.ADMISSION_MAX_QUEUE):
+        return AdmissionController(self.state_path, self.capacity,
+                                   max_queue=max_queue, poll_interval=0.01)
+
+    def _wait_state(self, condition, timeout=10):
+        # poll the shared state until condition holds on it
+        deadline = time.time() + timeout
+        while True:
+            state = self.controller.get_state()
+            if condition(state):
+                return state
+            if time.time() > deadline:
+                self.fail("Admission state is not changed: %s" % str(state))
+            time.sleep(0.01)
+
+    def _wait_queued(self, count):
+        self._wait_state(lambda state: len(state["queued"]) >= count)
+
+    def test_estimate(self):
+        blob_list = list()
+        for (comp_type, size, raw_size) in [
+                (Const.COMPRESSION_LZMA, 100, 300),
+                (Const.COMPRESSION_NONE, 100, 100)]:
+            blob_list.append({
+                Const.META_OVERLAY_FILE_COMPRESSION: comp_type,
+                Const.META_OVERLAY_FILE_SIZE: size,
+                Const.META_OVERLAY_FILE_RAW_SIZE: raw_size,
+                Const.META_OVERLAY_FILE_DISK_CHUNKS: [1, 2],
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: [3]})
+        meta_info = {Const.META_RESUME_VM_MEMORY_SIZE: 1024,
+                     Const.META_OVERLAY_FILES: blob_list}
+        cost = SessionCost.from_meta(meta_info, decomp_proc_count=4)
+        self.assertEqual(cost.cpu, 1 + 4*0.75)
+        self.assertEqual(cost.memory, 1024 + 400*4)
+        self.assertEqual(cost.io, 6*Const.CHUNK_SIZE)
+        # handoff meta does not list the blobs
+        del meta_info[Const.META_OVERLAY_FILES]
+        cost = SessionCost.from_meta(meta_info, decomp_proc_count=4)
+        self.assertEqual(cost.to_list(), [5, 1024, 1024])
+
+    def test_queue(self):
+        running = list()
+        admitted = list()
+        max_running = [0]
+        lock = threading.Lock()
+        finish_event = threading.Event()
+
+        def recover(session_id):
+            # stubbed recovery, which runs until the test finishes it
+            self.controller.admit(session_id, SessionCost(cpu=1, memory=40))
+            with lock:
+                admitted.append(session_id)
+                running.append(session_id)
+                max_running[0] = max(max_running[0], len(running))
+            finish_event.wait()
+            with lock:
+                running.remove(session_id)
+            self.controller.release(session_id)
+
+        thread_list = list()
+        for index in xrange(5):
+            thread = threading.Thread(target=recover, args=(index,))
+            thread.start()
+            thread_list.append(thread)
+            # arrival order of the sessions
+            self._wait_state(lambda state: str(index) in state["queued"] or
+                             str(index) in state["running"])
+        # two sessions fill the CPU and the others wait in order
+        state = self.controller.get_state()
+        self.assertEqual(sorted(state["running"].keys()), ["0", "1"])
+        self.assertEqual(state["queued"], ["2", "3", "4"])
+        finish_event.set()
+        for thread in thread_list:
+            thread.join()
+        self.assertEqual(max_running[0], 2)
+        self.assertEqual(admitted, range(5))
+        state = self.controller.get_state()
+        self.assertEqual(state["running"], dict())
+        self.assertEqual(state["queued"], list())
+        self.assertEqual(state["used"], [0, 0, 0])
+
+    def test_reject(self):
+        # VM larger than the host memory is never admitted
+        self.assertRaises(AdmissionError, self.controller.admit, "large",
+                          SessionCost(memory=200))
+        # CPU and IO are clamped to the host so that it runs alone
+        cost = self.controller.admit("busy", SessionCost(cpu=8, memory=60,
+                                                         io=2000))
+        self.assertEqual(cost.to_list(), [2, 60, 1000])
+        self.assertRaises(AdmissionError, self.controller.admit, "busy",
+                          SessionCost(cpu=1))
+        self.assertRaises(AdmissionError, self.controller.admit, "timeout",
+                          SessionCost(cpu=1), timeout=0.05)
+        self.assertEqual(self.controller.get_state()["queued"], list())
+
+        # session waits while the queue has room
+        controller = self._controller(max_queue=1)
+        thread = threading.Thread(target=controller.admit,
+                                  args=("waiting", SessionCost(cpu=1)))
+        thread.start()
+        self._wait_queued(1)
+        self.assertRaises(AdmissionError, controller.admit, "full",
+                          SessionCost(cpu=1))
+        # resources only for the VM are kept after the recovery
+        self.controller.update("busy", SessionCost(memory=60))
+        thread.join()
+        state = self.controller.get_state()
+        self.assertEqual(sorted(state["running"].keys()), ["busy", "waiting"])
+        self.assertEqual(state["used"], [1, 60, 0])
+
+    def test_dead_process(self):
+        proc = multiprocessing.Process(
+            target=_admit_and_exit, args=(self.state_path, self.capacity))
+        proc.start()
+        proc.join()
+        # memory of the crashed session is available again
+        self.controller.admit("alive", SessionCost(cpu=1, memory=100),
+                              timeout=0)
+        self.assertEqual(self.controller.get_state()["running"].keys(),
+                         ["alive"])
+
+
+if __name__ == "__main__":
+    unittest.main()
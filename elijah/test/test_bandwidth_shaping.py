@@ -0,0 +1,139 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import time
+import shutil
+import socket
+import threading
+from tempfile import mkdtemp
+
+from elijah.provisioning import stream_client
+from elijah.provisioning.stream_client import TokenBucket
+from elijah.provisioning.stream_client import FairShareScheduler
+from elijah.provisioning.stream_client import shaped_sendall
+
+
+class TestBandwidthShaping(unittest.TestCase):
+    SEND_SIZE = 1024*1024
+    HOST_RATE_Mbps = 16
+
+    def setUp(self):
+        super(TestBandwidthShaping, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-shaping-")
+        self.flow_dir = os.path.join(self.temp_dir, "flows")
+
+    def tearDown(self):
+        super(TestBandwidthShaping, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _send_loopback(self, token_bucket_list):
+        # send SEND_SIZE bytes by each flow over loopback at the same time,
+        # and return throughput of each flow in Mbps
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.bind(("127.0.0.1", 0))
+        server_sock.listen(len(token_bucket_list))
+        throughput_list = [0] * len(token_bucket_list)
+
+        def receive(conn):
+            while conn.recv(64*1024):
+                pass
+            conn.close()
+
+        def send(index, token_bucket):
+            sock = socket.create_connection(server_sock.getsockname())
+            time_start = time.time()
+            shaped_sendall(sock, 'x' * self.SEND_SIZE, token_bucket)
+            time_end = time.time()
+            sock.close()
+            throughput_list[index] = \
+                self.SEND_SIZE*8/(time_end-time_start)/1024/1024
+
+        thread_list = list()
+        for index, token_bucket in enumerate(token_bucket_list):
+            thread_list.append(threading.Thread(target=send,
+                                                args=(index, token_bucket)))
+        for thread in thread_list:
+            thread.start()
+        for index in xrange(len(token_bucket_list)):
+            conn, addr = server_sock.accept()
+            thread = threading.Thread(target=receive, args=(conn,))
+            thread.start()
+            thread_list.append(thread)
+        for thread in thread_list:
+            thread.join()
+        server_sock.close()
+        return throughput_list
+
+    def _assert_rate(self, measured_mbps, expected_mbps):
+        self.assertTrue(expected_mbps*0.8 < measured_mbps < expected_mbps*1.2,
+                        "%f Mbps is not close to %f Mbps" %
+                        (measured_mbps, expected_mbps))
+
+    def test_rate_cap(self):
+        token_bucket = TokenBucket(self.HOST_RATE_Mbps)
+        throughput_list = self._send_loopback([token_bucket])
+        self._assert_rate(throughput_list[0], self.HOST_RATE_Mbps)
+
+    def test_fair_share(self):
+        fair_share_list = [
+            FairShareScheduler(self.HOST_RATE_Mbps, flow_dir=self.flow_dir,
+                               flow_id="flow-%d" % index)
+            for index in xrange(2)]
+        for fair_share in fair_share_list:
+            fair_share.register()
+        # flow of a terminated handoff is not counted
+        open(os.path.join(self.flow_dir, "flow-dead"), "w").write("4194305")
+
+        token_bucket_list = [TokenBucket(-1, fair_share)
+                             for fair_share in fair_share_list]
+        self.assertEqual([token_bucket.get_rate() for token_bucket in
+                          token_bucket_list], [self.HOST_RATE_Mbps/2.0]*2)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.flow_dir, "flow-dead")))
+        throughput_list = self._send_loopback(token_bucket_list)
+        for throughput in throughput_list:
+            self._assert_rate(throughput, self.HOST_RATE_Mbps/2.0)
+
+        # cap of the flow lower than its share
+        self.assertEqual(TokenBucket(4, fair_share_list[1]).get_rate(), 4)
+        fair_share_list[1].unregister()
+        self.assertEqual(fair_share_list[0].get_share(), self.HOST_RATE_Mbps)
+
+    def test_unregister_at_failure(self):
+        flow_dir = self.flow_dir
+
+        class _FairShareScheduler(FairShareScheduler):
+            def __init__(self, host_rate_mbps):
+                FairShareScheduler.__init__(self, host_rate_mbps,
+                                            flow_dir=flow_dir)
+
+        def stream_blobs(sock, fair_share):
+            self.assertEqual(len(os.listdir(flow_dir)), 1)
+            raise socket.error("connection reset")
+
+        server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_sock.bind(("127.0.0.1", 0))
+        server_sock.listen(1)
+        # constructor starts a worker process
+        client = stream_client.StreamSynthesisClient.__new__(
+            stream_client.StreamSynthesisClient)
+        (client.remote_addr, client.remote_port) = server_sock.getsockname()
+        client.host_rate_mbps = self.HOST_RATE_Mbps
+        client._stream_blobs = stream_blobs
+        scheduler_class = stream_client.FairShareScheduler
+        stream_client.FairShareScheduler = _FairShareScheduler
+        try:
+            self.assertRaises(socket.error, client.transfer)
+        finally:
+            stream_client.FairShareScheduler = scheduler_class
+            server_sock.close()
+        # share of the host is not kept by the failed handoff
+        self.assertEqual(os.listdir(flow_dir), list())
+
+
+if __name__ == "__main__":
+    unittest.main()
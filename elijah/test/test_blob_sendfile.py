@@ -0,0 +1,125 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import socket
+import threading
+import zipfile
+from tempfile import mkdtemp
+
+from elijah.provisioning import synthesis_client
+from elijah.provisioning.synthesis_client import Client
+from elijah.provisioning.synthesis_client import ClientError
+from elijah.test.util import random_data
+
+
+class _Receiver(threading.Thread):
+    # reads everything sent to the other end of the socket pair
+    def __init__(self, sock):
+        self.sock = sock
+        self.data_list = list()
+        threading.Thread.__init__(self)
+
+    def run(self):
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                break
+            self.data_list.append(data)
+
+    def get_data(self):
+        self.join()
+        return ''.join(self.data_list)
+
+
+class TestBlobSendfile(unittest.TestCase):
+    BLOB_SIZE = 3*1024*1024 + 123
+
+    def setUp(self):
+        super(TestBlobSendfile, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-sendfile-")
+        self.rand = random.Random(1234)
+        self.blob_data = self._random_data(self.BLOB_SIZE)
+        self.blob_path = os.path.join(self.temp_dir, "overlay-blob_1")
+        open(self.blob_path, "wb").write(self.blob_data)
+        self.meta_path = os.path.join(self.temp_dir, "overlay-meta")
+        open(self.meta_path, "wb").write("meta")
+        # package is stored, and a member compressed by others is read
+        self.zip_path = os.path.join(self.temp_dir, "overlay.zip")
+        zz = zipfile.ZipFile(self.zip_path, "w", zipfile.ZIP_STORED, True)
+        zz.write(self.meta_path, "overlay-meta")
+        zz.write(self.blob_path, "overlay-blob_1")
+        zz.write(self.blob_path, "overlay-blob_2", zipfile.ZIP_DEFLATED)
+        zz.close()
+        # constructor connects to the cloudlet
+        self.client = Client.__new__(Client)
+        self.sendfile = synthesis_client._sendfile
+
+    def tearDown(self):
+        super(TestBlobSendfile, self).tearDown()
+        synthesis_client._sendfile = self.sendfile
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _random_data(self, size):
+        # repeated random block, since the blob spans several sendfile calls
+        block = random_data(self.rand, 4099)
+        return (block * (size / len(block) + 1))[:size]
+
+    def _send(self, send_func, *args):
+        (sock, peer) = socket.socketpair()
+        receiver = _Receiver(peer)
+        receiver.start()
+        try:
+            send_func(sock, *args)
+        finally:
+            sock.close()
+        data = receiver.get_data()
+        peer.close()
+        return data
+
+    def _send_blob(self, filepath, blobname, is_zipped, offset=0,
+                   size=None):
+        return self._send(self.client._send_overlay_blob, filepath,
+                          blobname, is_zipped, offset, size)
+
+    def test_send_blob(self):
+        self.assertTrue(synthesis_client._sendfile is not None)
+        for sendfile in (self.sendfile, None):
+            synthesis_client._sendfile = sendfile
+            for (filepath, blobname, is_zipped) in [
+                    (self.zip_path, "overlay-blob_1", True),
+                    (self.zip_path, "overlay-blob_2", True),
+                    (self.meta_path, "overlay-blob_1", False)]:
+                self.assertEqual(
+                    self._send_blob(filepath, blobname, is_zipped),
+                    self.blob_data)
+            # frame of the blob
+            self.assertEqual(
+                self._send_blob(self.zip_path, "overlay-blob_1", True,
+                                1000, 2*1024*1024),
+                self.blob_data[1000:1000+2*1024*1024])
+            self.assertEqual(
+                self.client._read_overlay_blob(self.zip_path,
+                                               "overlay-blob_1", True,
+                                               1000, 10),
+                self.blob_data[1000:1010])
+
+    def test_invalid_range(self):
+        self.assertRaises(ClientError, self._send_blob, self.zip_path,
+                          "overlay-blob_1", True, 1, self.BLOB_SIZE)
+        self.assertRaises(ClientError, self._send_blob, self.zip_path,
+                          "overlay-blob_2", True, 1, 10)
+        # range beyond the end of the file
+        with open(self.blob_path, "rb") as fd:
+            self.assertRaises(ClientError, self._send,
+                              synthesis_client.send_file_range, fd,
+                              self.BLOB_SIZE - 10, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
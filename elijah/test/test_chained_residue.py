@@ -0,0 +1,134 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaList
+from elijah.provisioning.delta import ChainedResidueFilter
+from elijah.test.util import random_data
+
+
+class TestChainedResidue(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 16
+
+    def setUp(self):
+        super(TestChainedResidue, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-chain-")
+        self.rand = random.Random(1234)
+        self.base_disk = os.path.join(self.temp_dir, "base-disk")
+        self.base_mem = os.path.join(self.temp_dir, "base-mem")
+        self.base_disk_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        self.base_mem_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        open(self.base_disk, "wb").write(self.base_disk_data)
+        open(self.base_mem, "wb").write(self.base_mem_data)
+
+    def tearDown(self):
+        super(TestChainedResidue, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _raw_item(self, delta_type, chunk, data, live_seq=0):
+        return DeltaItem(delta_type, chunk*self.CHUNK_SIZE, len(data),
+                         sha256(data).digest(), DeltaItem.REF_RAW,
+                         len(data), data, live_seq=live_seq)
+
+    def _recover(self, overlay_list, hashlist_path):
+        overlay_paths = list()
+        for index, delta_list in enumerate(overlay_list):
+            overlay_path = os.path.join(self.temp_dir, "overlay-%d" % index)
+            DeltaList.tofile(delta_list, overlay_path)
+            overlay_paths.append(overlay_path)
+        out_mem = os.path.join(self.temp_dir, "launch-mem")
+        out_disk = os.path.join(self.temp_dir, "launch-disk")
+        delta_proc = delta.Recovered_delta(
+            self.base_disk, self.base_mem, overlay_paths[-1],
+            out_mem, len(self.base_mem_data),
+            out_disk, len(self.base_disk_data), self.CHUNK_SIZE,
+            out_pipename=os.path.join(self.temp_dir, "pipe"),
+            parent_overlay_paths=overlay_paths[:-1],
+            residue_hashlist_path=hashlist_path, overlay_id="residue-1")
+        delta_proc.run()
+        return open(out_mem, "rb").read(), open(out_disk, "rb").read()
+
+    def _chunk(self, data, chunk):
+        return data[chunk*self.CHUNK_SIZE:(chunk+1)*self.CHUNK_SIZE]
+
+    def test_chain(self):
+        mem_2 = random_data(self.rand, self.CHUNK_SIZE)
+        mem_5 = random_data(self.rand, self.CHUNK_SIZE)
+        disk_3 = random_data(self.rand, self.CHUNK_SIZE)
+        residue_1 = [
+            self._raw_item(DeltaItem.DELTA_MEMORY, 2, mem_2),
+            self._raw_item(DeltaItem.DELTA_MEMORY, 5, mem_5),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 5, mem_2, 3),
+            self._raw_item(DeltaItem.DELTA_DISK, 3, disk_3),
+        ]
+        hashlist_path = os.path.join(self.temp_dir, "hashlist")
+        recovered_mem, recovered_disk = self._recover([residue_1],
+                                                      hashlist_path)
+        overlay_id, residue_hashdict = delta.load_residue_hashlist(
+            hashlist_path)
+        self.assertEqual(overlay_id, "residue-1")
+        self.assertEqual(len(residue_hashdict), 3)
+        for (delta_type, chunk, data) in [
+                (DeltaItem.DELTA_MEMORY, 2, recovered_mem),
+                (DeltaItem.DELTA_MEMORY, 5, recovered_mem),
+                (DeltaItem.DELTA_DISK, 3, recovered_disk)]:
+            index = DeltaItem.get_index(delta_type, chunk*self.CHUNK_SIZE)
+            self.assertEqual(residue_hashdict[index],
+                             (sha256(self._chunk(data, chunk)).digest(),
+                              self.CHUNK_SIZE))
+
+        # new VM state: memory chunk 2 is reverted to the base, 5 is not
+        # changed, and disk chunk 3 is overwritten with the same data
+        mem_7 = random_data(self.rand, self.CHUNK_SIZE)
+        disk_4 = random_data(self.rand, self.CHUNK_SIZE)
+        new_deltalist = [
+            self._raw_item(DeltaItem.DELTA_MEMORY, 5, mem_2),
+            self._raw_item(DeltaItem.DELTA_MEMORY, 7, mem_7),
+            self._raw_item(DeltaItem.DELTA_DISK, 3, disk_3),
+            self._raw_item(DeltaItem.DELTA_DISK, 4, disk_4),
+        ]
+        residue_filter = ChainedResidueFilter(residue_hashdict)
+        residue_2 = residue_filter.filter_deltalist(new_deltalist)
+        self.assertEqual([item.offset/self.CHUNK_SIZE for item in residue_2],
+                         [7, 4])
+        # page changed back to the previous residue at the next iteration
+        live_deltalist = [
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 7, mem_5, 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 5, mem_5, 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 5, mem_2, 2),
+        ]
+        residue_2 += residue_filter.filter_deltalist(live_deltalist)
+        self.assertEqual(len(residue_2), 5)
+        reverted_deltalist = residue_filter.get_reverted_deltalist()
+        self.assertEqual(len(reverted_deltalist), 1)
+        self.assertEqual(reverted_deltalist[0].ref_id, DeltaItem.REF_BASE_MEM)
+        self.assertEqual(reverted_deltalist[0].offset, 2*self.CHUNK_SIZE)
+        residue_2 += reverted_deltalist
+
+        # chain of residues recovers the new VM state
+        recovered_mem, recovered_disk = self._recover([residue_1, residue_2],
+                                                      None)
+        for (data, chunk, expected) in [
+                (recovered_mem, 2, self._chunk(self.base_mem_data, 2)),
+                (recovered_mem, 5, mem_2),
+                (recovered_mem, 7, mem_5),
+                (recovered_disk, 3, disk_3),
+                (recovered_disk, 4, disk_4)]:
+            self.assertEqual(self._chunk(data, chunk), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
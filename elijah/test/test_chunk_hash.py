@@ -0,0 +1,143 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import tool
+from elijah.provisioning import disk
+from elijah.provisioning import delta
+from elijah.provisioning import compression
+from elijah.provisioning.memory import Memory
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.configuration import Const
+from elijah.test.util import random_data
+
+
+class TestChunkHash(unittest.TestCase):
+    CHUNK_SIZE = Const.CHUNK_SIZE
+    CHUNK_COUNT = 8
+    TEST_HASH = "salted-sha256"
+
+    def setUp(self):
+        super(TestChunkHash, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-chunkhash-")
+        self.rand = random.Random(1234)
+        self.data = random_data(self.rand, self.CHUNK_SIZE*self.CHUNK_COUNT)
+        tool.register_chunk_hash(
+            self.TEST_HASH, lambda data: sha256("salt" + data))
+
+    def tearDown(self):
+        super(TestChunkHash, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _export_memory_meta(self, meta_path,
+                            hash_type=Const.CHUNK_HASH_DEFAULT):
+        memory = Memory(hash_type)
+        memory.hash_list = [
+            (offset, self.CHUNK_SIZE,
+             tool.chunk_hash(self.data[offset:offset+self.CHUNK_SIZE],
+                             hash_type))
+            for offset in xrange(0, len(self.data), self.CHUNK_SIZE)]
+        memory.export_to_file(meta_path)
+        return memory.hash_list
+
+    def test_sha256_meta(self):
+        # meta of sha256 is the same as the one of old Base VM
+        meta_path = os.path.join(self.temp_dir, "mem-meta")
+        hash_list = self._export_memory_meta(meta_path)
+        self.assertEqual(os.path.getsize(meta_path), 44*self.CHUNK_COUNT)
+        self.assertEqual(tool.read_hash_meta_type(meta_path),
+                         Const.CHUNK_HASH_SHA256)
+        self.assertEqual(hash_list[0][2],
+                         sha256(self.data[:self.CHUNK_SIZE]).digest())
+
+    def test_hash_meta_type(self):
+        mem_meta = os.path.join(self.temp_dir, "mem-meta")
+        hash_list = self._export_memory_meta(mem_meta, self.TEST_HASH)
+        base_disk = os.path.join(self.temp_dir, "disk")
+        disk_meta = os.path.join(self.temp_dir, "disk-meta")
+        open(base_disk, "wb").write(self.data)
+        disk.hashing(base_disk, disk_meta, hash_type=self.TEST_HASH)
+        for meta_path in (mem_meta, disk_meta):
+            self.assertEqual(tool.read_hash_meta_type(meta_path),
+                             self.TEST_HASH)
+
+        # header is not a hash item
+        self.assertEqual(Memory.import_hashlist(mem_meta, self.TEST_HASH),
+                         hash_list)
+        hash_dict = delta.DeltaDedup.memory_import_hashdict(mem_meta,
+                                                            self.TEST_HASH)
+        self.assertEqual(len(hash_dict), self.CHUNK_COUNT)
+        disk_hashlist = disk.base_hashlist(disk_meta, self.TEST_HASH)
+        self.assertEqual(disk_hashlist[0],
+                         (0, self.CHUNK_SIZE, hash_list[0][2]))
+        self.assertEqual(
+            len(delta.DeltaDedup.disk_import_hashdict(disk_meta,
+                                                      self.TEST_HASH)),
+            len(disk_hashlist))
+
+        # meta is not used with a different chunk hash
+        self.assertRaises(tool.ChunkHashError,
+                          Memory.import_hashlist, mem_meta)
+        self.assertRaises(tool.ChunkHashError, disk.base_hashlist, disk_meta)
+        self.assertRaises(tool.ChunkHashError,
+                          delta.DeltaDedup.disk_import_hashdict, disk_meta)
+        sha256_meta = os.path.join(self.temp_dir, "mem-meta-sha256")
+        self._export_memory_meta(sha256_meta)
+        self.assertRaises(tool.ChunkHashError,
+                          delta.DeltaDedup.memory_import_hashdict, sha256_meta,
+                          self.TEST_HASH)
+
+    def test_hash_type_per_call(self):
+        # chunk hash is not kept at the process, so hashing with one does
+        # not change the default used by the others
+        chunk = self.data[:self.CHUNK_SIZE]
+        self.assertEqual(tool.chunk_hash(chunk, self.TEST_HASH),
+                         sha256("salt" + chunk).digest())
+        self.assertEqual(tool.chunk_hash(chunk), sha256(chunk).digest())
+        self.assertRaises(tool.ChunkHashError, tool.chunk_hash, chunk,
+                          "unknown-hash")
+
+        hashlist_path = os.path.join(self.temp_dir, "hashlist")
+        delta.save_residue_hashlist(hashlist_path, "overlay-id",
+                                    {1L: (chunk, self.CHUNK_SIZE)},
+                                    self.TEST_HASH)
+        self.assertEqual(
+            delta.load_residue_hashlist(hashlist_path, self.TEST_HASH),
+            ("overlay-id", {1L: (chunk, self.CHUNK_SIZE)}))
+        self.assertRaises(delta.DeltaError, delta.load_residue_hashlist,
+                          hashlist_path)
+
+    def test_blob_digest(self):
+        delta_list = list()
+        for index in xrange(self.CHUNK_COUNT):
+            data = self.data[index*self.CHUNK_SIZE:(index+1)*self.CHUNK_SIZE]
+            delta_list.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, index*self.CHUNK_SIZE,
+                self.CHUNK_SIZE, None, DeltaItem.REF_RAW, len(data), data))
+        blob_list = delta.divide_blobs(
+            delta_list, os.path.join(self.temp_dir, Const.OVERLAY_FILE_PREFIX),
+            Const.OVERLAY_BLOB_SIZE_KB, self.CHUNK_SIZE, self.CHUNK_SIZE)
+        blob_path = os.path.join(
+            self.temp_dir, blob_list[0][Const.META_OVERLAY_FILE_NAME])
+        comp_data = open(blob_path, "rb").read()
+        self.assertEqual(blob_list[0][Const.META_OVERLAY_FILE_SHA256],
+                         sha256(comp_data).hexdigest())
+
+        corrupted = comp_data[:-1] + chr(ord(comp_data[-1]) ^ 0xFF)
+        self.assertRaises(compression.CompressionError,
+                          compression._decomp_blob, corrupted, blob_list[0])
+        self.assertEqual(compression._decomp_blob(comp_data, blob_list[0]),
+                         ''.join([item.get_serialized()
+                                  for item in delta_list]))
+
+
+if __name__ == "__main__":
+    unittest.main()
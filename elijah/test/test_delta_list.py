@@ -0,0 +1,157 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaList
+from elijah.provisioning.delta import IndexedDeltaList
+
+
+class TestDeltaList(unittest.TestCase):
+    CHUNK_SIZE = 4096
+
+    def setUp(self):
+        super(TestDeltaList, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-deltalist-")
+        self.delta_path = os.path.join(self.temp_dir, "deltalist")
+        rand = random.Random(1234)
+        self.delta_list = list()
+        for index in xrange(8):
+            data = ''.join([chr(rand.randint(0, 255))
+                            for i in xrange(self.CHUNK_SIZE)])
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, index*self.CHUNK_SIZE,
+                self.CHUNK_SIZE, sha256(data).digest(), DeltaItem.REF_RAW,
+                len(data), data))
+        self.delta_list += [
+            DeltaItem(DeltaItem.DELTA_DISK, 0, self.CHUNK_SIZE,
+                      sha256("base").digest(), DeltaItem.REF_BASE_DISK, 8,
+                      3*self.CHUNK_SIZE),
+            DeltaItem(DeltaItem.DELTA_DISK, self.CHUNK_SIZE, self.CHUNK_SIZE,
+                      sha256("self").digest(), DeltaItem.REF_SELF, 8,
+                      self.delta_list[2].index),
+            DeltaItem(DeltaItem.DELTA_MEMORY_LIVE, 2*self.CHUNK_SIZE,
+                      self.CHUNK_SIZE, sha256("live").digest(),
+                      DeltaItem.REF_RAW, 3, "abc", live_seq=2),
+        ]
+
+    def tearDown(self):
+        super(TestDeltaList, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _serialized(self, delta_list, with_hashvalue=False):
+        return [item.get_serialized(with_hashvalue=with_hashvalue)
+                for item in delta_list]
+
+    def test_round_trip(self):
+        for indexed in (False, True):
+            for with_hashvalue in (False, True):
+                DeltaList.tofile(self.delta_list, self.delta_path,
+                                 with_hashvalue=with_hashvalue,
+                                 indexed=indexed)
+                with open(self.delta_path, "rb") as fd:
+                    self.assertEqual(
+                        fd.read(len(IndexedDeltaList.MAGIC)) ==
+                        IndexedDeltaList.MAGIC, indexed)
+                delta_list = DeltaList.fromfile(
+                    self.delta_path, with_hashvalue=with_hashvalue)
+                self.assertEqual(len(delta_list), len(self.delta_list))
+                self.assertEqual(
+                    self._serialized(delta_list, with_hashvalue),
+                    self._serialized(self.delta_list, with_hashvalue))
+                self.assertEqual(delta_list[-1].live_seq, 2)
+                if with_hashvalue:
+                    self.assertEqual(
+                        [item.hash_value for item in delta_list],
+                        [item.hash_value for item in self.delta_list])
+                for position, item in enumerate(self.delta_list):
+                    self.assertEqual(
+                        delta_list.get_item_size(position),
+                        len(item.get_serialized(with_hashvalue)))
+                delta_list.close()
+
+                # items are read in order without the index
+                self.assertEqual(
+                    self._serialized(DeltaList.from_file_stream(
+                        self.delta_path, with_hashvalue=with_hashvalue)),
+                    self._serialized(self.delta_list))
+
+    def test_get(self):
+        for indexed in (False, True):
+            DeltaList.tofile(self.delta_list, self.delta_path,
+                             indexed=indexed)
+            delta_list = DeltaList.fromfile(self.delta_path)
+            # the last item of the index wins like a dictionary
+            live_item = self.delta_list[-1]
+            self.assertEqual(delta_list.get(live_item.index).live_seq, 2)
+            disk_item = delta_list.get(self.delta_list[8].index)
+            self.assertEqual((disk_item.ref_id, disk_item.data),
+                             (DeltaItem.REF_BASE_DISK, 3*self.CHUNK_SIZE))
+            self.assertEqual(delta_list.get(self.delta_list[0].index).data,
+                             self.delta_list[0].data)
+            self.assertEqual(delta_list.get(
+                DeltaItem.get_index(DeltaItem.DELTA_DISK,
+                                    100*self.CHUNK_SIZE)), None)
+            self.assertEqual(
+                [(item.delta_type, item.offset, item.ref_id)
+                 for item in delta_list.iter_headers()],
+                [(item.delta_type, item.offset, item.ref_id)
+                 for item in self.delta_list])
+            delta_list.close()
+
+    def test_residue_diff(self):
+        # previous overlay saved with hash values is looked up lazily
+        new_list = [self.delta_list[0]]
+        data = "changed" * 100
+        new_list.append(DeltaItem(
+            DeltaItem.DELTA_MEMORY, self.CHUNK_SIZE, self.CHUNK_SIZE,
+            sha256(data).digest(), DeltaItem.REF_RAW, len(data), data))
+        data = "new" * 100
+        new_list.append(DeltaItem(
+            DeltaItem.DELTA_MEMORY, 20*self.CHUNK_SIZE, self.CHUNK_SIZE,
+            sha256(data).digest(), DeltaItem.REF_RAW, len(data), data))
+        old_list = self.delta_list[:-1]
+        expected = self._serialized(delta.residue_diff_deltalists(
+            old_list, new_list, None))
+        DeltaList.tofile(old_list, self.delta_path, with_hashvalue=True,
+                         indexed=True)
+        old_deltalist = DeltaList.fromfile(self.delta_path)
+        self.assertEqual(self._serialized(delta.residue_diff_deltalists(
+            old_deltalist, new_list, None)), expected)
+        old_deltalist.close()
+        # changed and new page, and the others reverted to the base
+        self.assertEqual(len(expected), 2 + 6)
+
+    def test_stream_file(self):
+        # index is appended to the items written as a stream
+        with open(self.delta_path, "w+b") as fd:
+            IndexedDeltaList.begin_file(fd)
+            fd.write(''.join(self._serialized(self.delta_list)))
+            IndexedDeltaList.finish_file(fd)
+        delta_list = DeltaList.fromfile(self.delta_path)
+        self.assertEqual(self._serialized(delta_list),
+                         self._serialized(self.delta_list))
+        delta_list.close()
+
+        # empty delta list
+        with open(self.delta_path, "w+b") as fd:
+            IndexedDeltaList.begin_file(fd)
+            IndexedDeltaList.finish_file(fd)
+        delta_list = DeltaList.fromfile(self.delta_path)
+        self.assertEqual(len(delta_list), 0)
+        delta_list.close()
+        self.assertEqual(list(DeltaList.from_file_stream(self.delta_path)),
+                         [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning.disk import DiscardIndex
+from elijah.provisioning.configuration import Const
+
+
+class TestDiscardIndex(unittest.TestCase):
+    CHUNK_COUNT = 512
+
+    def setUp(self):
+        super(TestDiscardIndex, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-discard-")
+        self.rand = random.Random(1234)
+
+    def tearDown(self):
+        super(TestDiscardIndex, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _random_ranges(self, count):
+        range_list = list()
+        for index in xrange(count):
+            start = self.rand.randint(0, self.CHUNK_COUNT)
+            end = start + self.rand.randint(-2, 64)
+            # time is not always increasing in the log
+            range_list.append((start, end, self.rand.choice([1.0, 2.0, 3.0])))
+        return range_list
+
+    def _discard_dict(self, range_list):
+        discard_dict = dict()
+        for (start, end, event_time) in range_list:
+            for chunk in xrange(start, end):
+                discard_dict[chunk] = event_time
+        return discard_dict
+
+    def test_same_as_dict(self):
+        for count in [0, 1, 10, 200]:
+            range_list = self._random_ranges(count)
+            discard_dict = self._discard_dict(range_list)
+            discard_index = DiscardIndex(range_list)
+            self.assertEqual(len(discard_index), len(discard_dict))
+            for chunk in xrange(-1, self.CHUNK_COUNT + 70):
+                self.assertEqual(discard_index.get(chunk, None),
+                                 discard_dict.get(chunk, None))
+            # adjacent ranges with the same time are merged
+            self.assertTrue(len(discard_index.start_list) <= count)
+
+    def test_parse_qemu_log(self):
+        chunk_size = Const.CHUNK_SIZE
+        sectors = chunk_size / 512
+        range_list = self._random_ranges(100)
+        log_path = os.path.join(self.temp_dir, "qemu.log")
+        with open(log_path, "w") as log_file:
+            for (start, end, event_time) in range_list:
+                log_file.write(
+                    "time:%f, bdrv_discard, sector:%d, length:%d\n" %
+                    (event_time, start*sectors, max(0, end-start)*sectors))
+            # DMA and discard that is not aligned to the chunk
+            log_file.write("time:4.0, dma, mem:0, sector:16, length:%d, "
+                           "read:1\n" % chunk_size)
+            log_file.write("time:5.0, bdrv_discard, sector:1, length:%d\n" %
+                           (2*sectors))
+            range_list.append((1, 2, 5.0))
+        dma_dict, discard_index = disk.parse_qemu_log(log_path, chunk_size)
+        self.assertEqual(dma_dict.keys(), [2])
+        discard_dict = self._discard_dict(range_list)
+        self.assertEqual(len(discard_index), len(discard_dict))
+        for chunk in xrange(self.CHUNK_COUNT + 70):
+            self.assertEqual(discard_index.get(chunk),
+                             discard_dict.get(chunk))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning import tool
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaDedup
+from elijah.provisioning.configuration import Const
+
+
+class TestDiskCDC(unittest.TestCase):
+    DISK_SIZE = 1024*1024
+    CONTENT_SIZE = 256*1024
+    SHIFT = 16*Const.CHUNK_SIZE + 1000
+
+    def setUp(self):
+        super(TestDiskCDC, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-cdc-")
+        rand = random.Random(1234)
+        self.content = ''.join(
+            [chr(rand.randint(0, 255)) for i in xrange(self.CONTENT_SIZE)])
+
+        # modified disk has the same content of the base disk, but at the
+        # offset that is not aligned to the chunk size
+        self.base_data = self.content.ljust(self.DISK_SIZE, chr(0x00))
+        self.modified_data = (chr(0x00)*self.SHIFT + self.content).ljust(
+            self.DISK_SIZE, chr(0x00))
+        self.base_path = os.path.join(self.temp_dir, "base.raw")
+        self.modified_path = os.path.join(self.temp_dir, "modified.raw")
+        open(self.base_path, "wb").write(self.base_data)
+        open(self.modified_path, "wb").write(self.modified_data)
+
+        self.modified_chunk_dict = dict()
+        for offset in xrange(0, self.DISK_SIZE, Const.CHUNK_SIZE):
+            end_offset = offset + Const.CHUNK_SIZE
+            if self.base_data[offset:end_offset] !=\
+                    self.modified_data[offset:end_offset]:
+                self.modified_chunk_dict[offset/Const.CHUNK_SIZE] = 1.0
+
+    def tearDown(self):
+        super(TestDiskCDC, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _recover(self, delta_list):
+        recovered = bytearray(self.base_data)
+        for delta_item in delta_list:
+            offset = delta_item.offset
+            if delta_item.ref_id == DeltaItem.REF_RAW:
+                data = delta_item.data
+            elif delta_item.ref_id == DeltaItem.REF_BASE_DISK:
+                data = self.base_data[
+                    delta_item.data:delta_item.data+delta_item.offset_len]
+            elif delta_item.ref_id == DeltaItem.REF_XDELTA:
+                source_data = self.base_data[
+                    offset:offset+delta_item.offset_len]
+                data = tool.merge_data(source_data, delta_item.data,
+                                       len(source_data)*5)
+            else:
+                self.fail("Unexpected reference %d" % delta_item.ref_id)
+            self.assertEqual(len(data), delta_item.offset_len)
+            recovered[offset:offset+len(data)] = data
+        return str(recovered)
+
+    def test_cutpoints(self):
+        cut_list = disk.cdc_cutpoints(self.content)
+        self.assertEqual(cut_list[-1], len(self.content))
+        start = 0
+        for cut in cut_list:
+            self.assertTrue(cut - start <= Const.CDC_MAX_CHUNK_SIZE)
+            if cut != cut_list[-1]:
+                self.assertTrue(cut - start >= Const.CDC_MIN_CHUNK_SIZE)
+            start = cut
+
+        # boundaries are resynchronized after shifting the content
+        shift = 1000
+        shifted_cut_list = disk.cdc_cutpoints(chr(0x01)*shift + self.content)
+        shifted_cut_set = set([cut - shift for cut in shifted_cut_list])
+        common_cut = [cut for cut in cut_list if cut in shifted_cut_set]
+        self.assertTrue(len(common_cut) >= len(cut_list) - 2)
+
+    def test_cdc_hashing(self):
+        meta_path = os.path.join(self.temp_dir, "base.cdcmeta")
+        disk.cdc_hashing(self.base_path, meta_path)
+        hash_list = disk.base_hashlist(meta_path)
+        self.assertTrue(len(hash_list) > 0)
+        for (offset, length, hash_value) in hash_list:
+            self.assertTrue(length <= Const.CDC_MAX_CHUNK_SIZE)
+            self.assertEqual(
+                sha256(self.base_data[offset:offset+length]).digest(),
+                hash_value)
+
+        # reading in small pieces gives the same chunks
+        small_meta_path = os.path.join(self.temp_dir, "base.cdcmeta.small")
+        disk.cdc_hashing(self.base_path, small_meta_path,
+                         read_size=Const.CDC_MAX_CHUNK_SIZE+123)
+        self.assertEqual(sorted(disk.base_hashlist(small_meta_path)),
+                         sorted(hash_list))
+
+    def test_create_disk_deltalist_cdc(self):
+        meta_path = os.path.join(self.temp_dir, "base.cdcmeta")
+        disk.cdc_hashing(self.base_path, meta_path)
+        cdc_hashdict = DeltaDedup.disk_import_hashdict(meta_path)
+
+        delta_list = disk.create_disk_deltalist(
+            self.modified_path, self.modified_chunk_dict, Const.CHUNK_SIZE,
+            basedisk_path=self.base_path, cdc_hashdict=cdc_hashdict)
+        base_ref_size = sum([item.offset_len for item in delta_list
+                             if item.ref_id == DeltaItem.REF_BASE_DISK])
+        self.assertTrue(base_ref_size >= self.CONTENT_SIZE*0.8)
+
+        # every modified chunk is covered and recovered as it is
+        covered_chunks = set()
+        for delta_item in delta_list:
+            covered_chunks.update(delta_item.get_chunks(Const.CHUNK_SIZE))
+        self.assertEqual(covered_chunks, set(self.modified_chunk_dict.keys()))
+        self.assertEqual(self._recover(delta_list), self.modified_data)
+
+    def test_create_disk_deltalist_fixed(self):
+        delta_list = disk.create_disk_deltalist(
+            self.modified_path, self.modified_chunk_dict, Const.CHUNK_SIZE,
+            basedisk_path=self.base_path)
+        self.assertEqual(len(delta_list), len(self.modified_chunk_dict))
+        self.assertEqual(self._recover(delta_list), self.modified_data)
+
+
+if __name__ == "__main__":
+    unittest.main()
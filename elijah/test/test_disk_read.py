@@ -0,0 +1,67 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning import tool
+from elijah.provisioning.configuration import Const
+
+
+class TestDiskRead(unittest.TestCase):
+    CHUNK_SIZE = Const.CHUNK_SIZE
+    CHUNK_COUNT = 64
+
+    def setUp(self):
+        super(TestDiskRead, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-diskread-")
+        self.rand = random.Random(1234)
+        # the last chunk is partial
+        self.disk_data = ''.join(
+            [chr(self.rand.randint(0, 255)) for i in
+             xrange(self.CHUNK_SIZE*self.CHUNK_COUNT - 100)])
+        self.disk_path = os.path.join(self.temp_dir, "modified.raw")
+        open(self.disk_path, "wb").write(self.disk_data)
+
+    def tearDown(self):
+        super(TestDiskRead, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _read_each_chunk(self, modified_fd, chunk_list):
+        chunk_data_list = list()
+        for chunk in chunk_list:
+            offset = chunk * self.CHUNK_SIZE
+            modified_fd.seek(offset)
+            data = modified_fd.read(self.CHUNK_SIZE)
+            chunk_data_list.append(
+                (offset, data, tool.chunk_hash(data), None))
+        return chunk_data_list
+
+    def test_adjacent_runs(self):
+        self.assertEqual(disk.get_adjacent_runs([3, 4, 5, 9, 10, 2, 3, 3]),
+                         [(3, 3), (9, 2), (2, 2), (3, 1)])
+        self.assertEqual(disk.get_adjacent_runs(range(10), max_count=4),
+                         [(0, 4), (4, 4), (8, 2)])
+
+    def test_same_as_each_chunk(self):
+        chunk_list = sorted(self.rand.sample(xrange(self.CHUNK_COUNT), 40))
+        # chunk at the end of the disk and beyond it
+        chunk_list += [self.CHUNK_COUNT, self.CHUNK_COUNT + 1]
+        for each_list in [chunk_list, range(self.CHUNK_COUNT), [5], list()]:
+            with open(self.disk_path, "rb", 0) as modified_fd:
+                chunk_data_list = disk.read_modified_chunks(
+                    modified_fd, each_list, self.CHUNK_SIZE)
+            with open(self.disk_path, "rb") as modified_fd:
+                self.assertEqual(
+                    chunk_data_list,
+                    self._read_each_chunk(modified_fd, each_list))
+
+
+if __name__ == "__main__":
+    unittest.main()
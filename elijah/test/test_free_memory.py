@@ -0,0 +1,207 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import json
+import multiprocessing
+import random
+import shutil
+import struct
+from tempfile import mkdtemp
+
+from elijah.provisioning import free_memory
+from elijah.provisioning import tool
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.free_memory import PAGE_SIZE
+from elijah.provisioning.memory import Memory
+from elijah.provisioning.memory import MemoryDiffProc
+
+
+class SyntheticKernel(object):
+    """Memory image of 32-bit kernel with buddy allocator free lists
+    """
+    PAGE_OFFSET = 0xc0000000
+    PGLIST_PADDR = 0x8000
+    MEM_MAP_PADDR = 0x10000
+    LAYOUT = {
+        "page_offset": "c0000000",
+        "pointer_size": 4,
+        "nr_zones": 2,
+        "zone_size": 0x200,
+        "zone_free_area_offset": 0x40,
+        "max_order": 3,
+        "free_area_size": 2*2*4 + 4,
+        "nr_migratetypes": 2,
+        "page_struct_size": 32,
+        "page_lru_offset": 4,
+    }
+
+    def __init__(self, mem_size):
+        self.mem = bytearray(mem_size)
+        self.pglist_addr = self.PAGE_OFFSET + self.PGLIST_PADDR
+        self.mem_map_addr = self.PAGE_OFFSET + self.MEM_MAP_PADDR
+        # empty list head points itself
+        for zone in xrange(self.LAYOUT["nr_zones"]):
+            for order in xrange(self.LAYOUT["max_order"]):
+                for mtype in xrange(self.LAYOUT["nr_migratetypes"]):
+                    head = self.list_head(zone, order, mtype)
+                    self.write_pointer(head, head)
+                    self.write_pointer(head+4, head)
+
+    def write_pointer(self, vaddr, value):
+        paddr = vaddr - self.PAGE_OFFSET
+        self.mem[paddr:paddr+4] = struct.pack("<I", value)
+
+    def list_head(self, zone, order, mtype):
+        return self.pglist_addr + zone*self.LAYOUT["zone_size"] +\
+            self.LAYOUT["zone_free_area_offset"] +\
+            order*self.LAYOUT["free_area_size"] + mtype*8
+
+    def add_free_blocks(self, zone, order, mtype, pfn_list):
+        head = self.list_head(zone, order, mtype)
+        prev = head
+        for pfn in pfn_list:
+            lru = self.mem_map_addr + pfn*self.LAYOUT["page_struct_size"] +\
+                self.LAYOUT["page_lru_offset"]
+            self.write_pointer(prev, lru)
+            prev = lru
+        self.write_pointer(prev, head)
+
+
+class TestFreeMemory(unittest.TestCase):
+    MEM_SIZE_MB = 1
+    MEM_OFFSET = 8192
+
+    def setUp(self):
+        super(TestFreeMemory, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-freemem-")
+        self.snapshot_path = os.path.join(self.temp_dir, "snapshot")
+        self.profile_path = os.path.join(self.temp_dir, "profile.json")
+
+    def tearDown(self):
+        super(TestFreeMemory, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _write_snapshot(self, mem):
+        fd = open(self.snapshot_path, "wb")
+        fd.write(chr(0x01) * self.MEM_OFFSET)
+        fd.write(str(mem))
+        fd.close()
+
+    def _write_profile(self, kernels, heuristics):
+        profile = {"kernels": kernels, "heuristics": heuristics}
+        open(self.profile_path, "w").write(json.dumps(profile))
+
+    def _kernel_profile(self, kernel):
+        return {"name": "synthetic", "mem_size_mb": [self.MEM_SIZE_MB],
+                "pglist_addr": "%x" % kernel.pglist_addr,
+                "pgn0_addr": "%x" % kernel.mem_map_addr,
+                "layout": SyntheticKernel.LAYOUT}
+
+    def test_kernel_walk(self):
+        kernel = SyntheticKernel(self.MEM_SIZE_MB*1024*1024)
+        kernel.add_free_blocks(0, 0, 0, [100, 37])
+        kernel.add_free_blocks(1, 2, 1, [120])
+        self._write_snapshot(kernel.mem)
+        self._write_profile([self._kernel_profile(kernel)], [])
+
+        free_pfn_dict, coverage = free_memory.get_free_pfn_dict(
+            self.snapshot_path, self.MEM_SIZE_MB, self.MEM_OFFSET,
+            profile_path=self.profile_path)
+        offset = self.MEM_OFFSET/PAGE_SIZE
+        expected = set([pfn+offset for pfn in [37, 100, 120, 121, 122, 123]])
+        self.assertEqual(set(free_pfn_dict.keys()), expected)
+        self.assertEqual(coverage["method"], "kernel(synthetic)")
+        self.assertEqual(coverage["free_pages"], len(expected))
+        self.assertEqual(coverage["total_pages"],
+                         self.MEM_SIZE_MB*1024*1024/PAGE_SIZE)
+
+    def test_heuristic(self):
+        oracle = free_memory.HeuristicOracle(["poison"])
+        self.assertEqual(oracle.match(chr(0xaa) * PAGE_SIZE), "poison")
+        self.assertEqual(oracle.match(chr(0x00) * PAGE_SIZE), None)
+        oracle = free_memory.HeuristicOracle(["poison", "zero"])
+        self.assertEqual(oracle.match(chr(0x00) * PAGE_SIZE), "zero")
+        self.assertEqual(oracle.match(chr(0xaa) * (PAGE_SIZE-1) + "a"), None)
+        self.assertRaises(free_memory.FreeMemoryError,
+                          free_memory.HeuristicOracle, ["unknown"])
+
+    def test_no_fallback_to_heuristic(self):
+        # page of the poison pattern is not taken as free when the free list
+        # is broken
+        kernel = SyntheticKernel(self.MEM_SIZE_MB*1024*1024)
+        kernel.write_pointer(kernel.list_head(0, 1, 0), 0x1234)
+        pfn = 10
+        kernel.mem[pfn*PAGE_SIZE:(pfn+1)*PAGE_SIZE] = chr(0xaa) * PAGE_SIZE
+        self._write_snapshot(kernel.mem)
+        self._write_profile([self._kernel_profile(kernel)], ["poison"])
+
+        free_pfn_dict, coverage = free_memory.get_free_pfn_dict(
+            self.snapshot_path, self.MEM_SIZE_MB, self.MEM_OFFSET,
+            profile_path=self.profile_path)
+        self.assertEqual(free_pfn_dict, None)
+        self.assertEqual(coverage["method"], None)
+
+    def test_pattern_page_in_stream(self):
+        rand = random.Random(1234)
+        page_count = 4
+        base_mem = ''.join([chr(rand.randint(0, 255))
+                            for i in xrange(page_count*PAGE_SIZE)])
+        base_path = os.path.join(self.temp_dir, "base-mem")
+        open(base_path, "wb").write(base_mem)
+        hashlist = [(index*PAGE_SIZE, PAGE_SIZE,
+                     tool.chunk_hash(base_mem[index*PAGE_SIZE:
+                                              (index+1)*PAGE_SIZE]))
+                    for index in xrange(page_count)]
+        zero_page = chr(0x00) * PAGE_SIZE
+        poison_page = chr(0xaa) * PAGE_SIZE
+        # zero and poison pages at the first iteration, unchanged page, and
+        # zero page at the next iteration
+        page_list = [(0, 0, zero_page), (0, 1, poison_page),
+                     (0, 2, base_mem[2*PAGE_SIZE:3*PAGE_SIZE]),
+                     (1, 2, zero_page)]
+        memory_data = ''
+        for (iter_seq, pfn, data) in page_list:
+            memory_data += struct.pack(
+                Memory.CHUNK_HEADER_FMT,
+                (iter_seq << Memory.ITER_SEQ_SHIFT) | pfn*PAGE_SIZE) + data
+
+        task_queue = multiprocessing.Queue()
+        deltalist_queue = multiprocessing.Queue()
+        diff_proc = MemoryDiffProc(
+            multiprocessing.Queue(), task_queue, multiprocessing.Queue(),
+            deltalist_queue, "xdelta3", base_path, page_count, hashlist, 0,
+            None, True,
+            free_page_oracle=free_memory.HeuristicOracle(["poison", "zero"]))
+        task_queue.put([memory_data])
+        task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        diff_proc.process_diff()
+
+        # pages are sent as is, not dropped as free pages
+        deltaitem_list = deltalist_queue.get()
+        self.assertEqual(
+            [(item.delta_type, item.offset, item.ref_id, item.data)
+             for item in deltaitem_list],
+            [(DeltaItem.DELTA_MEMORY, 0, DeltaItem.REF_RAW, zero_page),
+             (DeltaItem.DELTA_MEMORY, PAGE_SIZE, DeltaItem.REF_RAW,
+              poison_page),
+             (DeltaItem.DELTA_MEMORY_LIVE, 2*PAGE_SIZE, DeltaItem.REF_RAW,
+              zero_page)])
+
+    def test_no_oracle(self):
+        kernel = SyntheticKernel(self.MEM_SIZE_MB*1024*1024)
+        self._write_snapshot(kernel.mem)
+        self._write_profile([], [])
+        free_pfn_dict, coverage = free_memory.get_free_pfn_dict(
+            self.snapshot_path, self.MEM_SIZE_MB, self.MEM_OFFSET,
+            profile_path=self.profile_path)
+        self.assertEqual(free_pfn_dict, None)
+        self.assertEqual(coverage["method"], None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import struct
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning import memory
+from elijah.provisioning.memory_util import _QemuMemoryHeader
+from elijah.provisioning.configuration import Const
+from elijah.test.util import random_data
+
+
+class TestIncrementalHashing(unittest.TestCase):
+    CHUNK_SIZE = Const.CHUNK_SIZE
+    DISK_SIZE = 64*Const.CHUNK_SIZE
+    MEM_SIZE = 32*Const.CHUNK_SIZE
+
+    def setUp(self):
+        super(TestIncrementalHashing, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-inchash-")
+        self.rand = random.Random(1234)
+        # base disk has zero and duplicated area to have the same hash
+        # at multiple windows
+        data = bytearray(random_data(self.rand, self.DISK_SIZE))
+        data[8*self.CHUNK_SIZE:12*self.CHUNK_SIZE] = \
+            chr(0x00) * 4*self.CHUNK_SIZE
+        data[20*self.CHUNK_SIZE:22*self.CHUNK_SIZE] = \
+            data[2*self.CHUNK_SIZE:4*self.CHUNK_SIZE]
+        data[40*self.CHUNK_SIZE+1000:42*self.CHUNK_SIZE+1000] = \
+            data[2*self.CHUNK_SIZE:4*self.CHUNK_SIZE]
+        self.base_data = str(data)
+        self.base_disk = os.path.join(self.temp_dir, "base.raw")
+        self.base_diskmeta = os.path.join(self.temp_dir, "base.raw-meta")
+        open(self.base_disk, "wb").write(self.base_data)
+        self.base_hashvalue = disk.hashing(self.base_disk, self.base_diskmeta)
+
+    def tearDown(self):
+        super(TestIncrementalHashing, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _modify(self, data, chunk_data_dict):
+        data = bytearray(data)
+        for chunk, chunk_data in chunk_data_dict.iteritems():
+            data[chunk*self.CHUNK_SIZE:(chunk+1)*self.CHUNK_SIZE] = chunk_data
+        return str(data)
+
+    def _assert_disk_hashing(self, new_data, modified_chunks):
+        new_disk = os.path.join(self.temp_dir, "new.raw")
+        full_meta = os.path.join(self.temp_dir, "new.raw-meta.full")
+        inc_meta = os.path.join(self.temp_dir, "new.raw-meta.inc")
+        open(new_disk, "wb").write(new_data)
+        full_hashvalue = disk.hashing(new_disk, full_meta)
+        inc_hashvalue = disk.incremental_hashing(
+            new_disk, inc_meta, self.base_disk, self.base_diskmeta,
+            modified_chunks, read_size=5*self.CHUNK_SIZE)
+        self.assertEqual(inc_hashvalue, full_hashvalue)
+        self.assertEqual(open(inc_meta, "rb").read(),
+                         open(full_meta, "rb").read())
+
+    def test_disk_modified(self):
+        # overwrite the first occurrence of zero and duplicated chunks, and
+        # copy a chunk of base disk to the earlier offset
+        chunk_data_dict = {
+            2: random_data(self.rand, self.CHUNK_SIZE),
+            8: random_data(self.rand, self.CHUNK_SIZE),
+            9: random_data(self.rand, self.CHUNK_SIZE),
+            5: self.base_data[30*self.CHUNK_SIZE:31*self.CHUNK_SIZE],
+            63: chr(0x00) * self.CHUNK_SIZE,
+        }
+        new_data = self._modify(self.base_data, chunk_data_dict)
+        self._assert_disk_hashing(new_data, chunk_data_dict.keys())
+
+    def test_disk_resized(self):
+        chunk_data_dict = {3: random_data(self.rand, self.CHUNK_SIZE)}
+        new_data = self._modify(self.base_data, chunk_data_dict)
+        self._assert_disk_hashing(
+            new_data + random_data(self.rand, 3*self.CHUNK_SIZE),
+            chunk_data_dict.keys())
+        self._assert_disk_hashing(
+            new_data[:50*self.CHUNK_SIZE], chunk_data_dict.keys())
+
+    def test_disk_unmodified(self):
+        self._assert_disk_hashing(self.base_data, [])
+
+    def _write_memory(self, mem_path, body):
+        xml = "<domain></domain>"
+        xml_len = Const.LIBVIRT_HEADER_SIZE - _QemuMemoryHeader.HEADER_LENGTH
+        header = [_QemuMemoryHeader.HEADER_MAGIC,
+                  _QemuMemoryHeader.HEADER_VERSION, xml_len, 0, 0]
+        header.extend([0] * _QemuMemoryHeader.HEADER_UNUSED_VALUES)
+        fd = open(mem_path, "wb")
+        fd.write(struct.pack(_QemuMemoryHeader.HEADER_FORMAT, *header))
+        fd.write(xml.ljust(xml_len, '\0'))
+        fd.write(body)
+        fd.close()
+
+    def test_memory(self):
+        base_mem = os.path.join(self.temp_dir, "base.mem")
+        base_memmeta = os.path.join(self.temp_dir, "base.mem-meta")
+        base_body = random_data(self.rand, self.MEM_SIZE)
+        self._write_memory(base_mem, base_body)
+        memory.hashing(base_mem).export_to_file(base_memmeta)
+
+        page_size = memory.Memory.RAM_PAGE_SIZE
+        header_pages = Const.LIBVIRT_HEADER_SIZE/page_size
+        modified_pages = [3, 10]
+        new_body = bytearray(base_body)
+        for page in modified_pages:
+            new_body[page*page_size:(page+1)*page_size] = \
+                random_data(self.rand, page_size)
+        new_body = str(new_body) + random_data(self.rand, 2*page_size)
+        modified_pages = [page+header_pages for page in modified_pages]
+
+        new_mem = os.path.join(self.temp_dir, "new.mem")
+        self._write_memory(new_mem, new_body)
+        full_mem = memory.hashing(new_mem)
+        inc_mem = memory.incremental_hashing(new_mem, base_memmeta,
+                                             modified_pages)
+        self.assertEqual(inc_mem.hash_list, full_mem.hash_list)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import json
+import shutil
+import socket
+import threading
+import time
+from tempfile import mkdtemp
+
+from elijah.provisioning import handoff
+from elijah.provisioning.handoff import DirtyRateModel
+from elijah.provisioning.configuration import VMOverlayCreationMode
+
+
+MB = 1024*1024
+
+
+class DirtyPageSimulator(object):
+    """Guest dirtying memory at a fixed rate and pipeline processing
+    received pages at a fixed rate. QEMU sends all the dirty pages at once
+    when an iteration is requested.
+    """
+
+    def __init__(self, memory_size, dirty_rate, drain_rate, cur_time):
+        self.memory_size = memory_size
+        self.dirty_rate = dirty_rate
+        self.drain_rate = drain_rate
+        self.iter_num = 0
+        self.iter_size = memory_size
+        self.backlog_size = memory_size
+        self.processed_size = 0
+        self.dirty_size = 0
+        self.cur_time = cur_time
+
+    def advance(self, cur_time):
+        duration = cur_time - self.cur_time
+        self.cur_time = cur_time
+        drained_size = min(self.backlog_size, self.drain_rate*duration)
+        self.backlog_size -= drained_size
+        self.processed_size += drained_size
+        self.dirty_size = min(self.memory_size,
+                              self.dirty_size + self.dirty_rate*duration)
+
+    def iterate(self):
+        if self.dirty_size > 0:
+            self.iter_num += 1
+            self.iter_size = self.dirty_size
+            self.backlog_size += self.dirty_size
+        self.dirty_size = 0
+
+    def downtime(self):
+        return (self.backlog_size + self.dirty_size)/self.drain_rate
+
+    def sample(self):
+        return (self.iter_num, int(self.iter_size), int(self.processed_size),
+                int(self.backlog_size))
+
+
+class StubQmpServer(threading.Thread):
+    """QMP channel of QEMU that records received commands
+    """
+
+    def __init__(self, sock_path, simulator):
+        self.sock_path = sock_path
+        self.simulator = simulator
+        self.commands = list()
+        self.stop_time = None
+        self.server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_sock.bind(sock_path)
+        self.server_sock.listen(1)
+        super(StubQmpServer, self).__init__(target=self.serve)
+        self.daemon = True
+
+    def serve(self):
+        conn, addr = self.server_sock.accept()
+        conn.sendall(json.dumps({"QMP": {"capabilities": []}}) + "\r\n")
+        decoder = json.JSONDecoder()
+        buf = ''
+        while True:
+            data = conn.recv(1024)
+            if not data:
+                break
+            buf += data
+            while True:
+                try:
+                    request, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                self.handle(conn, request)
+        conn.close()
+        self.server_sock.close()
+
+    def handle(self, conn, request):
+        command = request["execute"]
+        self.commands.append(command)
+        if command == "iterate-raw-live":
+            self.simulator.iterate()
+        conn.sendall(json.dumps({"return": {}, "id": request["id"]}))
+        if command == "stop-raw-live":
+            self.stop_time = time.time()
+            time.sleep(0.1)
+            conn.sendall(json.dumps({
+                "event": "STOP",
+                "timestamp": {"seconds": int(self.stop_time),
+                              "microseconds": 0}}))
+
+
+class StubProcessController(object):
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def get_migration_iteration_info(self):
+        self.simulator.advance(time.time())
+        return self.simulator.sample()[:3]
+
+
+class StubQueue(object):
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def qsize(self):
+        return int(self.simulator.backlog_size /
+                   VMOverlayCreationMode.PIPE_ONE_ELEMENT_SIZE)
+
+
+class StubMonitor(object):
+
+    def __init__(self):
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+
+class TestMigrationControl(unittest.TestCase):
+    MEMORY_SIZE = 1024*MB
+    DRAIN_RATE = 100*MB
+    TARGET_DOWNTIME = 1.0
+
+    def setUp(self):
+        super(TestMigrationControl, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-migration-")
+        self.stop_mode = VMOverlayCreationMode.LIVE_MIGRATION_STOP
+
+    def tearDown(self):
+        super(TestMigrationControl, self).tearDown()
+        VMOverlayCreationMode.LIVE_MIGRATION_STOP = self.stop_mode
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _simulate(self, dirty_rate, period=0.1, max_time=600):
+        model = DirtyRateModel(self.TARGET_DOWNTIME, 30, 0.9)
+        cur_time = 0.0
+        simulator = DirtyPageSimulator(self.MEMORY_SIZE, dirty_rate,
+                                       self.DRAIN_RATE, cur_time)
+        model.start(cur_time)
+        while cur_time < max_time:
+            cur_time += period
+            simulator.advance(cur_time)
+            model.update(cur_time, *simulator.sample())
+            decision = model.decide(cur_time)
+            if decision == DirtyRateModel.ITERATE:
+                simulator.iterate()
+                model.iteration_requested(cur_time)
+            elif decision == DirtyRateModel.STOP:
+                return model.requested_iteration, simulator.downtime()
+        self.fail("migration does not stop")
+
+    def test_idle_guest(self):
+        iteration, downtime = self._simulate(0)
+        self.assertTrue(iteration <= 1)
+        self.assertTrue(downtime <= self.TARGET_DOWNTIME)
+
+    def test_write_heavy_guest(self):
+        # converges slowly, but continues until the downtime is short
+        iteration, downtime = self._simulate(0.6*self.DRAIN_RATE)
+        self.assertTrue(iteration > 5)
+        self.assertTrue(downtime <= self.TARGET_DOWNTIME)
+
+    def test_not_converging_guest(self):
+        # more iterations only make residue bigger
+        iteration, downtime = self._simulate(1.5*self.DRAIN_RATE)
+        self.assertTrue(iteration <= 2)
+
+    def test_qmp_thread(self):
+        VMOverlayCreationMode.LIVE_MIGRATION_STOP = \
+            VMOverlayCreationMode.LIVE_MIGRATION_FINISH_DIRTY_RATE_MODEL
+        simulator = DirtyPageSimulator(50*MB, 20*MB, 100*MB, time.time())
+        qmp_path = os.path.join(self.temp_dir, "qmp")
+        qmp_server = StubQmpServer(qmp_path, simulator)
+        qmp_server.start()
+        monitor = StubMonitor()
+        qmp_thread = handoff.QmpThread(
+            qmp_path, StubProcessController(simulator), StubQueue(simulator),
+            None, None, monitor)
+        qmp_thread.daemon = True
+        qmp_thread.start()
+        qmp_thread.join(30)
+        self.assertFalse(qmp_thread.is_alive())
+
+        self.assertEqual(qmp_server.commands[:2],
+                         ["qmp_capabilities", "randomize-raw-live"])
+        self.assertEqual(qmp_server.commands[-1], "stop-raw-live")
+        self.assertTrue("iterate-raw-live" in qmp_server.commands)
+        self.assertEqual(qmp_thread.migration_stop_time,
+                         float(int(qmp_server.stop_time)))
+        self.assertTrue(monitor.terminated)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import msgpack
+from tempfile import mkdtemp
+from lzma import LZMADecompressor
+
+from elijah.provisioning import delta
+from elijah.provisioning import compression
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.configuration import Const
+
+
+class TestOverlayFrame(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    ITEM_COUNT = 64
+    FRAME_SIZE_KB = 16
+
+    def setUp(self):
+        super(TestOverlayFrame, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-frame-")
+        self.overlay_prefix = os.path.join(self.temp_dir, "overlay-blob")
+        rand = random.Random(1234)
+        self.delta_list = list()
+        for index in xrange(self.ITEM_COUNT):
+            for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+                data = ''.join([chr(rand.randint(0, 255))
+                                for i in xrange(self.CHUNK_SIZE)])
+                self.delta_list.append(DeltaItem(
+                    delta_type, index*self.CHUNK_SIZE, self.CHUNK_SIZE, None,
+                    DeltaItem.REF_RAW, len(data), data))
+        # deduplicated chunks follow the original chunk
+        for index in xrange(self.ITEM_COUNT, self.ITEM_COUNT+8):
+            ref_item = self.delta_list[(index % 8)*16]
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_DISK, index*self.CHUNK_SIZE, self.CHUNK_SIZE,
+                None, DeltaItem.REF_SELF, 8, ref_item.index))
+
+    def tearDown(self):
+        super(TestOverlayFrame, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _decomp_segment(self, segment, comp_type=Const.COMPRESSION_LZMA):
+        (segment_name, blob_name, offset, size) = segment
+        blob_data = open(os.path.join(self.temp_dir, blob_name), "rb").read()
+        if comp_type == Const.COMPRESSION_NONE:
+            data = blob_data[offset:offset+size]
+        else:
+            decompressor = LZMADecompressor()
+            data = decompressor.decompress(blob_data[offset:offset+size])
+            data += decompressor.flush()
+        delta_path = os.path.join(self.temp_dir, "segment")
+        open(delta_path, "wb").write(data)
+        return delta.DeltaList.fromfile(delta_path)
+
+    def test_frame_index(self):
+        blob_list = delta.divide_blobs(
+            self.delta_list, self.overlay_prefix, Const.OVERLAY_BLOB_SIZE_KB,
+            self.CHUNK_SIZE, self.CHUNK_SIZE, frame_size_kb=self.FRAME_SIZE_KB)
+        self.assertEqual(len(blob_list), 1)
+        frames = blob_list[0][Const.META_OVERLAY_FILE_FRAMES]
+        self.assertTrue(len(frames) > 1)
+        self.assertEqual(frames[0][Const.META_OVERLAY_FRAME_OFFSET], 0)
+        self.assertEqual(
+            sum([frame[Const.META_OVERLAY_FRAME_SIZE] for frame in frames]),
+            blob_list[0][Const.META_OVERLAY_FILE_SIZE])
+
+        # each frame is decompressed by itself and has the chunks indexed
+        segments = delta.get_overlay_segments(blob_list)
+        self.assertEqual(len(segments), len(frames))
+        disk_dict, memory_dict = delta.get_chunk_segment_dict(blob_list)
+        segment_compression = delta.get_segment_compression(blob_list)
+        item_count = 0
+        for segment in segments:
+            segment_name = segment[0]
+            frame_items = self._decomp_segment(
+                segment, segment_compression[segment_name])
+            item_count += len(frame_items)
+            for delta_item in frame_items:
+                if delta_item.ref_id == DeltaItem.REF_SELF:
+                    # reference is resolved in the same frame
+                    self.assertTrue(delta_item.data in
+                                    [item.index for item in frame_items])
+                chunk = delta_item.offset/self.CHUNK_SIZE
+                if delta_item.delta_type == DeltaItem.DELTA_DISK:
+                    self.assertEqual(disk_dict[chunk], [segment_name])
+                else:
+                    self.assertEqual(memory_dict[chunk], [segment_name])
+        self.assertEqual(item_count, len(self.delta_list))
+
+    def test_decomp_overlay(self):
+        # framed and unframed blobs recover the same delta stream
+        output_list = list()
+        for frame_size_kb in (None, self.FRAME_SIZE_KB):
+            blob_list = delta.divide_blobs(
+                self.delta_list, self.overlay_prefix,
+                Const.OVERLAY_BLOB_SIZE_KB, self.CHUNK_SIZE, self.CHUNK_SIZE,
+                frame_size_kb=frame_size_kb)
+            meta_path = os.path.join(self.temp_dir, Const.OVERLAY_META)
+            meta_dict = {Const.META_OVERLAY_FILES: blob_list}
+            open(meta_path, "wb").write(msgpack.packb(meta_dict))
+            output_path = os.path.join(self.temp_dir, "overlay")
+            compression.decomp_overlay(meta_path, output_path)
+            output_list.append(open(output_path, "rb").read())
+        self.assertEqual(output_list[0], output_list[1])
+
+        delta_list = delta.DeltaList.fromfile(output_path)
+        self.assertEqual(len(delta_list), len(self.delta_list))
+
+    def test_stored_frame(self):
+        # random chunks are grouped at a stored frame apart from the
+        # compressed frame of text chunks
+        text = ''.join(["cloudlet %08d\n" % i for i in xrange(256)])
+        delta_list = list()
+        for index, item in enumerate(self.delta_list[:8]):
+            if index % 3 == 0:
+                data = text[:self.CHUNK_SIZE]
+                item = DeltaItem(item.delta_type, item.offset,
+                                 self.CHUNK_SIZE, None, DeltaItem.REF_RAW,
+                                 len(data), data)
+            delta_list.append(item)
+        self.assertFalse(delta.is_incompressible(delta_list[0]))
+        self.assertTrue(delta.is_incompressible(delta_list[1]))
+
+        blob_list = delta.divide_blobs(
+            delta_list, self.overlay_prefix, Const.OVERLAY_BLOB_SIZE_KB,
+            self.CHUNK_SIZE, self.CHUNK_SIZE)
+        frames = blob_list[0][Const.META_OVERLAY_FILE_FRAMES]
+        self.assertEqual(
+            [frame[Const.META_OVERLAY_FRAME_COMPRESSION] for frame in frames],
+            [Const.COMPRESSION_LZMA, Const.COMPRESSION_NONE])
+        meta_path = os.path.join(self.temp_dir, Const.OVERLAY_META)
+        meta_dict = {Const.META_OVERLAY_FILES: blob_list}
+        open(meta_path, "wb").write(msgpack.packb(meta_dict))
+        output_path = os.path.join(self.temp_dir, "overlay")
+        compression.decomp_overlay(meta_path, output_path)
+        self.assertEqual(
+            [item.get_serialized() for item in
+             delta.DeltaList.from_file_stream(output_path)],
+            [item.get_serialized() for item in
+             delta_list[::3] + [item for (index, item) in
+                                enumerate(delta_list) if index % 3 != 0]])
+
+    def test_mixed_frame_index(self):
+        # frames of text chunks and random chunks are flushed apart, and
+        # the chunks are indexed at the frame holding them
+        text = ''.join(["cloudlet %08d\n" % i for i in xrange(256)])
+        delta_list = list()
+        for index, item in enumerate(self.delta_list[:32]):
+            if index % 3 == 0:
+                data = text[:self.CHUNK_SIZE]
+                item = DeltaItem(item.delta_type, item.offset,
+                                 self.CHUNK_SIZE, None, DeltaItem.REF_RAW,
+                                 len(data), data)
+            delta_list.append(item)
+        blob_list = delta.divide_blobs(
+            delta_list, self.overlay_prefix, Const.OVERLAY_BLOB_SIZE_KB,
+            self.CHUNK_SIZE, self.CHUNK_SIZE, frame_size_kb=8)
+        disk_dict, memory_dict = delta.get_chunk_segment_dict(blob_list)
+        segment_compression = delta.get_segment_compression(blob_list)
+        item_count = 0
+        for segment in delta.get_overlay_segments(blob_list):
+            segment_name = segment[0]
+            for delta_item in self._decomp_segment(
+                    segment, segment_compression[segment_name]):
+                item_count += 1
+                chunk = delta_item.offset/self.CHUNK_SIZE
+                if delta_item.delta_type == DeltaItem.DELTA_DISK:
+                    self.assertEqual(disk_dict[chunk], [segment_name])
+                else:
+                    self.assertEqual(memory_dict[chunk], [segment_name])
+        self.assertEqual(item_count, len(delta_list))
+
+    def test_straddle_frame(self):
+        # content-defined chunks cover parts of fixed size chunks. They are
+        # shuffled like the list sorted by hash, and the compressible ones
+        # would go to other frame than the random ones
+        text = ''.join(["cloudlet %08d\n" % i for i in xrange(4096)])
+        rand = random.Random(1234)
+        delta_list = list()
+        offset = 100*self.CHUNK_SIZE
+        for index in xrange(48):
+            length = rand.randint(1000, 3*self.CHUNK_SIZE)
+            if index % 2 == 0:
+                data = text[:length]
+            else:
+                data = self.delta_list[index].data * 3
+                data = data[:length]
+            delta_list.append(DeltaItem(
+                DeltaItem.DELTA_DISK, offset, length, None,
+                DeltaItem.REF_RAW, len(data), data))
+            offset += length
+        rand.shuffle(delta_list)
+        delta_list += self.delta_list[:16]
+
+        blob_list = delta.divide_blobs(
+            delta_list, self.overlay_prefix, 24, self.CHUNK_SIZE,
+            self.CHUNK_SIZE, frame_size_kb=4)
+        self.assertTrue(len(blob_list) > 1)
+        disk_dict, memory_dict = delta.get_chunk_segment_dict(blob_list)
+        segment_compression = delta.get_segment_compression(blob_list)
+        covered_size = dict()
+        item_count = 0
+        for segment in delta.get_overlay_segments(blob_list):
+            segment_name = segment[0]
+            for delta_item in self._decomp_segment(
+                    segment, segment_compression[segment_name]):
+                item_count += 1
+                if delta_item.delta_type != DeltaItem.DELTA_DISK:
+                    continue
+                end_offset = delta_item.offset + delta_item.offset_len
+                for chunk in delta_item.get_chunks(self.CHUNK_SIZE):
+                    # every part of the chunk is at its only segment
+                    self.assertEqual(disk_dict[chunk], [segment_name])
+                    covered_size[chunk] = covered_size.get(chunk, 0) + \
+                        min((chunk+1)*self.CHUNK_SIZE, end_offset) - \
+                        max(chunk*self.CHUNK_SIZE, delta_item.offset)
+        self.assertEqual(item_count, len(delta_list))
+        # chunks at both ends of the run are partly covered
+        self.assertEqual(len([size for size in covered_size.values()
+                              if size != self.CHUNK_SIZE]), 1)
+
+        # part of a chunk is not replaced with a reference to the same data
+        # elsewhere, which would move it to the frame of the reference
+        same_list = [DeltaItem(
+            DeltaItem.DELTA_DISK, chunk_offset, 1000, "hash",
+            DeltaItem.REF_RAW, 1000, text[:1000]) for chunk_offset in
+            (0, self.CHUNK_SIZE, 2*self.CHUNK_SIZE+1000)]
+        delta.DeltaList.get_self_delta(same_list, self.CHUNK_SIZE)
+        self.assertEqual([item.ref_id for item in same_list],
+                         [DeltaItem.REF_RAW]*3)
+
+    def test_parallel_decomp(self):
+        # several blobs are decompressed at worker processes in blob order
+        blob_list = delta.divide_blobs(
+            self.delta_list, self.overlay_prefix, 64, self.CHUNK_SIZE,
+            self.CHUNK_SIZE, frame_size_kb=self.FRAME_SIZE_KB)
+        self.assertTrue(len(blob_list) > 4)
+        blob_path_dict = dict(
+            (blob_info[Const.META_OVERLAY_FILE_NAME],
+             os.path.join(self.temp_dir,
+                          blob_info[Const.META_OVERLAY_FILE_NAME]))
+            for blob_info in blob_list)
+        read_size_list = list()
+
+        def read_blob(blob_info, offset=0, size=None):
+            data = open(blob_path_dict[
+                blob_info[Const.META_OVERLAY_FILE_NAME]], "rb").read()
+            if size is None:
+                size = len(data) - offset
+            read_size_list.append(size)
+            return data[offset:offset+size]
+
+        output_list = list()
+        for (num_proc, inflight_size) in [(1, 0), (4, 0), (4, 1024*1024)]:
+            output_path = os.path.join(self.temp_dir, "overlay")
+            with open(output_path, "wb") as out_fd:
+                compression._decomp_blobs(blob_list, read_blob, out_fd,
+                                          num_proc=num_proc,
+                                          inflight_size=inflight_size)
+            output_list.append(open(output_path, "rb").read())
+        self.assertEqual(output_list[0], output_list[1])
+        self.assertEqual(output_list[0], output_list[2])
+        delta_list = delta.DeltaList.fromfile(output_path)
+        self.assertEqual(len(delta_list), len(self.delta_list))
+        # frames are read one by one
+        self.assertEqual(max(read_size_list), max([
+            segment[3] for segment in delta.get_overlay_segments(blob_list)]))
+
+        # frames of a single blob are decompressed in parallel
+        single_list = delta.divide_blobs(
+            self.delta_list, self.overlay_prefix + "-single",
+            Const.OVERLAY_BLOB_SIZE_KB, self.CHUNK_SIZE, self.CHUNK_SIZE,
+            frame_size_kb=self.FRAME_SIZE_KB)
+        self.assertEqual(len(single_list), 1)
+        blob_path_dict[single_list[0][Const.META_OVERLAY_FILE_NAME]] = \
+            os.path.join(self.temp_dir,
+                         single_list[0][Const.META_OVERLAY_FILE_NAME])
+        with open(output_path, "wb") as out_fd:
+            compression._decomp_blobs(single_list, read_blob, out_fd,
+                                      num_proc=4, inflight_size=1024*64)
+        self.assertEqual(open(output_path, "rb").read(), output_list[0])
+
+        # error of a worker is raised at the caller
+        blob_list[2] = dict(blob_list[2])
+        frames = [dict(frame) for frame in
+                  blob_list[2][Const.META_OVERLAY_FILE_FRAMES]]
+        frames[0][Const.META_OVERLAY_FRAME_SHA256] = "0"*64
+        blob_list[2][Const.META_OVERLAY_FILE_FRAMES] = frames
+        with open(output_path, "wb") as out_fd:
+            self.assertRaises(compression.CompressionError,
+                              compression._decomp_blobs, blob_list,
+                              read_blob, out_fd, num_proc=4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,365 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import Queue
+import random
+import shutil
+import struct
+from cStringIO import StringIO
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning import compression
+from elijah.provisioning import server
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import Synthesis_Const
+from elijah.test.util import random_data
+
+
+class _CorruptingPackage(object):
+    # overlay package whose first reads of each piece are corrupted on the wire
+    def __init__(self, blob_dict, corrupt_count):
+        self.blob_dict = blob_dict
+        self.corrupt_count = corrupt_count
+        self.read_count = dict()
+
+    def read(self, blob_name, offset=0, size=None):
+        data = self.blob_dict[blob_name]
+        if size is None:
+            size = len(data) - offset
+        data = data[offset:offset+size]
+        count = self.read_count.get((blob_name, offset), 0)
+        self.read_count[(blob_name, offset)] = count + 1
+        if count < self.corrupt_count:
+            data = data[:-1] + chr(ord(data[-1]) ^ 0xFF)
+        return data
+
+    def read_blob(self, blob_info, offset=0, size=None):
+        return self.read(blob_info[Const.META_OVERLAY_FILE_NAME], offset,
+                         size)
+
+    def iter_blob(self, blob_name, chunk_size, offset=0, size=None):
+        data = self.read(blob_name, offset, size)
+        for index in xrange(0, len(data), chunk_size):
+            yield data[index:index+chunk_size]
+
+
+class _CorruptingClient(object):
+    # client answering the on-demand requests of NetworkStepThread, whose
+    # first answers of the segments at corrupt_dict are corrupted there
+    def __init__(self, blob_dict, corrupt_dict):
+        self.blob_dict = blob_dict
+        self.corrupt_dict = corrupt_dict
+        self.request = self
+        self.wfile = self
+        self.rfile = self
+        self.request_list = list()
+        self.buffer = ''
+
+    def send(self, data):
+        pass
+
+    def write(self, data):
+        message = server.NetworkUtil.decoding(data)
+        self.request_list.append(
+            message[server.Protocol.KEY_REQUEST_SEGMENT])
+
+    def flush(self):
+        pass
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            blob_name = self.request_list.pop(0)
+            data = self.blob_dict[blob_name]
+            if blob_name in self.corrupt_dict:
+                offset = self.corrupt_dict.pop(blob_name)
+                data = data[:offset] + chr(ord(data[offset]) ^ 0xFF) + \
+                    data[offset+1:]
+            header = server.NetworkUtil.encoding({
+                server.Protocol.KEY_COMMAND:
+                    server.Protocol.MESSAGE_COMMAND_SEND_OVERLAY,
+                server.Protocol.KEY_REQUEST_SEGMENT: blob_name,
+                server.Protocol.KEY_REQUEST_SEGMENT_SIZE: len(data)})
+            self.buffer += struct.pack("!I", len(header)) + header + data
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+
+class TestOverlayMerkle(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 16
+
+    def setUp(self):
+        super(TestOverlayMerkle, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-merkle-")
+        self.rand = random.Random(1234)
+        # incompressible chunks are stored frames, and the others are xz
+        self.delta_list = list()
+        for index in xrange(self.CHUNK_COUNT):
+            if index % 2 == 0:
+                data = random_data(self.rand, self.CHUNK_SIZE)
+            else:
+                data = chr(index) * self.CHUNK_SIZE
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, index*self.CHUNK_SIZE,
+                self.CHUNK_SIZE, None, DeltaItem.REF_RAW, len(data), data))
+        self.blob_list = delta.divide_blobs(
+            self.delta_list,
+            os.path.join(self.temp_dir, Const.OVERLAY_FILE_PREFIX), 16,
+            self.CHUNK_SIZE, self.CHUNK_SIZE, frame_size_kb=8)
+        self.blob_dict = dict()
+        for blob_info in self.blob_list:
+            blob_name = blob_info[Const.META_OVERLAY_FILE_NAME]
+            self.blob_dict[blob_name] = open(
+                os.path.join(self.temp_dir, blob_name), "rb").read()
+        self.meta_info = {
+            Const.META_OVERLAY_FILES: self.blob_list,
+            Const.META_OVERLAY_MERKLE_ROOT:
+                delta.get_overlay_merkle_root(self.blob_list)}
+
+    def tearDown(self):
+        super(TestOverlayMerkle, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _decomp(self, read_blob, num_proc):
+        out_fd = StringIO()
+        compression._decomp_blobs(self.blob_list, read_blob, out_fd,
+                                  num_proc=num_proc)
+        return out_fd.getvalue()
+
+    def test_merkle_root(self):
+        leaves = [sha256(str(index)).hexdigest() for index in xrange(3)]
+        self.assertEqual(delta.merkle_root(leaves[:1]), leaves[0])
+        node = sha256(leaves[0].decode("hex") +
+                      leaves[1].decode("hex")).digest()
+        root = sha256(node + leaves[2].decode("hex")).hexdigest()
+        self.assertEqual(delta.merkle_root(leaves), root)
+        self.assertNotEqual(delta.merkle_root(leaves[::-1]), root)
+        self.assertEqual(delta.merkle_root(list()), None)
+
+    def test_meta_chain(self):
+        self.assertTrue(len(self.blob_list) > 1)
+        segments = delta.get_overlay_segments(self.blob_list)
+        digest_dict = delta.get_segment_digests(self.blob_list)
+        self.assertEqual(len(digest_dict), len(segments))
+        for (segment_name, blob_name, offset, size) in segments:
+            data = self.blob_dict[blob_name][offset:offset+size]
+            self.assertEqual(digest_dict[segment_name],
+                             sha256(data).hexdigest())
+        self.assertTrue(delta.check_overlay_merkle(self.meta_info))
+
+        # digest of a frame does not chain up to the root once replaced
+        frame = self.blob_list[1][Const.META_OVERLAY_FILE_FRAMES][0]
+        frame[Const.META_OVERLAY_FRAME_SHA256] = sha256("").hexdigest()
+        self.assertRaises(delta.DeltaError, delta.check_overlay_merkle,
+                          self.meta_info)
+        del self.blob_list[1][Const.META_OVERLAY_FILE_MERKLE_ROOT]
+        self.assertRaises(delta.DeltaError, delta.check_overlay_merkle,
+                          self.meta_info)
+        # old overlay does not have the root
+        del self.meta_info[Const.META_OVERLAY_MERKLE_ROOT]
+        self.assertFalse(delta.check_overlay_merkle(self.meta_info))
+
+    def test_refetch_blob(self):
+        expected = self._decomp(_CorruptingPackage(self.blob_dict,
+                                                   0).read_blob, 1)
+        self.assertEqual(len(expected), sum(
+            [len(item.get_serialized()) for item in self.delta_list]))
+        for num_proc in (1, 4):
+            package = _CorruptingPackage(self.blob_dict,
+                                         Const.OVERLAY_REFETCH_COUNT)
+            self.assertEqual(self._decomp(package.read_blob, num_proc),
+                             expected)
+            package = _CorruptingPackage(self.blob_dict,
+                                         Const.OVERLAY_REFETCH_COUNT+1)
+            self.assertRaises(compression.CorruptedBlobError, self._decomp,
+                              package.read_blob, num_proc)
+
+    def _fetch_segments(self, package):
+        segments = delta.get_overlay_segments(self.blob_list)
+        out_queue = Queue.Queue()
+        fetch_step = server.URLFetchStep(
+            package, [segment[0] for segment in segments],
+            dict([(segment[0], segment[3]) for segment in segments]),
+            Queue.Queue(), out_queue, Queue.Queue(), 1024,
+            overlay_segments=dict([(segment[0], segment[1:])
+                                   for segment in segments]),
+            segment_digests=delta.get_segment_digests(self.blob_list))
+        fetch_step.run()
+        data_list = list()
+        while not out_queue.empty():
+            data_list.append(out_queue.get())
+        return data_list
+
+    def test_fetch_segment(self):
+        expected = self._fetch_segments(
+            _CorruptingPackage(self.blob_dict, 0))
+        self.assertEqual(expected[-1], Synthesis_Const.END_OF_FILE)
+        self.assertEqual(
+            expected.count(Synthesis_Const.END_OF_SEGMENT),
+            len(delta.get_overlay_segments(self.blob_list)))
+        # corrupted segment is not forwarded before it is fetched again
+        package = _CorruptingPackage(self.blob_dict,
+                                     Const.OVERLAY_REFETCH_COUNT)
+        self.assertEqual(self._fetch_segments(package), expected)
+        package = _CorruptingPackage(self.blob_dict,
+                                     Const.OVERLAY_REFETCH_COUNT+1)
+        self.assertEqual(self._fetch_segments(package)[-1],
+                         Synthesis_Const.ERROR_OCCURED)
+
+        # segment of the old overlay larger than a leaf fails at corruption
+        out_queue = Queue.Queue()
+        data = "a" * (Const.OVERLAY_MERKLE_LEAF_SIZE + 1)
+        self.assertRaises(server.RapidSynthesisError, server.forward_segment,
+                          iter([data[:10], data[10:]]), out_queue, "blob",
+                          len(data), False, sha256(data[1:]).hexdigest())
+        out_queue = Queue.Queue()
+        self.assertEqual(server.forward_segment(
+            iter(["ab", "cd"]), out_queue, "blob", 4, False,
+            sha256("abce").hexdigest()), (4, 2, 0, False))
+        self.assertTrue(out_queue.empty())
+
+    def _get_items(self, out_queue):
+        item_list = list()
+        while not out_queue.empty():
+            item_list.append(out_queue.get())
+        return item_list
+
+    def test_forward_leaves(self):
+        data = random_data(self.rand, 10)
+        leaf_digests = delta.get_leaf_digests(data, 4)
+        self.assertEqual(len(leaf_digests), 3)
+        digest = delta.get_segment_digest(data, 4)
+        self.assertEqual(digest, delta.merkle_root(leaf_digests))
+        chunk_list = [data[index:index+3] for index in xrange(0, 10, 3)]
+        out_queue = Queue.Queue()
+        self.assertEqual(server.forward_segment(
+            iter(chunk_list), out_queue, "blob", 10, True, digest,
+            (4, leaf_digests)), (10, 4, 10, True))
+        self.assertEqual(self._get_items(out_queue), [
+            Synthesis_Const.STORED_SEGMENT, data[:4], data[4:8], data[8:],
+            Synthesis_Const.END_OF_SEGMENT])
+
+        # leaves before the corrupted one are forwarded, and the rest of
+        # them are forwarded at the next fetch
+        corrupted = data[:5] + chr(ord(data[5]) ^ 0xFF) + data[6:]
+        self.assertEqual(server.forward_segment(
+            iter([corrupted]), out_queue, "blob", 10, True, digest,
+            (4, leaf_digests)), (10, 1, 4, False))
+        self.assertEqual(self._get_items(out_queue),
+                         [Synthesis_Const.STORED_SEGMENT, data[:4]])
+        self.assertEqual(server.forward_segment(
+            iter(chunk_list), out_queue, "blob", 10, True, digest,
+            (4, leaf_digests), skip_size=4), (10, 4, 10, True))
+        self.assertEqual(self._get_items(out_queue), [
+            data[4:8], data[8:], Synthesis_Const.END_OF_SEGMENT])
+
+        # truncated segment
+        self.assertEqual(server.forward_segment(
+            iter([data[:8]]), out_queue, "blob", 10, True, digest,
+            (4, leaf_digests))[2:], (8, False))
+
+    def test_receive_leaves(self):
+        # blobs without frames are verified by their leaves
+        blob_dict = dict()
+        blob_list = list()
+        for index in xrange(3):
+            blob_name = "%s_%d" % (Const.OVERLAY_FILE_PREFIX, index+1)
+            data = random_data(self.rand, 5000)
+            blob_dict[blob_name] = data
+            blob_list.append({
+                Const.META_OVERLAY_FILE_NAME: blob_name,
+                Const.META_OVERLAY_FILE_SIZE: len(data),
+                Const.META_OVERLAY_FILE_SHA256: sha256(data).hexdigest(),
+                Const.META_OVERLAY_FILE_LEAF_SIZE: 1024,
+                Const.META_OVERLAY_FILE_LEAVES:
+                    delta.get_leaf_digests(data, 1024)})
+        meta_info = {
+            Const.META_OVERLAY_FILES: blob_list,
+            Const.META_OVERLAY_MERKLE_ROOT:
+                delta.get_overlay_merkle_root(blob_list)}
+        self.assertTrue(delta.check_overlay_merkle(meta_info))
+        blob_list[0][Const.META_OVERLAY_FILE_LEAVES][2] = \
+            sha256("").hexdigest()
+        self.assertRaises(delta.DeltaError, delta.check_overlay_merkle,
+                          meta_info)
+        blob_list[0][Const.META_OVERLAY_FILE_LEAVES] = \
+            delta.get_leaf_digests(blob_dict[blob_list[0][
+                Const.META_OVERLAY_FILE_NAME]], 1024)
+
+        # first blob is corrupted after its first leaves are forwarded, and
+        # the next blobs wait for the rest of it
+        blob_names = sorted(blob_dict.keys())
+        client = _CorruptingClient(blob_dict, {blob_names[0]: 3000,
+                                               blob_names[2]: 10})
+        out_queue = Queue.Queue()
+        network_step = server.NetworkStepThread(
+            client, list(blob_names),
+            dict([(name, len(blob_dict[name])) for name in blob_names]),
+            Queue.Queue(), out_queue, Queue.Queue(), 1000,
+            segment_digests=delta.get_segment_digests(blob_list),
+            segment_leaves=delta.get_segment_leaves(blob_list))
+        network_step.run()
+        item_list = self._get_items(out_queue)
+        self.assertEqual(item_list[-1], Synthesis_Const.END_OF_FILE)
+        segment_list = ''.join([
+            item if item != Synthesis_Const.END_OF_SEGMENT else "\0|"
+            for item in item_list[:-1]]).split("\0|")[:-1]
+        self.assertEqual(segment_list, [blob_dict[blob_names[0]],
+                                        blob_dict[blob_names[1]],
+                                        blob_dict[blob_names[2]]])
+
+    def test_receive_whole_blob(self):
+        segments = delta.get_overlay_segments(self.blob_list)
+        (request_list, request_size, request_segments) = \
+            server.get_request_segments(self.blob_list)
+        self.assertEqual(request_list, [segment[0] for segment in segments])
+        # client without frame support is asked for the whole blobs
+        (request_list, request_size, request_segments) = \
+            server.get_request_segments(self.blob_list, False)
+        self.assertEqual(request_list, [
+            blob_info[Const.META_OVERLAY_FILE_NAME]
+            for blob_info in self.blob_list])
+        self.assertEqual(request_size, dict([
+            (blob_name, len(data))
+            for (blob_name, data) in self.blob_dict.iteritems()]))
+
+        # frames before the corrupted one are not forwarded again
+        blob_name = request_list[0]
+        frame_list = request_segments[blob_name]
+        self.assertTrue(len(frame_list) > 2)
+        client = _CorruptingClient(self.blob_dict,
+                                   {blob_name: frame_list[1][1] + 10})
+        out_queue = Queue.Queue()
+        network_step = server.NetworkStepThread(
+            client, list(request_list), request_size, Queue.Queue(),
+            out_queue, Queue.Queue(), 1000,
+            stored_segments=set([
+                segment for (segment, comp_type) in
+                delta.get_segment_compression(self.blob_list).iteritems()
+                if comp_type == Const.COMPRESSION_NONE]),
+            segment_digests=delta.get_segment_digests(self.blob_list),
+            request_segments=request_segments)
+        network_step.run()
+        item_list = self._get_items(out_queue)
+        self.assertEqual(item_list[-1], Synthesis_Const.END_OF_FILE)
+        segment_list = ''.join([
+            item if item != Synthesis_Const.END_OF_SEGMENT else "\0|"
+            for item in item_list[:-1]
+            if item != Synthesis_Const.STORED_SEGMENT]).split("\0|")[:-1]
+        self.assertEqual(segment_list, [
+            self.blob_dict[blob_name][offset:offset+size]
+            for (segment_name, blob_name, offset, size) in segments])
+        self.assertEqual(item_list.count(Synthesis_Const.STORED_SEGMENT),
+                         len(network_step.stored_segments))
+
+
+if __name__ == "__main__":
+    unittest.main()
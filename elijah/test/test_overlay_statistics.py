@@ -0,0 +1,160 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import socket
+import struct
+import time
+import Queue
+import msgpack
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning import process_manager
+from elijah.provisioning import stream_client
+from elijah.provisioning import synthesis
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.package import VMOverlayPackage
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import Options
+
+
+class TestOverlayStatistics(unittest.TestCase):
+    CHUNK_SIZE = Const.CHUNK_SIZE
+    ITEM_COUNT = 16
+
+    def setUp(self):
+        super(TestOverlayStatistics, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-stat-")
+        rand = random.Random(1234)
+        self.delta_list = list()
+        for index in xrange(self.ITEM_COUNT):
+            data = ''.join([chr(rand.randint(0, 255))
+                            for i in xrange(self.CHUNK_SIZE)])
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, index*self.CHUNK_SIZE,
+                self.CHUNK_SIZE, None, DeltaItem.REF_RAW, len(data), data))
+        for index in xrange(4):
+            ref_item = self.delta_list[index]
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_DISK, index*self.CHUNK_SIZE, self.CHUNK_SIZE,
+                None, DeltaItem.REF_SELF, 8, ref_item.index))
+        self.delta_list.append(DeltaItem(
+            DeltaItem.DELTA_DISK, 10*self.CHUNK_SIZE, self.CHUNK_SIZE, None,
+            DeltaItem.REF_ZEROS))
+
+    def tearDown(self):
+        super(TestOverlayStatistics, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def test_statistics_in_meta(self):
+        options = Options()
+        meta_path = os.path.join(self.temp_dir, Const.OVERLAY_META)
+        meta_path, blob_files = synthesis.generate_overlayfile(
+            self.delta_list, options, "base-hash", 10*1024*1024, 1024*1024,
+            meta_path, os.path.join(self.temp_dir, Const.OVERLAY_FILE_PREFIX),
+            mem_discarded=3, disk_discarded=2)
+        meta_info = msgpack.unpackb(open(meta_path, "rb").read())
+
+        statistics = meta_info[Const.META_OVERLAY_STATISTICS]
+        item_stats = statistics[Const.META_OVERLAY_STAT_ITEMS]
+        serialized_size = dict()
+        for item in self.delta_list:
+            serialized_size[item.index] = len(item.get_serialized())
+        raw_size = sum(serialized_size.values())
+        memory_raw = item_stats["memory"]["raw"]
+        self.assertEqual(memory_raw[0], self.ITEM_COUNT)
+        self.assertEqual(memory_raw[1], sum(
+            [serialized_size[item.index] for item in
+             self.delta_list[:self.ITEM_COUNT]]))
+        self.assertEqual(item_stats["disk"]["self"][0], 4)
+        self.assertEqual(item_stats["disk"]["zeros"][0], 1)
+        self.assertEqual(statistics[Const.META_OVERLAY_STAT_DISCARDED],
+                         {"memory": 3, "disk": 2})
+        self.assertEqual(statistics[Const.META_OVERLAY_STAT_CREATION_MODE],
+                         options.to_dict())
+
+        blob_list = meta_info[Const.META_OVERLAY_FILES]
+        self.assertEqual(
+            sum([blob[Const.META_OVERLAY_FILE_RAW_SIZE]
+                 for blob in blob_list]), raw_size)
+        for blob, blob_file in zip(blob_list, blob_files):
+            self.assertEqual(blob[Const.META_OVERLAY_FILE_SIZE],
+                             os.path.getsize(blob_file))
+
+        # info is printed from the meta without decompressing blobs
+        overlay_path = os.path.join(self.temp_dir, Const.OVERLAY_ZIP)
+        VMOverlayPackage.create(overlay_path, meta_path, blob_files)
+        output = synthesis.info_vm_overlay(overlay_path)
+        self.assertTrue("memory delta items\t\t: %d" % self.ITEM_COUNT
+                        in output)
+        self.assertTrue("disk delta items\t\t: 5" in output)
+
+        # items of the older overlay are counted from the decompressed one
+        del meta_info[Const.META_OVERLAY_STATISTICS]
+        open(meta_path, "wb").write(msgpack.packb(meta_info))
+        os.unlink(overlay_path)
+        VMOverlayPackage.create(overlay_path, meta_path, blob_files)
+        output = synthesis.info_vm_overlay(overlay_path)
+        self.assertTrue("memory delta items\t\t: %d (%d bytes, 0 discarded)" %
+                        (self.ITEM_COUNT, memory_raw[1]) in output)
+        self.assertTrue("disk delta items\t\t: 5" in output)
+
+    def _recv_header(self, sock):
+        header_size = struct.unpack("!I", self._recv_all(sock, 4))[0]
+        return msgpack.unpackb(self._recv_all(sock, header_size))
+
+    def _recv_all(self, sock, size):
+        data = ''
+        while len(data) < size:
+            data += sock.recv(size - len(data))
+        return data
+
+    def test_statistics_in_stream(self):
+        # statistics of each blob is carried at its header and merged at
+        # the destination into the one of the file path
+        item_stats = dict()
+        compdata_queue = Queue.Queue()
+        half = len(self.delta_list)/2
+        for delta_list in (self.delta_list[:half], self.delta_list[half:]):
+            blob_stats = dict()
+            for item in delta_list:
+                size = len(item.get_serialized())
+                delta.add_item_statistics(item_stats, item, size)
+                delta.add_item_statistics(blob_stats, item, size)
+            compdata_queue.put((Const.COMPRESSION_LZMA, "blob", list(),
+                                list(), 0, blob_stats))
+        compdata_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+
+        (sock, peer) = socket.socketpair()
+        client = stream_client.StreamSynthesisClient(
+            "127.0.0.1", 0, dict(), compdata_queue, send_rate_mbps=None,
+            host_rate_mbps=None)
+        client._stream_blobs(sock, None)
+        self._recv_header(peer)
+        recv_stats = dict()
+        while True:
+            blob_header = self._recv_header(peer)
+            blob_size = blob_header[Const.META_OVERLAY_FILE_SIZE]
+            if blob_size == 0:
+                break
+            self._recv_all(peer, blob_size)
+            delta.merge_item_statistics(
+                recv_stats, blob_header[Const.META_OVERLAY_STAT_ITEMS])
+        peer.sendall(struct.pack("!Qd", 0x10, time.time()))
+        client.receive_thread.join()
+        sock.close()
+        peer.close()
+        # worker is registered at the manager thread by its constructor
+        process_manager.kill_instance()
+        self.assertEqual(recv_stats, item_stats)
+        self.assertEqual(recv_stats["disk"]["self"][0], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import zipfile
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning.package import BaseVMPackage
+from elijah.provisioning.package import PackagingUtil
+from elijah.provisioning.package import BadPackageError
+from elijah.provisioning.package import _MemberImportThread
+from elijah.provisioning.package import _ParallelZipWriter
+
+
+class TestPackageImport(unittest.TestCase):
+    DISK_SIZE = 256*1024 + 1000
+
+    def setUp(self):
+        super(TestPackageImport, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-import-")
+        rand = random.Random(1234)
+        self.disk_data = ''.join(
+            [chr(rand.randint(0, 255)) for i in xrange(self.DISK_SIZE)])
+        self.disk_path = os.path.join(self.temp_dir, "base.raw")
+        open(self.disk_path, "wb").write(self.disk_data)
+        self.zip_path = os.path.join(self.temp_dir, "base.zip")
+        zip = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED, True)
+        zip.write(self.disk_path, "base.raw")
+        zip.close()
+
+    def tearDown(self):
+        super(TestPackageImport, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _import(self, hash_size=None, checksum=None):
+        target_path = os.path.join(self.temp_dir, "imported.raw")
+        import_thread = _MemberImportThread(
+            self.zip_path, "base.raw", target_path, hash_size=hash_size,
+            checksum=checksum, chunk_size=10000)
+        import_thread.start()
+        import_thread.join()
+        return import_thread
+
+    def test_import_member(self):
+        hash_value = disk.hashing(
+            self.disk_path, os.path.join(self.temp_dir, "base.raw-meta"))
+        import_thread = self._import(
+            PackagingUtil._get_disk_hash_size(self.DISK_SIZE))
+        self.assertEqual(import_thread.exception, None)
+        self.assertEqual(open(import_thread.target_path, "rb").read(),
+                         self.disk_data)
+        self.assertEqual(import_thread.hash_value, hash_value)
+
+    def test_corrupted_member(self):
+        # flip a byte in the stored member
+        zip = zipfile.ZipFile(self.zip_path, 'r')
+        info = zip.getinfo("base.raw")
+        zip.close()
+        zip_data = bytearray(open(self.zip_path, "rb").read())
+        zip_data[info.header_offset + 30 + len("base.raw") + 100] ^= 0xff
+        open(self.zip_path, "wb").write(zip_data)
+
+        import_thread = self._import()
+        self.assertTrue(isinstance(import_thread.exception, BadPackageError))
+
+    def test_parallel_zip(self):
+        # blocks deflated in parallel make a single deflated member
+        zip_path = os.path.join(self.temp_dir, "parallel.zip")
+        empty_path = os.path.join(self.temp_dir, "empty")
+        open(empty_path, "wb").close()
+        writer = _ParallelZipWriter(zip_path, comment="comment",
+                                    num_threads=4, block_size=10000)
+        size, checksum = writer.write(self.disk_path, "base.raw")
+        writer.write(empty_path, "empty")
+        writer.writestr("manifest", "manifest data")
+        writer.close()
+        self.assertEqual(size, self.DISK_SIZE)
+        self.assertEqual(checksum, sha256(self.disk_data).hexdigest())
+
+        zip = zipfile.ZipFile(zip_path, 'r')
+        self.assertEqual(zip.testzip(), None)
+        self.assertEqual(zip.comment, "comment")
+        self.assertEqual(zip.namelist(), ["base.raw", "empty", "manifest"])
+        self.assertEqual(zip.read("base.raw"), self.disk_data)
+        self.assertEqual(zip.read("empty"), '')
+        self.assertEqual(zip.read("manifest"), "manifest data")
+        zip.close()
+
+    def test_parallel_zip64(self):
+        # lower the limit so that zip64 records are written for small files
+        class _SmallLimitWriter(_ParallelZipWriter):
+            ZIP64_LIMIT = 1000
+
+        zip_path = os.path.join(self.temp_dir, "parallel64.zip")
+        writer = _SmallLimitWriter(zip_path, num_threads=4,
+                                   block_size=10000)
+        writer.write(self.disk_path, "base.raw")
+        writer.writestr("manifest", "manifest data")
+        writer.close()
+
+        zip = zipfile.ZipFile(zip_path, 'r')
+        self.assertEqual(zip.testzip(), None)
+        self.assertEqual(zip.read("base.raw"), self.disk_data)
+        self.assertEqual(zip.read("manifest"), "manifest data")
+        zip.close()
+
+    def test_create_package(self):
+        filelist = list()
+        for name in ("base.mem", "base.raw-meta", "base.mem-meta"):
+            path = os.path.join(self.temp_dir, name)
+            open(path, "wb").write(name * 1000)
+            filelist.append(path)
+        package_path = os.path.join(self.temp_dir, "package.zip")
+        BaseVMPackage.create(package_path, "hashvalue", self.disk_path,
+                             *filelist)
+
+        (hash_value, disk_name, memory_name, diskhash_name, memoryhash_name,
+         checksums, simindex_names) = \
+            PackagingUtil._get_basevm_attribute(package_path)
+        self.assertEqual(hash_value, "hashvalue")
+        self.assertEqual(
+            [disk_name, memory_name, diskhash_name, memoryhash_name],
+            [os.path.basename(path) for path in [self.disk_path] + filelist])
+        self.assertEqual(simindex_names, [None, None])
+        self.assertEqual(checksums[disk_name],
+                         sha256(self.disk_data).hexdigest())
+
+        # member not matching the checksum in the manifest
+        self.zip_path = package_path
+        import_thread = self._import(checksum=checksums[disk_name])
+        self.assertEqual(import_thread.exception, None)
+        import_thread = self._import(checksum=checksums[memory_name])
+        self.assertTrue(isinstance(import_thread.exception, BadPackageError))
+
+    def test_create_package_simindex(self):
+        filelist = list()
+        for name in ("base.mem", "base.raw-meta", "base.mem-meta",
+                     "base.raw.simindex", "base.mem.simindex"):
+            path = os.path.join(self.temp_dir, name)
+            open(path, "wb").write(name * 1000)
+            filelist.append(path)
+        package_path = os.path.join(self.temp_dir, "package.zip")
+        BaseVMPackage.create(package_path, "hashvalue", self.disk_path,
+                             *filelist[:3], disk_simindex=filelist[3],
+                             memory_simindex=filelist[4])
+
+        attributes = PackagingUtil._get_basevm_attribute(package_path)
+        (checksums, simindex_names) = attributes[-2:]
+        self.assertEqual(simindex_names,
+                         ["base.raw.simindex", "base.mem.simindex"])
+        for path in filelist[3:]:
+            self.assertEqual(checksums[os.path.basename(path)],
+                             sha256(open(path, "rb").read()).hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import struct
+from tempfile import mkdtemp
+
+from elijah.provisioning import memory
+from elijah.provisioning.memory import Memory
+from elijah.provisioning.memory import MemoryDiffProc
+from elijah.provisioning.memory import PageBuffer
+from elijah.test.util import random_data
+
+
+class TestPageBuffer(unittest.TestCase):
+    CHUNK_SIZE = Memory.CHUNK_HEADER_SIZE + Memory.RAM_PAGE_SIZE
+    PAGE_COUNT = 10
+
+    def setUp(self):
+        super(TestPageBuffer, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-pagebuffer-")
+        self.rand = random.Random(1234)
+        self.pages = list()
+        snapshot = ""
+        for index in xrange(self.PAGE_COUNT):
+            page = random_data(self.rand, Memory.RAM_PAGE_SIZE)
+            header = struct.pack(Memory.CHUNK_HEADER_FMT,
+                                 index*Memory.RAM_PAGE_SIZE)
+            self.pages.append((index*Memory.RAM_PAGE_SIZE, page))
+            snapshot += header + page
+        self.snapshot = snapshot
+
+    def tearDown(self):
+        super(TestPageBuffer, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def test_read_whole_chunks(self):
+        # data read with the header is not aligned with the chunk
+        head_size = self.CHUNK_SIZE + 100
+        trailer = "LibvirtQemudSave"
+        snapshot_path = os.path.join(self.temp_dir, "snapshot")
+        open(snapshot_path, "wb").write(self.snapshot[head_size:] + trailer)
+
+        read_buffer = PageBuffer(3)
+        read_buffer.write(self.snapshot[:head_size])
+        data_list = list()
+        with open(snapshot_path, "rb") as fin:
+            while read_buffer.readinto(fin) > 0:
+                if read_buffer.is_full():
+                    data_list.append(read_buffer.pop())
+        data_list.append(read_buffer.pop())
+        for data in data_list[:-1]:
+            self.assertEqual(len(data), 3*self.CHUNK_SIZE)
+        self.assertEqual(''.join(data_list), self.snapshot + trailer)
+
+        data_list[-1] = data_list[-1][:-len(trailer)]
+        self.assertEqual(list(MemoryDiffProc._iter_pages(data_list)),
+                         self.pages)
+
+    def test_buffer_overflow(self):
+        read_buffer = PageBuffer(1)
+        self.assertRaises(memory.MemoryError, read_buffer.write,
+                          self.snapshot[:self.CHUNK_SIZE+1])
+
+
+if __name__ == "__main__":
+    unittest.main()
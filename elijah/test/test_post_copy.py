@@ -0,0 +1,146 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import Queue
+import random
+import shutil
+from hashlib import sha256
+from tempfile import mkdtemp
+
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import PostCopyScheduler
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.stream_server import RecoverDeltaProc
+from elijah.test.util import random_data
+
+
+class TestPostCopy(unittest.TestCase):
+    CHUNK_SIZE = Const.CHUNK_SIZE
+    CHUNK_COUNT = 8
+
+    def setUp(self):
+        super(TestPostCopy, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-postcopy-")
+        self.rand = random.Random(1234)
+        self.base_disk = os.path.join(self.temp_dir, "base-disk")
+        self.base_mem = os.path.join(self.temp_dir, "base-mem")
+        for path in [self.base_disk, self.base_mem]:
+            open(path, "wb").write(
+                random_data(self.rand, self.CHUNK_SIZE*self.CHUNK_COUNT))
+        self.working_set = [DeltaItem.get_index(DeltaItem.DELTA_MEMORY,
+                                                chunk*self.CHUNK_SIZE)
+                            for chunk in [0, 1]]
+
+    def tearDown(self):
+        super(TestPostCopy, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _raw_item(self, delta_type, chunk, data, live_seq=0):
+        return DeltaItem(delta_type, chunk*self.CHUNK_SIZE, len(data),
+                         sha256(data).digest(), DeltaItem.REF_RAW,
+                         len(data), data, live_seq=live_seq)
+
+    def _chunks(self, deltaitem_list):
+        return [(item.delta_type, item.offset/self.CHUNK_SIZE)
+                for item in deltaitem_list]
+
+    def test_scheduler(self):
+        mem_2 = random_data(self.rand, self.CHUNK_SIZE)
+        mem_3 = random_data(self.rand, self.CHUNK_SIZE)
+        mem_4 = random_data(self.rand, self.CHUNK_SIZE)
+        self_ref_item = DeltaItem(
+            DeltaItem.DELTA_MEMORY, 0, self.CHUNK_SIZE, sha256(mem_3).digest(),
+            DeltaItem.REF_SELF_HASH, 32, sha256(mem_3).digest())
+        scheduler = PostCopyScheduler(self.working_set)
+        deltaitem_list = scheduler.schedule_deltalist([
+            self._raw_item(DeltaItem.DELTA_DISK, 5, mem_2),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 2, mem_2, 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 3, mem_3, 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 4, mem_2, 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 2, mem_4, 2),
+        ])
+        self.assertEqual(self._chunks(deltaitem_list),
+                         [(DeltaItem.DELTA_DISK, 5)])
+        # reference to the held back page is sent before the item
+        deltaitem_list = scheduler.schedule_deltalist([self_ref_item])
+        self.assertEqual(self._chunks(deltaitem_list),
+                         [(DeltaItem.DELTA_MEMORY_LIVE, 3),
+                          (DeltaItem.DELTA_MEMORY, 0)])
+        self.assertEqual(
+            scheduler.resume_chunks[DeltaItem.get_index(
+                DeltaItem.DELTA_MEMORY, 2*self.CHUNK_SIZE)],
+            [2, 2*self.CHUNK_SIZE, self.CHUNK_SIZE, 1])
+        self.assertEqual(len(scheduler.resume_chunks), 5)
+
+        # demanded page first, and every version of a page
+        deltaitem_list = scheduler.pop_deferred_deltalist(
+            [DeltaItem.get_index(DeltaItem.DELTA_MEMORY, 4*self.CHUNK_SIZE)],
+            2)
+        self.assertEqual(self._chunks(deltaitem_list),
+                         [(DeltaItem.DELTA_MEMORY_LIVE, 4),
+                          (DeltaItem.DELTA_MEMORY_LIVE, 2),
+                          (DeltaItem.DELTA_MEMORY_LIVE, 2)])
+        # held back items are read back from the spill file
+        self.assertEqual([(item.data, item.hash_value, item.live_seq)
+                          for item in deltaitem_list],
+                         [(data, sha256(data).digest(), live_seq)
+                          for (data, live_seq) in
+                          [(mem_2, 1), (mem_2, 1), (mem_4, 2)]])
+        self.assertFalse(scheduler.has_deferred())
+        scheduler.close()
+
+    def test_recover(self):
+        launch_mem = os.path.join(self.temp_dir, "launch-mem")
+        launch_disk = os.path.join(self.temp_dir, "launch-disk")
+        decomp_queue = Queue.Queue()
+        fuse_info_queue = Queue.Queue()
+        delta_proc = RecoverDeltaProc(self.base_disk, self.base_mem,
+                                      decomp_queue, launch_mem, launch_disk,
+                                      self.CHUNK_SIZE, fuse_info_queue,
+                                      Queue.Queue(), post_copy=True)
+        data_list = [random_data(self.rand, self.CHUNK_SIZE)
+                     for i in xrange(5)]
+        scheduler = PostCopyScheduler(self.working_set)
+        early_list = scheduler.schedule_deltalist([
+            self._raw_item(DeltaItem.DELTA_MEMORY, 0, data_list[0]),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 1, data_list[1], 1),
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 2, data_list[2], 1),
+            self._raw_item(DeltaItem.DELTA_DISK, 3, data_list[3]),
+        ])
+        early_list += scheduler.schedule_deltalist([
+            self._raw_item(DeltaItem.DELTA_MEMORY_LIVE, 1, data_list[4], 2),
+        ])
+        deferred_list = scheduler.pop_deferred_deltalist(list(), 10)
+        self.assertEqual(self._chunks(deferred_list),
+                         [(DeltaItem.DELTA_MEMORY_LIVE, 2)])
+
+        # disk chunk and the latest memory chunk 1 arrive after resuming
+        decomp_queue.put(''.join(
+            [item.get_serialized() for item in early_list[:2]]))
+        decomp_queue.put((Const.QUEUE_POST_COPY_MESSAGE,
+                          scheduler.resume_chunks))
+        decomp_queue.put(''.join(
+            [item.get_serialized() for item in early_list[2:]]))
+        decomp_queue.put(''.join(
+            [item.get_serialized() for item in deferred_list]))
+        decomp_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        delta_proc.recover_deltaitem()
+
+        self.assertEqual(fuse_info_queue.get(), ("3:0", "0:1,1:0,2:0"))
+        self.assertEqual(fuse_info_queue.get(), ["1:3", "2:1"])
+        self.assertEqual(fuse_info_queue.get(), ["2:2"])
+        self.assertEqual(fuse_info_queue.get(), Const.QUEUE_SUCCESS_MESSAGE)
+        recovered_mem = open(launch_mem, "rb").read()
+        for chunk, data in [(0, data_list[0]), (1, data_list[4]),
+                            (2, data_list[2])]:
+            self.assertEqual(recovered_mem[chunk*self.CHUNK_SIZE:
+                                           (chunk+1)*self.CHUNK_SIZE], data)
+        delta_proc.finish()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import json
+import shutil
+import socket
+import threading
+import time
+from tempfile import mkdtemp
+
+from elijah.provisioning import qmp_af_unix
+from elijah.provisioning.qmp_af_unix import QmpAfUnix
+
+
+class StubQmpServer(threading.Thread):
+    """QMP channel of QEMU. Response of a command in delayed_commands is
+    sent after the response of the next command.
+    """
+
+    def __init__(self, sock_path, delayed_commands=()):
+        self.sock_path = sock_path
+        self.delayed_commands = delayed_commands
+        self.commands = list()
+        self.conn = None
+        self.connected = threading.Event()
+        # STOP event can be lost
+        self.send_stop_event = True
+        self.server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_sock.bind(sock_path)
+        self.server_sock.listen(1)
+        super(StubQmpServer, self).__init__(target=self.serve)
+        self.daemon = True
+
+    def send(self, message):
+        self.conn.sendall(json.dumps(message) + "\r\n")
+
+    def send_event(self, event_name, seconds=0, data=None):
+        message = {"event": event_name,
+                   "timestamp": {"seconds": seconds, "microseconds": 500000}}
+        if data is not None:
+            message["data"] = data
+        self.send(message)
+
+    def serve(self):
+        self.conn, addr = self.server_sock.accept()
+        self.connected.set()
+        self.send({"QMP": {"version": {}, "capabilities": []}})
+        decoder = json.JSONDecoder()
+        buf = ''
+        delayed_list = list()
+        while True:
+            data = self.conn.recv(1024)
+            if not data:
+                break
+            buf += data
+            while True:
+                try:
+                    request, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                command = request["execute"]
+                self.commands.append(command)
+                if command in self.delayed_commands:
+                    delayed_list.append(request)
+                    continue
+                if command == "unknown-command":
+                    self.send({"error": {"class": "CommandNotFound"},
+                               "id": request["id"]})
+                else:
+                    self.send({"return": {}, "id": request["id"]})
+                for delayed_request in delayed_list:
+                    self.send({"return": {}, "id": delayed_request["id"]})
+                del delayed_list[:]
+                if command == "stop-raw-live" and self.send_stop_event:
+                    self.send_event(QmpAfUnix.EVENT_STOP, seconds=100)
+        self.conn.close()
+        self.server_sock.close()
+
+
+class TestQmpAfUnix(unittest.TestCase):
+
+    def setUp(self):
+        super(TestQmpAfUnix, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-qmp-")
+        self.qmp_path = os.path.join(self.temp_dir, "qmp")
+
+    def tearDown(self):
+        super(TestQmpAfUnix, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _connect(self, delayed_commands=()):
+        server = StubQmpServer(self.qmp_path, delayed_commands)
+        server.start()
+        qmp = QmpAfUnix(self.qmp_path)
+        qmp.connect()
+        self.assertTrue(qmp.qmp_negotiate())
+        return server, qmp
+
+    def test_pipelined_commands(self):
+        server, qmp = self._connect(delayed_commands=["iterate-raw-live"])
+        # response of the first command arrives after the second one
+        iterate_request = qmp.iterate_raw_live(wait=False)
+        self.assertFalse(iterate_request.done())
+        randomize_request = qmp.execute("randomize-raw-live")
+        self.assertTrue(randomize_request.is_success(timeout=5))
+        self.assertTrue(iterate_request.is_success(timeout=5))
+        self.assertNotEqual(iterate_request.request_id,
+                            randomize_request.request_id)
+        self.assertFalse(qmp.execute("unknown-command").is_success(timeout=5))
+        qmp.disconnect()
+        server.join(5)
+        self.assertEqual(server.commands,
+                         ["qmp_capabilities", "iterate-raw-live",
+                          "randomize-raw-live", "unknown-command"])
+
+    def test_event_subscription(self):
+        server, qmp = self._connect()
+        received = list()
+        qmp.subscribe(QmpAfUnix.EVENT_MIGRATION, received.append)
+        server.send_event(QmpAfUnix.EVENT_RESUME)
+        server.send_event(QmpAfUnix.EVENT_MIGRATION,
+                          data={"status": "active"})
+        event = qmp.wait_event(QmpAfUnix.EVENT_RESUME, timeout=5)
+        self.assertEqual(event["event"], QmpAfUnix.EVENT_RESUME)
+        event = qmp.wait_event(QmpAfUnix.EVENT_MIGRATION, timeout=5)
+        self.assertEqual(event["data"]["status"], "active")
+        self.assertEqual(received, [event])
+        self.assertEqual(qmp.wait_event(QmpAfUnix.EVENT_STOP, timeout=0.1),
+                         None)
+
+        # stop_raw_live returns the time stamp of STOP event
+        self.assertEqual(qmp.stop_raw_live(timeout=5), 100.5)
+        # lost STOP event does not block the handoff
+        server.send_stop_event = False
+        self.assertEqual(qmp.stop_raw_live(timeout=0.1), None)
+        qmp.disconnect()
+        server.join(5)
+
+    def test_disconnection(self):
+        server, qmp = self._connect(delayed_commands=["iterate-raw-live"])
+        request = qmp.iterate_raw_live(wait=False)
+        server.connected.wait()
+        server.conn.shutdown(socket.SHUT_RDWR)
+        # pending request and event wait do not block after disconnection
+        self.assertEqual(request.wait(timeout=5), None)
+        self.assertEqual(qmp.wait_event(QmpAfUnix.EVENT_STOP), None)
+        self.assertRaises(qmp_af_unix.QmpError, qmp.execute,
+                          "iterate-raw-live")
+        self.assertFalse(qmp.randomize_raw_live())
+        qmp.disconnect()
+        server.join(5)
+
+
+if __name__ == "__main__":
+    unittest.main()
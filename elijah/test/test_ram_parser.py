@@ -0,0 +1,186 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import struct
+import zlib
+from tempfile import mkdtemp
+
+from elijah.provisioning import memory
+from elijah.provisioning.memory_util import _QemuMemoryHeader
+from elijah.provisioning.memory_util import _QemuRamParser
+from elijah.provisioning.memory_util import MachineGenerationError
+from elijah.test.util import random_data
+
+
+class _Stream(object):
+    # stream that cannot seek such as a pipe
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        data = self.data[self.offset:self.offset+size]
+        self.offset += len(data)
+        return data
+
+
+class TestRamParser(unittest.TestCase):
+    PAGE_SIZE = _QemuRamParser.PAGE_SIZE
+    P = _QemuRamParser
+
+    def setUp(self):
+        super(TestRamParser, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-ramparser-")
+        self.rand = random.Random(1234)
+        # vga block is listed before pc.ram
+        self.block_list = [("vga.vram", 2*self.PAGE_SIZE),
+                           ("pc.ram", 6*self.PAGE_SIZE),
+                           ("pc.rom", 1*self.PAGE_SIZE)]
+
+    def tearDown(self):
+        super(TestRamParser, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _libvirt_header(self):
+        xml_len = 2*self.PAGE_SIZE - _QemuMemoryHeader.HEADER_LENGTH
+        header = [_QemuMemoryHeader.HEADER_MAGIC,
+                  _QemuMemoryHeader.HEADER_VERSION, xml_len, 1, 0]
+        header.extend([0] * _QemuMemoryHeader.HEADER_UNUSED_VALUES)
+        return struct.pack(_QemuMemoryHeader.HEADER_FORMAT, *header) + \
+            "<domain/>".ljust(xml_len, "\0")
+
+    def _string(self, value):
+        return chr(len(value)) + value
+
+    def _section(self, section_type, section_id, name=None):
+        data = chr(section_type) + struct.pack(">I", section_id)
+        if name is not None:
+            data += self._string(name) + struct.pack(">II", 0, 4)
+        return data
+
+    def _ram_start(self):
+        # block section without block migration, and RAM block list
+        data = struct.pack(">II", self.P.VM_FILE_MAGIC,
+                           self.P.VM_FILE_VERSION)
+        data += self._section(self.P.VM_SECTION_START, 1, "block")
+        data += struct.pack(">Q", self.P.BLK_MIG_FLAG_EOS)
+        data += self._section(self.P.VM_SECTION_START, 2, "ram")
+        total_length = sum([length for (name, length) in self.block_list])
+        data += struct.pack(">Q", total_length | self.P.RAM_SAVE_FLAG_MEM_SIZE)
+        for (name, length) in self.block_list:
+            data += self._string(name) + struct.pack(">Q", length)
+        return data
+
+    def _page(self, addr, flags, name=None):
+        data = struct.pack(">Q", addr | flags)
+        if name is not None:
+            data += self._string(name)
+        return data
+
+    def test_raw_blocks(self):
+        snapshot = self._libvirt_header() + self._ram_start()
+        block_data = dict()
+        block_offset = dict()
+        for (name, length) in self.block_list:
+            snapshot += self._page(0, self.P.RAM_SAVE_FLAG_RAW, name)
+            snapshot += "\0" * (self.PAGE_SIZE -
+                                 len(snapshot) % self.PAGE_SIZE)
+            block_offset[name] = len(snapshot)
+            block_data[name] = random_data(self.rand, length)
+            snapshot += block_data[name]
+        end_offset = len(snapshot)
+        snapshot += self._section(self.P.VM_SECTION_FULL, 3, "timer")
+
+        parser = _QemuRamParser(_Stream(snapshot))
+        header = parser.read_libvirt_header()
+        self.assertEqual(header.xml.rstrip("\0"), "<domain/>")
+        recovered = dict()
+        for (block, addr, file_offset, data) in parser.iter_pages():
+            self.assertEqual(snapshot[file_offset:file_offset+len(data)],
+                             data)
+            recovered[block.name] = recovered.get(block.name, "") + data
+        self.assertEqual(recovered, block_data)
+        self.assertEqual(parser.end_offset, end_offset)
+        self.assertEqual(parser.get_main_block().name, "pc.ram")
+        for (name, length) in self.block_list:
+            self.assertEqual(parser.blocks[name].offset, block_offset[name])
+
+        # snapshot file is parsed skipping the raw blocks
+        snapshot_path = os.path.join(self.temp_dir, "snapshot")
+        open(snapshot_path, "wb").write(snapshot)
+        with open(snapshot_path, "rb") as fin:
+            memory.Memory._check_libvirt_header(fin)
+            ram_end_offset, parser = memory.Memory._seek_to_end_of_ram(fin)
+            self.assertEqual(ram_end_offset, end_offset)
+            self.assertEqual(fin.tell(), end_offset)
+        self.assertEqual(parser.get_main_block().offset,
+                         block_offset["pc.ram"])
+
+    def test_page_records(self):
+        pages = [random_data(self.rand, self.PAGE_SIZE) for i in xrange(4)]
+        # first iteration: pages of pc.ram continued from the first one,
+        # zero page, compressed page and the other block
+        snapshot = self._libvirt_header() + self._ram_start()
+        snapshot += self._page(0, self.P.RAM_SAVE_FLAG_PAGE, "pc.ram")
+        snapshot += pages[0]
+        snapshot += self._page(
+            self.PAGE_SIZE, self.P.RAM_SAVE_FLAG_PAGE |
+            self.P.RAM_SAVE_FLAG_CONTINUE) + pages[1]
+        snapshot += self._page(
+            2*self.PAGE_SIZE, self.P.RAM_SAVE_FLAG_ZERO |
+            self.P.RAM_SAVE_FLAG_CONTINUE) + "\0"
+        comp_page = zlib.compress(pages[2])
+        snapshot += self._page(
+            3*self.PAGE_SIZE, self.P.RAM_SAVE_FLAG_COMPRESS_PAGE |
+            self.P.RAM_SAVE_FLAG_CONTINUE) + \
+            struct.pack(">I", len(comp_page)) + comp_page
+        snapshot += self._page(self.PAGE_SIZE, self.P.RAM_SAVE_FLAG_ZERO,
+                               "vga.vram") + chr(0xff)
+        snapshot += self._page(0, self.P.RAM_SAVE_FLAG_EOS)
+        # last iteration sends the page changed again
+        snapshot += self._section(self.P.VM_SECTION_PART, 1)
+        snapshot += struct.pack(">Q", self.P.BLK_MIG_FLAG_EOS)
+        snapshot += self._section(self.P.VM_SECTION_END, 2)
+        snapshot += self._page(self.PAGE_SIZE, self.P.RAM_SAVE_FLAG_PAGE,
+                               "pc.ram") + pages[3]
+        snapshot += self._page(0, self.P.RAM_SAVE_FLAG_EOS)
+        end_offset = len(snapshot)
+        snapshot += self._section(self.P.VM_SECTION_FULL, 3, "timer")
+
+        parser = _QemuRamParser(_Stream(snapshot))
+        parser.read_libvirt_header()
+        ram = dict()
+        for (block, addr, file_offset, data) in parser.iter_pages():
+            ram[(block.name, addr)] = data
+        self.assertEqual(ram, {
+            ("pc.ram", 0): pages[0],
+            ("pc.ram", self.PAGE_SIZE): pages[3],
+            ("pc.ram", 2*self.PAGE_SIZE): "\0"*self.PAGE_SIZE,
+            ("pc.ram", 3*self.PAGE_SIZE): pages[2],
+            ("vga.vram", self.PAGE_SIZE): chr(0xff)*self.PAGE_SIZE,
+        })
+        self.assertEqual(parser.end_offset, end_offset)
+        self.assertEqual(parser.get_main_block().offset, None)
+
+    def test_invalid_stream(self):
+        snapshot = self._libvirt_header() + self._ram_start()
+        # continued page at the start, unknown block, and truncated page
+        for record in [
+                self._page(0, self.P.RAM_SAVE_FLAG_PAGE |
+                           self.P.RAM_SAVE_FLAG_CONTINUE),
+                self._page(0, self.P.RAM_SAVE_FLAG_PAGE, "pc.bios"),
+                self._page(0, self.P.RAM_SAVE_FLAG_PAGE, "pc.ram") + "\0"]:
+            parser = _QemuRamParser(_Stream(snapshot + record))
+            parser.read_libvirt_header()
+            self.assertRaises(MachineGenerationError, list,
+                              parser.iter_pages())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+import stat
+import time
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaList
+from elijah.provisioning.recovery_pool import RecoveryContextPool
+from elijah.provisioning.recovery_pool import RecoveryPoolError
+from elijah.test.util import random_data
+
+
+class TestRecoveryPool(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 8
+
+    def setUp(self):
+        super(TestRecoveryPool, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-recoverypool-")
+        self.rand = random.Random(1234)
+        self.base_disk = os.path.join(self.temp_dir, "base-disk")
+        self.base_mem = os.path.join(self.temp_dir, "base-mem")
+        self.base_disk_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        self.base_mem_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        open(self.base_disk, "wb").write(self.base_disk_data)
+        open(self.base_mem, "wb").write(self.base_mem_data)
+        self.pool = RecoveryContextPool(min_size=1, max_size=4, horizon=10,
+                                        background=False)
+        self.pool.register(self.base_disk, self.base_mem)
+
+    def tearDown(self):
+        super(TestRecoveryPool, self).tearDown()
+        self.pool.close()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _set_interval(self, interval):
+        # averaged interval of the requests, as if they came at that rate
+        self.pool.rate_dict[self.base_disk] = [time.time(), interval]
+
+    def test_context(self):
+        self.assertEqual(self.pool.get_state()[self.base_disk],
+                         {"ready": 1, "target": 1, "interval": None})
+        context = self.pool.get(self.base_disk)
+        for path in (context.overlay_pipe, context.fuse_pipe):
+            self.assertTrue(stat.S_ISFIFO(os.stat(path).st_mode))
+        for path in (context.launch_disk, context.launch_mem):
+            self.assertEqual(os.path.getsize(path), 0)
+        (raw_disk, raw_mem) = context.base_mappings
+        self.assertEqual(raw_disk[:], self.base_disk_data)
+        self.assertEqual(raw_mem[:], self.base_mem_data)
+
+        # contexts of the base VM share its mapping, not the files
+        other_context = self.pool.get(self.base_disk)
+        self.assertTrue(other_context.base_mappings is context.base_mappings)
+        self.assertNotEqual(other_context.temp_dir, context.temp_dir)
+        context.close()
+        self.assertFalse(os.path.exists(context.temp_dir))
+        self.assertTrue(os.path.exists(other_context.overlay_pipe))
+        other_context.close()
+        self.assertRaises(RecoveryPoolError, self.pool.get, self.base_mem)
+
+    def test_target_size(self):
+        self._set_interval(2.5)
+        self.pool.get(self.base_disk).close()
+        state = self.pool.get_state()[self.base_disk]
+        self.assertEqual(state["ready"], state["target"])
+        self.assertTrue(1 < state["target"] <= 4)
+
+        # burst of requests is capped at the max size
+        self._set_interval(0.01)
+        self.pool.get(self.base_disk).close()
+        self.assertEqual(self.pool.get_state()[self.base_disk]["ready"], 4)
+
+        # contexts beyond the target are closed once the requests slow down
+        temp_dirs = [context.temp_dir for context in
+                     self.pool.context_dict[self.base_disk]]
+        self._set_interval(100)
+        self.pool.get(self.base_disk).close()
+        self.assertEqual(self.pool.get_state()[self.base_disk]["ready"], 1)
+        self.assertEqual(len([path for path in temp_dirs
+                              if os.path.exists(path)]), 1)
+
+        self.pool.close()
+        self.assertEqual(self.pool.get_state(), dict())
+        for path in temp_dirs:
+            self.assertFalse(os.path.exists(path))
+
+    def test_recover(self):
+        mem_1 = random_data(self.rand, self.CHUNK_SIZE)
+        delta_list = [
+            DeltaItem(DeltaItem.DELTA_MEMORY, self.CHUNK_SIZE,
+                      self.CHUNK_SIZE, None, DeltaItem.REF_RAW,
+                      len(mem_1), mem_1),
+            DeltaItem(DeltaItem.DELTA_MEMORY, 2*self.CHUNK_SIZE,
+                      self.CHUNK_SIZE, None, DeltaItem.REF_BASE_MEM, 8,
+                      5*self.CHUNK_SIZE),
+            DeltaItem(DeltaItem.DELTA_DISK, 0, self.CHUNK_SIZE, None,
+                      DeltaItem.REF_BASE_DISK, 8, 3*self.CHUNK_SIZE),
+        ]
+        overlay_path = os.path.join(self.temp_dir, "overlay")
+        DeltaList.tofile(delta_list, overlay_path)
+
+        # recoveries one after another read the base from the same mapping
+        for index in xrange(2):
+            context = self.pool.get(self.base_disk)
+            delta_proc = delta.Recovered_delta(
+                self.base_disk, self.base_mem, overlay_path,
+                context.launch_mem, len(self.base_mem_data),
+                context.launch_disk, len(self.base_disk_data),
+                self.CHUNK_SIZE,
+                out_pipename=os.path.join(self.temp_dir, "pipe"),
+                base_mappings=context.base_mappings)
+            delta_proc.run()
+            recovered_mem = open(context.launch_mem, "rb").read()
+            recovered_disk = open(context.launch_disk, "rb").read()
+            self.assertEqual(
+                recovered_mem[self.CHUNK_SIZE:3*self.CHUNK_SIZE],
+                mem_1 + self.base_mem_data[5*self.CHUNK_SIZE:
+                                           6*self.CHUNK_SIZE])
+            self.assertEqual(
+                recovered_disk[:self.CHUNK_SIZE],
+                self.base_disk_data[3*self.CHUNK_SIZE:4*self.CHUNK_SIZE])
+            context.close()
+        (raw_disk, raw_mem) = context.base_mappings
+        self.assertEqual(raw_mem[:self.CHUNK_SIZE],
+                         self.base_mem_data[:self.CHUNK_SIZE])
+
+
+if __name__ == "__main__":
+    unittest.main()
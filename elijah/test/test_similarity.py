@@ -0,0 +1,156 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+import random
+import shutil
+from tempfile import mkdtemp
+
+from elijah.provisioning import delta
+from elijah.provisioning import similarity
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaList
+from elijah.provisioning.similarity import SimilarityIndex
+from elijah.test.util import random_data
+
+
+class TestSimilarity(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 8
+
+    def setUp(self):
+        super(TestSimilarity, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-similarity-")
+        self.rand = random.Random(1234)
+        self.base_disk = os.path.join(self.temp_dir, "base-disk")
+        self.base_mem = os.path.join(self.temp_dir, "base-mem")
+        self.base_disk_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        self.base_mem_data = random_data(self.rand, 
+            self.CHUNK_SIZE*self.CHUNK_COUNT)
+        open(self.base_disk, "wb").write(self.base_disk_data)
+        open(self.base_mem, "wb").write(self.base_mem_data)
+
+    def tearDown(self):
+        super(TestSimilarity, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _base_chunk(self, index):
+        return self.base_mem_data[index*self.CHUNK_SIZE:
+                                  (index+1)*self.CHUNK_SIZE]
+
+    def _modified_chunk(self, index):
+        # base chunk with a few bytes changed
+        data = bytearray(self._base_chunk(index))
+        data[100:116] = random_data(self.rand, 16)
+        return str(data)
+
+    def test_super_features(self):
+        # chunk without enough distinct words is not summarized
+        self.assertEqual(SimilarityIndex.super_features(
+            chr(0x00) * self.CHUNK_SIZE), None)
+        self.assertEqual(SimilarityIndex.super_features(''), None)
+
+        sf_list = SimilarityIndex.super_features(self._base_chunk(3))
+        self.assertEqual(len(sf_list), SimilarityIndex.NUM_SUPER_FEATURES)
+        self.assertEqual(sf_list,
+                         SimilarityIndex.super_features(self._base_chunk(3)))
+        # slightly modified chunk shares a super-feature, but other chunk
+        # does not
+        self.assertTrue(set(sf_list) & set(SimilarityIndex.super_features(
+            self._modified_chunk(3))))
+        self.assertFalse(set(sf_list) & set(SimilarityIndex.super_features(
+            self._base_chunk(4))))
+
+    def test_index_file(self):
+        index = SimilarityIndex.build(self.base_mem, self.CHUNK_SIZE)
+        self.assertEqual(len(index),
+                         self.CHUNK_COUNT*SimilarityIndex.NUM_SUPER_FEATURES)
+        self.assertEqual(index.find(self._modified_chunk(3)),
+                         3*self.CHUNK_SIZE)
+        self.assertEqual(index.find(self._modified_chunk(3),
+                                    exclude_offset=3*self.CHUNK_SIZE), None)
+
+        index.tofile(similarity.get_index_path(self.base_mem))
+        loaded = SimilarityIndex.load(self.base_mem, self.CHUNK_SIZE)
+        item_list = list(index.iteritems())
+        self.assertEqual(list(loaded.iteritems()), item_list)
+        # records are sorted by super-feature for bisect
+        self.assertEqual(sorted(item_list), item_list)
+        self.assertEqual(loaded.find(self._modified_chunk(3)),
+                         3*self.CHUNK_SIZE)
+        self.assertEqual(loaded.get(item_list[-1][0] + 1), None)
+
+        # first chunk is kept for the super-feature shared by chunks
+        index.add(self._base_chunk(3), 7*self.CHUNK_SIZE)
+        self.assertEqual(list(index.iteritems()), item_list)
+        # index of other chunk size or broken index is not used
+        self.assertEqual(SimilarityIndex.load(self.base_mem, 512), None)
+        open(similarity.get_index_path(self.base_mem), "r+b").write("0")
+        self.assertEqual(SimilarityIndex.load(self.base_mem,
+                                              self.CHUNK_SIZE), None)
+        self.assertEqual(SimilarityIndex.load(self.base_disk,
+                                              self.CHUNK_SIZE), None)
+
+    def test_diff_with_similar(self):
+        index = SimilarityIndex.build(self.base_mem, self.CHUNK_SIZE)
+        data = self._modified_chunk(3)
+        packed = similarity.diff_with_similar(
+            index, self.base_mem_data, DeltaItem.REF_BASE_MEM, data,
+            5*self.CHUNK_SIZE, self.CHUNK_SIZE)
+        self.assertTrue(len(packed) < self.CHUNK_SIZE/2)
+        (ref_source, ref_offset, patch) = \
+            similarity.unpack_similar_patch(packed)
+        self.assertEqual((ref_source, ref_offset),
+                         (DeltaItem.REF_BASE_MEM, 3*self.CHUNK_SIZE))
+
+        # patch is not used unless it is smaller than the other encoding
+        self.assertEqual(similarity.diff_with_similar(
+            index, self.base_mem_data, DeltaItem.REF_BASE_MEM, data,
+            5*self.CHUNK_SIZE, len(packed)), None)
+        self.assertEqual(similarity.diff_with_similar(
+            index, self.base_mem_data, DeltaItem.REF_BASE_MEM,
+            random_data(self.rand, self.CHUNK_SIZE), 5*self.CHUNK_SIZE,
+            self.CHUNK_SIZE), None)
+        self.assertEqual(similarity.diff_with_similar(
+            None, self.base_mem_data, DeltaItem.REF_BASE_MEM, data,
+            5*self.CHUNK_SIZE, self.CHUNK_SIZE), None)
+
+    def test_recover(self):
+        # chunks are recovered from the similar chunk of the other base file
+        mem_data = self._modified_chunk(3)
+        disk_data = self._modified_chunk(6)
+        mem_index = SimilarityIndex.build(self.base_mem, self.CHUNK_SIZE)
+        delta_list = list()
+        for (delta_type, offset, data) in [
+                (DeltaItem.DELTA_MEMORY, 5*self.CHUNK_SIZE, mem_data),
+                (DeltaItem.DELTA_DISK, 2*self.CHUNK_SIZE, disk_data)]:
+            packed = similarity.diff_with_similar(
+                mem_index, self.base_mem_data, DeltaItem.REF_BASE_MEM, data,
+                offset, self.CHUNK_SIZE)
+            delta_list.append(DeltaItem(
+                delta_type, offset, self.CHUNK_SIZE, None,
+                DeltaItem.REF_BASE_SIMILAR, len(packed), packed))
+        overlay_path = os.path.join(self.temp_dir, "overlay")
+        DeltaList.tofile(delta_list, overlay_path)
+
+        launch_mem = os.path.join(self.temp_dir, "launch-mem")
+        launch_disk = os.path.join(self.temp_dir, "launch-disk")
+        delta_proc = delta.Recovered_delta(
+            self.base_disk, self.base_mem, overlay_path, launch_mem,
+            len(self.base_mem_data), launch_disk, len(self.base_disk_data),
+            self.CHUNK_SIZE, out_pipename=os.path.join(self.temp_dir, "pipe"))
+        delta_proc.run()
+        recovered_mem = open(launch_mem, "rb").read()
+        recovered_disk = open(launch_disk, "rb").read()
+        self.assertEqual(recovered_mem[5*self.CHUNK_SIZE:6*self.CHUNK_SIZE],
+                         mem_data)
+        self.assertEqual(recovered_disk[2*self.CHUNK_SIZE:3*self.CHUNK_SIZE],
+                         disk_data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -50,3 +50,7 @@ class VMUtility(object):
                 base_dir = os.path.dirname(base_path)
                 shutil.rmtree(base_dir)
 
+
+def random_data(rand, size):
+    '''Returns size bytes of data from random.Random rand'''
+    return ''.join([chr(rand.randint(0, 255)) for i in xrange(size)])